@@ -1,6 +1,6 @@
 # distbuild/__init__.py -- library for Morph's distributed build plugin
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -37,6 +37,7 @@ from json_router import JsonRouter
 from helper_router import (HelperRouter, HelperRequest, HelperOutput, 
                            HelperResult)
 from initiator_connection import (InitiatorConnection, InitiatorDisconnect)
+from artifact_locations import ArtifactLocations
 from connection_machine import (ConnectionMachine, InitiatorConnectionMachine,
                                 Reconnect, StopConnecting)
 from worker_build_scheduler import (WorkerBuildQueuer, 
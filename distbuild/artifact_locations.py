@@ -0,0 +1,81 @@
+# distbuild/artifact_locations.py -- remember which workers hold artifacts
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+
+
+class ArtifactLocations(object):
+
+    '''Remember which workers hold the artifacts of which sources.
+
+    Workers serve their local artifact caches, so the artifacts of a
+    source can be fetched from a worker that built it, or fetched it to
+    build something else, rather than from the shared cache. For each
+    cache key, the URLs of the cache servers of the last ``max_holders``
+    workers to get its artifacts are kept, most recent first, as those
+    are the least likely to have removed them since. Only the
+    ``max_keys`` cache keys recorded last are kept, so that the
+    directory stays small however long the controller runs.
+
+    '''
+
+    def __init__(self, max_keys=10000, max_holders=3):
+        self.max_keys = max_keys
+        self.max_holders = max_holders
+        self._holders = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._holders)
+
+    def record(self, cache_keys, url):
+        '''Remember that a worker holds the artifacts of some sources.'''
+
+        for cache_key in cache_keys:
+            holders = self._holders.pop(cache_key, [])
+            if url in holders:
+                holders.remove(url)
+            holders.insert(0, url)
+            del holders[self.max_holders:]
+            self._holders[cache_key] = holders
+        while len(self._holders) > self.max_keys:
+            self._holders.popitem(last=False)
+
+    def forget(self, url):
+        '''Forget everything a worker holds, as when it goes away.'''
+
+        for cache_key, holders in self._holders.items():
+            if url in holders:
+                holders.remove(url)
+                if not holders:
+                    del self._holders[cache_key]
+
+    def holders(self, cache_keys, exclude=None):
+        '''Return a dict of the URLs of the holders of some cache keys.
+
+        Cache keys nobody is known to hold are left out, as is the URL
+        ``exclude``, for the worker that is to fetch the artifacts.
+
+        '''
+
+        result = {}
+        for cache_key in cache_keys:
+            urls = [url for url in self._holders.get(cache_key, ())
+                    if url != exclude]
+            if urls:
+                result[cache_key] = urls
+        return result
@@ -0,0 +1,71 @@
+# distbuild/artifact_locations_tests.py -- unit tests for artifact locations
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+
+import distbuild
+
+
+class ArtifactLocationsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.locations = distbuild.ArtifactLocations(max_keys=3,
+                                                     max_holders=2)
+
+    def test_knows_nothing_at_first(self):
+        self.assertEqual(len(self.locations), 0)
+        self.assertEqual(self.locations.holders(['foo']), {})
+
+    def test_lists_the_latest_holders_first(self):
+        self.locations.record(['foo', 'bar'], 'http://w1:8080/')
+        self.locations.record(['foo'], 'http://w2:8080/')
+        self.assertEqual(self.locations.holders(['foo', 'bar', 'baz']), {
+            'foo': ['http://w2:8080/', 'http://w1:8080/'],
+            'bar': ['http://w1:8080/'],
+        })
+
+    def test_keeps_only_a_few_holders_of_each_key(self):
+        for url in ('http://w1:8080/', 'http://w2:8080/', 'http://w3:8080/',
+                    'http://w2:8080/'):
+            self.locations.record(['foo'], url)
+        self.assertEqual(self.locations.holders(['foo']),
+                         {'foo': ['http://w2:8080/', 'http://w3:8080/']})
+
+    def test_keeps_only_the_keys_recorded_last(self):
+        self.locations.record(['a', 'b', 'c'], 'http://w1:8080/')
+        self.locations.record(['a'], 'http://w2:8080/')
+        self.locations.record(['d'], 'http://w1:8080/')
+        self.assertEqual(len(self.locations), 3)
+        self.assertEqual(sorted(self.locations.holders('abcd')),
+                         ['a', 'c', 'd'])
+
+    def test_leaves_out_the_excluded_holder(self):
+        self.locations.record(['foo', 'bar'], 'http://w1:8080/')
+        self.locations.record(['foo'], 'http://w2:8080/')
+        self.assertEqual(
+            self.locations.holders(['foo', 'bar'],
+                                   exclude='http://w1:8080/'),
+            {'foo': ['http://w2:8080/']})
+
+    def test_forgets_workers(self):
+        self.locations.record(['foo', 'bar'], 'http://w1:8080/')
+        self.locations.record(['foo'], 'http://w2:8080/')
+        self.locations.forget('http://w1:8080/')
+        self.assertEqual(self.locations.holders(['foo', 'bar']),
+                         {'foo': ['http://w2:8080/']})
+        self.assertEqual(len(self.locations), 1)
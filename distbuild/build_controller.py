@@ -1,6 +1,6 @@
 # distbuild/build_controller.py -- control the steps for one build
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -18,12 +18,14 @@
 
 import logging
 import httplib
+import time
 import traceback
 import urllib
 import urlparse
 import json
 
 import distbuild
+import morphlib
 
 
 # Artifact build states
@@ -162,13 +164,18 @@ class BuildController(distbuild.StateMachine):
     _idgen = distbuild.IdentifierGenerator('BuildController')
     
     def __init__(self, initiator_connection, build_request_message,
-                 artifact_cache_server, morph_instance):
+                 artifact_cache_server, morph_instance, build_history=None):
         distbuild.crash_point()
         distbuild.StateMachine.__init__(self, 'init')
         self._initiator_connection = initiator_connection
         self._request = build_request_message
         self._artifact_cache_server = artifact_cache_server
         self._morph_instance = morph_instance
+        self._build_history = build_history
+        self._priorities = None
+        self._step_start_times = {}
+        self._graph = None
+        self._by_cache_key = {}
         self._helper_id = None
         self.debug_transitions = False
         self.debug_graph_state = False
@@ -329,13 +336,15 @@ class BuildController(distbuild.StateMachine):
 
         self._artifact = event.artifact
         self._helper_id = self._idgen.next()
-        artifact_names = []
 
-        def set_state_and_append(artifact):
+        # The graph does not change during the build, so it is indexed
+        # once instead of being walked for every event.
+        self._graph = morphlib.artifactgraph.ArtifactGraph([self._artifact])
+        for artifact in self._graph.artifacts:
             artifact.state = UNKNOWN
-            artifact_names.append(artifact.basename())
-
-        map_build_graph(self._artifact, set_state_and_append)
+            self._by_cache_key.setdefault(artifact.source.cache_key,
+                                          artifact)
+        artifact_names = [a.basename() for a in self._graph.artifacts]
 
         url = urlparse.urljoin(self._artifact_cache_server, '/1.0/artifacts')
         msg = distbuild.message('http-request',
@@ -352,10 +361,6 @@ class BuildController(distbuild.StateMachine):
 
     def _maybe_handle_cache_response(self, event_source, event):
 
-        def set_status(artifact):
-            is_in_cache = cache_state[artifact.basename()]
-            artifact.state = BUILT if is_in_cache else UNBUILT
-
         if self._helper_id != event.msg['id']:
             return    # this event is not for us
 
@@ -372,11 +377,13 @@ class BuildController(distbuild.StateMachine):
             return
 
         cache_state = json.loads(event.msg['body'])
-        map_build_graph(self._artifact, set_status)
+        for artifact in self._graph.artifacts:
+            is_in_cache = cache_state[artifact.basename()]
+            artifact.state = BUILT if is_in_cache else UNBUILT
+        self._compute_priorities()
         self.mainloop.queue_event(self, _Annotated())
 
-        count = sum(map_build_graph(self._artifact,
-                    lambda a: 1 if a.state == UNBUILT else 0))
+        count = sum(1 for a in self._graph.artifacts if a.state == UNBUILT)
 
         progress = BuildProgress(
             self._request['id'],
@@ -387,15 +394,44 @@ class BuildController(distbuild.StateMachine):
             logging.info('There seems to be nothing to build')
             self.mainloop.queue_event(self, _Built())
 
+    def _compute_priorities(self):
+        '''Work out which artifacts to build first.
+
+        An artifact is more urgent the longer the chain of builds from it
+        to the end of the build is expected to take, going by how long
+        each source took to build before. Sources that are already built
+        take no time.
+
+        '''
+
+        artifacts = self._graph.artifacts
+        built = set(a.source for a in artifacts if a.state == BUILT)
+
+        dependents = dict((a.source, set()) for a in artifacts)
+        for source in dependents:
+            for dependency in source.dependencies:
+                if dependency.source in dependents:
+                    dependents[dependency.source].add(source)
+
+        def duration(source):
+            if source in built:
+                return None
+            return self._build_history.estimate(source)
+
+        paths = morphlib.buildplan.longest_paths(dependents, duration)
+        self._priorities = dict((source, seconds) for source, (seconds, path)
+                                in paths.iteritems())
+
+    def _priority(self, artifact):
+        return self._priorities.get(artifact.source, 0)
+
     def _find_artifacts_that_are_ready_to_build(self):
         def is_ready_to_build(artifact):
             return (artifact.state == UNBUILT and
                     all(a.state == BUILT
                         for a in artifact.source.dependencies))
 
-        return [a 
-                for a in map_build_graph(self._artifact, lambda a: a)
-                if is_ready_to_build(a)]
+        return [a for a in self._graph.artifacts if is_ready_to_build(a)]
 
     def _queue_worker_builds(self, event_source, event):
         distbuild.crash_point()
@@ -408,7 +444,7 @@ class BuildController(distbuild.StateMachine):
         logging.debug('Queuing more worker-builds to run')
         if self.debug_graph_state:
             logging.debug('Current state of build graph nodes:')
-            for a in map_build_graph(self._artifact, lambda a: a):
+            for a in self._graph.artifacts:
                 logging.debug('  %s state is %s' % (a.name, a.state))
                 if a.state != BUILT:
                     for dep in a.dependencies:
@@ -416,20 +452,26 @@ class BuildController(distbuild.StateMachine):
                             '    depends on %s which is %s' %
                                 (dep.name, dep.state))
 
-        while True:
-            ready = self._find_artifacts_that_are_ready_to_build()
-
-            if len(ready) == 0:
-                logging.debug('No new artifacts queued for building')
-                break
-
-            artifact = ready[0]
+        # Requesting builds only changes the state of ready artifacts,
+        # so the ready ones are found once and requested in turn. The
+        # artifact with the longest chain of builds still to do after it
+        # goes first; of equals, the first in the graph.
+        ready = self._find_artifacts_that_are_ready_to_build()
+        if not ready:
+            logging.debug('No new artifacts queued for building')
+        ready.sort(key=self._priority, reverse=True)
+        for artifact in ready:
+            if artifact.state != UNBUILT:
+                continue
 
             logging.debug(
-                'Requesting worker-build of %s (%s)' %
-                    (artifact.name, artifact.source.cache_key))
+                'Requesting worker-build of %s (%s), %.0fs from the end '
+                'of the build' %
+                    (artifact.name, artifact.source.cache_key,
+                     self._priority(artifact)))
             request = distbuild.WorkerBuildRequest(artifact,
-                                                   self._request['id'])
+                                                   self._request['id'],
+                                                   self._priority(artifact))
             self.mainloop.queue_event(distbuild.WorkerBuildQueuer, request)
 
             artifact.state = BUILDING
@@ -490,6 +532,7 @@ class BuildController(distbuild.StateMachine):
             return
 
         logging.debug('BC: got build step started: %s' % artifact.name)
+        self._step_start_times[event.artifact_cache_key] = time.time()
         started = BuildStepStarted(
             self._request['id'], build_step_name(artifact), event.worker_name)
         self.mainloop.queue_event(BuildController, started)
@@ -542,12 +585,7 @@ class BuildController(distbuild.StateMachine):
         self.mainloop.queue_event(BuildController, progress)
 
     def _find_artifact(self, cache_key):
-        artifacts = map_build_graph(self._artifact, lambda a: a)
-        wanted = [a for a in artifacts if a.source.cache_key == cache_key]
-        if wanted:
-            return wanted[0]
-        else:
-            return None
+        return self._by_cache_key.get(cache_key)
             
     def _maybe_check_result_and_queue_more_builds(self, event_source, event):
         distbuild.crash_point()
@@ -568,16 +606,20 @@ class BuildController(distbuild.StateMachine):
 
         artifact.state = BUILT
 
-        def set_state(a):
-            if a.source == artifact.source:
-                a.state = BUILT
+        start_time = self._step_start_times.pop(event.artifact_cache_key,
+                                                None)
+        if start_time is not None:
+            self._build_history.record(artifact.source,
+                                       time.time() - start_time)
 
         if artifact.source.morphology['kind'] == 'chunk':
             # Building a single chunk artifact
             # yields all chunk artifacts for the given source
             # so we set the state of this source's artifacts
             # to BUILT
-            map_build_graph(self._artifact, set_state)
+            for a in artifact.source.artifacts.itervalues():
+                if a in self._graph:
+                    a.state = BUILT
 
         self._queue_worker_builds(None, event)
 
@@ -609,6 +651,8 @@ class BuildController(distbuild.StateMachine):
         logging.info(
             'Build step failed for %s: %s', artifact.name, repr(event.msg))
 
+        self._build_history.save()
+
         step_failed = BuildStepFailed(
             self._request['id'], build_step_name(artifact))
         self.mainloop.queue_event(BuildController, step_failed)
@@ -636,6 +680,8 @@ class BuildController(distbuild.StateMachine):
     def _notify_build_done(self, event_source, event):
         distbuild.crash_point()
 
+        self._build_history.save()
+
         logging.debug('Notifying initiator of successful build')
         baseurl = urlparse.urljoin(
             self._artifact_cache_server, '/1.0/artifacts')
@@ -1,6 +1,6 @@
-# mainloop/mainloop.py -- select-based main loop
+# mainloop/mainloop.py -- poll-based main loop
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -16,15 +16,19 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
 
 
+import bisect
+import collections
 import fcntl
+import itertools
 import logging
 import os
-import select
+
+from poller import new_poller
 
 
 class MainLoop(object):
 
-    '''A select-based main loop.
+    '''A poll-based main loop.
     
     The main loop watches a set of file descriptors wrapped in 
     EventSource objects, and when something happens with them,
@@ -32,22 +36,41 @@ class MainLoop(object):
     feeds into user-supplied state machines. The state machines
     can create further events, which are processed further.
     
-    When nothing is happening, the main loop sleeps in the
-    select.select call.
+    An event is only given to the state machines that have a transition
+    for its event source and class, which are found from an index built
+    as transitions are added, rather than by offering it to every one.
+
+    The file descriptors each event source wants watched are kept
+    between iterations, rather than asked for every time. A source's
+    are forgotten when it is added, removed or asked for events, and
+    all are forgotten once a state machine has handled an event, as
+    that may start or stop any source reading or writing. Sources
+    with a timeout are asked every time, as it depends on the time.
+
+    When nothing is happening, the main loop sleeps in the poller,
+    which is poll, or select if poll is not available.
     
     '''
 
-    def __init__(self):
-        self._machines = []
+    def __init__(self, poller=None):
+        self._machines = collections.OrderedDict()
         self._sources = []
-        self._events = []
+        self._select_params = {}
+        self._events = collections.deque()
+        self._interested = {}
+        self._counter = itertools.count()
+        self._poller = new_poller(poller)
         self.dump_filename = None
         
     def add_state_machine(self, machine):
         logging.debug('MainLoop.add_state_machine: %s' % machine)
         machine.mainloop = self
+        # Machines get events in the order they were added, as they did
+        # when every event was offered to every machine.
+        self._machines[machine] = next(self._counter)
         machine.setup()
-        self._machines.append(machine)
+        for source, event_class in machine.interests():
+            self.add_interest(machine, source, event_class)
         if self.dump_filename:
             filename = '%s%s.dot' % (self.dump_filename, 
                                      machine.__class__.__name__)
@@ -55,26 +78,64 @@ class MainLoop(object):
         
     def remove_state_machine(self, machine):
         logging.debug('MainLoop.remove_state_machine: %s' % machine)
-        self._machines.remove(machine)
-    
+        order = self._machines.pop(machine)
+        for key in machine.interests():
+            machines = self._interested.get(key)
+            if machines is not None and (order, machine) in machines:
+                machines.remove((order, machine))
+                if not machines:
+                    del self._interested[key]
+
+    def add_interest(self, machine, source, event_class):
+        '''Give events of a class from a source to a state machine.
+
+        State machines call this when a transition is added.
+
+        '''
+
+        order = self._machines.get(machine)
+        if order is None:
+            # Not added yet; add_state_machine will ask for its interests.
+            return
+        machines = self._interested.setdefault((source, event_class), [])
+        if (order, machine) not in machines:
+            bisect.insort(machines, (order, machine))
+
+    def _interested_machines(self, event_source, event):
+        machines = self._interested.get((event_source, event.__class__))
+        if not machines:
+            return []
+        return [machine for order, machine in machines]
+
     def add_event_source(self, event_source):
         logging.debug('MainLoop.add_event_source: %s' % event_source)
         self._sources.append(event_source)
+        self._select_params.pop(event_source, None)
     
     def remove_event_source(self, event_source):
         logging.debug('MainLoop.remove_event_source: %s' % event_source)
         self._sources.remove(event_source)
+        self._select_params.pop(event_source, None)
     
     def _setup_select(self):
         r = []
         w = []
         x = []
         timeout = None
+        active = []
+
+        for event_source in [s for s in self._sources if s.is_finished()]:
+            self.remove_event_source(event_source)
 
-        self._sources = [s for s in self._sources if not s.is_finished()]
-        
         for event_source in self._sources:
-            sr, sw, sx, st = event_source.get_select_params()
+            params = self._select_params.get(event_source)
+            if params is None:
+                params = event_source.get_select_params()
+                if params[3] is None:
+                    self._select_params[event_source] = params
+            sr, sw, sx, st = params
+            if sr or sw or sx or st is not None:
+                active.append((event_source, sr, sw, sx, st))
             r.extend(sr)
             w.extend(sw)
             x.extend(sx)
@@ -83,25 +144,37 @@ class MainLoop(object):
             elif st is not None:
                 timeout = min(timeout, st)
 
-        return r, w, x, timeout
+        return r, w, x, timeout, active
+
+    @staticmethod
+    def _any_in(fds, ready):
+        for fd in fds:
+            if fd in ready:
+                return True
+        return False
 
     def _run_once(self):
-        r, w, x, timeout = self._setup_select()
+        r, w, x, timeout, active = self._setup_select()
         assert r or w or x or timeout is not None
-        r, w, x = select.select(r, w, x, timeout)
+        r, w, x = self._poller.poll(r, w, x, timeout)
 
-        for event_source in self._sources:
+        # Only sources with a timeout or a ready file descriptor can have
+        # anything to say.
+        for event_source, sr, sw, sx, st in active:
             if event_source.is_finished():
                 self.remove_event_source(event_source)
-            else:
+            elif (st is not None or self._any_in(sr, r) or
+                  self._any_in(sw, w) or self._any_in(sx, x)):
+                self._select_params.pop(event_source, None)
                 for event in event_source.get_events(r, w, x):
                     self.queue_event(event_source, event)
 
         for event_source, event in self._dequeue_events():
-            for machine in self._machines[:]:
+            for machine in self._interested_machines(event_source, event):
+                self._select_params.clear()
                 for new_event in machine.handle_event(event_source, event):
                     self.queue_event(event_source, new_event)
-                if machine.state is None:
+                if machine.state is None and machine in self._machines:
                     self.remove_state_machine(machine)
 
     def run(self):
@@ -115,6 +188,7 @@ class MainLoop(object):
         logging.debug('MainLoop starts')
         while self._machines:
             self._run_once()
+        self._poller.close()
         logging.debug('MainLoop ends')
 
     def queue_event(self, event_source, event):
@@ -124,6 +198,6 @@ class MainLoop(object):
 
     def _dequeue_events(self):
         while self._events:
-            event_source, event = self._events.pop(0)
+            event_source, event = self._events.popleft()
 
             yield event_source, event
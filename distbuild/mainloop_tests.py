@@ -0,0 +1,241 @@
+# distbuild/mainloop_tests.py -- unit tests for the main loop
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import distbuild
+
+
+class Ping(object):
+
+    pass
+
+
+class Pong(object):
+
+    pass
+
+
+class PipeEventSource(distbuild.EventSource):
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        self.finished = False
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+    def get_select_params(self):
+        return [self.read_fd], [], [], None
+
+    def get_events(self, r, w, x):
+        if self.read_fd in r:
+            os.read(self.read_fd, 1)
+            return [Ping()]
+        return []
+
+    def is_finished(self):
+        return self.finished
+
+
+class TimeoutEventSource(distbuild.EventSource):
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.calls = 0
+
+    def get_select_params(self):
+        return [], [], [], self.timeout
+
+    def get_events(self, r, w, x):
+        self.calls += 1
+        return []
+
+
+class CountingEventSource(distbuild.EventSource):
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.asked = 0
+
+    def get_select_params(self):
+        self.asked += 1
+        return [], [], [], self.timeout
+
+
+class Recorder(distbuild.StateMachine):
+
+    def __init__(self, name, source, log, stop=False):
+        distbuild.StateMachine.__init__(self, 'waiting')
+        self.name = name
+        self.source = source
+        self.log = log
+        self.stop = stop
+
+    def setup(self):
+        new_state = None if self.stop else 'waiting'
+        self.add_transition('waiting', self.source, Ping, new_state,
+                            self.record)
+
+    def record(self, event_source, event):
+        self.log.append(self.name)
+
+
+class MainLoopTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = distbuild.MainLoop()
+        self.source = PipeEventSource()
+        self.loop.add_event_source(self.source)
+        self.log = []
+
+    def tearDown(self):
+        self.source.close()
+
+    def test_gives_events_only_to_interested_machines(self):
+        other = PipeEventSource()
+        self.addCleanup(other.close)
+        first = Recorder('first', self.source, self.log)
+        second = Recorder('second', other, self.log)
+        third = Recorder('third', self.source, self.log)
+        third.record = lambda *args: self.log.append('third') or [Pong()]
+        self.loop.add_event_source(other)
+        for machine in (first, second, third):
+            self.loop.add_state_machine(machine)
+        calls = []
+        second.handle_event = lambda *args: calls.append(args) or []
+        self.loop.queue_event(self.source, Pong())
+        os.write(self.source.write_fd, 'x')
+        self.loop._run_once()
+        self.assertEqual(self.log, ['first', 'third'])
+        self.assertEqual(calls, [])
+
+    def test_indexes_transitions_added_after_setup(self):
+        machine = Recorder('machine', self.source, self.log)
+        self.loop.add_state_machine(machine)
+        machine.add_transition('waiting', self.source, Pong, 'waiting',
+                               machine.record)
+        machine.add_transition('other', self.source, Pong, 'waiting', None)
+        self.assertEqual(self.loop._interested_machines(self.source, Pong()),
+                         [machine])
+
+    def test_keeps_order_machines_were_added_in(self):
+        first = Recorder('first', None, self.log)
+        second = Recorder('second', self.source, self.log)
+        self.loop.add_state_machine(first)
+        self.loop.add_state_machine(second)
+        first.add_transition('waiting', self.source, Ping, 'waiting',
+                             first.record)
+        self.assertEqual(self.loop._interested_machines(self.source, Ping()),
+                         [first, second])
+
+    def test_runs_until_machines_finish(self):
+        machine = Recorder('once', self.source, self.log, stop=True)
+        self.loop.add_state_machine(machine)
+        timeout = TimeoutEventSource(0)
+        self.loop.add_event_source(timeout)
+        os.write(self.source.write_fd, 'x')
+        self.loop.run()
+        self.assertEqual(self.log, ['once'])
+        self.assertEqual(self.loop._interested_machines(self.source, Ping()),
+                         [])
+        self.assertTrue(timeout.calls > 0)
+        machine.add_transition('waiting', self.source, Pong, 'waiting', None)
+        self.assertEqual(self.loop._interested_machines(self.source, Pong()),
+                         [])
+
+    def test_does_not_ask_idle_sources_for_events(self):
+        self.loop.add_state_machine(
+            Recorder('once', self.source, self.log, stop=True))
+        idle = TimeoutEventSource(None)
+        self.loop.add_event_source(idle)
+        self.loop.add_event_source(TimeoutEventSource(20))
+        self.loop.add_event_source(TimeoutEventSource(10))
+        os.write(self.source.write_fd, 'x')
+        self.loop.run()
+        self.assertEqual(idle.calls, 0)
+
+    def test_removes_finished_event_sources(self):
+        finished = PipeEventSource()
+        self.addCleanup(finished.close)
+        self.loop.add_event_source(finished)
+        os.write(finished.write_fd, 'x')
+        # Finishes while the main loop is waiting.
+        finished.is_finished = iter([False, True]).next
+        self.loop._run_once()
+        self.assertFalse(finished in self.loop._sources)
+
+    def test_forgets_sources_that_finished_between_iterations(self):
+        finished = CountingEventSource(0)
+        self.loop.add_event_source(finished)
+        finished.is_finished = lambda: True
+        self.loop.add_event_source(TimeoutEventSource(0))
+        self.loop._run_once()
+        self.assertFalse(finished in self.loop._sources)
+        self.assertEqual(finished.asked, 0)
+
+    def test_removes_machine_removed_during_dispatch_once(self):
+        machine = Recorder('machine', self.source, self.log, stop=True)
+        machine.record = lambda *args: self.loop.remove_state_machine(machine)
+        self.loop.add_state_machine(machine)
+        os.write(self.source.write_fd, 'x')
+        self.loop.run()
+        self.assertEqual(self.loop._machines, {})
+
+    def test_writes_dot_files_when_asked(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.loop.dump_filename = os.path.join(tempdir, 'dump-')
+        self.loop.add_state_machine(Recorder('m', self.source, self.log))
+        self.assertTrue(
+            os.path.exists(os.path.join(tempdir, 'dump-Recorder.dot')))
+
+    def test_keeps_select_params_while_nothing_happens(self):
+        counting = CountingEventSource()
+        timed = CountingEventSource(0)
+        self.loop.add_event_source(counting)
+        self.loop.add_event_source(timed)
+        self.loop._run_once()
+        self.loop._run_once()
+        self.assertEqual(counting.asked, 1)
+        self.assertEqual(timed.asked, 2)
+
+    def test_asks_again_for_select_params_after_events(self):
+        counting = CountingEventSource()
+        self.loop.add_event_source(counting)
+        self.loop.add_state_machine(Recorder('m', self.source, self.log))
+        os.write(self.source.write_fd, 'x')
+        self.loop._run_once()
+        self.loop.add_event_source(TimeoutEventSource(0))
+        self.loop._run_once()
+        self.assertEqual(self.log, ['m'])
+        self.assertEqual(counting.asked, 2)
+
+    def test_asks_again_for_select_params_of_readded_sources(self):
+        counting = CountingEventSource(None)
+        self.loop.add_event_source(counting)
+        self.loop.add_event_source(TimeoutEventSource(0))
+        self.loop._run_once()
+        self.loop.remove_event_source(counting)
+        self.loop.add_event_source(counting)
+        self.loop._run_once()
+        self.assertEqual(counting.asked, 2)
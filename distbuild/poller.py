@@ -0,0 +1,140 @@
+# distbuild/poller.py -- wait for file descriptors to become ready
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import errno
+import select
+
+
+class SelectPoller(object):
+
+    '''Wait for file descriptors with select.select.
+
+    All the pollers have the same interface: ``poll`` takes the lists
+    of file descriptors that event sources want to read, write, and
+    watch for exceptional conditions, and a timeout in seconds, and
+    returns three sets of the ones that are ready.
+
+    '''
+
+    name = 'select'
+
+    def poll(self, r, w, x, timeout):
+        try:
+            r, w, x = select.select(r, w, x, timeout)
+        except select.error, e: # pragma: no cover
+            if e.args[0] == errno.EINTR:
+                return set(), set(), set()
+            raise
+        return set(r), set(w), set(x)
+
+    def close(self):
+        pass
+
+
+class PollPoller(object):
+
+    '''Wait for file descriptors with select.poll.
+
+    Unlike select, poll has no limit on the value of a file descriptor.
+    Every call is given all the descriptors that are wanted, as with
+    select, but the poll object remembers the ones it watches, so only
+    the ones added, removed or wanted for other events since the last
+    call are registered, unregistered or modified.
+
+    An epoll set is deliberately not used: event sources do not say
+    when they close a descriptor, and the kernel drops closed ones from
+    an epoll set, so a new socket that reuses the number of a closed one
+    would look unchanged here and never be watched. A poll object
+    watches descriptors by number, whatever they refer to.
+
+    '''
+
+    name = 'poll'
+
+    def __init__(self):
+        self.READ = select.POLLIN
+        self.WRITE = select.POLLOUT
+        self.EXCEPT = select.POLLPRI
+        self.ERROR = select.POLLERR | select.POLLHUP | select.POLLNVAL
+        self._poller = select.poll()
+        self._masks = {}
+
+    def _update(self, wanted):
+        for fd in self._masks.keys():
+            if fd not in wanted:
+                del self._masks[fd]
+                self._poller.unregister(fd)
+        for fd, mask in wanted.iteritems():
+            old = self._masks.get(fd)
+            if old is None:
+                self._poller.register(fd, mask)
+            elif old != mask:
+                self._poller.modify(fd, mask)
+            self._masks[fd] = mask
+
+    def poll(self, r, w, x, timeout):
+        wanted = {}
+        for fds, flag in ((r, self.READ), (w, self.WRITE), (x, self.EXCEPT)):
+            for fd in fds:
+                wanted[fd] = wanted.get(fd, 0) | flag
+        self._update(wanted)
+
+        if timeout is not None:
+            # poll takes milliseconds, rounded up so that we do not wake
+            # up just before a timer is due and spin.
+            timeout = int(timeout * 1000 + 0.999)
+        try:
+            ready = self._poller.poll(timeout)
+        except select.error, e: # pragma: no cover
+            if e.args[0] == errno.EINTR:
+                return set(), set(), set()
+            raise
+
+        rs = set()
+        ws = set()
+        xs = set()
+        for fd, events in ready:
+            mask = wanted.get(fd, 0)
+            # Like select, report errors and hangups as readiness, so that
+            # the event source finds out about them when it reads or writes.
+            if events & self.ERROR:
+                events |= self.READ | self.WRITE
+            if events & mask & self.READ:
+                rs.add(fd)
+            if events & mask & self.WRITE:
+                ws.add(fd)
+            if events & mask & self.EXCEPT:
+                xs.add(fd)
+        return rs, ws, xs
+
+    def close(self):
+        pass
+
+
+pollers = [PollPoller, SelectPoller]
+
+
+def new_poller(name=None):
+    '''Return a poller, by name or the best one this system supports.'''
+
+    for poller in pollers:
+        if name is not None and poller.name != name:
+            continue
+        if poller.name == 'select' or hasattr(select, poller.name):
+            return poller()
+    raise ValueError('Unknown or unsupported poller %s' % name)
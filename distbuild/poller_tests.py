@@ -0,0 +1,104 @@
+# distbuild/poller_tests.py -- unit tests for pollers
+#
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA..
+
+
+import os
+import socket
+import unittest
+
+import poller
+
+
+class PollerTests(object):
+
+    def setUp(self):
+        self.poller = self.new_poller()
+        self.read_fd, self.write_fd = os.pipe()
+
+    def tearDown(self):
+        self.poller.close()
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+    def test_times_out_when_nothing_is_ready(self):
+        self.assertEqual(self.poller.poll([self.read_fd], [], [], 0),
+                         (set(), set(), set()))
+
+    def test_reports_writeable_descriptor(self):
+        self.assertEqual(
+            self.poller.poll([self.read_fd], [self.write_fd], [], None),
+            (set(), set([self.write_fd]), set()))
+
+    def test_reports_readable_descriptor(self):
+        os.write(self.write_fd, 'x')
+        self.assertEqual(
+            self.poller.poll([self.read_fd], [], [], 0.5),
+            (set([self.read_fd]), set(), set()))
+
+    def test_follows_changes_between_calls(self):
+        os.write(self.write_fd, 'x')
+        fds = [self.read_fd, self.write_fd]
+        self.assertEqual(self.poller.poll(fds, fds, [], 0),
+                         (set([self.read_fd]), set([self.write_fd]), set()))
+        self.assertEqual(self.poller.poll([self.read_fd], [], [], 0),
+                         (set([self.read_fd]), set(), set()))
+        self.assertEqual(self.poller.poll([], [self.write_fd], [], 0),
+                         (set(), set([self.write_fd]), set()))
+        self.assertEqual(self.poller.poll([], [], [], 0),
+                         (set(), set(), set()))
+
+    def test_reports_hangup_as_readable(self):
+        os.close(self.write_fd)
+        self.write_fd = os.open(os.devnull, os.O_WRONLY)
+        self.assertEqual(self.poller.poll([self.read_fd], [], [], 0),
+                         (set([self.read_fd]), set(), set()))
+
+    def test_reports_urgent_data_as_exceptional(self):
+        listener = socket.socket()
+        self.addCleanup(listener.close)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        sender = socket.create_connection(listener.getsockname())
+        self.addCleanup(sender.close)
+        receiver, addr = listener.accept()
+        self.addCleanup(receiver.close)
+        sender.send('x', socket.MSG_OOB)
+        fd = receiver.fileno()
+        self.assertEqual(self.poller.poll([], [], [fd], 1),
+                         (set(), set(), set([fd])))
+
+
+class SelectPollerTests(PollerTests, unittest.TestCase):
+
+    new_poller = poller.SelectPoller
+
+
+class PollPollerTests(PollerTests, unittest.TestCase):
+
+    new_poller = poller.PollPoller
+
+
+class NewPollerTests(unittest.TestCase):
+
+    def test_prefers_poll(self):
+        self.assertEqual(poller.new_poller().name, 'poll')
+
+    def test_returns_poller_by_name(self):
+        self.assertEqual(poller.new_poller('select').name, 'select')
+
+    def test_raises_error_for_unknown_poller(self):
+        self.assertRaises(ValueError, poller.new_poller, 'kqueue')
@@ -1,6 +1,6 @@
 # mainloop/sm.py -- state machine abstraction
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -77,6 +77,21 @@ class StateMachine(object):
             'Transition %s already registered' % str(key)
         self._transitions[key] = (new_state, callback)
 
+        mainloop = getattr(self, 'mainloop', None)
+        if mainloop is not None:
+            mainloop.add_interest(self, source, event_class)
+
+    def interests(self):
+        '''Return the (event source, event class) pairs we handle.
+
+        The main loop only gives a machine the events that match one of
+        these, whatever state it is in.
+
+        '''
+
+        return set((source, event_class)
+                   for state, source, event_class in self._transitions)
+
     def add_transitions(self, specification):
         '''Add many transitions.
         
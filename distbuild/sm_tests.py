@@ -1,6 +1,6 @@
 # distbuild/sm_tests.py -- unit tests for state machine abstraction
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -96,3 +96,24 @@ class StateMachineTests(unittest.TestCase):
         self.assertEqual(self.event_sources, [self.event_source])
         self.assertEqual(self.events, [self.event])
 
+    def test_lists_interests(self):
+        spec = [
+            ('init', self.event_source, DummyEvent, 'next', None),
+            ('next', self.event_source, DummyEvent, 'init', None),
+            ('next', DummyEventSource, str, 'init', None),
+        ]
+        self.sm.add_transitions(spec)
+        self.assertEqual(self.sm.interests(),
+                         set([(self.event_source, DummyEvent),
+                              (DummyEventSource, str)]))
+
+    def test_tells_main_loop_about_new_transitions(self):
+        interests = []
+        class DummyMainLoop(object):
+            def add_interest(self, *args):
+                interests.append(args)
+        self.sm.mainloop = DummyMainLoop()
+        self.sm.add_transition(
+            'init', self.event_source, DummyEvent, 'init', None)
+        self.assertEqual(interests,
+                         [(self.sm, self.event_source, DummyEvent)])
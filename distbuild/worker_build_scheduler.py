@@ -1,6 +1,6 @@
 # distbuild/worker_build_scheduler.py -- schedule worker-builds on workers
 #
-# Copyright (C) 2012, 2014  Codethink Limited
+# Copyright (C) 2012, 2014, 2026  Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -18,6 +18,7 @@
 
 import collections
 import httplib
+import json
 import logging
 import socket
 import urllib
@@ -28,9 +29,10 @@ import distbuild
 
 class WorkerBuildRequest(object):
 
-    def __init__(self, artifact, initiator_id):
+    def __init__(self, artifact, initiator_id, priority=0):
         self.artifact = artifact
         self.initiator_id = initiator_id
+        self.priority = priority
 
 class WorkerCancelPending(object):
     
@@ -95,10 +97,11 @@ class _HaveAJob(object):
 
 class Job(object):
 
-    def __init__(self, job_id, artifact, initiator_id):
+    def __init__(self, job_id, artifact, initiator_id, priority=0):
         self.id = job_id
         self.artifact = artifact
         self.initiators = [initiator_id]
+        self.priority = priority
         self.who = None  # we don't know who's going to do this yet
         self.running = False
         self.failed = False
@@ -114,8 +117,8 @@ class Jobs(object):
         return (self._jobs[artifact_basename]
             if artifact_basename in self._jobs else None)
 
-    def create(self, artifact, initiator_id):
-        job = Job(self._idgen.next(), artifact, initiator_id)
+    def create(self, artifact, initiator_id, priority=0):
+        job = Job(self._idgen.next(), artifact, initiator_id, priority)
         self._jobs[job.artifact.basename()] = job
         return job
 
@@ -137,11 +140,11 @@ class Jobs(object):
         return artifact_basename in self._jobs
 
     def get_next_job(self):
-        # for now just return the first thing we find that's not being built
+        # Return the job with the highest priority that is not being built
         waiting = [job for (_, job) in
             self._jobs.iteritems() if job.who == None]
 
-        return waiting.pop() if len(waiting) > 0 else None
+        return max(waiting, key=lambda job: job.priority) if waiting else None
 
     def __repr__(self):
         return str([job.artifact.basename()
@@ -257,6 +260,7 @@ class WorkerBuildQueuer(distbuild.StateMachine):
         if self._jobs.exists(event.artifact.basename()):
             job = self._jobs.get(event.artifact.basename())
             job.initiators.append(event.initiator_id)
+            job.priority = max(job.priority, event.priority)
 
             if job.running:
                 logging.debug('Worker build step already started: %s' %
@@ -273,7 +277,8 @@ class WorkerBuildQueuer(distbuild.StateMachine):
             self.mainloop.queue_event(WorkerConnection, progress)
         else:
             logging.debug('WBQ: Creating job for: %s' % event.artifact.name)
-            job = self._jobs.create(event.artifact, event.initiator_id)
+            job = self._jobs.create(event.artifact, event.initiator_id,
+                                    event.priority)
 
             if self._available_workers:
                 self._give_job(job)
@@ -365,13 +370,15 @@ class WorkerConnection(distbuild.StateMachine):
     _initiator_request_map = collections.defaultdict(set)
 
     def __init__(self, cm, conn, writeable_cache_server, 
-                 worker_cache_server_port, morph_instance):
+                 worker_cache_server_port, morph_instance,
+                 artifact_locations=None):
         distbuild.StateMachine.__init__(self, 'idle')
         self._cm = cm
         self._conn = conn
         self._writeable_cache_server = writeable_cache_server
         self._worker_cache_server_port = worker_cache_server_port
         self._morph_instance = morph_instance
+        self._artifact_locations = artifact_locations
         self._helper_id = None
         self._job = None
         self._exec_response_msg = None
@@ -380,6 +387,8 @@ class WorkerConnection(distbuild.StateMachine):
         addr, port = self._conn.getpeername()
         name = socket.getfqdn(addr)
         self._worker_name = '%s:%s' % (name, port)
+        self._cache_server_url = 'http://%s:%d/' % (
+            addr, self._worker_cache_server_port)
 
     def name(self):
         return self._worker_name
@@ -387,6 +396,19 @@ class WorkerConnection(distbuild.StateMachine):
     def job(self):
         return self._job
 
+    def _held_cache_keys(self):
+        '''Return the cache keys of the sources the worker has built.
+
+        This is the source of the job, and the sources of everything it
+        depends on, which the worker fetched to build it. Systems are
+        left out, as workers remove them before each build.
+
+        '''
+
+        return set(artifact.source.cache_key
+                   for artifact in self._job.artifact.walk()
+                   if artifact.source.morphology['kind'] != 'system')
+
     def setup(self):
         distbuild.crash_point()
 
@@ -453,6 +475,8 @@ class WorkerConnection(distbuild.StateMachine):
         distbuild.crash_point()
 
         logging.debug('WC: Triggering reconnect')
+        if self._artifact_locations is not None:
+            self._artifact_locations.forget(self._cache_server_url)
         self.mainloop.queue_event(self._cm, distbuild.Reconnect())
 
     def _start_build(self, event_source, event):
@@ -471,10 +495,18 @@ class WorkerConnection(distbuild.StateMachine):
             '--build-log-on-stdout',
             self._job.artifact.name,
         ]
+        # The artifact is the first line of the input. It is followed by
+        # the workers known to hold the artifacts it depends on, which
+        # the worker fetches from them rather than the shared cache.
+        stdin_contents = distbuild.serialise_artifact(self._job.artifact)
+        if self._artifact_locations is not None:
+            holders = self._artifact_locations.holders(
+                self._held_cache_keys(), exclude=self._cache_server_url)
+            stdin_contents += '\n' + json.dumps(holders)
         msg = distbuild.message('exec-request',
             id=self._job.id,
             argv=argv,
-            stdin_contents=distbuild.serialise_artifact(self._job.artifact),
+            stdin_contents=stdin_contents,
         )
         self._jm.send(msg)
 
@@ -590,6 +622,10 @@ class WorkerConnection(distbuild.StateMachine):
             if event.msg['status'] == httplib.OK:
                 logging.debug('Shared artifact cache population done')
 
+                if self._artifact_locations is not None:
+                    self._artifact_locations.record(
+                        self._held_cache_keys(), self._cache_server_url)
+
                 new_event = WorkerBuildFinished(
                     self._exec_response_msg,
                     self._job.artifact.source.cache_key)
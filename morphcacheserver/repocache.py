@@ -1,4 +1,4 @@
-# Copyright (C) 2013,2014 Codethink Limited
+# Copyright (C) 2013,2014,2026 Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -18,8 +18,11 @@ import cliapp
 import os
 import re
 import string
+import threading
 import urlparse
 
+import morphlib
+
 
 class RepositoryNotFoundError(cliapp.AppException):
 
@@ -51,6 +54,8 @@ class RepoCache(object):
         self.repo_cache_dir = repo_cache_dir
         self.bundle_cache_dir = bundle_cache_dir
         self.direct_mode = direct_mode
+        self._readers = {}
+        self._readers_lock = threading.Lock()
 
     def resolve_ref(self, repo_url, ref):
         quoted_url = self._quote_url(repo_url)
@@ -73,10 +78,11 @@ class RepoCache(object):
             raise
 
     def _tree_from_commit(self, repo_dir, commitsha):
-        commit_info = self.app.runcmd(['git', 'log', '-1',
-                                       '--format=format:%T', commitsha],
-                                      cwd=repo_dir)
-        return commit_info.strip()
+        info = self._reader(repo_dir).info('%s^{tree}' % commitsha)
+        if info is None:
+            raise cliapp.AppException('Commit %s not found in %s' %
+                                      (commitsha, repo_dir))
+        return info[0]
 
     def cat_file(self, repo_url, ref, filename):
         quoted_url = self._quote_url(repo_url)
@@ -141,14 +147,33 @@ class RepoCache(object):
             transl = lambda x: x if x in valid_chars else '_'
             return ''.join([transl(x) for x in url])
 
+    def _reader(self, repo_dir):
+        '''Return the object reader for a repository.
+
+        The readers are kept for as long as the server runs, so that
+        requests do not each need to start git.
+
+        '''
+
+        with self._readers_lock:
+            if repo_dir not in self._readers:
+                self._readers[repo_dir] = \
+                    morphlib.gitbatch.ObjectReader(repo_dir)
+            return self._readers[repo_dir]
+
     def _rev_parse(self, repo_dir, ref):
-        return self.app.runcmd(['git', 'rev-parse', '--verify', ref],
-                               cwd=repo_dir)[0:40]
+        info = self._reader(repo_dir).info(ref)
+        if info is None:
+            raise cliapp.AppException('Ref %s not found in %s' %
+                                      (ref, repo_dir))
+        return info[0]
 
     def _cat_file(self, repo_dir, sha1, filename):
-        return self.app.runcmd(
-                ['git', 'cat-file', 'blob', '%s:%s' % (sha1, filename)],
-                cwd=repo_dir)
+        result = self._reader(repo_dir).read('%s:%s' % (sha1, filename))
+        if result is None or result[1] != 'blob':
+            raise cliapp.AppException('File %s not found in %s of %s' %
+                                      (filename, sha1, repo_dir))
+        return result[2]
 
     def _ls_tree(self, repo_dir, sha1, path):
         return self.app.runcmd(['git', 'ls-tree', sha1, path], cwd=repo_dir)
@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2015  Codethink Limited
+# Copyright (C) 2011-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -48,6 +48,7 @@ class Error(cliapp.AppException):
 
 import artifact
 import artifactcachereference
+import artifactgraph
 import artifactresolver
 import artifactsplitrule
 import branchmanager
@@ -55,19 +56,28 @@ import bins
 import buildbranch
 import buildcommand
 import buildenvironment
+import buildplan
 import buildsystem
 import builder
 import cachedrepo
 import cachekeycomputer
+import cachekeystore
+import chunkstore
+import contentstore
 import extensions
 import extractedtarball
 import fsutils
 import git
+import gitbatch
 import gitdir
 import gitindex
+import jsonstore
+# localartifactcache subclasses savefile.SaveFile, so it must come first.
+import savefile
 import localartifactcache
 import localrepocache
 import mountableimage
+import morphologycache
 import morphologyfactory
 import morphologyfinder
 import morphology
@@ -76,14 +86,17 @@ import morphset
 import remoteartifactcache
 import remoterepocache
 import repoaliasresolver
-import savefile
 import source
 import sourcepool
 import sourceresolver
 import stagingarea
+import stagingpool
 import stopwatch
 import sysbranchdir
+import systemassembly
 import systemmetadatadir
+import tieredartifactcache
+import tracing
 import util
 import workspace
 
@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2015  Codethink Limited
+# Copyright (C) 2011-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -19,6 +19,7 @@ import logging
 import os
 import pipes
 import sys
+import threading
 import time
 import urlparse
 import extensions
@@ -53,6 +54,11 @@ defaults = {
 
 class Morph(cliapp.Application):
 
+    # Status output may come from several build threads at once, each of
+    # which has its own status prefix.
+    _thread_state = threading.local()
+    _status_lock = threading.Lock()
+
     def add_settings(self):
         self.settings.boolean(['verbose', 'v'],
                               'show what is happening in much detail')
@@ -114,6 +120,12 @@ class Morph(cliapp.Application):
             metavar='URL',
             default=None,
             group=group_advanced)
+        self.settings.integer(['artifact-fetch-connections'],
+                              'download up to N artifacts at once from the '
+                              'artifact cache server (default: %default)',
+                              metavar='N',
+                              default=4,
+                              group=group_advanced)
         self.settings.string(['tarball-server'],
                              'base URL to download tarballs. '
                              'If not provided, defaults to '
@@ -130,6 +142,14 @@ class Morph(cliapp.Application):
                               metavar='N',
                               default=defaults['max-jobs'],
                               group=group_build)
+        self.settings.integer(['max-concurrent-builds'],
+                              'build at most N sources at the same time '
+                              'when their dependencies allow it; the '
+                              'max-jobs budget is shared between them '
+                              '(default: %default)',
+                              metavar='N',
+                              default=1,
+                              group=group_build)
         self.settings.boolean(['no-ccache'], 'do not use ccache',
                               group=group_build)
         self.settings.boolean(['no-distcc'],
@@ -147,6 +167,42 @@ class Morph(cliapp.Application):
                               'those changes. Disable this behaviour with the '
                               '`ignore` setting.',
                               group=group_build)
+        self.settings.choice(['staging-area-backend'],
+                             ['hardlink', 'overlay'],
+                             'how to assemble staging areas: hardlink every '
+                             'file of the build dependencies into one '
+                             'directory, or stack them with overlayfs, '
+                             'which falls back to hardlinks when the kernel '
+                             'does not support it',
+                             group=group_build)
+        self.settings.choice(['system-assembly'],
+                             ['unpack', 'stream'],
+                             'how to make system artifacts: unpack every '
+                             'chunk and then write the tree out, or copy '
+                             'the chunks straight into the system, reading '
+                             'back only what system integration changes '
+                             'in a tree hardlinked from the unpacked chunks',
+                             group=group_build)
+        self.settings.choice(['source-extraction'],
+                             ['copy', 'export'],
+                             'how to get the sources of a chunk: copy the '
+                             'whole cached repository and check out the '
+                             'commit, or write only the files of the '
+                             'commit, copying anyway when the chunk looks '
+                             'like it needs git history to build',
+                             group=group_build)
+        self.settings.boolean(['plan'],
+                              'do not build anything: show which sources '
+                              'are in the local or remote artifact cache, '
+                              'which need building, and how long building '
+                              'them is likely to take, from the times of '
+                              'earlier builds',
+                              group=group_build)
+        self.settings.choice(['plan-format'],
+                             ['text', 'json'],
+                             'write the build plan made with --plan as '
+                             'text or as JSON',
+                             group=group_build)
 
         group_storage = 'Storage Options'
         self.settings.string(['tempdir'],
@@ -183,6 +239,38 @@ class Morph(cliapp.Application):
                                metavar='SIZE',
                                group=group_storage,
                                default='4G')
+        self.settings.choice(['artifact-compression'],
+                             ['none', 'gzip', 'xz', 'zstd'],
+                             'compress the chunk artifacts that are built '
+                             'with this format; chunks in any of these '
+                             'formats can be used whatever this is set to',
+                             group=group_storage)
+        self.settings.bytesize(['unpacked-chunks-max-size'],
+                               'Remove the least recently used chunks '
+                               'unpacked in tempdir when they take more than '
+                               'SIZE bytes; 0 means no limit '
+                               '(default: %default)',
+                               metavar='SIZE',
+                               group=group_storage,
+                               default='0')
+        self.settings.integer(['staging-pool-max-roots'],
+                              'keep up to N staging areas, as they are '
+                              'once the build dependencies are installed, '
+                              'in tempdir, and set up new staging areas '
+                              'by copying the closest one and adding or '
+                              'removing the chunks that differ; 0 turns '
+                              'this off (default: %default)',
+                              metavar='N',
+                              group=group_storage,
+                              default=0)
+        self.settings.bytesize(['staging-pool-max-size'],
+                               'remove the least recently used staging '
+                               'areas kept for reuse when their files add '
+                               'up to more than SIZE bytes; 0 means no '
+                               'limit (default: %default)',
+                               metavar='SIZE',
+                               group=group_storage,
+                               default='0')
         # The cachedir default size of 4G comes from twice the size of the
         # largest system artifact.
         # It's twice the size because it needs space for all the chunks that
@@ -198,6 +286,20 @@ class Morph(cliapp.Application):
                                metavar='SIZE',
                                group=group_storage,
                                default='4G')
+        self.settings.bytesize(['cachedir-artifact-max-size'],
+                               'remove the least recently used artifacts '
+                               'from the local artifact cache as new ones '
+                               'are added, to keep it under SIZE bytes; '
+                               'artifacts that running builds need are '
+                               'kept; 0 means no limit (default: %default)',
+                               metavar='SIZE',
+                               group=group_storage,
+                               default='0')
+        self.settings.boolean(['cachedir-artifact-dedup'],
+                              'store artifacts with the same contents once '
+                              'in the local artifact cache, hardlinking '
+                              'them to a copy in CACHEDIR/artifacts-cas',
+                              group=group_storage)
 
     def check_time(self):
         # Check that the current time is not far in the past.
@@ -317,10 +419,19 @@ class Morph(cliapp.Application):
                     if (submod.url, submod.commit) not in done:
                         subs_to_process.add((submod.url, submod.commit))
 
+    @property
+    def status_prefix(self):
+        return getattr(self._thread_state, 'status_prefix', '')
+
+    @status_prefix.setter
+    def status_prefix(self, value):
+        self._thread_state.status_prefix = value
+
     def _write_status(self, text):
         timestamp = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
-        self.output.write('%s %s\n' % (timestamp, text))
-        self.output.flush()
+        with self._status_lock:
+            self.output.write('%s %s\n' % (timestamp, text))
+            self.output.flush()
 
     def status(self, **kwargs):
         '''Show user a status update.
@@ -337,7 +448,8 @@ class Morph(cliapp.Application):
         All other keywords are ignored unless embedded in ``msg``.
         
         The ``self.status_prefix`` string is prepended to the output.
-        It is set to the empty string by default.
+        It is set to the empty string by default, and is kept separately
+        for each thread.
 
         '''
 
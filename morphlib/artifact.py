@@ -1,4 +1,4 @@
-# Copyright (C) 2012, 2013, 2014  Codethink Limited
+# Copyright (C) 2012, 2013, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -14,6 +14,9 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import morphlib
+
+
 class Artifact(object):
 
     '''Represent a build result generated from a source.
@@ -24,11 +27,18 @@ class Artifact(object):
     * ``name`` -- the name of the artifact
     * ``dependents`` -- list of Sources that need this Artifact to be built
 
+    Build graphs can have tens of thousands of artifacts, so artifacts
+    have slots instead of a ``__dict__``. The slots after ``dependents``
+    are only set by the code that uses them.
+
     '''
 
+    __slots__ = ('source', 'name', 'dependents', 'arch', 'build_env',
+                 'state')
+
     def __init__(self, source, name):
         self.source = source
-        self.name = name
+        self.name = morphlib.util.intern_string(name)
         self.dependents = []
 
     def basename(self):  # pragma: no cover
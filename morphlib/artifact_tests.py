@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -58,3 +58,7 @@ class ArtifactTests(unittest.TestCase):
 
     def test_sets_dependents_to_empty(self):
         self.assertEqual(self.artifact.dependents, [])
+
+    def test_has_no_attributes_besides_its_slots(self):
+        self.assertRaises(AttributeError, setattr, self.artifact, 'colour',
+                          'blue')
@@ -0,0 +1,127 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+class ArtifactGraph(object):
+
+    '''An index of the build graph of some artifacts.
+
+    Every artifact the roots depend on, directly or through other
+    artifacts, gets an integer id: its place in the ``artifacts`` list,
+    which has each artifact after all of its dependencies, in the same
+    order as ``Artifact.walk``. The recursive dependencies of each
+    artifact are kept as a bitset, a Python integer with the bits of
+    their ids set, so that they can be found and combined for any number
+    of artifacts without walking the graph again.
+
+    The graph must not change once it has been indexed.
+
+    '''
+
+    def __init__(self, roots):
+        self.artifacts = []
+        self.ids = {}
+        self._closures = []
+        self._strata = {}
+        for root in roots:
+            self._add(root)
+
+    def __len__(self):
+        return len(self.artifacts)
+
+    def __contains__(self, artifact):
+        return artifact in self.ids
+
+    def _add(self, root):
+        # The graph can be deeper than Python lets functions recurse, so
+        # this walks it with a stack of iterators over dependencies.
+        if root in self.ids:
+            return
+        seen = set([root])
+        stack = [(root, iter(root.source.dependencies))]
+        while stack:
+            artifact, dependencies = stack[-1]
+            for dependency in dependencies:
+                if dependency not in seen and dependency not in self.ids:
+                    seen.add(dependency)
+                    stack.append(
+                        (dependency, iter(dependency.source.dependencies)))
+                    break
+            else:
+                stack.pop()
+                self._append(artifact)
+
+    def _append(self, artifact):
+        closure = 0
+        for dependency in artifact.source.dependencies:
+            i = self.ids.get(dependency)
+            if i is not None:
+                closure |= self._closures[i] | (1 << i)
+        self.ids[artifact] = len(self.artifacts)
+        self.artifacts.append(artifact)
+        self._closures.append(closure)
+
+    def _bits(self, artifacts):
+        bits = 0
+        for artifact in artifacts:
+            bits |= 1 << self.ids[artifact]
+        return bits
+
+    def _select(self, bits):
+        # bin() gives the bits with the highest first, after a '0b'.
+        return [self.artifacts[i]
+                for i, bit in enumerate(reversed(bin(bits)[2:]))
+                if bit == '1']
+
+    def dependencies(self, artifacts):
+        '''Return the recursive dependencies of some artifacts.
+
+        The dependencies are in build order, and do not include any of
+        the artifacts themselves.
+
+        '''
+
+        closure = 0
+        for artifact in artifacts:
+            closure |= self._closures[self.ids[artifact]]
+        return self._select(closure & ~self._bits(artifacts))
+
+    def depends_on(self, artifact, other):
+        '''Does artifact need other to be built first, at any remove?'''
+
+        return bool(self._closures[self.ids[artifact]] >> self.ids[other] & 1)
+
+    def strata(self, source):
+        '''Return the morphologies of the strata that contain a source.
+
+        These are the strata with an artifact that depends directly on
+        an artifact of the source, whether they are in the graph or not.
+
+        '''
+
+        strata = self._strata.get(source)
+        if strata is None:
+            strata = frozenset(
+                dependent.morphology
+                for artifact in source.artifacts.itervalues()
+                for dependent in artifact.dependents
+                if dependent.morphology['kind'] == 'stratum')
+            self._strata[source] = strata
+        return strata
+
+    def in_same_stratum(self, source, other):
+        '''Are two sources in the same strata?'''
+
+        return self.strata(source) == self.strata(other)
@@ -0,0 +1,183 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import unittest
+
+import morphlib
+
+
+class FakeMorphology(dict):
+
+    def __hash__(self):
+        return id(self)
+
+
+class FakeSource(object):
+
+    def __init__(self, name, kind='chunk'):
+        self.name = name
+        self.morphology = FakeMorphology(kind=kind, name=name)
+        self.dependencies = []
+        self.artifacts = {}
+
+
+def make_artifact(name, kind='chunk'):
+    source = FakeSource(name, kind)
+    artifact = morphlib.artifact.Artifact(source, name)
+    source.artifacts[name] = artifact
+    return artifact
+
+
+def depend(artifact, *dependencies):
+    for dependency in dependencies:
+        artifact.source.dependencies.append(dependency)
+        dependency.dependents.append(artifact.source)
+
+
+class ArtifactGraphTests(unittest.TestCase):
+
+    def setUp(self):
+        # A small system: two strata, the second building on the first.
+        names = ['fhs', 'glibc', 'make', 'core', 'gcc', 'perl', 'devel',
+                 'system']
+        self.a = dict((name, make_artifact(name)) for name in names)
+        for name in ['core', 'devel']:
+            self.a[name].source.morphology['kind'] = 'stratum'
+        self.a['system'].source.morphology['kind'] = 'system'
+        a = self.a
+        depend(a['glibc'], a['fhs'])
+        depend(a['make'], a['fhs'], a['glibc'])
+        depend(a['core'], a['fhs'], a['glibc'], a['make'])
+        depend(a['gcc'], a['core'])
+        depend(a['perl'], a['core'], a['gcc'])
+        depend(a['devel'], a['core'], a['gcc'], a['perl'])
+        depend(a['system'], a['core'], a['devel'])
+        self.graph = morphlib.artifactgraph.ArtifactGraph([a['system']])
+
+    def names(self, artifacts):
+        return [artifact.name for artifact in artifacts]
+
+    def test_orders_artifacts_as_walk_does(self):
+        self.assertEqual(self.graph.artifacts, self.a['system'].walk())
+
+    def test_numbers_artifacts_in_order(self):
+        for i, artifact in enumerate(self.graph.artifacts):
+            self.assertEqual(self.graph.ids[artifact], i)
+        self.assertEqual(len(self.graph), 8)
+
+    def test_only_contains_dependencies_of_roots(self):
+        graph = morphlib.artifactgraph.ArtifactGraph([self.a['make']])
+        self.assertEqual(self.names(graph.artifacts),
+                         ['fhs', 'glibc', 'make'])
+        self.assertTrue(self.a['glibc'] in graph)
+        self.assertFalse(self.a['gcc'] in graph)
+
+    def test_indexes_several_roots_once(self):
+        graph = morphlib.artifactgraph.ArtifactGraph(
+            [self.a['perl'], self.a['make'], self.a['perl']])
+        self.assertEqual(self.names(graph.artifacts),
+                         ['fhs', 'glibc', 'make', 'core', 'gcc', 'perl'])
+
+    def test_returns_recursive_dependencies_in_build_order(self):
+        self.assertEqual(
+            self.names(self.graph.dependencies([self.a['perl']])),
+            ['fhs', 'glibc', 'make', 'core', 'gcc'])
+
+    def test_combines_dependencies_without_the_artifacts(self):
+        self.assertEqual(
+            self.names(self.graph.dependencies([self.a['perl'],
+                                                self.a['gcc']])),
+            ['fhs', 'glibc', 'make', 'core'])
+        self.assertEqual(self.graph.dependencies([self.a['fhs']]), [])
+
+    def test_knows_indirect_dependencies(self):
+        self.assertTrue(self.graph.depends_on(self.a['perl'],
+                                              self.a['glibc']))
+        self.assertFalse(self.graph.depends_on(self.a['glibc'],
+                                               self.a['perl']))
+        self.assertFalse(self.graph.depends_on(self.a['perl'],
+                                               self.a['perl']))
+
+    def test_finds_strata_of_sources(self):
+        a = self.a
+        self.assertEqual(self.graph.strata(a['make'].source),
+                         frozenset([a['core'].source.morphology]))
+        self.assertTrue(self.graph.in_same_stratum(a['make'].source,
+                                                   a['glibc'].source))
+        self.assertFalse(self.graph.in_same_stratum(a['make'].source,
+                                                    a['perl'].source))
+
+    def test_finds_strata_outside_the_graph(self):
+        graph = morphlib.artifactgraph.ArtifactGraph([self.a['perl']])
+        self.assertEqual(graph.strata(self.a['perl'].source),
+                         frozenset([self.a['devel'].source.morphology]))
+
+    def test_survives_dependency_cycles(self):
+        depend(self.a['fhs'], self.a['make'])
+        graph = morphlib.artifactgraph.ArtifactGraph([self.a['make']])
+        self.assertEqual(self.names(graph.artifacts),
+                         ['fhs', 'glibc', 'make'])
+
+
+class ArtifactGraphScalingTests(unittest.TestCase):
+
+    def test_indexes_chains_deeper_than_the_recursion_limit(self):
+        artifacts = [make_artifact('a0')]
+        for i in xrange(1, 20000):
+            artifact = make_artifact('a%d' % i)
+            depend(artifact, artifacts[-1])
+            artifacts.append(artifact)
+        graph = morphlib.artifactgraph.ArtifactGraph([artifacts[-1]])
+        self.assertEqual(graph.artifacts, artifacts)
+        self.assertEqual(graph.dependencies([artifacts[-1]]),
+                         artifacts[:-1])
+        self.assertTrue(graph.depends_on(artifacts[-1], artifacts[0]))
+
+    def test_indexes_wide_graphs(self):
+        # 100 layers of 120 artifacts, each depending on a few artifacts
+        # of the layer below.
+        width = 120
+        layers = [[make_artifact('0-%d' % i) for i in xrange(width)]]
+        for n in xrange(1, 100):
+            layer = []
+            for i in xrange(width):
+                artifact = make_artifact('%d-%d' % (n, i))
+                below = layers[-1]
+                depend(artifact, below[i], below[(i * 7 + 1) % width],
+                       below[(i * 13 + 5) % width])
+                layer.append(artifact)
+            layers.append(layer)
+        root = make_artifact('root')
+        depend(root, *layers[-1])
+        graph = morphlib.artifactgraph.ArtifactGraph([root])
+        self.assertEqual(len(graph), 100 * width + 1)
+
+        def walk(artifact):
+            done = set()
+            todo = list(artifact.source.dependencies)
+            while todo:
+                dependency = todo.pop()
+                if dependency not in done:
+                    done.add(dependency)
+                    todo.extend(dependency.source.dependencies)
+            return done
+
+        position = graph.ids
+        for artifact in [layers[50][3], layers[99][0], layers[10][119]]:
+            dependencies = graph.dependencies([artifact])
+            self.assertEqual(set(dependencies), walk(artifact))
+            for dependency in dependencies:
+                self.assertTrue(position[dependency] < position[artifact])
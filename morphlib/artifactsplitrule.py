@@ -1,4 +1,4 @@
-# Copyright (C) 2013-2014  Codethink Limited
+# Copyright (C) 2013-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -17,6 +17,7 @@
 import collections
 import itertools
 import re
+import weakref
 
 import morphlib
 
@@ -45,9 +46,11 @@ class FileMatch(Rule):
     '''
 
     def __init__(self, regexes):
-        # Possible optimisation: compile regexes as one pattern
         self._regexes = [re.compile(r) for r in regexes]
 
+    def key(self, path):
+        return path
+
     def match(self, path):
         return any(r.match(path) for r in self._regexes)
 
@@ -60,9 +63,11 @@ class ArtifactMatch(Rule):
     '''
 
     def __init__(self, regexes):
-        # Possible optimisation: compile regexes as one pattern
         self._regexes = [re.compile(r) for r in regexes]
 
+    def key(self, (source_name, artifact_name)):
+        return artifact_name
+
     def match(self, (source_name, artifact_name)):
         return any(r.match(artifact_name) for r in self._regexes)
 
@@ -109,6 +114,117 @@ class SourceAssign(Rule):
         return 'SourceAssign(%s, *)' % self._source
 
 
+# This finds some escaped backslashes too, which only means the rule is
+# not fused.
+_backreference = re.compile(r'\\[1-9]|\(\?P=')
+
+# Python's re module cannot compile patterns with 100 or more groups.
+_max_groups = 99
+
+
+def _fusable_groups(rule):
+    '''Return how many groups a rule adds to a fused pattern, or None.
+
+    Only rules matching regular expressions against a key can be fused.
+    Backreferences, named groups and inline flags do not mean the same
+    thing once the regular expressions are part of a larger one, so
+    rules using them are matched on their own.
+
+    '''
+
+    regexes = getattr(rule, '_regexes', None)
+    if regexes is None:
+        return None
+    for r in regexes:
+        if (r.flags & ~re.UNICODE or r.groupindex or
+                _backreference.search(r.pattern)):
+            return None
+    count = sum(r.groups for r in regexes) + 1
+    if count > _max_groups:
+        return None
+    return count
+
+
+class CompiledRules(object):
+    '''Match against a list of rules in as few passes as possible.
+
+    Consecutive rules matching the same key with regular expressions are
+    fused into one alternation, with a named group around each rule's
+    regular expressions, so that the first of them to match is found
+    with one call into the regular expression engine. The rules after a
+    match are tried the same way, to find every rule that matches.
+    Other rules are matched one at a time.
+
+    '''
+
+    def __init__(self, rules):
+        self._rules = list(rules)
+        counts = [_fusable_groups(r) for a, r in self._rules]
+        self._fusable = [c is not None for c in counts]
+        self._fused = {}
+
+        # Split the rules into runs that can be fused, and record where
+        # the run of each rule ends.
+        self._ends = [None] * len(self._rules)
+        start = 0
+        groups = 0
+        for i, (artifact, rule) in enumerate(self._rules):
+            count = counts[i]
+            if (count is None or not self._fusable[start] or
+                    type(rule) is not type(self._rules[start][1]) or
+                    groups + count > _max_groups):
+                self._close_run(start, i)
+                start = i
+                groups = 0
+            groups += count or 0
+        self._close_run(start, len(self._rules))
+
+    def _close_run(self, start, end):
+        for i in xrange(start, end):
+            self._ends[i] = end
+
+    def _pattern(self, start):
+        fused = self._fused.get(start)
+        if fused is None:
+            alternatives = []
+            for i in xrange(start, self._ends[start]):
+                regexes = self._rules[i][1]._regexes
+                alternatives.append('(?P<r%d>%s)' % (
+                    i, '|'.join('(?:%s)' % r.pattern for r in regexes)))
+            fused = self._fused[start] = re.compile('|'.join(alternatives))
+        return fused
+
+    def first(self, arg, start=0):
+        '''Return the index of the first rule from start that matches.
+
+        None is returned if no rule matches.
+
+        '''
+
+        i = start
+        while i < len(self._rules):
+            rule = self._rules[i][1]
+            if not self._fusable[i]:
+                if rule.match(arg):
+                    return i
+            else:
+                m = self._pattern(i).match(rule.key(arg))
+                if m is not None:
+                    return int(m.lastgroup[1:])
+            i = self._ends[i]
+        return None
+
+    def match(self, arg):
+        '''Return all artifact names arg matches, in rule order.'''
+
+        result = []
+        i = self.first(arg)
+        while i is not None:
+            result.append(self._rules[i][0])
+            i = self.first(arg, i + 1)
+        return result
+
+
 class SplitRules(collections.Iterable):
     '''Rules engine for splitting a source's artifacts.
 
@@ -124,12 +240,21 @@ class SplitRules(collections.Iterable):
 
     def __init__(self, *args):
         self._rules = list(*args)
+        self._compiled = None
 
     def __iter__(self):
         return iter(self._rules)
 
     def add(self, artifact, rule):
         self._rules.append((artifact, rule))
+        self._compiled = None
+
+    def compiled(self):
+        '''Return the rules compiled for matching, compiling them once.'''
+
+        if self._compiled is None:
+            self._compiled = CompiledRules(self._rules)
+        return self._compiled
 
     @property
     def artifacts(self):
@@ -157,7 +282,18 @@ class SplitRules(collections.Iterable):
 
         '''
 
-        return [a for a, r in self._rules if r.match(*args)]
+        if len(args) != 1:
+            return [a for a, r in self._rules if r.match(*args)]
+        return self.compiled().match(args[0])
+
+    def first_match(self, arg):
+        '''Return the name of the first artifact arg matches, or None.'''
+
+        compiled = self.compiled()
+        i = compiled.first(arg)
+        if i is None:
+            return None
+        return self._rules[i][0]
 
     def partition(self, iterable):
         '''Match many files or artifacts.
@@ -172,9 +308,10 @@ class SplitRules(collections.Iterable):
         matches = collections.defaultdict(list)
         overlaps = collections.defaultdict(set)
         unmatched = set()
+        match = self.compiled().match
 
         for arg in iterable:
-            matched = self.match(arg)
+            matched = match(arg)
             if len(matched) == 0:
                 unmatched.add(arg)
                 continue
@@ -230,6 +367,40 @@ DEFAULT_STRATUM_RULES = [
 ]
 
 
+# Rules and split rules are not changed once they are made, so equal
+# ones are shared for as long as any of them is in use. Every chunk has
+# a copy of the default rules, and distbuild makes a new build graph for
+# every build request, with split rules for each of its sources.
+_shared = weakref.WeakValueDictionary()
+
+
+def _freeze(value):
+    '''Return a hashable copy of some lists and dicts from a morphology.'''
+
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _shared_object(key, make, *args):
+    obj = _shared.get(key)
+    if obj is None:
+        obj = make(*args)
+        _shared[key] = obj
+    return obj
+
+
+def _file_match(patterns):
+    return _shared_object((FileMatch, _freeze(patterns)), FileMatch, patterns)
+
+
+def _artifact_match(patterns):
+    return _shared_object((ArtifactMatch, _freeze(patterns)), ArtifactMatch,
+                          patterns)
+
+
 def unify_chunk_matches(morphology, default_rules=DEFAULT_CHUNK_RULES):
     '''Create split rules including defaults and per-chunk rules.
 
@@ -239,11 +410,18 @@ def unify_chunk_matches(morphology, default_rules=DEFAULT_CHUNK_RULES):
 
     '''
 
+    key = ('chunk', morphology['name'], _freeze(morphology['products']),
+           _freeze(default_rules))
+    return _shared_object(key, _unify_chunk_matches, morphology,
+                          default_rules)
+
+
+def _unify_chunk_matches(morphology, default_rules):
     split_rules = SplitRules()
 
     for ca_name, patterns in ((d['artifact'], d['include'])
                               for d in morphology['products']):
-        split_rules.add(ca_name, FileMatch(patterns))
+        split_rules.add(ca_name, _file_match(patterns))
 
     name = morphology['name']
     for suffix, patterns in default_rules:
@@ -252,7 +430,7 @@ def unify_chunk_matches(morphology, default_rules=DEFAULT_CHUNK_RULES):
         # override: there is no way to extend the default split rules right now
         # without duplicating them in the chunk morphology.
         if ca_name not in split_rules.artifacts:
-            split_rules.add(ca_name, FileMatch(patterns))
+            split_rules.add(ca_name, _file_match(patterns))
 
     return split_rules
 
@@ -267,6 +445,15 @@ def unify_stratum_matches(morphology, default_rules=DEFAULT_STRATUM_RULES):
 
     '''
 
+    key = ('stratum', morphology['name'],
+           _freeze([(spec['name'], spec.get('artifacts', {}))
+                    for spec in morphology['chunks']]),
+           _freeze(morphology.get('products', {})), _freeze(default_rules))
+    return _shared_object(key, _unify_stratum_matches, morphology,
+                          default_rules)
+
+
+def _unify_stratum_matches(morphology, default_rules):
     assignment_split_rules = SplitRules()
     for spec in morphology['chunks']:
         source_name = spec['name']
@@ -282,7 +469,7 @@ def unify_stratum_matches(morphology, default_rules=DEFAULT_STRATUM_RULES):
     match_split_rules = SplitRules()
     for sta_name, patterns in ((d['artifact'], d['include'])
                                for d in morphology.get('products', {})):
-        match_split_rules.add(sta_name, ArtifactMatch(patterns))
+        match_split_rules.add(sta_name, _artifact_match(patterns))
 
     for suffix, patterns in default_rules:
         sta_name = morphology['name'] + suffix
@@ -290,7 +477,7 @@ def unify_stratum_matches(morphology, default_rules=DEFAULT_STRATUM_RULES):
         # override: there is no way to extend the default split rules right now
         # without duplicating them in the chunk morphology.
         if sta_name not in match_split_rules.artifacts:
-            match_split_rules.add(sta_name, ArtifactMatch(patterns))
+            match_split_rules.add(sta_name, _artifact_match(patterns))
 
     # Construct a new SplitRules with the assignments before matches
     return SplitRules(itertools.chain(assignment_split_rules,
@@ -0,0 +1,244 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import unittest
+
+import morphlib
+from morphlib.artifactsplitrule import (
+    ArtifactAssign, ArtifactMatch, FileMatch, SourceAssign, SplitRules,
+    DEFAULT_CHUNK_RULES)
+
+
+PATHS = [
+    'usr/bin/foo', 'bin/sh', 'usr/lib/libfoo.so.1', 'usr/lib/libfoo.a',
+    'usr/include/foo.h', 'usr/share/doc/foo/README', 'USR/SHARE/DOC/X',
+    'usr/share/locale/de/foo.mo', 'xx-xx', 'xx-x', 'dir7/a', 'dir123/b',
+    'etc/foo.conf', '',
+]
+
+
+ARTIFACTS = [
+    ('foo', 'foo-bins'), ('foo', 'foo-libs'), ('foo', 'foo-doc'),
+    ('bar', 'bar-devel'), ('bar', 'bar-misc'), ('baz', 'baz-locale'),
+]
+
+
+def match_one_at_a_time(rules, arg):
+    return [a for a, r in rules if r.match(arg)]
+
+
+def partition_one_at_a_time(rules, args):
+    matches = collections.defaultdict(list)
+    overlaps = collections.defaultdict(set)
+    unmatched = set()
+    for arg in args:
+        matched = match_one_at_a_time(rules, arg)
+        if not matched:
+            unmatched.add(arg)
+            continue
+        if len(matched) != 1:
+            overlaps[arg].update(matched)
+        matches[matched[0]].append(arg)
+    return matches, overlaps, unmatched
+
+
+class CompiledRulesTests(unittest.TestCase):
+
+    def assertMatchesOneAtATime(self, rules, args):
+        for arg in args:
+            expected = match_one_at_a_time(rules, arg)
+            self.assertEqual(rules.match(arg), expected)
+            self.assertEqual(rules.first_match(arg),
+                             expected[0] if expected else None)
+        self.assertEqual(rules.partition(args),
+                         partition_one_at_a_time(rules, args))
+
+    def test_matches_the_default_chunk_rules(self):
+        rules = SplitRules()
+        for suffix, patterns in DEFAULT_CHUNK_RULES:
+            rules.add('foo' + suffix, FileMatch(patterns))
+        self.assertMatchesOneAtATime(rules, PATHS)
+
+    def test_matches_more_rules_than_one_pattern_can_have_groups(self):
+        rules = SplitRules()
+        for i in xrange(150):
+            rules.add('dir%d' % i, FileMatch([r'dir(%d)/(.*)' % i]))
+        rules.add('any', FileMatch([r'(d)(i)(r).*']))
+        self.assertMatchesOneAtATime(rules, PATHS)
+        self.assertEqual(rules.match('dir123/b'), ['dir123', 'any'])
+
+    def test_matches_rules_with_too_many_groups_to_fuse(self):
+        rules = SplitRules()
+        rules.add('before', FileMatch([r'(d)ir7/.*']))
+        rules.add('many', FileMatch(['(d)' + '(.)' * 98]))
+        rules.add('after', FileMatch([r'(d).*']))
+        self.assertMatchesOneAtATime(rules, PATHS + ['d' * 99])
+        self.assertEqual(rules.match('d' * 99), ['many', 'after'])
+
+    def test_matches_case_insensitive_rules_on_their_own(self):
+        rules = SplitRules()
+        rules.add('-doc', FileMatch([r'usr/share/doc/.*']))
+        rules.add('-upper', FileMatch([r'(?i)usr/share/DOC/.*']))
+        rules.add('-exact', FileMatch([r'USR/.*']))
+        self.assertMatchesOneAtATime(rules, PATHS)
+        self.assertEqual(rules.match('usr/share/doc/foo/README'),
+                         ['-doc', '-upper'])
+        self.assertEqual(rules.match('USR/SHARE/DOC/X'),
+                         ['-upper', '-exact'])
+
+    def test_matches_backreferences_on_their_own(self):
+        rules = SplitRules()
+        rules.add('-first', FileMatch([r'(y+)-.*']))
+        rules.add('-twice', FileMatch([r'(x+)-\1$']))
+        rules.add('-named', FileMatch([r'(?P<x>x+)-(?P=x)$']))
+        rules.add('-rest', FileMatch([r'(x+).*']))
+        self.assertMatchesOneAtATime(rules, PATHS)
+        self.assertEqual(rules.match('xx-xx'), ['-twice', '-named', '-rest'])
+        self.assertEqual(rules.match('xx-x'), ['-rest'])
+
+    def test_matches_overlapping_file_rules_across_runs(self):
+        rules = SplitRules()
+        rules.add('-a', FileMatch([r'usr/.*']))
+        rules.add('-b', FileMatch([r'usr/lib/.*', r'(usr/)?bin/.*']))
+        rules.add('-c', FileMatch([r'(?i)usr/.*']))
+        rules.add('-d', FileMatch([r'.*\.so(\.\d+)*', r'usr/bin/foo']))
+        rules.add('-e', FileMatch([r'.*']))
+        self.assertMatchesOneAtATime(rules, PATHS)
+        self.assertEqual(rules.match('usr/lib/libfoo.so.1'),
+                         ['-a', '-b', '-c', '-d', '-e'])
+
+    def test_matches_overlapping_artifact_rules_across_runs(self):
+        rules = SplitRules()
+        rules.add('s-devel', ArtifactAssign('foo', 'foo-bins'))
+        rules.add('s-runtime', ArtifactMatch([r'.*-bins', r'.*-libs']))
+        rules.add('s-devel', ArtifactMatch([r'foo-.*']))
+        rules.add('s-all', SourceAssign('bar'))
+        rules.add('s-devel', ArtifactMatch([r'.*-devel', r'.*-doc']))
+        rules.add('s-runtime', ArtifactMatch([r'.*']))
+        self.assertMatchesOneAtATime(rules, ARTIFACTS)
+        self.assertEqual(rules.match(('foo', 'foo-bins')),
+                         ['s-devel', 's-runtime', 's-devel', 's-runtime'])
+        self.assertEqual(rules.match(('bar', 'bar-devel')),
+                         ['s-all', 's-devel', 's-runtime'])
+
+    def test_matches_the_default_stratum_rules(self):
+        rules = morphlib.artifactsplitrule.unify_stratum_matches({
+            'name': 's',
+            'chunks': [{'name': 'foo', 'artifacts': {'foo-doc': 's-x'}}],
+        })
+        self.assertMatchesOneAtATime(rules, ARTIFACTS)
+        self.assertEqual(rules.match(('foo', 'foo-doc')),
+                         ['s-x', 's-devel', 's-runtime'])
+
+    def test_recompiles_after_rules_are_added(self):
+        rules = SplitRules()
+        rules.add('-a', FileMatch([r'a.*']))
+        self.assertEqual(rules.match('ab'), ['-a'])
+        rules.add('-b', FileMatch([r'ab']))
+        self.assertEqual(rules.match('ab'), ['-a', '-b'])
+
+    def test_matches_no_rules(self):
+        rules = SplitRules()
+        self.assertMatchesOneAtATime(rules, PATHS)
+        self.assertEqual(rules.first_match('foo'), None)
+
+
+class SplitRulesTests(unittest.TestCase):
+
+    def test_lists_artifacts_once_in_the_order_added(self):
+        rules = SplitRules()
+        rules.add('b', FileMatch(['x']))
+        rules.add('a', FileMatch(['y']))
+        rules.add('b', FileMatch(['z']))
+        self.assertEqual(rules.artifacts, ['b', 'a'])
+
+    def test_copies_rules(self):
+        rules = SplitRules([('a', FileMatch(['x']))])
+        copy = SplitRules(rules)
+        copy.add('b', FileMatch(['y']))
+        self.assertEqual(rules.artifacts, ['a'])
+        self.assertEqual(copy.artifacts, ['a', 'b'])
+
+    def test_matches_rules_taking_several_arguments(self):
+        rules = SplitRules([('a', morphlib.artifactsplitrule.Rule())])
+        self.assertEqual(rules.match('x', 'y'), ['a'])
+
+    def test_shows_rules(self):
+        rules = SplitRules([
+            ('a', FileMatch(['x', 'y'])),
+            ('b', ArtifactMatch(['z'])),
+            ('c', ArtifactAssign('s', 'z')),
+            ('d', SourceAssign('s')),
+        ])
+        self.assertEqual(
+            repr(rules),
+            'SplitRules(a=FileMatch(x|y), b=ArtifactMatch(z), '
+            'c=ArtifactAssign(s, z), d=SourceAssign(s, *))')
+
+
+class UnifyTests(unittest.TestCase):
+
+    def test_overrides_default_chunk_rules(self):
+        rules = morphlib.artifactsplitrule.unify_chunk_matches({
+            'name': 'foo',
+            'products': [{'artifact': 'foo-doc', 'include': ['doc/.*']}],
+        })
+        self.assertEqual(rules.artifacts, [
+            'foo-doc', 'foo-bins', 'foo-libs', 'foo-devel', 'foo-locale',
+            'foo-misc'])
+        self.assertEqual(rules.first_match('doc/x'), 'foo-doc')
+        self.assertEqual(rules.first_match('usr/share/doc/x'), 'foo-misc')
+
+    def test_shares_equal_rules(self):
+        morphology = {'name': 'foo', 'products': []}
+        rules = morphlib.artifactsplitrule.unify_chunk_matches(morphology)
+        self.assertTrue(
+            morphlib.artifactsplitrule.unify_chunk_matches(dict(morphology))
+            is rules)
+        other = morphlib.artifactsplitrule.unify_chunk_matches(
+            {'name': 'bar', 'products': []})
+        self.assertFalse(other is rules)
+        self.assertTrue(list(other)[0][1] is list(rules)[0][1])
+
+    def test_overrides_default_stratum_rules(self):
+        rules = morphlib.artifactsplitrule.unify_stratum_matches({
+            'name': 's',
+            'chunks': [{'name': 'foo'}],
+            'products': [{'artifact': 's-devel', 'include': ['.*-bins']}],
+        })
+        self.assertEqual(rules.artifacts, ['s-devel', 's-runtime'])
+        self.assertEqual(rules.first_match(('foo', 'foo-bins')), 's-devel')
+        self.assertEqual(rules.first_match(('foo', 'foo-doc')), 's-runtime')
+
+    def test_assigns_strata_to_the_system_rootfs(self):
+        rules = morphlib.artifactsplitrule.unify_system_matches({
+            'name': 'sys',
+            'strata': [
+                {'morph': 'core'},
+                {'name': 'tools', 'morph': 'tools',
+                 'artifacts': ['tools-runtime']},
+            ],
+        })
+        self.assertEqual(rules.match(('core', 'core-devel')),
+                         ['sys-rootfs'])
+        self.assertEqual(rules.match(('tools', 'tools-runtime')),
+                         ['sys-rootfs'])
+        self.assertEqual(rules.match(('tools', 'tools-devel')), [])
+
+    def test_has_no_cluster_rules(self):
+        rules = morphlib.artifactsplitrule.unify_cluster_matches({})
+        self.assertEqual(list(rules), [])
@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2014  Codethink Limited
+# Copyright (C) 2011-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -22,14 +22,18 @@ Binaries are chunks, strata, and system images.
 
 
 import cliapp
+import contextlib
 import logging
 import os
+import Queue
 import sys
 import re
 import errno
 import stat
 import shutil
+import subprocess
 import tarfile
+import threading
 
 import morphlib
 
@@ -79,40 +83,257 @@ if sys.version_info < (2, 7, 3): # pragma: no cover
                 raise ExtractError("could not change owner")
     tarfile.TarFile.chown = fixed_chown
 
-def create_chunk(rootdir, f, include, dump_memory_profile=None):
+# The formats chunk artifacts can be compressed with. Each has the magic
+# bytes a compressed file starts with, then the commands that compress
+# and decompress a stream, in order of preference. The compressors use
+# as many CPU cores as there are. Python's tarfile can deal with gzip
+# itself, so it is used when none of the gzip commands are installed.
+compression_formats = {
+    'gzip': ('\x1f\x8b',
+             [['pigz', '-c'], ['gzip', '-c']],
+             [['pigz', '-dc'], ['gzip', '-dc']]),
+    'xz': ('\xfd7zXZ\x00',
+           [['xz', '-c', '-T0']],
+           [['xz', '-dc']]),
+    'zstd': ('\x28\xb5\x2f\xfd',
+             [['zstd', '-q', '-c', '-T0']],
+             [['zstd', '-q', '-dc']]),
+}
+
+
+class CompressionError(cliapp.AppException):
+    pass
+
+
+def _find_command(candidates):
+    '''Return the first of a list of commands that is in $PATH, or None.'''
+
+    path = os.environ.get('PATH', os.defpath).split(os.pathsep)
+    for argv in candidates:
+        for dirname in path:
+            filename = os.path.join(dirname, argv[0])
+            if os.path.isfile(filename) and os.access(filename, os.X_OK):
+                return argv
+    return None
+
+
+def detect_compression(head):
+    '''Return the compression format of a file starting with head.
+
+    None is returned for uncompressed files.
+
+    '''
+
+    for name, (magic, compressors, decompressors) in \
+            compression_formats.iteritems():
+        if head.startswith(magic):
+            return name
+    return None
+
+
+def _copy_in_thread(src, dst, close_src=False, close_dst=False):
+    '''Copy one file to another in a new thread.
+
+    Errors are kept in the ``errors`` list of the returned thread, to be
+    reported once the process at the other end of the pipe has finished.
+
+    '''
+
+    def copy():
+        try:
+            shutil.copyfileobj(src, dst)
+        except (IOError, OSError), e:
+            thread.errors.append(e)
+        finally:
+            if close_src:
+                src.close()
+            if close_dst:
+                try:
+                    dst.close()
+                except (IOError, OSError), e:
+                    thread.errors.append(e)
+
+    thread = threading.Thread(target=copy)
+    thread.daemon = True
+    thread.errors = []
+    thread.start()
+    return thread
+
+
+def _wait_for_filter(p, argv, thread):
+    returncode = p.wait()
+    thread.join()
+    if returncode != 0:
+        raise CompressionError('%s failed with exit code %d' %
+                               (argv[0], returncode))
+    if thread.errors:
+        raise thread.errors[0]
+
+
+def _filter_command(compression, candidates):
+    '''Find the command to (de)compress with, or None to use tarfile.'''
+
+    argv = _find_command(candidates)
+    if argv is None and compression != 'gzip':
+        raise CompressionError('Cannot handle %s compressed chunks, as none '
+                               'of %s is installed' %
+                               (compression,
+                                ', '.join(c[0] for c in candidates)))
+    return argv
+
+
+@contextlib.contextmanager
+def chunk_writer(f, compression='none'):
+    '''Open a tar file to write a chunk to f, compressed as requested.
+
+    ``compression`` is 'none' or one of the keys of
+    ``compression_formats``. Compression happens in another process, at
+    the same time as the tar file is written.
+
+    '''
+
+    if compression == 'none':
+        tar = tarfile.open(fileobj=f, mode='w')
+        yield tar
+        tar.close()
+        return
+
+    magic, compressors, decompressors = compression_formats[compression]
+    argv = _filter_command(compression, compressors)
+    if argv is None:
+        tar = tarfile.open(fileobj=f, mode='w|gz')
+        yield tar
+        tar.close()
+        return
+
+    p = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    thread = _copy_in_thread(p.stdout, f, close_src=True)
+    try:
+        tar = tarfile.open(fileobj=p.stdin, mode='w|')
+        yield tar
+        tar.close()
+    except BaseException:
+        p.stdin.close()
+        p.wait()
+        thread.join()
+        raise
+    p.stdin.close()
+    _wait_for_filter(p, argv, thread)
+
+
+class _HeadedFile(object):
+
+    '''Read from a file whose first bytes have already been read.'''
+
+    def __init__(self, head, f):
+        self.head = head
+        self.f = f
+
+    def read(self, size=-1):
+        if not self.head:
+            return self.f.read(size)
+        if size < 0:
+            data, self.head = self.head + self.f.read(), ''
+        elif size <= len(self.head):
+            data, self.head = self.head[:size], self.head[size:]
+        else:
+            data = self.head + self.f.read(size - len(self.head))
+            self.head = ''
+        return data
+
+
+@contextlib.contextmanager
+def chunk_reader(f, errorlevel=1):
+    '''Open a chunk in any of the supported formats as a tar file.
+
+    The format is detected from the first bytes of ``f``. Compressed
+    chunks are decompressed in another process while the tar file is
+    read, so the members can only be read in order, as with the "r|"
+    mode of ``tarfile.open``.
+
+    '''
+
+    head = f.read(max(len(magic) for magic, compressors, decompressors
+                      in compression_formats.itervalues()))
+    headed = _HeadedFile(head, f)
+    compression = detect_compression(head)
+
+    argv = None
+    mode = 'r|'
+    if compression is not None:
+        magic, compressors, decompressors = compression_formats[compression]
+        argv = _filter_command(compression, decompressors)
+        if argv is None:
+            mode = 'r|gz'
+
+    if argv is None:
+        tar = tarfile.open(fileobj=headed, mode=mode, errorlevel=errorlevel)
+        try:
+            yield tar
+        finally:
+            tar.close()
+        return
+
+    p = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    thread = _copy_in_thread(headed, p.stdin, close_dst=True)
+    try:
+        tar = tarfile.open(fileobj=p.stdout, mode='r|',
+                           errorlevel=errorlevel)
+        yield tar
+        tar.close()
+        # Let the decompressor write out the padding at the end of the
+        # tar file, which tarfile does not read.
+        while p.stdout.read(64 * 1024):
+            pass
+    except BaseException:
+        p.stdout.close()
+        p.wait()
+        thread.join()
+        raise
+    p.stdout.close()
+    _wait_for_filter(p, argv, thread)
+
+
+# This timestamp is used to normalize the mtime for every file in
+# chunk artifact. This is useful to avoid problems from smallish
+# clock skew. It needs to be recent enough, however, that GNU tar
+# does not complain about an implausibly old timestamp.
+normalized_timestamp = 683074800
+
+
+def _add_to_chunk(tar, rootdir, relname):
+    filename = os.path.join(rootdir, relname)
+    # Normalize mtime for everything.
+    tarinfo = tar.gettarinfo(filename, arcname=relname)
+    tarinfo.ctime = normalized_timestamp
+    tarinfo.mtime = normalized_timestamp
+    if tarinfo.isreg():
+        with open(filename, 'rb') as f:
+            tar.addfile(tarinfo, fileobj=f)
+    else:
+        tar.addfile(tarinfo)
+
+
+def create_chunk(rootdir, f, include, dump_memory_profile=None,
+                 compression='none'):
     '''Create a chunk from the contents of a directory.
-    
+
     ``f`` is an open file handle, to which the tar file is written.
+    ``compression`` is 'none' or one of the keys of
+    ``compression_formats``.
 
     '''
 
     dump_memory_profile = dump_memory_profile or (lambda msg: None)
 
-    # This timestamp is used to normalize the mtime for every file in
-    # chunk artifact. This is useful to avoid problems from smallish
-    # clock skew. It needs to be recent enough, however, that GNU tar
-    # does not complain about an implausibly old timestamp.
-    normalized_timestamp = 683074800
-
     dump_memory_profile('at beginning of create_chunk')
     
-    path_pairs = [(relname, os.path.join(rootdir, relname))
-                  for relname in include]
-    tar = tarfile.open(fileobj=f, mode='w')
-    for relname, filename in path_pairs:
-        # Normalize mtime for everything.
-        tarinfo = tar.gettarinfo(filename,
-                                 arcname=relname)
-        tarinfo.ctime = normalized_timestamp
-        tarinfo.mtime = normalized_timestamp
-        if tarinfo.isreg():
-            with open(filename, 'rb') as f:
-                tar.addfile(tarinfo, fileobj=f)
-        else:
-            tar.addfile(tarinfo)
-    tar.close()
+    with chunk_writer(f, compression) as tar:
+        for relname in include:
+            _add_to_chunk(tar, rootdir, relname)
 
-    for relname, filename in reversed(path_pairs):
+    for relname in reversed(include):
+        filename = os.path.join(rootdir, relname)
         if os.path.isdir(filename) and not os.path.islink(filename):
             continue
         else:
@@ -120,10 +341,118 @@ def create_chunk(rootdir, f, include, dump_memory_profile=None):
     dump_memory_profile('after removing in create_chunks')
 
 
+class _Aborted(Exception):
+
+    pass
+
+
+class ChunkWriters(object):
+
+    '''Write several chunks from the files of one directory at once.
+
+    ``files`` maps the name of each chunk to the open file it is written
+    to. Each chunk is written by a thread of its own, so when they are
+    compressed, all the compressors run at the same time. A file is
+    added to a chunk with ``add``, after any of its parent directories
+    that the chunk does not have yet, so one walk of the directory can
+    send each file to the chunk it belongs in as it is found.
+
+    Unlike ``create_chunk``, nothing is removed from the directory.
+
+    '''
+
+    def __init__(self, rootdir, files, compression='none'):
+        self.rootdir = rootdir
+        self._added = {}
+        self._queues = {}
+        self._threads = []
+        self._errors = []
+        self._aborted = False
+        for name, f in files.iteritems():
+            queue = Queue.Queue()
+            thread = threading.Thread(target=self._write,
+                                      args=(f, queue, compression))
+            thread.daemon = True
+            thread.start()
+            self._added[name] = set()
+            self._queues[name] = queue
+            self._threads.append(thread)
+
+    def _write(self, f, queue, compression):
+        try:
+            with chunk_writer(f, compression) as tar:
+                while True:
+                    relname = queue.get()
+                    if self._aborted:
+                        raise _Aborted()
+                    if relname is None:
+                        break
+                    _add_to_chunk(tar, self.rootdir, relname)
+        except _Aborted:
+            pass
+        except BaseException:
+            self._errors.append(sys.exc_info())
+
+    def _raise_error(self):
+        exc_type, exc_value, exc_traceback = self._errors[0]
+        raise exc_type, exc_value, exc_traceback
+
+    def add(self, name, relname):
+        '''Add a file, and any parents missing, to the chunk name.'''
+
+        if self._errors:
+            self.abort()
+            self._raise_error()
+        added = self._added[name]
+        relnames = []
+        while relname and relname not in added:
+            relnames.append(relname)
+            relname = os.path.dirname(relname)
+        queue = self._queues[name]
+        for relname in reversed(relnames):
+            added.add(relname)
+            queue.put(relname)
+
+    def contents(self, name, extra=()):
+        '''Return the sorted names of everything in the chunk name.
+
+        The names in ``extra``, and their parents, are included as if
+        they had already been added.
+
+        '''
+
+        result = set(self._added[name])
+        for relname in extra:
+            while relname:
+                result.add(relname)
+                relname = os.path.dirname(relname)
+        return sorted(result)
+
+    def close(self):
+        '''Finish writing every chunk.'''
+
+        self._finish()
+        if self._errors:
+            self._raise_error()
+
+    def abort(self):
+        '''Stop writing, leaving the chunks incomplete.'''
+
+        self._aborted = True
+        self._finish()
+
+    def _finish(self):
+        for queue in self._queues.itervalues():
+            queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
 def unpack_binary_from_file(f, dirname):  # pragma: no cover
     '''Unpack a binary into a directory.
 
-    The directory must exist already.
+    The directory must exist already. Compressed chunks are decompressed
+    while they are unpacked.
 
     '''
 
@@ -196,18 +525,15 @@ def unpack_binary_from_file(f, dirname):  # pragma: no cover
                 return ret
         return make_something
 
-    tf = tarfile.open(fileobj=f, errorlevel=2)
-    tf.makedir = monkey_patcher(tf.makedir)
-    tf.makefile = monkey_patcher(tf.makefile)
-    tf.makeunknown = monkey_patcher(tf.makeunknown)
-    tf.makefifo = monkey_patcher(tf.makefifo)
-    tf.makedev = monkey_patcher(tf.makedev)
-    tf.makelink = monkey_patcher(tf.makelink)
+    with chunk_reader(f, errorlevel=2) as tf:
+        tf.makedir = monkey_patcher(tf.makedir)
+        tf.makefile = monkey_patcher(tf.makefile)
+        tf.makeunknown = monkey_patcher(tf.makeunknown)
+        tf.makefifo = monkey_patcher(tf.makefifo)
+        tf.makedev = monkey_patcher(tf.makedev)
+        tf.makelink = monkey_patcher(tf.makelink)
 
-    try:
         tf.extractall(path=dirname)
-    finally:
-        tf.close()
 
 
 def unpack_binary(filename, dirname):
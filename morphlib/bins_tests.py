@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2014  Codethink Limited
+# Copyright (C) 2011-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -18,8 +18,10 @@ import gzip
 import os
 import shutil
 import stat
+import subprocess
 import tempfile
 import tarfile
+import time
 import unittest
 import StringIO
 
@@ -107,9 +109,10 @@ class ChunkTests(BinsTest):
 
         self.instdir_orig_files = self.recursive_lstat(self.instdir)
 
-    def create_chunk(self, includes):
+    def create_chunk(self, includes, compression='none'):
         self.populate_instdir()
-        morphlib.bins.create_chunk(self.instdir, self.chunk_f, includes)
+        morphlib.bins.create_chunk(self.instdir, self.chunk_f, includes,
+                                   compression=compression)
         self.chunk_f.flush()
 
     def unpack_chunk(self):
@@ -141,6 +144,207 @@ class ChunkTests(BinsTest):
         self.assertRaises(IOError, f.read)
         f.close()
 
+    def test_compresses_artifact_with_gzip(self):
+        self.create_chunk(['bin', 'bin/foo', 'lib', 'lib/libfoo.so'],
+                          compression='gzip')
+        f = gzip.open(self.chunk_file)
+        f.read()
+        f.close()
+        self.unpack_chunk()
+        self.assertEqual(self.instdir_orig_files,
+                         self.recursive_lstat(self.unpacked))
+
+    def test_compresses_with_gzip_without_external_commands(self):
+        old_path = os.environ.get('PATH')
+        os.environ['PATH'] = ''
+        try:
+            self.create_chunk(['bin', 'bin/foo', 'lib', 'lib/libfoo.so'],
+                              compression='gzip')
+            self.unpack_chunk()
+        finally:
+            os.environ['PATH'] = old_path
+        with open(self.chunk_file, 'rb') as f:
+            self.assertEqual(
+                morphlib.bins.detect_compression(f.read(2)), 'gzip')
+        self.assertEqual(self.instdir_orig_files,
+                         self.recursive_lstat(self.unpacked))
+
+    def test_fails_when_compressor_is_missing(self):
+        old_path = os.environ.get('PATH')
+        os.environ['PATH'] = ''
+        try:
+            self.assertRaises(morphlib.bins.CompressionError,
+                              self.create_chunk, ['bin'], compression='zstd')
+        finally:
+            os.environ['PATH'] = old_path
+
+    def test_detects_compression_formats(self):
+        detect = morphlib.bins.detect_compression
+        self.assertEqual(detect('\x1f\x8b\x08\x00'), 'gzip')
+        self.assertEqual(detect('\xfd7zXZ\x00\x00'), 'xz')
+        self.assertEqual(detect('\x28\xb5\x2f\xfd\x00'), 'zstd')
+        self.assertEqual(detect('bin/\x00\x00\x00'), None)
+
+
+class ChunkWritersTests(BinsTest):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.instdir = os.path.join(self.tempdir, 'inst')
+        os.makedirs(os.path.join(self.instdir, 'usr', 'bin'))
+        os.makedirs(os.path.join(self.instdir, 'usr', 'share', 'doc'))
+        for name in ('usr/bin/foo', 'usr/share/doc/README'):
+            with open(os.path.join(self.instdir, name), 'w') as f:
+                f.write(name)
+        self.files = {
+            'bins': StringIO.StringIO(),
+            'doc': StringIO.StringIO(),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def members(self, name):
+        self.files[name].seek(0)
+        tar = tarfile.open(fileobj=self.files[name])
+        return [(m.name, m.mtime, m.isreg() and tar.extractfile(m).read())
+                for m in tar]
+
+    def test_writes_each_file_after_its_parents(self):
+        writers = morphlib.bins.ChunkWriters(self.instdir, self.files)
+        writers.add('bins', 'usr')
+        writers.add('bins', 'usr/bin/foo')
+        writers.add('doc', 'usr/share/doc/README')
+        writers.add('doc', 'usr/share')
+        writers.close()
+        mtime = morphlib.bins.normalized_timestamp
+        self.assertEqual(self.members('bins'), [
+            ('usr', mtime, False),
+            ('usr/bin', mtime, False),
+            ('usr/bin/foo', mtime, 'usr/bin/foo'),
+        ])
+        self.assertEqual(self.members('doc'), [
+            ('usr', mtime, False),
+            ('usr/share', mtime, False),
+            ('usr/share/doc', mtime, False),
+            ('usr/share/doc/README', mtime, 'usr/share/doc/README'),
+        ])
+        self.assertTrue(os.path.exists(
+            os.path.join(self.instdir, 'usr', 'bin', 'foo')))
+
+    def test_lists_contents_with_extra_names(self):
+        writers = morphlib.bins.ChunkWriters(self.instdir, self.files)
+        writers.add('bins', 'usr/bin/foo')
+        self.assertEqual(writers.contents('bins', ['baserock/bins.meta']),
+                         ['baserock', 'baserock/bins.meta',
+                          'usr', 'usr/bin', 'usr/bin/foo'])
+        self.assertEqual(writers.contents('doc'), [])
+        writers.close()
+
+    def test_compresses_chunks(self):
+        writers = morphlib.bins.ChunkWriters(self.instdir, self.files,
+                                             compression='gzip')
+        writers.add('bins', 'usr/bin/foo')
+        writers.close()
+        self.assertEqual(morphlib.bins.detect_compression(
+            self.files['bins'].getvalue()[:2]), 'gzip')
+        self.assertEqual(self.members('doc'), [])
+
+    def test_reports_errors_from_writers(self):
+        writers = morphlib.bins.ChunkWriters(self.instdir, self.files)
+        writers.add('bins', 'missing')
+        self.assertRaises(OSError, writers.close)
+
+    def test_stops_adding_after_an_error(self):
+        writers = morphlib.bins.ChunkWriters(self.instdir, self.files)
+        writers.add('bins', 'missing')
+        for i in xrange(100):
+            if writers._errors:
+                break
+            time.sleep(0.1)
+        self.assertRaises(OSError, writers.add, 'bins', 'usr/bin/foo')
+
+    def test_abort_stops_writers(self):
+        writers = morphlib.bins.ChunkWriters(self.instdir, self.files,
+                                             compression='gzip')
+        writers.add('bins', 'usr/bin/foo')
+        writers.abort()
+        self.assertEqual(writers._errors, [])
+
+
+class FailingFile(object):
+
+    def read(self, size=-1):
+        raise IOError('cannot read')
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        raise IOError('cannot close')
+
+
+class FilterTests(unittest.TestCase):
+
+    def gzipped_tar(self, trailer=''):
+        tarball = StringIO.StringIO()
+        tar = tarfile.open(fileobj=tarball, mode='w')
+        info = tarfile.TarInfo('foo')
+        info.size = 3
+        tar.addfile(info, StringIO.StringIO('foo'))
+        tar.close()
+        compressed = StringIO.StringIO()
+        f = gzip.GzipFile(fileobj=compressed, mode='wb')
+        f.write(tarball.getvalue() + trailer)
+        f.close()
+        compressed.seek(0)
+        return compressed
+
+    def test_copy_keeps_read_errors(self):
+        thread = morphlib.bins._copy_in_thread(FailingFile(),
+                                               StringIO.StringIO())
+        thread.join()
+        self.assertEqual(len(thread.errors), 1)
+
+    def test_copy_keeps_close_errors(self):
+        thread = morphlib.bins._copy_in_thread(StringIO.StringIO('x'),
+                                               FailingFile(), close_dst=True)
+        thread.join()
+        self.assertEqual(len(thread.errors), 1)
+
+    def test_reports_filter_exit_code(self):
+        p = subprocess.Popen(['false'])
+        thread = morphlib.bins._copy_in_thread(StringIO.StringIO(),
+                                               StringIO.StringIO())
+        self.assertRaises(morphlib.bins.CompressionError,
+                          morphlib.bins._wait_for_filter, p, ['false'], thread)
+
+    def test_reports_copy_errors_after_filter_exits(self):
+        p = subprocess.Popen(['true'])
+        thread = morphlib.bins._copy_in_thread(FailingFile(),
+                                               StringIO.StringIO())
+        self.assertRaises(IOError,
+                          morphlib.bins._wait_for_filter, p, ['true'], thread)
+
+    def test_reads_past_the_head(self):
+        f = morphlib.bins._HeadedFile('abc', StringIO.StringIO('def'))
+        self.assertEqual(f.read(2), 'ab')
+        self.assertEqual(f.read(), 'cdef')
+        f = morphlib.bins._HeadedFile('abc', StringIO.StringIO('def'))
+        self.assertEqual(f.read(4), 'abcd')
+        self.assertEqual(f.read(), 'ef')
+
+    def test_reads_compressed_chunk_with_trailing_data(self):
+        f = self.gzipped_tar(trailer='\0' * 100000)
+        with morphlib.bins.chunk_reader(f) as tar:
+            self.assertEqual([m.name for m in tar], ['foo'])
+
+    def test_stops_decompressor_after_errors(self):
+        def read_chunk():
+            with morphlib.bins.chunk_reader(self.gzipped_tar()) as tar:
+                raise RuntimeError('failed to use %r' % tar)
+        self.assertRaises(RuntimeError, read_chunk)
+
 
 class ExtractTests(unittest.TestCase):
 
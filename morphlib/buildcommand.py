@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2015  Codethink Limited
+# Copyright (C) 2011-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -14,12 +14,15 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
-import itertools
 import os
 import shutil
 import logging
 import tempfile
 import datetime
+import functools
+import sys
+import threading
+import Queue
 
 import morphlib
 import distbuild
@@ -50,6 +53,16 @@ class BuildCommand(object):
         self.lac, self.rac = self.new_artifact_caches()
         self.lrc, self.rrc = self.new_repo_caches()
 
+        # Index of the build graph, made once the artifacts are resolved.
+        self.graph = None
+
+        # How long sources took to build, recorded while building.
+        self.build_history = None
+
+        # Git repository cache updates are not safe to run concurrently
+        # when sources are built in parallel.
+        self._fetch_lock = threading.Lock()
+
     def build(self, repo_name, ref, filename, original_ref=None):
         '''Build a given system morphology.'''
 
@@ -62,6 +75,9 @@ class BuildCommand(object):
             repo_name, ref, filename, original_ref)
         self.validate_sources(srcpool)
         root_artifact = self.resolve_artifacts(srcpool)
+        if self.app.settings['plan']:
+            self.plan(root_artifact)
+            return
         self.build_in_order(root_artifact)
 
         self.app.status(
@@ -98,7 +114,9 @@ class BuildCommand(object):
             self.lrc, self.rrc, repo_name, ref, filename,
             original_ref=original_ref,
             update_repos=not self.app.settings['no-git-update'],
-            status_cb=self.app.status)
+            status_cb=self.app.status,
+            morphology_cache=morphlib.util.new_morphology_cache(
+                self.app.settings))
         return srcpool
 
     def validate_sources(self, srcpool):
@@ -165,12 +183,18 @@ class BuildCommand(object):
         build_env = self.new_build_env(arch)
 
         self.app.status(msg='Computing cache keys', chatty=True)
-        ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env)
+        store = morphlib.util.new_cache_key_store(self.app.settings)
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env, store)
 
-        for source in set(a.source for a in root_artifact.walk()):
+        for source in set(a.source for a in self.graph.artifacts):
             source.cache_key = ckc.compute_key(source)
             source.cache_id = ckc.get_cache_id(source)
 
+        store.save()
+        self.app.status(msg='Cache key store: %(hits)d hits, '
+                            '%(misses)d misses',
+                        hits=store.hits, misses=store.misses, chatty=True)
+
         root_artifact.build_env = build_env
 
     def resolve_artifacts(self, srcpool):
@@ -192,6 +216,9 @@ class BuildCommand(object):
         self.app.status(msg='Validating root artifact', chatty=True)
         self._validate_root_artifact(root_artifact)
 
+        self.app.status(msg='Indexing build graph', chatty=True)
+        self.graph = morphlib.artifactgraph.ArtifactGraph([root_artifact])
+
         self._compute_cache_keys(root_artifact)
 
         return root_artifact
@@ -269,25 +296,153 @@ class BuildCommand(object):
                 yield artifact.source
 
     def build_in_order(self, root_artifact):
-        '''Build everything specified in a build order.'''
+        '''Build everything specified in a build order.
+
+        How long each source took to build is saved in the build history,
+        even if a later one fails, to estimate later builds from.
+
+        '''
 
         self.app.status(msg='Building a set of sources', chatty=True)
         build_env = root_artifact.build_env
-        ordered_sources = list(self.get_ordered_sources(root_artifact.walk()))
+        graph = self.artifact_graph([root_artifact])
+        ordered_sources = list(self.get_ordered_sources(graph.artifacts))
+        self.build_history = morphlib.util.new_build_history(
+            self.app.settings)
+        try:
+            if self.app.settings['max-concurrent-builds'] > 1:
+                self.build_in_parallel(ordered_sources, build_env)
+                return
+
+            old_prefix = self.app.status_prefix
+            for i, s in enumerate(ordered_sources):
+                self.app.status_prefix = (
+                    old_prefix + '[Build %(index)d/%(total)d] [%(name)s] ' % {
+                        'index': (i+1),
+                        'total': len(ordered_sources),
+                        'name': s.name,
+                    })
+
+                self.cache_or_build_source(s, build_env)
+
+            self.app.status_prefix = old_prefix
+        finally:
+            self.build_history.save()
+
+    def plan(self, root_artifact):
+        '''Show what building would do, and how long it would take.'''
+
+        self.app.status(msg='Checking the artifact caches')
+        graph = self.artifact_graph([root_artifact])
+        ordered_sources = list(self.get_ordered_sources(graph.artifacts))
+        history = morphlib.util.new_build_history(self.app.settings)
+        plan = morphlib.buildplan.plan(
+            ordered_sources, self.get_source_dependencies(ordered_sources),
+            self.lac, self.rac, history)
+
+        if self.app.settings['plan-format'] == 'json':
+            plan.write_json(self.app.output)
+        else:
+            for line in plan.format_text():
+                self.app.output.write(line + '\n')
+
+    @staticmethod
+    def get_source_dependencies(sources):
+        '''Map each source to the set of sources it directly depends on.'''
+
+        return dict((source, set(a.source for a in source.dependencies))
+                    for source in sources)
+
+    def build_in_parallel(self, ordered_sources, build_env):
+        '''Build sources concurrently as their dependencies become ready.
+
+        A source is started, in build order, as soon as every source it
+        depends on has been built, with at most max-concurrent-builds
+        running at once. Each build gets its own staging area and an equal
+        share of the max-jobs budget.
+
+        If a build fails no more builds are started, the ones already
+        running are allowed to finish, and then the first error is raised.
+
+        '''
+
+        max_builds = self.app.settings['max-concurrent-builds']
+        max_jobs = max(1, self.app.settings['max-jobs'] // max_builds)
+        self.app.status(msg='Building up to %(builds)d sources at once, '
+                            'with up to %(jobs)d jobs each',
+                        builds=max_builds, jobs=max_jobs, chatty=True)
+
+        dependencies = self.get_source_dependencies(ordered_sources)
+        total = len(ordered_sources)
+        waiting = list(ordered_sources)
+        built = set()
+        running = {}
+        results = Queue.Queue()
+        errors = []
         old_prefix = self.app.status_prefix
-        for i, s in enumerate(ordered_sources):
-            self.app.status_prefix = (
-                old_prefix + '[Build %(index)d/%(total)d] [%(name)s] ' % {
-                    'index': (i+1),
-                    'total': len(ordered_sources),
-                    'name': s.name,
-                })
 
-            self.cache_or_build_source(s, build_env)
+        def run(source, prefix):
+            self.app.status_prefix = prefix
+            try:
+                self.cache_or_build_source(source, build_env, max_jobs)
+            except BaseException:
+                results.put((source, sys.exc_info()))
+            else:
+                results.put((source, None))
+
+        while waiting or running:
+            ready = [s for s in waiting
+                     if not errors and dependencies[s] <= built]
+            for source in ready[:max_builds - len(running)]:
+                waiting.remove(source)
+                prefix = (
+                    old_prefix + '[Build %(index)d/%(total)d] [%(name)s] ' % {
+                        'index': total - len(waiting),
+                        'total': total,
+                        'name': source.name,
+                    })
+                thread = threading.Thread(target=run, args=(source, prefix))
+                # Builds still running when the main thread is interrupted
+                # must not keep morph from exiting.
+                thread.daemon = True
+                running[source] = thread
+                thread.start()
+
+            if not running:
+                break
+
+            source, exc_info = self._wait_for_result(results)
+            running.pop(source).join()
+            if exc_info is None:
+                built.add(source)
+            else:
+                if not errors and running:
+                    self.app.status(
+                        msg='Build of %(name)s failed, waiting for '
+                            '%(count)d running builds to finish',
+                        name=source.name, count=len(running), error=True)
+                errors.append(exc_info)
+
+        if errors:
+            exc_type, exc_value, exc_traceback = errors[0]
+            raise exc_type, exc_value, exc_traceback
+
+    @staticmethod
+    def _wait_for_result(results):
+        '''Wait for a build to finish, however long it takes.
 
-        self.app.status_prefix = old_prefix
+        Waiting on a queue without a timeout cannot be interrupted with
+        Ctrl-C, so this waits for short times until there is a result.
+
+        '''
+
+        while True:
+            try:
+                return results.get(True, 1)
+            except Queue.Empty:
+                pass
 
-    def cache_or_build_source(self, source, build_env):
+    def cache_or_build_source(self, source, build_env, max_jobs=None):
         '''Make artifacts of the built source available in the local cache.
 
         This can be done by retrieving from a remote artifact cache, or if
@@ -303,7 +458,7 @@ class BuildCommand(object):
                 pass
 
         if any(not self.lac.has(artifact) for artifact in artifacts):
-            self.build_source(source, build_env)
+            self.build_source(source, build_env, max_jobs)
 
         for a in artifacts:
             self.app.status(msg='%(kind)s %(name)s is cached at %(cachepath)s',
@@ -311,11 +466,15 @@ class BuildCommand(object):
                             cachepath=self.lac.artifact_filename(a),
                             chatty=(source.morphology['kind'] != "system"))
 
-    def build_source(self, source, build_env):
+    def build_source(self, source, build_env, max_jobs=None):
         '''Build all artifacts for one source.
 
         All the dependencies are assumed to be built and available
-        in either the local or remote cache already.
+        in either the local or remote cache already. The number of jobs
+        the build may run defaults to the max-jobs setting. The source
+        and its dependencies are pinned in the local artifact cache while
+        it is built, so they are not evicted to make room. A trace of the
+        build is saved with its metadata, whether or not it succeeds.
 
         '''
         starttime = datetime.datetime.now()
@@ -323,13 +482,33 @@ class BuildCommand(object):
                         name=source.name,
                         kind=source.morphology['kind'])
 
-        self.fetch_sources(source)
-        # TODO: Make an artifact.walk() that takes multiple root artifacts.
-        # as this does a walk for every artifact. This was the status
-        # quo before build logic was made to work per-source, but we can
-        # now do better.
         deps = self.get_recursive_deps(source.artifacts.values())
-        self.cache_artifacts_locally(deps)
+        pinned = [source.cache_key] + [a.source.cache_key for a in deps]
+        tracer = morphlib.tracing.Tracer(source.name)
+        with self.lac.pin(pinned):
+            try:
+                with tracer.span('build-source', name=source.name,
+                                 kind=source.morphology['kind'],
+                                 cache_key=source.cache_key):
+                    self._build_source(source, build_env, max_jobs, tracer)
+            finally:
+                with self.lac.put_source_metadata(
+                        source, source.cache_key, 'trace') as f:
+                    tracer.write(f)
+
+        td = datetime.datetime.now() - starttime
+        if self.build_history is not None:
+            self.build_history.record(source, td.total_seconds())
+        hours, remainder = divmod(int(td.total_seconds()), 60*60)
+        minutes, seconds = divmod(remainder, 60)
+        td_string = "%02d:%02d:%02d" % (hours, minutes, seconds)
+        self.app.status(msg="Elapsed time %(duration)s", duration=td_string)
+
+    def _build_source(self, source, build_env, max_jobs, tracer):
+        self.fetch_sources(source, tracer)
+        deps = self.get_recursive_deps(source.artifacts.values())
+        with tracer.span('cache-dependencies', artifacts=len(deps)):
+            self.cache_artifacts_locally(deps)
 
         use_chroot = False
         setup_mounts = False
@@ -351,40 +530,71 @@ class BuildCommand(object):
                 use_chroot = True
                 setup_mounts = True
 
-            staging_area = self.create_staging_area(build_env,
-                                                    use_chroot,
-                                                    extra_env=extra_env,
-                                                    extra_path=extra_path)
+            with tracer.span('create-staging-area'):
+                staging_area = self.create_staging_area(
+                    build_env, use_chroot, extra_env=extra_env,
+                    extra_path=extra_path)
             try:
-                self.install_dependencies(staging_area, deps, source)
+                self.install_dependencies(staging_area, deps, source, tracer)
             except BaseException:
                 staging_area.abort()
                 raise
         else:
-            staging_area = self.create_staging_area(build_env, False)
+            with tracer.span('create-staging-area'):
+                staging_area = self.create_staging_area(build_env, False)
 
-        self.build_and_cache(staging_area, source, setup_mounts)
-        self.remove_staging_area(staging_area)
+        self.build_and_cache(staging_area, source, setup_mounts, max_jobs,
+                             tracer)
+        with tracer.span('remove-staging-area'):
+            self.remove_staging_area(staging_area)
 
-        td = datetime.datetime.now() - starttime
-        hours, remainder = divmod(int(td.total_seconds()), 60*60)
-        minutes, seconds = divmod(remainder, 60)
-        td_string = "%02d:%02d:%02d" % (hours, minutes, seconds)
-        self.app.status(msg="Elapsed time %(duration)s", duration=td_string)
+    def _indexed(self, artifacts):
+        '''Leave out the artifacts the build does not need of its sources.
+
+        All the artifacts of a source have the same dependencies, so
+        split artifacts that nothing in the build depends on, and so are
+        not in its index, can be left out of queries about a source that
+        has other artifacts in it.
+
+        '''
+
+        if self.graph is None:
+            return list(artifacts)
+        sources = set(a.source for a in artifacts if a in self.graph)
+        return [a for a in artifacts
+                if a in self.graph or a.source not in sources]
+
+    def artifact_graph(self, artifacts):
+        '''Return an index of the build graph containing some artifacts.
+
+        This is the index of the whole build if it has the artifacts.
+        Otherwise, it is a new index of just the artifacts, which is kept
+        as the index of the build if there is none yet, as when building
+        a single source for distbuild.
+
+        '''
+
+        if self.graph is None:
+            self.graph = morphlib.artifactgraph.ArtifactGraph(artifacts)
+        elif any(a not in self.graph for a in artifacts):
+            return morphlib.artifactgraph.ArtifactGraph(artifacts)
+        return self.graph
 
     def get_recursive_deps(self, artifacts):
-        deps = set()
-        ordered_deps = []
-        for artifact in artifacts:
-            for dep in artifact.walk():
-                if dep not in deps and dep not in artifacts:
-                    deps.add(dep)
-                    ordered_deps.append(dep)
-        return ordered_deps
+        '''Return the dependencies of artifacts in build order.'''
 
-    def fetch_sources(self, source):
+        artifacts = self._indexed(artifacts)
+        return self.artifact_graph(artifacts).dependencies(artifacts)
+
+    def fetch_sources(self, source, tracer=None):
         '''Update the local git repository cache with the sources.'''
 
+        tracer = tracer or morphlib.tracing.NullTracer()
+        with tracer.span('fetch-sources', repo=source.repo_name):
+            with self._fetch_lock:
+                self._fetch_sources(source, tracer)
+
+    def _fetch_sources(self, source, tracer):
         repo_name = source.repo_name
         if self.app.settings['no-git-update']:
             self.app.status(msg='Not updating existing git repository '
@@ -408,61 +618,93 @@ class BuildCommand(object):
             except morphlib.gitdir.InvalidRefError:
                 self.app.status(msg='Updating %(repo_name)s',
                                 repo_name=repo_name)
-                source.repo.update()
+                with tracer.span('update-repo', repo=repo_name):
+                    source.repo.update()
         else:
             self.app.status(msg='Cloning %(repo_name)s',
                             repo_name=repo_name)
-            source.repo = self.lrc.cache_repo(repo_name)
+            with tracer.span('clone-repo', repo=repo_name):
+                source.repo = self.lrc.cache_repo(repo_name)
 
         # Update submodules.
         done = set()
-        self.app.cache_repo_and_submodules(
-            self.lrc, source.repo.url,
-            source.sha1, done)
+        with tracer.span('update-submodules', repo=repo_name):
+            self.app.cache_repo_and_submodules(
+                self.lrc, source.repo.url,
+                source.sha1, done)
 
     def cache_artifacts_locally(self, artifacts):
-        '''Get artifacts missing from local cache from remote cache.'''
+        '''Get artifacts missing from local cache from remote cache.
 
-        def fetch_files(to_fetch):
-            '''Fetch a set of files atomically.
+        The remote cache is asked which of the missing files it has in one
+        request, and then they are downloaded over several connections at
+        once. The files of each source are fetched atomically: if any of
+        them cannot be fetched, none of them are kept, to ensure integrity
+        of the local cache.
 
-            If an error occurs during the transfer of any files, all downloaded
-            data is deleted, to ensure integrity of the local cache.
-
-            '''
-            try:
-                for remote, local in to_fetch:
-                    shutil.copyfileobj(remote, local)
-            except BaseException:
-                for remote, local in to_fetch:
-                    local.abort()
-                raise
-            else:
-                for remote, local in to_fetch:
-                    remote.close()
-                    local.close()
+        '''
 
+        groups = []
+        group_artifacts = []
+        group_for_source = {}
         for artifact in artifacts:
-            # This block should fetch all artifact files in one go, using the
-            # 1.0/artifacts method of morph-cache-server. The code to do that
-            # needs bringing in from the distbuild.worker_build_connection
-            # module into morphlib.remoteartififactcache first.
             to_fetch = []
             if not self.lac.has(artifact):
-                to_fetch.append((self.rac.get(artifact),
-                                 self.lac.put(artifact)))
+                to_fetch.append((artifact.basename(),
+                                 functools.partial(self.lac.put, artifact)))
 
             if artifact.source.morphology.needs_artifact_metadata_cached:
                 if not self.lac.has_artifact_metadata(artifact, 'meta'):
                     to_fetch.append((
-                        self.rac.get_artifact_metadata(artifact, 'meta'),
-                        self.lac.put_artifact_metadata(artifact, 'meta')))
+                        artifact.metadata_basename('meta'),
+                        functools.partial(self.lac.put_artifact_metadata,
+                                          artifact, 'meta')))
 
             if len(to_fetch) > 0:
-                self.app.status(
-                    msg='Fetching to local cache: artifact %(name)s',
-                    name=artifact.name)
-                fetch_files(to_fetch)
+                if artifact.source not in group_for_source:
+                    group_for_source[artifact.source] = len(groups)
+                    groups.append([])
+                    group_artifacts.append([])
+                index = group_for_source[artifact.source]
+                groups[index].extend(to_fetch)
+                group_artifacts[index].append(artifact)
+
+        if not groups:
+            return
+
+        present = self.rac.has_files(
+            filename for group in groups for filename, open_local in group)
+        unavailable = []
+        wanted = []
+        first_artifact = {}
+        for group, group_artifact_list in zip(groups, group_artifacts):
+            first_artifact[id(group)] = group_artifact_list[0]
+            if all(filename in present for filename, open_local in group):
+                wanted.append(group)
+                for artifact in group_artifact_list:
+                    self.app.status(
+                        msg='Fetching to local cache: artifact %(name)s',
+                        name=artifact.name, chatty=True)
+            else:
+                unavailable.append(group)
+
+        if wanted:
+            self.app.status(msg='Fetching %(count)d files to local cache',
+                            count=sum(len(group) for group in wanted))
+            starttime = datetime.datetime.now()
+            size, failed = self.rac.fetch_files(
+                wanted, self.app.settings['artifact-fetch-connections'])
+            td = datetime.datetime.now() - starttime
+            seconds = max(td.total_seconds(), 0.001)
+            self.app.status(msg='Fetched %(size).1f MiB in %(seconds).1f s '
+                                '(%(rate).1f MiB/s)',
+                            size=size / 1024.0**2, seconds=seconds,
+                            rate=size / 1024.0**2 / seconds)
+            unavailable.extend(failed)
+
+        if unavailable:
+            raise morphlib.remoteartifactcache.GetError(
+                self.rac, first_artifact[id(unavailable[0])])
 
     def create_staging_area(self, build_env, use_chroot=True, extra_env={},
                             extra_path=[]):
@@ -471,7 +713,16 @@ class BuildCommand(object):
         self.app.status(msg='Creating staging area')
         staging_dir = tempfile.mkdtemp(
             dir=os.path.join(self.app.settings['tempdir'], 'staging'))
-        staging_area = morphlib.stagingarea.StagingArea(
+        staging_area_class = morphlib.stagingarea.StagingArea
+        if (self.app.settings['staging-area-backend'] == 'overlay' and
+                use_chroot):
+            if morphlib.stagingarea.OverlayStagingArea.is_supported():
+                staging_area_class = morphlib.stagingarea.OverlayStagingArea
+            else:
+                self.app.status(msg='Overlay filesystems are not supported, '
+                                    'using a hardlinked staging area',
+                                chatty=True)
+        staging_area = staging_area_class(
             self.app, staging_dir, build_env, use_chroot, extra_env,
             extra_path)
         return staging_area
@@ -494,15 +745,11 @@ class BuildCommand(object):
         that belong to sources which have the same morphology.
 
         '''
-        def dependent_stratum_morphs(source):
-            dependents = set(itertools.chain.from_iterable(
-                a.dependents for a in source.artifacts.itervalues()))
-            dependent_strata = set(s for s in dependents
-                                   if s.morphology['kind'] == 'stratum')
-            return set(s.morphology for s in dependent_strata)
-        return dependent_stratum_morphs(s1) == dependent_stratum_morphs(s2)
-
-    def install_dependencies(self, staging_area, artifacts, target_source):
+        graph = self.artifact_graph(self._indexed(s2.artifacts.values()))
+        return graph.in_same_stratum(s1, s2)
+
+    def install_dependencies(self, staging_area, artifacts, target_source,
+                             tracer=None):
         '''Install chunk artifacts into staging area.
 
         We only ever care about chunk artifacts as build dependencies,
@@ -513,32 +760,116 @@ class BuildCommand(object):
 
         '''
 
+        tracer = tracer or morphlib.tracing.NullTracer()
+        chunks = []
         for artifact in artifacts:
             if artifact.source.morphology['kind'] != 'chunk':
                 continue
             if artifact.source.build_mode == 'bootstrap':
-               if not self.in_same_stratum(artifact.source, target_source):
+               if not self.in_same_stratum(artifact.source,
+                                           target_source):
                     continue
-            self.app.status(
-                msg='Installing chunk %(chunk_name)s from cache %(cache)s',
-                chunk_name=artifact.name,
-                cache=artifact.source.cache_key[:7],
-                chatty=True)
-            handle = self.lac.get(artifact)
-            staging_area.install_artifact(handle)
-
-        if target_source.build_mode == 'staging':
-            morphlib.builder.ldconfig(self.app.runcmd, staging_area.dirname)
-
-    def build_and_cache(self, staging_area, source, setup_mounts):
+            chunks.append(artifact)
+
+        pool = self.staging_pool(staging_area, target_source)
+        if pool is not None:
+            self.install_from_staging_pool(pool, staging_area, chunks,
+                                           tracer)
+            return
+
+        with tracer.span('install-dependencies') as totals:
+            totals['chunks'] = 0
+            totals['bytes'] = 0
+            for artifact in chunks:
+                self.app.status(
+                    msg='Installing chunk %(chunk_name)s from cache '
+                        '%(cache)s',
+                    chunk_name=artifact.name,
+                    cache=artifact.source.cache_key[:7],
+                    chatty=True)
+                with tracer.span('install-chunk',
+                                 chunk=artifact.name) as args:
+                    handle = self.lac.get(artifact)
+                    args['bytes'] = os.fstat(handle.fileno()).st_size
+                    staging_area.install_artifact(handle)
+                totals['chunks'] += 1
+                totals['bytes'] += args['bytes']
+
+            if target_source.build_mode == 'staging':
+                with tracer.span('ldconfig'):
+                    staging_area.ldconfig()
+
+    def staging_pool(self, staging_area, target_source):
+        '''Return the pool of staging roots to use, or None.
+
+        Only staging areas for chroot builds that hardlink their chunks
+        are kept in the pool.
+
+        '''
+
+        max_roots = self.app.settings['staging-pool-max-roots']
+        if (max_roots <= 0 or target_source.build_mode != 'staging' or
+                type(staging_area) is not morphlib.stagingarea.StagingArea):
+            return None
+        return morphlib.stagingpool.StagingPool(
+            os.path.join(self.app.settings['tempdir'], 'staging-pool'),
+            self.app.runcmd, max_roots,
+            self.app.settings['staging-pool-max-size'],
+            status_cb=self.app.status)
+
+    def install_from_staging_pool(self, pool, staging_area, chunks, tracer):
+        '''Install chunks by changing a copy of a root from the pool.
+
+        If there is no root in the pool close enough to the chunks, they
+        are installed one by one as usual. Either way, the result is kept
+        in the pool for the next build.
+
+        '''
+
+        store = staging_area.chunk_store()
+        by_basename = dict((a.basename(), a) for a in chunks)
+        basenames = [a.basename() for a in chunks]
+
+        def unpack(basename):
+            with self.lac.get(by_basename[basename]) as handle:
+                return store.unpacked(handle)
+
+        with tracer.span('install-dependencies',
+                         chunks=len(chunks)) as args:
+            result = pool.install(basenames, staging_area.dirname, unpack)
+            if result is None:
+                for artifact in chunks:
+                    with self.lac.get(artifact) as handle:
+                        staging_area.install_artifact(handle)
+                manifests = dict((b, store.manifest(b)) for b in basenames)
+                run_ldconfig = True
+            else:
+                args.update(root=result['root'], added=result['added'],
+                            removed=result['removed'])
+                manifests = result['manifests']
+                run_ldconfig = result['ldconfig']
+
+            if run_ldconfig:
+                with tracer.span('ldconfig'):
+                    staging_area.ldconfig()
+            args['ldconfig'] = run_ldconfig
+
+        if all(m is not None for m in manifests.itervalues()):
+            with tracer.span('add-staging-root'):
+                pool.add(staging_area.dirname, basenames, manifests)
+
+    def build_and_cache(self, staging_area, source, setup_mounts,
+                        max_jobs=None, tracer=None):
         '''Build a source and put its artifacts into the local cache.'''
 
         self.app.status(msg='Starting actual build: %(name)s '
                             '%(sha1)s',
                         name=source.name, sha1=source.sha1[:7])
+        if max_jobs is None:
+            max_jobs = self.app.settings['max-jobs']
         builder = morphlib.builder.Builder(
             self.app, staging_area, self.lac, self.rac, self.lrc,
-            self.app.settings['max-jobs'], setup_mounts)
+            max_jobs, setup_mounts, tracer)
         return builder.build_and_cache(source)
 
 class InitiatorBuildCommand(BuildCommand):
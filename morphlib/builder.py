@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2015  Codethink Limited
+# Copyright (C) 2012-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -17,10 +17,12 @@
 from collections import defaultdict
 import datetime
 import errno
+import functools
 import json
 import logging
 import os
 from os.path import relpath
+import re
 import shutil
 import stat
 import tarfile
@@ -39,16 +41,49 @@ import morphlib.gitversion
 
 SYSTEM_INTEGRATION_PATH = os.path.join('baserock', 'system-integration')
 
-def extract_sources(app, repo_cache, repo, sha1, srcdir): #pragma: no cover
-    '''Get sources from git to a source directory, including submodules'''
+def needs_git_repository(repo, sha1):  # pragma: no cover
+    '''Guess whether building a commit needs the git repository.
+
+    Some projects work out their version from git when they are built,
+    and git-fat stores the real contents of large files outside the
+    tree. These are only known to work when the sources are a real
+    checkout, with the history, so they are not exported.
+
+    '''
+
+    toplevel = repo.list_files(ref=sha1, recurse=False)
+    if '.gitfat' in toplevel or 'git-version-gen' in toplevel:
+        return True
+    try:
+        repo.read_file('build-aux/git-version-gen', sha1)
+    except IOError:
+        return False
+    return True
+
+def extract_sources(app, repo_cache, repo, sha1, srcdir,
+                    export=False): #pragma: no cover
+    '''Get sources from git to a source directory, including submodules
+
+    With export, only the files of each commit are written, unless the
+    repository looks like it needs its history to build. Otherwise the
+    whole repository is copied and the commit checked out in it.
+
+    '''
+
+    now = time.time()
+    copied = []
 
     def extract_repo(repo, sha1, destdir):
         app.status(msg='Extracting %(source)s into %(target)s',
                    source=repo.original_name,
                    target=destdir)
 
-        repo.checkout(sha1, destdir)
-        morphlib.git.reset_workdir(app.runcmd, destdir)
+        if export and not needs_git_repository(repo, sha1):
+            repo.export(sha1, destdir, now)
+        else:
+            repo.checkout(sha1, destdir)
+            morphlib.git.reset_workdir(app.runcmd, destdir)
+            copied.append(destdir)
         submodules = morphlib.git.Submodules(app, repo.path, sha1)
         try:
             submodules.load()
@@ -66,7 +101,9 @@ def extract_sources(app, repo_cache, repo, sha1, srcdir): #pragma: no cover
     while todo:
         repo, sha1, srcdir = todo.pop()
         todo += extract_repo(repo, sha1, srcdir)
-    set_mtime_recursively(srcdir)
+    # Exported files already have their times set.
+    if copied:
+        set_mtime_recursively(srcdir)
 
 def set_mtime_recursively(root):  # pragma: no cover
     '''Set the mtime for every file in a directory tree to the same.
@@ -128,30 +165,53 @@ def ldconfig(runcmd, rootdir):  # pragma: no cover
 
 
 def download_depends(constituents, lac, rac, metadatas=None):
+    '''Download the constituents missing from the local artifact cache.
+
+    The named metadata of the constituents is downloaded too, if the
+    remote cache has it. The remote cache is asked about all of the
+    metadata at once, and everything is fetched over one connection.
+
+    '''
+
+    groups = []
+    errors = {}
+    optional = []
     for constituent in constituents:
         if not lac.has(constituent):
-            source = rac.get(constituent)
-            target = lac.put(constituent)
-            shutil.copyfileobj(source, target)
-            target.close()
-            source.close()
-        if metadatas is not None:
-            for metadata in metadatas:
-                if not lac.has_artifact_metadata(constituent, metadata):
-                    if rac.has_artifact_metadata(constituent, metadata):
-                        src = rac.get_artifact_metadata(constituent, metadata)
-                        dst = lac.put_artifact_metadata(constituent, metadata)
-                        shutil.copyfileobj(src, dst)
-                        dst.close()
-                        src.close()
+            group = [(constituent.basename(),
+                      functools.partial(lac.put, constituent))]
+            groups.append(group)
+            errors[id(group)] = functools.partial(
+                morphlib.remoteartifactcache.GetError, rac, constituent)
+        for metadata in metadatas or ():
+            if not lac.has_artifact_metadata(constituent, metadata):
+                optional.append((constituent, metadata))
+    if optional:
+        present = rac.has_files(constituent.metadata_basename(metadata)
+                                for constituent, metadata in optional)
+        for constituent, metadata in optional:
+            filename = constituent.metadata_basename(metadata)
+            if filename in present:
+                group = [(filename,
+                          functools.partial(lac.put_artifact_metadata,
+                                            constituent, metadata))]
+                groups.append(group)
+                errors[id(group)] = functools.partial(
+                    morphlib.remoteartifactcache.GetArtifactMetadataError,
+                    rac, constituent, metadata)
+    if not groups:
+        return
+
+    size, failed = rac.fetch_files(groups)
+    if failed:
+        raise errors[id(failed[0])]()
 
 
 def get_chunk_files(f):  # pragma: no cover
-    tar = tarfile.open(fileobj=f)
-    for member in tar.getmembers():
-        if member.type is not tarfile.DIRTYPE:
-            yield member.name
-    tar.close()
+    with morphlib.bins.chunk_reader(f) as tar:
+        for member in tar:
+            if member.type is not tarfile.DIRTYPE:
+                yield member.name
 
 
 def get_stratum_files(f, lac):  # pragma: no cover
@@ -169,7 +229,7 @@ class BuilderBase(object):
 
     def __init__(self, app, staging_area, local_artifact_cache,
                  remote_artifact_cache, source, repo_cache, max_jobs,
-                 setup_mounts):
+                 setup_mounts, tracer=None):
         self.app = app
         self.staging_area = staging_area
         self.local_artifact_cache = local_artifact_cache
@@ -177,14 +237,21 @@ class BuilderBase(object):
         self.source = source
         self.repo_cache = repo_cache
         self.max_jobs = max_jobs
-        self.build_watch = morphlib.stopwatch.Stopwatch()
+        self.tracer = tracer or morphlib.tracing.NullTracer()
+        self.build_watch = morphlib.stopwatch.Stopwatch(tracer)
         self.setup_mounts = setup_mounts
+        self.assembly_stats = {}
 
     def save_build_times(self):
         '''Write the times captured by the stopwatch'''
         meta = {
             'build-times': {}
         }
+        if self.source.morphology['kind'] == 'chunk':
+            meta['artifact-compression'] = \
+                self.app.settings['artifact-compression']
+        if self.assembly_stats:
+            meta['system-assembly'] = self.assembly_stats
         for stage in self.build_watch.ticks.iterkeys():
             meta['build-times'][stage] = {
                 'start': '%s' % self.build_watch.start_time(stage),
@@ -268,6 +335,8 @@ class ChunkBuilder(BuilderBase):
 
     '''Build chunk artifacts.'''
 
+    git_command_pattern = re.compile(r'\bgit\b')
+
     def create_devices(self, destdir): # pragma: no cover
         '''Creates device nodes if the morphology specifies them'''
         morphology = self.source.morphology
@@ -306,11 +375,13 @@ class ChunkBuilder(BuilderBase):
             _, temppath = tempfile.mkstemp(dir=os.path.dirname(logpath))
 
             try:
-                self.get_sources(builddir)
+                with self.tracer.span('extract-sources'):
+                    self.get_sources(builddir)
                 self.run_commands(builddir, destdir, temppath, stdout)
                 self.create_devices(destdir)
 
                 os.rename(temppath, logpath)
+                cache.record_file(logpath)
             except BaseException, e:
                 logging.error('Caught exception: %s' % str(e))
                 logging.info('Cleaning up staging area')
@@ -322,6 +393,7 @@ class ChunkBuilder(BuilderBase):
                                           line.rstrip('\n'))
 
                     os.rename(temppath, logpath)
+                    cache.record_file(logpath)
                 else:
                     logging.error("Couldn't find build log at %s", temppath)
 
@@ -387,13 +459,16 @@ class ChunkBuilder(BuilderBase):
                         if stdout:
                             stdout.flush()
 
-                        self.runcmd(['sh', '-c', cmd],
-                                    extra_env=extra_env,
-                                    cwd=relative_builddir,
-                                    stdout=stdout or subprocess.PIPE,
-                                    stderr=subprocess.STDOUT,
-                                    logfile=logfilepath,
-                                    ccache_dir=ccache_dir)
+                        with self.tracer.span('%s-command' % step,
+                                              category='command',
+                                              command=cmd):
+                            self.runcmd(['sh', '-c', cmd],
+                                        extra_env=extra_env,
+                                        cwd=relative_builddir,
+                                        stdout=stdout or subprocess.PIPE,
+                                        stderr=subprocess.STDOUT,
+                                        logfile=logfilepath,
+                                        ccache_dir=ccache_dir)
 
                         if stdout:
                             stdout.flush()
@@ -436,69 +511,110 @@ class ChunkBuilder(BuilderBase):
         return scripts_created
 
     def assemble_chunk_artifacts(self, destdir):  # pragma: no cover
-        built_artifacts = []
-        filenames = []
+        '''Write every chunk artifact of the source from destdir.
+
+        destdir is walked once, and each file is sent to the artifact
+        its split rules match as it is found. The artifacts are written
+        at the same time, each in its own thread, and the metadata of
+        each goes in last, once its contents are known. destdir is then
+        removed in one go.
+
+        '''
+
         source = self.source
         split_rules = source.split_rules
         morphology = source.morphology
         sys_tag = 'system-integration'
+        system_integration = morphology.get(sys_tag) or {}
 
         def filepaths(destdir):
             for dirname, subdirs, basenames in os.walk(destdir):
+                # Sort, so the artifacts are the same every time.
+                subdirs.sort()
                 subdirsymlinks = [os.path.join(dirname, x) for x in subdirs
                                   if os.path.islink(os.path.join(dirname, x))]
-                filenames = [os.path.join(dirname, x) for x in basenames]
+                filenames = [os.path.join(dirname, x)
+                             for x in sorted(basenames)]
                 for relpath in (os.path.relpath(x, destdir) for x in
                                 [dirname] + subdirsymlinks + filenames):
                     yield relpath
 
-        with self.build_watch('determine-splits'):
-            matches, overlaps, unmatched = \
-                split_rules.partition(filepaths(destdir))
-
-        system_integration = morphology.get(sys_tag) or {}
-
-        with self.build_watch('create-chunks'):
-            for chunk_artifact_name, chunk_artifact \
-                in source.artifacts.iteritems():
-                file_paths = matches[chunk_artifact_name]
-                chunk_artifact = source.artifacts[chunk_artifact_name]
-
-                def all_parents(path):
-                    while path != '':
-                        yield path
-                        path = os.path.dirname(path)
-
-                def parentify(filenames):
-                    names = set()
-                    for name in filenames:
-                        names.update(all_parents(name))
-                    return sorted(names)
-
-                extra_files = self.write_system_integration_commands(
-                                  destdir, system_integration,
-                                  chunk_artifact_name)
-                extra_files += ['baserock/%s.meta' % chunk_artifact_name]
-                parented_paths = parentify(file_paths + extra_files)
-
-                with self.local_artifact_cache.put(chunk_artifact) as f:
-                    self.write_metadata(destdir, chunk_artifact_name,
-                                        parented_paths)
+        built_artifacts = source.artifacts.values()
+        files = {}
+        try:
+            for chunk_artifact in built_artifacts:
+                files[chunk_artifact.name] = \
+                    self.local_artifact_cache.put(chunk_artifact)
+            writers = morphlib.bins.ChunkWriters(
+                destdir, files,
+                compression=self.app.settings['artifact-compression'])
+        except BaseException:
+            for f in files.itervalues():
+                f.abort()
+            raise
 
+        try:
+            with self.build_watch('create-chunks'):
+                unmatched = []
+                for relpath in filepaths(destdir):
+                    chunk_artifact_name = split_rules.first_match(relpath)
+                    if chunk_artifact_name is not None:
+                        writers.add(chunk_artifact_name, relpath)
+                    elif not os.path.isdir(os.path.join(destdir, relpath)):
+                        unmatched.append(relpath)
+                if unmatched:
+                    raise Exception('DESTDIR %s has files in no artifact: %s'
+                                    % (destdir, unmatched))
+
+                for chunk_artifact in built_artifacts:
+                    chunk_artifact_name = chunk_artifact.name
                     self.app.status(msg='Creating chunk artifact %(name)s',
                                     name=chunk_artifact_name)
-                    morphlib.bins.create_chunk(destdir, f, parented_paths)
-                built_artifacts.append(chunk_artifact)
+                    extra_files = self.write_system_integration_commands(
+                                      destdir, system_integration,
+                                      chunk_artifact_name)
+                    for relpath in extra_files:
+                        writers.add(chunk_artifact_name, relpath)
+                    meta = 'baserock/%s.meta' % chunk_artifact_name
+                    self.write_metadata(
+                        destdir, chunk_artifact_name,
+                        writers.contents(chunk_artifact_name, [meta]))
+                    writers.add(chunk_artifact_name, meta)
+                writers.close()
+        except BaseException:
+            writers.abort()
+            for f in files.itervalues():
+                f.abort()
+            raise
+        for f in files.itervalues():
+            f.close()
 
-        for dirname, subdirs, files in os.walk(destdir):
-            if files:
-                raise Exception('DESTDIR %s is not empty: %s' %
-                                (destdir, files))
+        shutil.rmtree(destdir)
+        os.mkdir(destdir)
         return built_artifacts
 
     def get_sources(self, srcdir):  # pragma: no cover
         s = self.source
-        extract_sources(self.app, self.repo_cache, s.repo, s.sha1, srcdir)
+        export = self.app.settings['source-extraction'] == 'export'
+        if export and self.commands_use_git():
+            self.app.status(msg='Copying %(repo)s, since the commands of '
+                                '%(name)s run git',
+                            repo=s.repo_name, name=s.name, chatty=True)
+            export = False
+        extract_sources(self.app, self.repo_cache, s.repo, s.sha1, srcdir,
+                        export=export)
+
+    def commands_use_git(self):  # pragma: no cover
+        '''Whether any build command of the chunk mentions git.'''
+
+        m = self.source.morphology
+        for key in m.keys():
+            if not key.endswith('-commands') or not m[key]:
+                continue
+            for cmd in m[key]:
+                if self.git_command_pattern.search(cmd):
+                    return True
+        return False
 
 
 class StratumBuilder(BuilderBase):
@@ -517,11 +633,10 @@ class StratumBuilder(BuilderBase):
             # the only reason the StratumBuilder has to download chunks is to
             # check for overlap now that strata are lists of chunks
             with self.build_watch('check-chunks'):
-                for a_name, a in self.source.artifacts.iteritems():
-                    # download the chunk artifact if necessary
-                    download_depends(constituents,
-                                     self.local_artifact_cache,
-                                     self.remote_artifact_cache)
+                # download the chunk artifacts if necessary
+                download_depends(constituents,
+                                 self.local_artifact_cache,
+                                 self.remote_artifact_cache)
 
             with self.build_watch('create-chunk-list'):
                 lac = self.local_artifact_cache
@@ -558,21 +673,10 @@ class SystemBuilder(BuilderBase):  # pragma: no cover
 
                 try:
                     fs_root = self.staging_area.destdir(self.source)
-                    self.unpack_strata(fs_root)
-                    self.write_metadata(fs_root, a_name)
-                    self.run_system_integration_commands(fs_root)
-                    unslashy_root = fs_root[1:]
-                    def uproot_info(info):
-                        info.name = relpath(info.name, unslashy_root)
-                        if info.islnk():
-                            info.linkname = relpath(info.linkname,
-                                                    unslashy_root)
-                        return info
-                    tar = tarfile.open(fileobj=handle, mode="w", name=a_name)
-                    self.app.status(msg='Constructing tarball of rootfs',
-                                    chatty=True)
-                    tar.add(fs_root, recursive=True, filter=uproot_info)
-                    tar.close()
+                    if self.app.settings['system-assembly'] == 'stream':
+                        self.assemble_streaming(fs_root, a_name, handle)
+                    else:
+                        self.assemble_unpacked(fs_root, a_name, handle)
                 except BaseException as e:
                     logging.error(traceback.format_exc())
                     self.app.status(msg='Error while building system',
@@ -585,52 +689,176 @@ class SystemBuilder(BuilderBase):  # pragma: no cover
         self.save_build_times()
         return self.source.artifacts.itervalues()
 
+    def assemble_unpacked(self, fs_root, a_name, handle):
+        '''Unpack the strata into fs_root and write it out.'''
+
+        self.unpack_strata(fs_root)
+        self.write_metadata(fs_root, a_name)
+        self.run_system_integration_commands(fs_root)
+        self.write_rootfs_tarball(fs_root, a_name, handle)
+
+    def write_rootfs_tarball(self, fs_root, a_name, handle):
+        '''Write the tree at fs_root out as the system tarball.'''
+
+        unslashy_root = fs_root[1:]
+        def uproot_info(info):
+            info.name = relpath(info.name, unslashy_root)
+            if info.islnk():
+                info.linkname = relpath(info.linkname, unslashy_root)
+            return info
+        tar = tarfile.open(fileobj=handle, mode="w", name=a_name)
+        self.app.status(msg='Constructing tarball of rootfs', chatty=True)
+        tar.add(fs_root, recursive=True, filter=uproot_info)
+        tar.close()
+
+    def stratum_chunks(self, stratum_artifact):
+        '''Return the chunks of a stratum, in the order to unpack them.'''
+
+        with self.local_artifact_cache.get(stratum_artifact) as stratum_file:
+            artifact_list = json.load(stratum_file, encoding='unicode-escape')
+        return [ArtifactCacheReference(a) for a in artifact_list]
+
     def unpack_one_stratum(self, stratum_artifact, target):
         '''Unpack a single stratum into a target directory'''
 
         cache = self.local_artifact_cache
-        with cache.get(stratum_artifact) as stratum_file:
-            artifact_list = json.load(stratum_file, encoding='unicode-escape')
-            for chunk in (ArtifactCacheReference(a) for a in artifact_list):
-                self.app.status(msg='Unpacking chunk %(basename)s',
-                                basename=chunk.basename(), chatty=True)
-                with cache.get(chunk) as chunk_file:
-                    morphlib.bins.unpack_binary_from_file(chunk_file, target)
+        for chunk in self.stratum_chunks(stratum_artifact):
+            self.app.status(msg='Unpacking chunk %(basename)s',
+                            basename=chunk.basename(), chatty=True)
+            with cache.get(chunk) as chunk_file:
+                morphlib.bins.unpack_binary_from_file(chunk_file, target)
+
+        self.copy_stratum_metadata(stratum_artifact, target)
 
+    def copy_stratum_metadata(self, stratum_artifact, target):
+        cache = self.local_artifact_cache
         target_metadata = os.path.join(
                 target, 'baserock', '%s.meta' % stratum_artifact.name)
         with cache.get_artifact_metadata(stratum_artifact, 'meta') as meta_src:
             with morphlib.savefile.SaveFile(target_metadata, 'w') as meta_dst:
                 shutil.copyfileobj(meta_src, meta_dst)
 
+    def download_strata(self):
+        '''Download the strata and their chunks, if necessary.'''
+
+        # download the stratum artifacts if necessary
+        download_depends(self.source.dependencies,
+                         self.local_artifact_cache,
+                         self.remote_artifact_cache,
+                         ('meta',))
+
+        # download the chunk artifacts of all the strata if necessary
+        chunks = []
+        for stratum_artifact in self.source.dependencies:
+            chunks.extend(self.stratum_chunks(stratum_artifact))
+        download_depends(chunks,
+                         self.local_artifact_cache,
+                         self.remote_artifact_cache)
+
     def unpack_strata(self, path):
         '''Unpack strata into a directory.'''
 
         self.app.status(msg='Unpacking strata to %(path)s',
                         path=path, chatty=True)
         with self.build_watch('unpack-strata'):
-            for a_name, a in self.source.artifacts.iteritems():
-                # download the stratum artifacts if necessary
-                download_depends(self.source.dependencies,
-                                 self.local_artifact_cache,
-                                 self.remote_artifact_cache,
-                                 ('meta',))
+            self.download_strata()
 
-                # download the chunk artifacts if necessary
-                for stratum_artifact in self.source.dependencies:
-                    f = self.local_artifact_cache.get(stratum_artifact)
-                    chunks = [ArtifactCacheReference(c) for c in json.load(f)]
-                    download_depends(chunks,
-                                     self.local_artifact_cache,
-                                     self.remote_artifact_cache)
-                    f.close()
-
-                # unpack it from the local artifact cache
-                for stratum_artifact in self.source.dependencies:
-                    self.unpack_one_stratum(stratum_artifact, path)
+            # unpack it from the local artifact cache
+            for stratum_artifact in self.source.dependencies:
+                self.unpack_one_stratum(stratum_artifact, path)
 
             ldconfig(self.app.runcmd, path)
 
+    def assemble_streaming(self, fs_root, a_name, handle):
+        '''Write the system tarball mostly straight from the chunks.
+
+        The chunks are hardlinked into fs_root from the store of unpacked
+        chunks, so that the metadata can be written and the system
+        integration commands run there. Only what is changed in fs_root
+        is then read back; everything else is copied from the chunks.
+
+        If the chunks cannot be copied like that, because they replace
+        each other's directories, for example, the strata are unpacked
+        and written out as usual. So they are if overlay filesystems are
+        not supported, since the system integration commands must not
+        change the linked files, which are shared with the store.
+
+        '''
+
+        if not morphlib.stagingarea.OverlayStagingArea.is_supported():
+            self.app.status(msg='Overlay filesystems are not supported, '
+                                'unpacking strata instead')
+            self.assemble_unpacked(fs_root, a_name, handle)
+            return
+
+        with self.build_watch('download-strata'):
+            self.download_strata()
+        chunks = []
+        for stratum_artifact in self.source.dependencies:
+            chunks.extend(self.stratum_chunks(stratum_artifact))
+        assembler = morphlib.systemassembly.StreamingAssembler(
+            self.local_artifact_cache, chunks)
+
+        self.app.status(msg='Indexing %(count)d chunks', count=len(chunks),
+                        chatty=True)
+        try:
+            with self.build_watch('index-chunks'):
+                index = assembler.index()
+        except morphlib.systemassembly.CannotStreamError as e:
+            self.app.status(msg='%(reason)s, unpacking strata instead',
+                            reason=str(e))
+            self.assemble_unpacked(fs_root, a_name, handle)
+            return
+        self.report_assembly('index-chunks', assembler.bytes_read, 0)
+
+        self.app.status(msg='Linking chunks into %(path)s', path=fs_root,
+                        chatty=True)
+        with self.build_watch('link-chunks'):
+            store = self.staging_area.chunk_store()
+            for chunk in chunks:
+                with self.local_artifact_cache.get(chunk) as chunk_file:
+                    store.install(chunk_file, fs_root)
+            before = morphlib.systemassembly.snapshot(fs_root)
+        self.report_assembly('link-chunks', 0, 0)
+
+        with self.build_watch('integrate-system'):
+            for stratum_artifact in self.source.dependencies:
+                self.copy_stratum_metadata(stratum_artifact, fs_root)
+            ldconfig(self.app.runcmd, fs_root)
+            self.write_metadata(fs_root, a_name)
+            self.run_system_integration_commands_on_overlay(fs_root)
+            after = morphlib.systemassembly.snapshot(fs_root)
+        self.report_assembly('integrate-system', 0, 0)
+
+        with self.build_watch('write-tarball'):
+            try:
+                changed, removed = assembler.check(index, before, after)
+            except morphlib.systemassembly.CannotStreamError as e:
+                self.app.status(msg='%(reason)s, writing %(path)s instead',
+                                reason=str(e), path=fs_root)
+                self.write_rootfs_tarball(fs_root, a_name, handle)
+                return
+            self.app.status(msg='Writing system tarball from chunks, '
+                                'with %(count)d changed files',
+                            count=len(changed), chatty=True)
+            assembler.bytes_read = 0
+            assembler.write(handle, a_name, index, fs_root,
+                            changed, removed, after)
+        self.report_assembly('write-tarball', assembler.bytes_read,
+                             assembler.bytes_written)
+
+    def report_assembly(self, phase, bytes_read, bytes_written):
+        seconds = self.build_watch.start_stop_seconds(phase)
+        self.assembly_stats[phase] = {
+            'bytes-read': bytes_read,
+            'bytes-written': bytes_written,
+            'seconds': '%.4f' % seconds,
+        }
+        self.app.status(msg='%(phase)s: read %(read)d bytes, wrote '
+                            '%(written)d bytes in %(seconds).1f seconds',
+                        phase=phase, read=bytes_read, written=bytes_written,
+                        seconds=seconds)
+
     def write_metadata(self, instdir, artifact_name):
         BuilderBase.write_metadata(self, instdir, artifact_name)
 
@@ -647,8 +875,48 @@ class SystemBuilder(BuilderBase):  # pragma: no cover
 
         os.chmod(os_release_file, 0644)
 
-    def run_system_integration_commands(self, rootdir):  # pragma: no cover
-        ''' Run the system integration commands '''
+    def run_system_integration_commands_on_overlay(
+            self, rootdir):  # pragma: no cover
+        '''Run the system integration commands without writing to rootdir.
+
+        The commands run on an overlay filesystem with rootdir as its
+        lower layer, and what they change is then moved from the upper
+        layer into rootdir, replacing its files rather than writing to
+        them.
+
+        '''
+
+        sys_integration_dir = os.path.join(rootdir, SYSTEM_INTEGRATION_PATH)
+        if not os.path.isdir(sys_integration_dir):
+            return
+
+        # The upper layer must be on the same file system as rootdir, so
+        # files can be moved from one to the other.
+        topdir = tempfile.mkdtemp(dir=os.path.dirname(rootdir))
+        try:
+            upper, work, root = [os.path.join(topdir, d)
+                                 for d in ('upper', 'work', 'root')]
+            for d in (upper, work, root):
+                os.mkdir(d)
+            options = 'lowerdir=%s,upperdir=%s,workdir=%s' % (
+                rootdir, upper, work)
+            self.run_system_integration_commands(
+                rootdir, container_root=root,
+                mounts=(('', 'overlay', 'overlay', options),))
+            morphlib.systemassembly.OverlayUpperLayer(upper).merge_into(
+                rootdir)
+        finally:
+            shutil.rmtree(topdir)
+
+    def run_system_integration_commands(self, rootdir, container_root=None,
+                                        mounts=()):  # pragma: no cover
+        '''Run the system integration commands
+
+        The commands are found in rootdir, and run in a chroot at
+        container_root, which defaults to rootdir, once the given mounts
+        are made in it.
+
+        '''
 
         sys_integration_dir = os.path.join(rootdir, SYSTEM_INTEGRATION_PATH)
         if not os.path.isdir(sys_integration_dir):
@@ -660,7 +928,7 @@ class SystemBuilder(BuilderBase):  # pragma: no cover
 
         self.app.status(msg='Running the system integration commands')
 
-        to_mount = (
+        to_mount = tuple(mounts) + (
             ('dev/shm', 'tmpfs', 'none'),
             ('tmp',     'tmpfs', 'none'),
         )
@@ -668,7 +936,8 @@ class SystemBuilder(BuilderBase):  # pragma: no cover
             for bin in sorted(os.listdir(sys_integration_dir)):
                 argv = [os.path.join(SYSTEM_INTEGRATION_PATH, bin)]
                 container_config = dict(
-                    root=rootdir, mounts=to_mount, mount_proc=True)
+                    root=container_root or rootdir, mounts=to_mount,
+                    mount_proc=True)
                 cmdline = morphlib.util.containerised_cmdline(
                     argv, **container_config)
                 exit, out, err = self.app.runcmd_unchecked(
@@ -696,7 +965,8 @@ class Builder(object):  # pragma: no cover
     }
 
     def __init__(self, app, staging_area, local_artifact_cache,
-                 remote_artifact_cache, repo_cache, max_jobs, setup_mounts):
+                 remote_artifact_cache, repo_cache, max_jobs, setup_mounts,
+                 tracer=None):
         self.app = app
         self.staging_area = staging_area
         self.local_artifact_cache = local_artifact_cache
@@ -704,6 +974,7 @@ class Builder(object):  # pragma: no cover
         self.repo_cache = repo_cache
         self.max_jobs = max_jobs
         self.setup_mounts = setup_mounts
+        self.tracer = tracer
 
     def build_and_cache(self, source):
         kind = source.morphology['kind']
@@ -711,7 +982,7 @@ class Builder(object):  # pragma: no cover
                                self.local_artifact_cache,
                                self.remote_artifact_cache, source,
                                self.repo_cache, self.max_jobs,
-                               self.setup_mounts)
+                               self.setup_mounts, self.tracer)
         self.app.status(msg='Builder.build: artifact %s with %s' %
                        (source.name, repr(o)),
                        chatty=True)
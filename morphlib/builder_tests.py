@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2015  Codethink Limited
+# Copyright (C) 2012-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -32,6 +32,7 @@ class FakeBuildSystem(object):
 class FakeApp(object):
     def __init__(self, runcmd=None):
         self.runcmd = runcmd
+        self.settings = {'artifact-compression': 'xz'}
 
 
 class FakeStagingArea(object):
@@ -50,6 +51,7 @@ class FakeSource(object):
             'description': 'c',
         }
         self.name = 'a'
+        self.cache_key = 'blahblah'
 
         with morphlib.gitdir_tests.allow_nonexistant_git_repos():
             self.repo = morphlib.cachedrepo.CachedRepo(
@@ -68,6 +70,12 @@ class FakeArtifact(object):
         self.cache_key = 'blahblah'
         self.cache_id = {}
 
+    def basename(self):
+        return '%s.%s' % (self.cache_key, self.name)
+
+    def metadata_basename(self, metadata_name):
+        return '%s.%s' % (self.basename(), metadata_name)
+
 
 class FakeBuildEnv(object):
 
@@ -135,6 +143,29 @@ class FakeArtifactCache(object):
     def has_source_metadata(self, source, cachekey, name):
         return (cachekey, name) in self._cached
 
+    def _files(self):
+        return dict(('.'.join(key), value)
+                    for key, value in self._cached.iteritems())
+
+    def has_files(self, filenames):
+        files = self._files()
+        return set(filename for filename in filenames if filename in files)
+
+    def fetch_files(self, groups):
+        self.fetched_groups = groups
+        files = self._files()
+        failed = []
+        size = 0
+        for group in groups:
+            if not all(filename in files for filename, open_local in group):
+                failed.append(group)
+                continue
+            for filename, open_local in group:
+                with open_local() as f:
+                    f.write(files[filename])
+                size += len(files[filename])
+        return size, failed
+
 
 class BuilderBaseTests(unittest.TestCase):
 
@@ -160,7 +191,7 @@ class BuilderBaseTests(unittest.TestCase):
                                                      self.staging_area,
                                                      self.artifact_cache,
                                                      None,
-                                                     self.artifact,
+                                                     self.artifact.source,
                                                      self.repo_cache,
                                                      self.max_jobs,
                                                      False)
@@ -187,6 +218,29 @@ class BuilderBaseTests(unittest.TestCase):
         self.assertEqual(sorted(events),
                          sorted(meta['build-times'].keys()))
 
+    def test_records_compression_of_chunks(self):
+        self.builder.save_build_times()
+        meta = json.load(self.artifact_cache.get_source_metadata(
+            self.artifact.source, self.artifact.cache_key, 'meta'))
+        self.assertFalse('artifact-compression' in meta)
+        self.artifact.source.morphology['kind'] = 'chunk'
+        self.builder.save_build_times()
+        meta = json.load(self.artifact_cache.get_source_metadata(
+            self.artifact.source, self.artifact.cache_key, 'meta'))
+        self.assertEqual(meta['artifact-compression'], 'xz')
+
+    def test_records_system_assembly_statistics(self):
+        self.builder.save_build_times()
+        meta = json.load(self.artifact_cache.get_source_metadata(
+            self.artifact.source, self.artifact.cache_key, 'meta'))
+        self.assertFalse('system-assembly' in meta)
+        stats = {'bytes-read': 3, 'bytes-written': 2, 'seconds': '0.0100'}
+        self.builder.assembly_stats['unpack'] = stats
+        self.builder.save_build_times()
+        meta = json.load(self.artifact_cache.get_source_metadata(
+            self.artifact.source, self.artifact.cache_key, 'meta'))
+        self.assertEqual(meta['system-assembly'], {'unpack': stats})
+
     def test_downloads_depends(self):
         lac = FakeArtifactCache()
         rac = FakeArtifactCache()
@@ -214,6 +268,50 @@ class BuilderBaseTests(unittest.TestCase):
         self.assertTrue(all(lac.has_artifact_metadata(a, 'meta')
                             for a in afacts))
 
+    def test_downloads_depends_in_one_batch(self):
+        lac = FakeArtifactCache()
+        rac = FakeArtifactCache()
+        afacts = [FakeArtifact(name) for name in ('a', 'b', 'c')]
+        for a in afacts:
+            with rac.put(a) as fh:
+                fh.write(a.name)
+        with rac.put_artifact_metadata(afacts[0], 'meta') as fh:
+            fh.write('metadata')
+        with lac.put(afacts[1]) as fh:
+            fh.write('b')
+        morphlib.builder.download_depends(afacts, lac, rac, ('meta',))
+        self.assertEqual(
+            sorted(filename for group in rac.fetched_groups
+                   for filename, open_local in group),
+            ['blahblah.a', 'blahblah.a.meta', 'blahblah.c'])
+        self.assertFalse(lac.has_artifact_metadata(afacts[1], 'meta'))
+
+    def test_does_not_need_remote_cache_for_cached_depends(self):
+        lac = FakeArtifactCache()
+        afacts = [FakeArtifact(name) for name in ('a', 'b')]
+        for a in afacts:
+            with lac.put(a) as fh:
+                fh.write(a.name)
+        morphlib.builder.download_depends(afacts, lac, None)
+
+    def test_fails_to_download_missing_depends(self):
+        lac = FakeArtifactCache()
+        rac = FakeArtifactCache()
+        self.assertRaises(morphlib.remoteartifactcache.GetError,
+                          morphlib.builder.download_depends,
+                          [FakeArtifact('a')], lac, rac)
+
+    def test_fails_to_download_metadata_that_vanished(self):
+        lac = FakeArtifactCache()
+        rac = FakeArtifactCache()
+        a = FakeArtifact('a')
+        with lac.put(a) as fh:
+            fh.write(a.name)
+        rac.has_files = lambda filenames: set(filenames)
+        self.assertRaises(
+            morphlib.remoteartifactcache.GetArtifactMetadataError,
+            morphlib.builder.download_depends, [a], lac, rac, ('meta',))
+
 
 class ChunkBuilderTests(unittest.TestCase):
 
@@ -0,0 +1,340 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Work out what a build would do, without doing it.
+
+Each source of a build is either in the local artifact cache, in the
+remote one, or has to be built. How long a build takes is estimated from
+how long earlier builds of the same sources took, which local builds and
+the distbuild controller both record in a build history file.
+
+'''
+
+
+import json
+import logging
+import threading
+import time
+
+import morphlib
+
+
+class BuildHistory(object):
+
+    '''Remember how long the build of each source took.
+
+    Durations are kept by the kind and name of the source, not its cache
+    key, since every change to a source gives it a new cache key but
+    seldom changes how long it takes to build. Only the latest duration
+    of each source is kept.
+
+    The history is kept in a JSON file, which several runs of morph and
+    the distbuild controller can share. Recorded durations are written
+    to it by ``save``, rather than each time one is recorded, since the
+    whole file is rewritten. If ``save_interval`` is given, ``record``
+    saves the history too once that many seconds have passed since it
+    was last saved, so that a long-running process that stops without
+    saving loses only the latest durations.
+
+    '''
+
+    format_version = 1
+
+    # Used by ``estimate`` for sources that have never been built, when
+    # nothing else has been built either.
+    default_seconds = 60.0
+
+    def __init__(self, filename, max_entries=10000, save_interval=None,
+                 clock=time.time):
+        self.filename = filename
+        self.save_interval = save_interval
+        self._store = morphlib.jsonstore.JsonStore(
+            filename, self.format_version, ['durations'], max_entries)
+        self._lock = threading.Lock()
+        self._default = None
+        self._clock = clock
+        self._saved = clock()
+        self._unsaved = False
+
+    @staticmethod
+    def _key(source):
+        return '%s:%s' % (source.morphology['kind'], source.name)
+
+    def record(self, source, seconds):
+        '''Remember that building source took seconds.'''
+
+        with self._lock:
+            self._store.put('durations', self._key(source), float(seconds))
+            self._default = None
+            self._unsaved = True
+            due = (self.save_interval is not None and
+                   self._clock() - self._saved >= self.save_interval)
+        if due:
+            self.save()
+
+    def save(self):
+        '''Write any new durations to the file, logging any failure.'''
+
+        with self._lock:
+            if not self._unsaved:
+                return
+            try:
+                self._store.save()
+            except (IOError, OSError) as e:
+                logging.warning('Could not write build history to %s: %s' %
+                                (self.filename, e))
+            self._saved = self._clock()
+            self._unsaved = False
+
+    def duration(self, source):
+        '''Return how long the latest build of the source took, or None.'''
+
+        with self._lock:
+            return self._store.get('durations', self._key(source))
+
+    def default(self):
+        '''Return the duration assumed for a source never built before.
+
+        This is the median of the known durations, so that new sources
+        are neither put ahead of nor behind everything else.
+
+        '''
+
+        with self._lock:
+            if self._default is None:
+                durations = sorted(
+                    self._store.entries('durations').itervalues())
+                if durations:
+                    self._default = durations[len(durations) // 2]
+                else:
+                    self._default = self.default_seconds
+            return self._default
+
+    def estimate(self, source):
+        '''Return how long building source is expected to take.'''
+
+        seconds = self.duration(source)
+        if seconds is None:
+            return self.default()
+        return seconds
+
+
+class BuildPlan(object):
+
+    '''The state of every source of a build, and how long it would take.
+
+    ``entries`` is a list of dicts, in build order, with the name, kind
+    and cache key of each source, its state, which is one of
+    ``'local'``, ``'remote'`` and ``'build'``, and the estimated number
+    of seconds building it would take, or None if it is not known.
+
+    The critical path is the chain of dependent sources to be built that
+    would take the longest. No matter how many sources are built at
+    once, the build cannot be faster than it. Sources with no estimate
+    are counted as taking no time.
+
+    '''
+
+    def __init__(self, entries, critical_path):
+        self.entries = entries
+        self.critical_path = critical_path
+
+    def count(self, state):
+        return len([e for e in self.entries if e['state'] == state])
+
+    def to_build(self):
+        return [e for e in self.entries if e['state'] == 'build']
+
+    def total_seconds(self):
+        return sum(e['estimate'] or 0 for e in self.to_build())
+
+    def critical_seconds(self):
+        return sum(e['estimate'] or 0 for e in self.critical_path)
+
+    def unknown(self):
+        return len([e for e in self.to_build() if e['estimate'] is None])
+
+    def as_dict(self):
+        return {
+            'sources': self.entries,
+            'local': self.count('local'),
+            'remote': self.count('remote'),
+            'build': self.count('build'),
+            'unknown-estimates': self.unknown(),
+            'total-seconds': self.total_seconds(),
+            'critical-path-seconds': self.critical_seconds(),
+            'critical-path': [e['name'] for e in self.critical_path],
+        }
+
+    def write_json(self, f):
+        json.dump(self.as_dict(), f, indent=4, sort_keys=True)
+        f.write('\n')
+
+    def format_text(self):
+        '''Return the plan as lines of text.'''
+
+        lines = ['%-7s %-8s %10s  %s' % ('STATE', 'KIND', 'ESTIMATE', 'NAME')]
+        for entry in self.entries:
+            if entry['state'] != 'build':
+                estimate = '-'
+            elif entry['estimate'] is None:
+                estimate = 'unknown'
+            else:
+                estimate = format_seconds(entry['estimate'])
+            lines.append('%-7s %-8s %10s  %s' %
+                         (entry['state'], entry['kind'], estimate,
+                          entry['name']))
+        lines.append('%d sources in the local cache, %d in the remote '
+                     'cache, %d to build' %
+                     (self.count('local'), self.count('remote'),
+                      self.count('build')))
+        if self.to_build():
+            lines.append('Estimated build time: %s one at a time, %s on '
+                         'the critical path' %
+                         (format_seconds(self.total_seconds()),
+                          format_seconds(self.critical_seconds())))
+            lines.append('Critical path: %s' %
+                         ' -> '.join(e['name'] for e in self.critical_path))
+        if self.unknown():
+            lines.append('%d sources to build have no earlier build to '
+                         'estimate from' % self.unknown())
+        return lines
+
+
+def format_seconds(seconds):
+    '''Format a duration like the elapsed time of a build.'''
+
+    seconds = int(round(seconds))
+    return '%02d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60,
+                               seconds % 60)
+
+
+def source_states(sources, lac, rac):
+    '''Map each source to where its artifacts are.
+
+    A source is ``'local'`` if the local artifact cache has all of its
+    artifacts, and ``'remote'`` if the remote one has those the local
+    one does not. The remote cache is asked about every missing artifact
+    in one request.
+
+    '''
+
+    missing = {}
+    for source in sources:
+        missing[source] = [a.basename() for a in source.artifacts.itervalues()
+                           if not lac.has(a)]
+
+    wanted = [f for filenames in missing.itervalues() for f in filenames]
+    if rac is not None and wanted:
+        present = rac.has_files(wanted)
+    else:
+        present = set()
+
+    states = {}
+    for source, filenames in missing.iteritems():
+        if not filenames:
+            states[source] = 'local'
+        elif present.issuperset(filenames):
+            states[source] = 'remote'
+        else:
+            states[source] = 'build'
+    return states
+
+
+def _path_key(path):
+    # Of paths that take as long, the one with more nodes is longest,
+    # since sources with no estimate do take some time.
+    seconds, nodes = path
+    return seconds, len(nodes)
+
+
+def longest_paths(predecessors, duration):
+    '''Return the longest path to each node of a dependency graph.
+
+    ``predecessors`` maps each node to the nodes that come before it;
+    any that are not themselves keys of it are ignored. ``duration``
+    gives how long a node takes, or None for a node that takes no time
+    and is left out of paths.
+
+    The result maps each node to a (seconds, nodes) pair: how long the
+    longest path ending at the node takes, and the nodes along it.
+    Given the dependencies of sources, this is the longest chain of
+    builds before each one can finish; given the sources depending on
+    each, it is the longest chain of builds still to come after it.
+
+    '''
+
+    successors = dict((node, []) for node in predecessors)
+    waiting = {}
+    for node, before in predecessors.iteritems():
+        before = [p for p in before if p in successors]
+        waiting[node] = len(before)
+        for p in before:
+            successors[p].append(node)
+
+    # Visit each node once every node before it has been visited.
+    result = {}
+    ready = [node for node, count in waiting.iteritems() if count == 0]
+    while ready:
+        node = ready.pop()
+        before = max([result[p] for p in predecessors[node] if p in result]
+                     or [(0, [])],
+                     key=_path_key)
+        seconds = duration(node)
+        if seconds is None:
+            result[node] = before
+        else:
+            result[node] = (before[0] + seconds, before[1] + [node])
+        for successor in successors[node]:
+            waiting[successor] -= 1
+            if waiting[successor] == 0:
+                ready.append(successor)
+    return result
+
+
+def plan(ordered_sources, dependencies, lac, rac, history):
+    '''Return the BuildPlan for building sources in the given order.
+
+    ``dependencies`` maps each source to the set of sources it directly
+    depends on, as ``BuildCommand.get_source_dependencies`` returns.
+
+    '''
+
+    states = source_states(ordered_sources, lac, rac)
+    entries = {}
+    for source in ordered_sources:
+        state = states[source]
+        entries[source] = {
+            'name': source.name,
+            'kind': source.morphology['kind'],
+            'cache-key': source.cache_key,
+            'state': state,
+            'estimate': (history.duration(source) if state == 'build'
+                         else None),
+        }
+
+    def duration(source):
+        entry = entries[source]
+        if entry['state'] != 'build':
+            return None
+        return entry['estimate'] or 0
+
+    paths = longest_paths(
+        dict((s, dependencies[s]) for s in ordered_sources), duration)
+    seconds, critical = max(paths.values() or [(0, [])], key=_path_key)
+
+    return BuildPlan([entries[s] for s in ordered_sources],
+                     [entries[s] for s in critical])
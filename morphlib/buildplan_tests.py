@@ -0,0 +1,324 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import json
+import os
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import morphlib.buildplan
+
+
+class FakeArtifact(object):
+
+    def __init__(self, source, name):
+        self.source = source
+        self.name = name
+
+    def basename(self):
+        return '%s.%s.%s' % (self.source.cache_key,
+                             self.source.morphology['kind'], self.name)
+
+
+class FakeSource(object):
+
+    def __init__(self, name, kind, cache_key, artifact_names=None):
+        self.name = name
+        self.morphology = {'kind': kind}
+        self.cache_key = cache_key
+        self.artifacts = dict(
+            (a, FakeArtifact(self, a))
+            for a in (artifact_names or [name]))
+
+
+class FakeLocalArtifactCache(object):
+
+    def __init__(self, basenames=()):
+        self.basenames = set(basenames)
+
+    def has(self, artifact):
+        return artifact.basename() in self.basenames
+
+
+class FakeRemoteArtifactCache(object):
+
+    def __init__(self, basenames=()):
+        self.basenames = set(basenames)
+        self.requests = []
+
+    def has_files(self, filenames):
+        self.requests.append(list(filenames))
+        return self.basenames.intersection(filenames)
+
+
+class FakeHistory(object):
+
+    def __init__(self, durations):
+        self.durations = durations
+
+    def duration(self, source):
+        return self.durations.get(source.name)
+
+
+def key(c):
+    return c * 64
+
+
+class BuildHistoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'history.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def source(self, name, kind='chunk'):
+        return FakeSource(name, kind, key('a'))
+
+    def test_knows_nothing_about_sources_never_built(self):
+        history = morphlib.buildplan.BuildHistory(self.filename)
+        self.assertEqual(history.duration(self.source('gcc')), None)
+        self.assertEqual(history.estimate(self.source('gcc')),
+                         history.default_seconds)
+
+    def test_returns_latest_recorded_duration(self):
+        history = morphlib.buildplan.BuildHistory(self.filename)
+        history.record(self.source('gcc'), 100)
+        history.record(self.source('gcc'), 120)
+        self.assertEqual(history.duration(self.source('gcc')), 120)
+        self.assertEqual(history.estimate(self.source('gcc')), 120)
+
+    def test_keeps_kinds_apart(self):
+        history = morphlib.buildplan.BuildHistory(self.filename)
+        history.record(self.source('core', 'stratum'), 5)
+        history.record(self.source('core', 'chunk'), 500)
+        self.assertEqual(history.duration(self.source('core', 'stratum')), 5)
+
+    def test_estimates_median_for_unknown_sources(self):
+        history = morphlib.buildplan.BuildHistory(self.filename)
+        for name, seconds in [('a', 10), ('b', 3000), ('c', 40)]:
+            history.record(self.source(name), seconds)
+        self.assertEqual(history.estimate(self.source('new')), 40)
+        history.record(self.source('d'), 50)
+        self.assertEqual(history.estimate(self.source('new')), 50)
+
+    def test_survives_restarts(self):
+        history = morphlib.buildplan.BuildHistory(self.filename)
+        history.record(self.source('gcc'), 100)
+        history.save()
+        history = morphlib.buildplan.BuildHistory(self.filename)
+        self.assertEqual(history.duration(self.source('gcc')), 100)
+
+    def test_writes_durations_only_when_saved(self):
+        history = morphlib.buildplan.BuildHistory(self.filename)
+        history.record(self.source('gcc'), 100)
+        self.assertFalse(os.path.exists(self.filename))
+        history.save()
+        os.remove(self.filename)
+        history.save()
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_saves_when_recording_after_the_save_interval(self):
+        now = [1000]
+        history = morphlib.buildplan.BuildHistory(
+            self.filename, save_interval=60, clock=lambda: now[0])
+        history.record(self.source('gcc'), 100)
+        self.assertFalse(os.path.exists(self.filename))
+        now[0] += 60
+        history.record(self.source('glibc'), 200)
+        history = morphlib.buildplan.BuildHistory(self.filename)
+        self.assertEqual(history.duration(self.source('gcc')), 100)
+        self.assertEqual(history.duration(self.source('glibc')), 200)
+
+    def test_keeps_going_if_history_cannot_be_written(self):
+        os.mkdir(self.filename)
+        history = morphlib.buildplan.BuildHistory(self.filename)
+        history.record(self.source('gcc'), 100)
+        history.save()
+        self.assertEqual(history.duration(self.source('gcc')), 100)
+
+
+class LongestPathTests(unittest.TestCase):
+
+    def setUp(self):
+        # A long toolchain chain and a short independent library, both
+        # needed by the system.
+        self.dependencies = {
+            'gcc1': [],
+            'glibc': ['gcc1'],
+            'gcc2': ['glibc'],
+            'zlib': [],
+            'system': ['gcc2', 'zlib'],
+        }
+        self.durations = {'gcc1': 600, 'glibc': 900, 'gcc2': 1200,
+                          'zlib': 30, 'system': 300}
+
+    def dependents(self):
+        result = dict((name, []) for name in self.dependencies)
+        for name, dependencies in self.dependencies.iteritems():
+            for dependency in dependencies:
+                result[dependency].append(name)
+        return result
+
+    def paths(self, predecessors):
+        return morphlib.buildplan.longest_paths(predecessors,
+                                                self.durations.get)
+
+    def test_follows_the_longest_chain_of_dependencies(self):
+        paths = self.paths(self.dependencies)
+        self.assertEqual(paths['system'],
+                         (3000, ['gcc1', 'glibc', 'gcc2', 'system']))
+        self.assertEqual(paths['zlib'], (30, ['zlib']))
+
+    def test_adds_up_the_longest_chain_of_dependents(self):
+        paths = self.paths(self.dependents())
+        self.assertEqual(
+            dict((name, seconds)
+                 for name, (seconds, nodes) in paths.iteritems()), {
+                'system': 300,
+                'gcc2': 1500,
+                'zlib': 330,
+                'glibc': 2400,
+                'gcc1': 3000,
+            })
+
+    def test_takes_the_longest_of_several_dependents(self):
+        self.dependencies['zlib'].append('gcc1')
+        self.durations['zlib'] = 5000
+        self.assertEqual(self.paths(self.dependents())['gcc1'][0], 5900)
+
+    def test_ignores_nodes_outside_the_graph(self):
+        paths = self.paths({'system': ['gcc2', 'zlib'], 'gcc2': ['glibc']})
+        self.assertEqual(paths, {'system': (1500, ['gcc2', 'system']),
+                                 'gcc2': (1200, ['gcc2'])})
+
+    def test_leaves_out_nodes_without_a_duration(self):
+        del self.durations['gcc2']
+        self.assertEqual(self.paths(self.dependencies)['system'],
+                         (1800, ['gcc1', 'glibc', 'system']))
+
+
+class PlanTests(unittest.TestCase):
+
+    def setUp(self):
+        # base <- (tools, lib) <- app, with base cached locally and lib
+        # cached remotely.
+        self.base = FakeSource('base', 'chunk', key('1'))
+        self.tools = FakeSource('tools', 'chunk', key('2'))
+        self.lib = FakeSource('lib', 'chunk', key('3'),
+                              ['lib-bins', 'lib-devel'])
+        self.app = FakeSource('app', 'stratum', key('4'))
+        self.sources = [self.base, self.tools, self.lib, self.app]
+        self.dependencies = {
+            self.base: set(),
+            self.tools: set([self.base]),
+            self.lib: set([self.base]),
+            self.app: set([self.tools, self.lib]),
+        }
+        lib = self.lib.artifacts
+        self.lac = FakeLocalArtifactCache([
+            self.base.artifacts['base'].basename(),
+            lib['lib-devel'].basename(),
+        ])
+        self.rac = FakeRemoteArtifactCache([lib['lib-bins'].basename()])
+        self.history = FakeHistory({'tools': 70, 'lib': 500})
+
+    def make_plan(self, rac='default'):
+        return morphlib.buildplan.plan(
+            self.sources, self.dependencies, self.lac,
+            self.rac if rac == 'default' else rac, self.history)
+
+    def test_reports_where_each_source_is(self):
+        plan = self.make_plan()
+        self.assertEqual([(e['name'], e['state']) for e in plan.entries],
+                         [('base', 'local'), ('tools', 'build'),
+                          ('lib', 'remote'), ('app', 'build')])
+        self.assertEqual(map(sorted, self.rac.requests),
+                         [[self.tools.artifacts['tools'].basename(),
+                           self.lib.artifacts['lib-bins'].basename(),
+                           self.app.artifacts['app'].basename()]])
+
+    def test_everything_missing_locally_is_built_without_remote_cache(self):
+        plan = self.make_plan(rac=None)
+        self.assertEqual([e['state'] for e in plan.entries],
+                         ['local', 'build', 'build', 'build'])
+        self.assertEqual([e['name'] for e in plan.critical_path],
+                         ['lib', 'app'])
+        self.assertEqual(plan.critical_seconds(), 500)
+        self.assertEqual(plan.total_seconds(), 570)
+
+    def test_estimates_only_sources_to_build(self):
+        plan = self.make_plan()
+        self.assertEqual([e['estimate'] for e in plan.entries],
+                         [None, 70, None, None])
+        self.assertEqual(plan.unknown(), 1)
+        self.assertEqual(plan.total_seconds(), 70)
+        self.assertEqual([e['name'] for e in plan.critical_path],
+                         ['tools', 'app'])
+        self.assertEqual(plan.critical_seconds(), 70)
+
+    def test_nothing_to_build_has_empty_critical_path(self):
+        self.lac.basenames.update(
+            a.basename() for s in self.sources
+            for a in s.artifacts.itervalues())
+        plan = self.make_plan()
+        self.assertEqual(plan.count('local'), 4)
+        self.assertEqual(plan.critical_path, [])
+        self.assertEqual(self.rac.requests, [])
+        self.assertEqual(plan.format_text()[-1],
+                         '4 sources in the local cache, 0 in the remote '
+                         'cache, 0 to build')
+
+    def test_formats_text(self):
+        lines = self.make_plan().format_text()
+        self.assertEqual(lines, [
+            'STATE   KIND       ESTIMATE  NAME',
+            'local   chunk             -  base',
+            'build   chunk      00:01:10  tools',
+            'remote  chunk             -  lib',
+            'build   stratum     unknown  app',
+            '1 sources in the local cache, 1 in the remote cache, '
+            '2 to build',
+            'Estimated build time: 00:01:10 one at a time, 00:01:10 on '
+            'the critical path',
+            'Critical path: tools -> app',
+            '1 sources to build have no earlier build to estimate from',
+        ])
+
+    def test_writes_json(self):
+        f = StringIO.StringIO()
+        self.make_plan().write_json(f)
+        data = json.loads(f.getvalue())
+        self.assertEqual(data['critical-path'], ['tools', 'app'])
+        self.assertEqual(data['critical-path-seconds'], 70)
+        self.assertEqual(data['total-seconds'], 70)
+        self.assertEqual((data['local'], data['remote'], data['build']),
+                         (1, 1, 2))
+        self.assertEqual(data['unknown-estimates'], 1)
+        self.assertEqual(data['sources'][1], {
+            'name': 'tools',
+            'kind': 'chunk',
+            'cache-key': key('2'),
+            'state': 'build',
+            'estimate': 70,
+        })
+
+    def test_formats_long_durations(self):
+        self.assertEqual(morphlib.buildplan.format_seconds(3 * 3600 + 61.6),
+                         '03:01:02')
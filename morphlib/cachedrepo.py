@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -53,6 +53,15 @@ class CheckoutError(cliapp.AppException):
             'Failed to check out ref %s in %s' % (ref, target_dir))
 
 
+class ExportError(cliapp.AppException):
+
+    def __init__(self, repo, ref, target_dir):
+        cliapp.AppException.__init__(
+            self,
+            'Failed to export ref %s of %s into %s' %
+            (ref, repo.original_name, target_dir))
+
+
 class UpdateError(cliapp.AppException):
 
     def __init__(self, repo):
@@ -169,6 +178,26 @@ class CachedRepo(object):
 
         self._checkout_ref_in_clone(ref, target_dir)
 
+    def export(self, ref, target_dir, mtime=None):
+        '''Writes only the files of a commit ref into a directory.
+
+        Unlike checkout, the repository is not copied, so the directory
+        is not a git repository afterwards. Every file and directory
+        written gets mtime as its modification time, or the current time.
+
+        Raises an gitdir.InvalidRefError if the ref is not found in the
+        repository. Raises an ExportError if something goes wrong while
+        writing the files.
+
+        '''
+
+        sha1 = self._gitdir.resolve_ref_to_commit(ref)
+
+        if not os.path.exists(target_dir):
+            os.mkdir(target_dir)
+
+        self._export_tree(sha1, target_dir, mtime)
+
     def requires_update_for_ref(self, ref):
         '''Returns False if there's no need to update this cached repo.
 
@@ -231,6 +260,13 @@ class CachedRepo(object):
         except cliapp.AppException:
             raise CopyError(self, target_dir)
 
+    def _export_tree(self, ref, target_dir, mtime):  # pragma: no cover
+        try:
+            morphlib.git.export_tree(
+                self._runcmd, self.path, ref, target_dir, mtime)
+        except cliapp.AppException:
+            raise ExportError(self, ref, target_dir)
+
     def _checkout_ref_in_clone(self, ref, clone_dir):  # pragma: no cover
         # This is a separate GitDirectory instance. Don't confuse it with the
         # internal ._gitdir attribute!
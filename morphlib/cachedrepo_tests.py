@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -71,6 +71,14 @@ class CachedRepoTests(unittest.TestCase):
         self.clone_target = target_dir
         self.clone_ref = ref
 
+    def export_tree(self, ref, target_dir, mtime):
+        if target_dir.endswith('failed-export'):
+            raise morphlib.cachedrepo.ExportError(self.repo, ref, target_dir)
+        self.export_ref = ref
+        self.export_mtime = mtime
+        with open(os.path.join(target_dir, 'foo.morph'), 'w') as f:
+            f.write('contents of foo.morph')
+
     def update_successfully(self, **kwargs):
         pass
 
@@ -141,6 +149,35 @@ class CachedRepoTests(unittest.TestCase):
         morph_filename = os.path.join(unpack_dir, 'foo.morph')
         self.assertTrue(os.path.exists(morph_filename))
 
+    def test_export_resolves_ref_into_new_directory(self):
+        self.repo._gitdir._rev_parse = self.rev_parse
+        self.repo._export_tree = self.export_tree
+
+        export_dir = self.tempfs.getsyspath('export-dir')
+        self.repo.export('master', export_dir, 683074800)
+        self.assertEqual(self.export_ref,
+                         'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9')
+        self.assertEqual(self.export_mtime, 683074800)
+        self.assertTrue(
+            os.path.exists(os.path.join(export_dir, 'foo.morph')))
+
+    def test_fail_export_from_invalid_ref(self):
+        self.repo._gitdir._rev_parse = self.rev_parse
+        self.repo._export_tree = self.export_tree
+
+        self.assertRaises(
+            cliapp.AppException, self.repo.export,
+            '079bbfd447c8534e464ce5d40b80114c2022ebf4',
+            self.tempfs.getsyspath('export-from-invalid-ref'))
+
+    def test_fail_export_due_to_export_error(self):
+        self.repo._gitdir._rev_parse = self.rev_parse
+        self.repo._export_tree = self.export_tree
+
+        self.assertRaises(
+            morphlib.cachedrepo.ExportError, self.repo.export,
+            'master', self.tempfs.getsyspath('failed-export'))
+
     def test_successful_update(self):
         self.repo._gitdir.update_remotes = self.update_successfully
         self.repo.update()
@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -15,6 +15,7 @@
 
 
 import hashlib
+import json
 import logging
 
 import morphlib
@@ -22,27 +23,47 @@ import morphlib
 
 class CacheKeyComputer(object):
 
-    def __init__(self, build_env):
+    # Changing either of these changes every cache key, so they are also
+    # used to invalidate a CacheKeyStore.
+    metadata_version = 1
+    env_keys = ("LOGNAME", "MORPH_ARCH", "TARGET", "TARGET_STAGE1",
+                "USER", "USERNAME")
+
+    def __init__(self, build_env, store=None):
         self._build_env = build_env
         self._calculated = {}
         self._hashed = {}
+        self._store = store
 
     def _filterenv(self, env):
-        keys = ["LOGNAME", "MORPH_ARCH", "TARGET", "TARGET_STAGE1",
-                "USER", "USERNAME"]
-        return dict([(k, env[k]) for k in keys])
+        return dict([(k, env[k]) for k in self.env_keys])
 
     def compute_key(self, source):
         try:
             return self._hashed[source]
         except KeyError:
-            ret = self._hash_id(self.get_cache_id(source))
+            cache_id = self.get_cache_id(source)
+            if self._store is None:
+                ret = self._hash_id(cache_id)
+            else:
+                digest = self._input_digest(cache_id)
+                ret = self._store.get(digest)
+                if ret is None:
+                    ret = self._hash_id(cache_id)
+                    self._store.put(digest, ret)
             self._hashed[source] = ret
             logging.debug(
                 'computed cache key %s for artifact %s from source ',
                  ret, (source.repo_name, source.sha1, source.filename))
             return ret
 
+    def _input_digest(self, cache_id):
+        # The cache id holds everything the key depends on, including the
+        # keys of dependencies. JSON serialisation is done in C, so this
+        # is much cheaper than walking the cache id with _hash_thing.
+        text = json.dumps(cache_id, sort_keys=True, default=str)
+        return hashlib.sha1(text).hexdigest()
+
     def _hash_id(self, cache_id):
         sha = hashlib.sha256()
         self._hash_dict(sha, cache_id)
@@ -85,7 +106,7 @@ class CacheKeyComputer(object):
             'kids': [{'artifact': a.name,
                       'cache-key': self.compute_key(a.source)}
                      for a in source.dependencies],
-            'metadata-version': 1
+            'metadata-version': self.metadata_version
         }
 
         morphology = source.morphology
@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -160,3 +160,57 @@ class CacheKeyComputerTests(unittest.TestCase):
         ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env)
 
         self.assertNotEqual(oldsha, ckc.compute_key(artifact.source))
+
+    def test_store_gives_same_key_as_computing_it(self):
+        artifact = self._find_artifact('system-rootfs')
+        store = FakeCacheKeyStore()
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(self.build_env,
+                                                         store)
+        self.assertEqual(ckc.compute_key(artifact.source),
+                         self.ckc.compute_key(artifact.source))
+        self.assertNotEqual(store.misses, 0)
+        self.assertEqual(store.hits, 0)
+
+    def test_store_hits_avoid_hashing(self):
+        artifact = self._find_artifact('system-rootfs')
+        store = FakeCacheKeyStore()
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(self.build_env,
+                                                         store)
+        key = ckc.compute_key(artifact.source)
+
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(self.build_env,
+                                                         store)
+        def fail(cache_id):
+            raise AssertionError('cache id should not be hashed')
+        ckc._hash_id = fail
+        self.assertEqual(ckc.compute_key(artifact.source), key)
+        self.assertEqual(store.misses, store.hits)
+
+    def test_changed_input_misses_store(self):
+        artifact = self._find_artifact('system-rootfs')
+        store = FakeCacheKeyStore()
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(self.build_env,
+                                                         store)
+        oldsha = ckc.compute_key(artifact.source)
+        build_env = copy.deepcopy(self.build_env)
+        build_env.env["USER"] = "brian"
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env, store)
+        self.assertNotEqual(oldsha, ckc.compute_key(artifact.source))
+
+
+class FakeCacheKeyStore(object):
+
+    def __init__(self):
+        self.keys = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, digest):
+        if digest in self.keys:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return self.keys.get(digest)
+
+    def put(self, digest, key):
+        self.keys[digest] = key
@@ -0,0 +1,73 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import morphlib
+
+
+class CacheKeyStore(object):
+
+    '''Remember computed cache keys between runs of morph.
+
+    Cache keys are stored in a JSON file, indexed by a digest of
+    everything the key was computed from. The stored keys are only valid
+    for the metadata version and the list of environment variables they
+    were computed with, so the store starts empty if either of those has
+    changed since it was saved.
+
+    The ``hits`` and ``misses`` attributes count lookups that found and
+    did not find a key.
+
+    '''
+
+    format_version = 1
+
+    def __init__(self, filename, metadata_version, env_keys,
+                 max_entries=50000):
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        header = {
+            'format': self.format_version,
+            'metadata-version': metadata_version,
+            'env-keys': sorted(env_keys),
+        }
+        self._store = morphlib.jsonstore.JsonStore(
+            filename, header, ['keys'], max_entries)
+
+    def get(self, digest):
+        '''Return the cache key stored for digest, or None.'''
+
+        key = self._store.get('keys', digest)
+        if key is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return key
+
+    def put(self, digest, key):
+        '''Store the cache key computed for inputs with a given digest.'''
+
+        self._store.put('keys', digest, key)
+
+    def save(self):
+        '''Write the store to disk.
+
+        Keys used or added since the store was loaded are always kept.
+        Older keys are kept too, until there are max_entries in total.
+
+        '''
+
+        self._store.save()
@@ -0,0 +1,92 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+
+
+class CacheKeyStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'cache', 'keys.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def new_store(self, metadata_version=1, env_keys=('USER',), **kwargs):
+        return morphlib.cachekeystore.CacheKeyStore(
+            self.filename, metadata_version, env_keys, **kwargs)
+
+    def test_starts_empty_without_a_file(self):
+        store = self.new_store()
+        self.assertEqual(store.get('digest'), None)
+        self.assertEqual(store.misses, 1)
+        self.assertEqual(store.hits, 0)
+
+    def test_returns_key_that_was_put(self):
+        store = self.new_store()
+        store.put('digest', 'key')
+        self.assertEqual(store.get('digest'), 'key')
+        self.assertEqual(store.hits, 1)
+
+    def test_remembers_keys_after_save(self):
+        store = self.new_store()
+        store.put('digest', 'key')
+        store.save()
+        store = self.new_store()
+        self.assertEqual(store.get('digest'), 'key')
+        self.assertEqual(store.hits, 1)
+        self.assertEqual(store.misses, 0)
+
+    def test_forgets_keys_if_metadata_version_changes(self):
+        store = self.new_store()
+        store.put('digest', 'key')
+        store.save()
+        store = self.new_store(metadata_version=2)
+        self.assertEqual(store.get('digest'), None)
+
+    def test_forgets_keys_if_env_keys_change(self):
+        store = self.new_store()
+        store.put('digest', 'key')
+        store.save()
+        store = self.new_store(env_keys=('USER', 'TARGET'))
+        self.assertEqual(store.get('digest'), None)
+
+    def test_ignores_corrupt_file(self):
+        os.makedirs(os.path.dirname(self.filename))
+        with open(self.filename, 'w') as f:
+            f.write('{not json')
+        store = self.new_store()
+        self.assertEqual(store.get('digest'), None)
+
+    def test_keeps_used_keys_before_old_ones(self):
+        store = self.new_store()
+        store.put('old', 'key1')
+        store.put('used', 'key2')
+        store.save()
+        store = self.new_store(max_entries=1)
+        store.get('used')
+        store.put('new', 'key3')
+        store.save()
+        store = self.new_store()
+        self.assertEqual(store.get('old'), None)
+        self.assertEqual(store.get('used'), 'key2')
+        self.assertEqual(store.get('new'), 'key3')
@@ -0,0 +1,347 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import contextlib
+import errno
+import fcntl
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+
+import morphlib
+
+
+def read_manifest(filename):
+    '''Return the manifest in filename, or None if it cannot be read.'''
+
+    try:
+        with open(filename) as f:
+            fields = f.read().split('\0')[:-1]
+    except (IOError, OSError):
+        return None
+    return [(relname, kind, int(mode), extra)
+            for relname, kind, mode, extra in zip(*[iter(fields)] * 4)]
+
+
+def write_manifest(filename, manifest):
+    '''Write a manifest to filename atomically.'''
+
+    f = morphlib.savefile.SaveFile(filename, 'w')
+    try:
+        for entry in manifest:
+            f.write(''.join('%s\0' % field for field in entry))
+    except BaseException: # pragma: no cover
+        f.abort()
+        raise
+    f.close()
+
+
+class UnpackedChunkStore(object):
+
+    '''Chunk artifacts unpacked once, to be hardlinked into staging areas.
+
+    Each chunk artifact is unpacked into DIRNAME/BASENAME.d, where BASENAME
+    is the file name of the artifact in the artifact cache. The cache key
+    is part of that name, so an unpacked tree never needs to be updated.
+
+    After unpacking, DIRNAME/BASENAME.manifest is written, listing every
+    entry of the tree in the order they must be created. Installing a chunk
+    uses the manifest rather than walking the tree again. A tree without a
+    manifest is incomplete. Manifests hold file names as they are on disk,
+    so every field of an entry ends with a NUL byte.
+
+    DIRNAME/BASENAME.lock is locked exclusively while a tree is unpacked or
+    removed, and shared while it is linked from, so builds running at the
+    same time can use the store. It is removed along with the tree. The
+    sizes of the unpacked trees are kept in DIRNAME/index.json. When they
+    add up to more than ``max_size`` bytes, the least recently used trees
+    are removed. A ``max_size`` of 0 means there is no limit.
+
+    '''
+
+    def __init__(self, dirname, max_size=0, status_cb=None):
+        self.dirname = dirname
+        self.max_size = max_size
+        self.status = status_cb or (lambda **kwargs: None)
+
+    def _path(self, basename, suffix):
+        return os.path.join(self.dirname, basename + suffix)
+
+    @contextlib.contextmanager
+    def _locked(self, basename, operation):
+        with open(self._path(basename, '.lock'), 'a') as f:
+            fcntl.flock(f.fileno(), operation)
+            try:
+                yield f
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def install(self, handle, destdir):
+        '''Install the chunk artifact open as handle into destdir.
+
+        The chunk is unpacked into the store first if it is not there
+        already.
+
+        '''
+
+        basename = os.path.basename(handle.name)
+        with self._locked(basename, fcntl.LOCK_SH) as lock:
+            manifest, added_size = self._ensure_unpacked(lock, handle)
+            self.link_tree(self._path(basename, '.d'), manifest, destdir)
+        self._added(basename, added_size)
+
+    def unpacked_tree(self, handle):
+        '''Return the directory the chunk open as handle is unpacked in.
+
+        The chunk is unpacked into the store first if it is not there
+        already. Unless it is pinned, the tree may be evicted at any time
+        after this returns.
+
+        '''
+
+        return self.unpacked(handle)[0]
+
+    def unpacked(self, handle):
+        '''Return the unpacked tree of a chunk and its manifest.
+
+        This is like ``unpacked_tree``, for callers that need to know
+        what is in the tree as well.
+
+        '''
+
+        basename = os.path.basename(handle.name)
+        with self._locked(basename, fcntl.LOCK_SH) as lock:
+            manifest, added_size = self._ensure_unpacked(lock, handle)
+        self._added(basename, added_size)
+        return self._path(basename, '.d'), manifest
+
+    def manifest(self, basename):
+        '''Return the manifest of an unpacked chunk, or None.'''
+
+        return self._read_manifest(basename)
+
+    def pin(self, tree):
+        '''Stop an unpacked tree from being evicted.
+
+        Return an open file; the tree is unpinned when it is closed.
+
+        '''
+
+        basename = os.path.basename(tree)[:-len('.d')]
+        f = open(self._path(basename, '.lock'), 'a')
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+        return f
+
+    def _ensure_unpacked(self, lock, handle):
+        '''Unpack a chunk, if needed, while holding a shared lock on it.
+
+        Return the manifest of the tree, and its size if it was unpacked
+        now, or None if it was already there.
+
+        '''
+
+        basename = os.path.basename(handle.name)
+        added_size = None
+        manifest = self._read_manifest(basename)
+        if manifest is None:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            # Another build may have unpacked the chunk while we were
+            # waiting for the lock.
+            manifest = self._read_manifest(basename)
+            if manifest is None:
+                self.status(msg='Unpacking chunk from cache %(filename)s',
+                            filename=basename)
+                manifest, added_size = self._unpack(handle, basename)
+            fcntl.flock(lock.fileno(), fcntl.LOCK_SH)
+        # The manifest's mtime records when the tree was last used.
+        os.utime(self._path(basename, '.manifest'), None)
+        return manifest, added_size
+
+    def _added(self, basename, size):
+        if size is not None:
+            self._update_index(add={basename: size})
+            self.evict(keep=basename)
+
+    def _read_manifest(self, basename):
+        return read_manifest(self._path(basename, '.manifest'))
+
+    def _unpack(self, handle, basename):
+        tree = self._path(basename, '.d')
+        if os.path.exists(tree):
+            # Left over from an interrupted unpack.
+            shutil.rmtree(tree)
+
+        savedir = tempfile.mkdtemp(dir=self.dirname)
+        try:
+            morphlib.bins.unpack_binary_from_file(handle, savedir + '/')
+            manifest, size = self.make_manifest(savedir)
+        except BaseException:
+            shutil.rmtree(savedir)
+            raise
+        os.rename(savedir, tree)
+
+        write_manifest(self._path(basename, '.manifest'), manifest)
+        return manifest, size
+
+    @staticmethod
+    def make_manifest(root):
+        '''List the entries of a tree and add up the sizes of its files.
+
+        Each entry is a tuple of the path relative to root, the type of
+        the entry, its mode, and for symlinks the target or for devices
+        the device number. Directories come before their contents.
+
+        '''
+
+        manifest = []
+        size = 0
+        for dirname, subdirs, basenames in os.walk(root):
+            for name in sorted(subdirs) + sorted(basenames):
+                filename = os.path.join(dirname, name)
+                relname = os.path.relpath(filename, root)
+                st = os.lstat(filename)
+                mode = st.st_mode
+                if stat.S_ISDIR(mode):
+                    manifest.append((relname, 'dir', mode, ''))
+                elif stat.S_ISLNK(mode):
+                    manifest.append(
+                        (relname, 'symlink', mode, os.readlink(filename)))
+                elif stat.S_ISREG(mode):
+                    manifest.append((relname, 'file', mode, ''))
+                    size += st.st_size
+                elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+                    manifest.append(
+                        (relname, 'device', mode, str(st.st_rdev)))
+                else:
+                    raise IOError('Cannot extract %s into staging-area. '
+                                  'Unsupported type.' % filename)
+        return manifest, size
+
+    @staticmethod
+    def link_tree(tree, manifest, destdir):
+        '''Hardlink the files of an unpacked tree into destdir.
+
+        Existing files in destdir are replaced. Existing directories, and
+        symlinks to directories, are kept.
+
+        '''
+
+        def replace(create, destpath):
+            try:
+                create()
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+                os.remove(destpath)
+                create()
+
+        if not os.path.exists(destdir):
+            os.makedirs(destdir)
+
+        for relname, kind, mode, extra in manifest:
+            srcpath = os.path.join(tree, relname)
+            destpath = os.path.join(destdir, relname)
+            if kind == 'dir':
+                try:
+                    os.mkdir(destpath)
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+                    dest_stat = os.stat(os.path.realpath(destpath))
+                    if not stat.S_ISDIR(dest_stat.st_mode):
+                        raise IOError('Destination not a directory. source '
+                                      'has %s destination has %s' %
+                                      (srcpath, destpath))
+            elif kind == 'symlink':
+                replace(lambda: os.symlink(extra, destpath), destpath)
+            elif kind == 'file':
+                replace(lambda: os.link(srcpath, destpath), destpath)
+            else: # pragma: no cover
+                replace(lambda: os.mknod(destpath, mode, int(extra)),
+                        destpath)
+                os.chmod(destpath, mode)
+
+    def _update_index(self, add={}, remove=()):
+        '''Change the index of unpacked trees and return its new contents.'''
+
+        with self._locked('index', fcntl.LOCK_EX):
+            filename = os.path.join(self.dirname, 'index.json')
+            try:
+                with open(filename) as f:
+                    index = json.load(f)
+            except (IOError, OSError, ValueError):
+                index = {}
+            index.update(add)
+            for basename in remove:
+                index.pop(basename, None)
+            if add or remove:
+                f = morphlib.savefile.SaveFile(filename, 'w')
+                try:
+                    json.dump(index, f)
+                except BaseException: # pragma: no cover
+                    f.abort()
+                    raise
+                f.close()
+            return index
+
+    def _last_used(self, basename):
+        try:
+            return os.path.getmtime(self._path(basename, '.manifest'))
+        except OSError:
+            return 0
+
+    def evict(self, keep=None):
+        '''Remove least recently used trees until the store fits max_size.
+
+        Trees that are in use by another build are skipped.
+
+        '''
+
+        if self.max_size <= 0:
+            return
+        index = self._update_index()
+        total = sum(index.itervalues())
+        if total <= self.max_size:
+            return
+
+        removed = []
+        for basename in sorted(index, key=self._last_used):
+            if total <= self.max_size:
+                break
+            if basename == keep:
+                logging.debug('Unpacked chunk %s is in use' % basename)
+                continue
+            try:
+                with self._locked(basename, fcntl.LOCK_EX | fcntl.LOCK_NB):
+                    logging.debug('Removing unpacked chunk %s' % basename)
+                    manifest = self._path(basename, '.manifest')
+                    if os.path.exists(manifest):
+                        os.remove(manifest)
+                    tree = self._path(basename, '.d')
+                    if os.path.exists(tree):
+                        shutil.rmtree(tree)
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise # pragma: no cover
+                logging.debug('Unpacked chunk %s is in use' % basename)
+                continue
+            os.remove(self._path(basename, '.lock'))
+            removed.append(basename)
+            total -= index[basename]
+        self._update_index(remove=removed)
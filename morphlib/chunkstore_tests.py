@@ -0,0 +1,215 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import time
+import unittest
+
+import morphlib
+
+
+class UnpackedChunkStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.storedir = os.path.join(self.tempdir, 'chunks')
+        os.mkdir(self.storedir)
+        self.store = morphlib.chunkstore.UnpackedChunkStore(self.storedir)
+        self.staging = os.path.join(self.tempdir, 'staging')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def create_chunk(self, name, contents='data', basename=None):
+        chunkdir = os.path.join(self.tempdir, name)
+        os.makedirs(os.path.join(chunkdir, 'usr', 'bin'))
+        with open(os.path.join(chunkdir, 'usr', 'bin', name), 'w') as f:
+            f.write(contents)
+        os.symlink('usr/bin', os.path.join(chunkdir, 'bin'))
+        basename = basename or '%s.chunk.%s' % (name, name)
+        chunk_tar = os.path.join(self.tempdir, basename)
+        tf = tarfile.TarFile(name=chunk_tar, mode='w')
+        tf.add(chunkdir, arcname='.')
+        tf.close()
+        shutil.rmtree(chunkdir)
+        return chunk_tar
+
+    def install(self, chunk_tar, destdir=None):
+        with open(chunk_tar, 'rb') as f:
+            self.store.install(f, destdir or self.staging)
+
+    def test_installs_chunk(self):
+        self.install(self.create_chunk('foo'))
+        filename = os.path.join(self.staging, 'usr', 'bin', 'foo')
+        with open(filename) as f:
+            self.assertEqual(f.read(), 'data')
+        self.assertEqual(os.readlink(os.path.join(self.staging, 'bin')),
+                         'usr/bin')
+
+    def test_hardlinks_files_from_store(self):
+        chunk_tar = self.create_chunk('foo')
+        self.install(chunk_tar)
+        stored = os.path.join(self.storedir, 'foo.chunk.foo.d',
+                              'usr', 'bin', 'foo')
+        installed = os.path.join(self.staging, 'usr', 'bin', 'foo')
+        self.assertTrue(os.path.samefile(stored, installed))
+
+    def test_writes_manifest_with_directories_first(self):
+        self.install(self.create_chunk('foo'))
+        manifest = self.store._read_manifest('foo.chunk.foo')
+        paths = [entry[0] for entry in manifest]
+        self.assertEqual(paths, ['bin', 'usr', 'usr/bin', 'usr/bin/foo'])
+
+    def test_second_install_uses_manifest(self):
+        chunk_tar = self.create_chunk('foo')
+        self.install(chunk_tar)
+        def fail(handle, basename):
+            raise AssertionError('chunk should not be unpacked again')
+        self.store._unpack = fail
+        other = os.path.join(self.tempdir, 'other')
+        self.install(chunk_tar, other)
+        self.assertTrue(os.path.exists(os.path.join(other, 'usr/bin/foo')))
+
+    def test_replaces_existing_files(self):
+        self.install(self.create_chunk('foo', 'old'))
+        self.install(self.create_chunk('foo', 'new', 'foo.chunk.new'))
+        with open(os.path.join(self.staging, 'usr', 'bin', 'foo')) as f:
+            self.assertEqual(f.read(), 'new')
+
+    def test_rejects_file_where_directory_is_needed(self):
+        os.makedirs(self.staging)
+        with open(os.path.join(self.staging, 'usr'), 'w'):
+            pass
+        self.assertRaises(IOError, self.install, self.create_chunk('foo'))
+
+    def test_recovers_from_interrupted_unpack(self):
+        os.mkdir(os.path.join(self.storedir, 'foo.chunk.foo.d'))
+        self.install(self.create_chunk('foo'))
+        self.assertTrue(
+            os.path.exists(os.path.join(self.staging, 'usr', 'bin', 'foo')))
+
+    def test_keeps_index_of_sizes(self):
+        self.install(self.create_chunk('foo', 'twelve bytes'))
+        self.assertEqual(self.store._update_index(), {'foo.chunk.foo': 12})
+
+    def test_evicts_least_recently_used_chunks(self):
+        self.store.max_size = 10
+        foo = self.create_chunk('foo', 'xxxxxx')
+        self.install(foo)
+        manifest = os.path.join(self.storedir, 'foo.chunk.foo.manifest')
+        past = time.time() - 60
+        os.utime(manifest, (past, past))
+        self.install(self.create_chunk('bar', 'yyyyyy'))
+        self.assertEqual(self.store._update_index(), {'bar.chunk.bar': 6})
+        self.assertFalse(
+            os.path.exists(os.path.join(self.storedir, 'foo.chunk.foo.d')))
+        self.assertFalse(
+            os.path.exists(os.path.join(self.storedir, 'foo.chunk.foo.lock')))
+        self.assertTrue(
+            os.path.exists(os.path.join(self.storedir, 'bar.chunk.bar.d')))
+
+    def test_does_not_evict_without_size_limit(self):
+        self.install(self.create_chunk('foo', 'xxxxxx'))
+        self.install(self.create_chunk('bar', 'yyyyyy'))
+        self.assertEqual(len(self.store._update_index()), 2)
+
+    def test_returns_unpacked_tree(self):
+        with open(self.create_chunk('foo'), 'rb') as f:
+            tree = self.store.unpacked_tree(f)
+        self.assertEqual(tree, os.path.join(self.storedir, 'foo.chunk.foo.d'))
+        self.assertTrue(os.path.exists(os.path.join(tree, 'usr/bin/foo')))
+
+    def test_returns_manifest_of_unpacked_tree(self):
+        with open(self.create_chunk('foo'), 'rb') as f:
+            tree, manifest = self.store.unpacked(f)
+        self.assertEqual(tree, os.path.join(self.storedir, 'foo.chunk.foo.d'))
+        self.assertEqual(manifest, self.store.manifest('foo.chunk.foo'))
+        self.assertEqual([e[0] for e in manifest],
+                         ['bin', 'usr', 'usr/bin', 'usr/bin/foo'])
+        self.assertEqual(self.store.manifest('bar.chunk.bar'), None)
+
+    def test_does_not_evict_pinned_trees(self):
+        self.store.max_size = 10
+        with open(self.create_chunk('foo', 'xxxxxx'), 'rb') as f:
+            pin = self.store.pin(self.store.unpacked_tree(f))
+        past = time.time() - 60
+        os.utime(os.path.join(self.storedir, 'foo.chunk.foo.manifest'),
+                 (past, past))
+        try:
+            self.install(self.create_chunk('bar', 'yyyyyy'))
+            self.assertEqual(len(self.store._update_index()), 2)
+        finally:
+            pin.close()
+        self.store.evict()
+        self.assertEqual(self.store._update_index(), {'bar.chunk.bar': 6})
+
+    def test_evicts_chunks_whose_manifest_is_missing_first(self):
+        self.store.max_size = 10
+        self.store._update_index(add={'gone.chunk.gone': 6})
+        self.install(self.create_chunk('foo', 'xxxxxx'))
+        self.assertEqual(self.store._update_index(), {'foo.chunk.foo': 6})
+
+    def test_cleans_up_after_failed_unpack(self):
+        chunk_tar = os.path.join(self.tempdir, 'foo.chunk.foo')
+        with open(chunk_tar, 'w') as f:
+            f.write('not a tarball')
+        self.assertRaises(tarfile.TarError, self.install, chunk_tar)
+        self.assertEqual(sorted(os.listdir(self.storedir)),
+                         ['foo.chunk.foo.lock'])
+
+    def test_lists_devices_in_manifest(self):
+        root = os.path.join(self.tempdir, 'root')
+        os.mkdir(root)
+        with open(os.path.join(root, 'null'), 'w'):
+            pass
+        real_lstat = os.lstat
+
+        class FakeDeviceStat(object):
+            st_mode = stat.S_IFCHR | 0666
+            st_rdev = 259
+
+        def lstat(filename):
+            if filename == os.path.join(root, 'null'):
+                return FakeDeviceStat()
+            return real_lstat(filename)
+
+        os.lstat = lstat
+        try:
+            manifest, size = self.store.make_manifest(root)
+        finally:
+            os.lstat = real_lstat
+        self.assertEqual(manifest,
+                         [('null', 'device', stat.S_IFCHR | 0666, '259')])
+
+    def test_rejects_unsupported_file_types(self):
+        root = os.path.join(self.tempdir, 'root')
+        os.mkdir(root)
+        os.mkfifo(os.path.join(root, 'fifo'))
+        self.assertRaises(IOError, self.store.make_manifest, root)
+
+    def test_reports_errors_creating_directories(self):
+        manifest = [('missing/dir', 'dir', 040755, '')]
+        self.assertRaises(OSError, self.store.link_tree,
+                          self.tempdir, manifest, self.staging)
+
+    def test_reports_errors_linking_files(self):
+        manifest = [('missing', 'file', 0100644, '')]
+        self.assertRaises(OSError, self.store.link_tree,
+                          self.tempdir, manifest, self.staging)
@@ -0,0 +1,199 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import collections
+import errno
+import hashlib
+import os
+import tempfile
+
+
+class DedupStats(collections.namedtuple(
+        'DedupStats', ('blobs', 'links', 'logical_size', 'physical_size'))):
+
+    '''How much a content store saves.
+
+    ``blobs`` is the number of distinct contents stored and ``links`` the
+    number of file names sharing them. ``logical_size`` is the size the
+    files would take if each was stored separately, and ``physical_size``
+    the size the blobs take.
+
+    '''
+
+    @property
+    def ratio(self):
+        '''How many times larger the files would be without the store.'''
+
+        if self.physical_size == 0:
+            return 1.0
+        return float(self.logical_size) / self.physical_size
+
+
+class ContentStore(object):
+
+    '''Store the contents of files once, hardlinking the files to them.
+
+    Each distinct content is a blob named DIRNAME/XX/DIGEST, where DIGEST
+    is the SHA-256 of the contents and XX its first two characters. When
+    a file is added, it is replaced by a hardlink to the blob with the
+    same contents, or becomes that blob if there is none yet, so files
+    must be on the same file system as DIRNAME.
+
+    A blob's link count, less one for the blob itself, is the number of
+    files sharing it. Once the files are removed, the blob has no other
+    link and is garbage, which ``release`` or ``collect`` remove.
+
+    Files in the store must never be changed in place, as that would
+    change every file sharing their blob. They must be replaced by saving
+    a new file and renaming it over the old one, as SaveFile does.
+
+    '''
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def blob_filename(self, digest):
+        return os.path.join(self.dirname, digest[:2], digest)
+
+    @staticmethod
+    def digest(filename):
+        '''Return the digest of the contents of a file.'''
+
+        sha = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for data in iter(lambda: f.read(64 * 1024), ''):
+                sha.update(data)
+        return sha.hexdigest()
+
+    def add(self, filename):
+        '''Store the contents of a file and return their digest.
+
+        The file is replaced by a link to the blob with its contents.
+
+        '''
+
+        digest = self.digest(filename)
+        blob = self.blob_filename(digest)
+        # Other processes may add or release the blob at the same time,
+        # in which case this tries again.
+        while True:
+            try:
+                blob_stat = os.stat(blob)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise # pragma: no cover
+                if self._link(filename, blob):
+                    return digest
+                continue # pragma: no cover
+            if os.path.samestat(blob_stat, os.stat(filename)):
+                return digest
+            if self._replace(filename, blob):
+                return digest
+
+    @staticmethod
+    def _replace(filename, blob):
+        '''Replace a file by a link to a blob, unless the blob is gone.
+
+        This is done in one step, so readers find one or the other.
+
+        '''
+
+        dirname = os.path.dirname(filename)
+        while True:
+            tempname = tempfile.mktemp(dir=dirname)
+            try:
+                os.link(blob, tempname)
+            except OSError as e: # pragma: no cover
+                if e.errno == errno.ENOENT:
+                    return False
+                if e.errno != errno.EEXIST:
+                    raise
+                continue
+            os.rename(tempname, filename)
+            return True
+
+    def _link(self, filename, blob):
+        '''Make a file the blob of its contents, unless there is one now.'''
+
+        try:
+            os.makedirs(os.path.dirname(blob))
+        except OSError as e: # pragma: no cover
+            if e.errno != errno.EEXIST:
+                raise
+        try:
+            os.link(filename, blob)
+        except OSError as e: # pragma: no cover
+            if e.errno != errno.EEXIST:
+                raise
+            return False
+        return True
+
+    def release(self, digest):
+        '''Remove a blob if no file shares it any more.
+
+        Return the number of bytes freed.
+
+        '''
+
+        return self._release(self.blob_filename(digest)) or 0
+
+    @staticmethod
+    def _release(blob):
+        '''Remove a blob no file shares and return its size, or None.'''
+
+        try:
+            st = os.stat(blob)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise # pragma: no cover
+            return None
+        if st.st_nlink > 1:
+            return None
+        os.remove(blob)
+        return st.st_size
+
+    def _blobs(self):
+        for dirname, subdirs, basenames in os.walk(self.dirname):
+            for basename in basenames:
+                yield os.path.join(dirname, basename)
+
+    def collect(self):
+        '''Remove every blob no file shares.
+
+        Return the number of blobs removed and the bytes freed.
+
+        '''
+
+        removed = 0
+        freed = 0
+        for blob in self._blobs():
+            size = self._release(blob)
+            if size is not None:
+                removed += 1
+                freed += size
+        return removed, freed
+
+    def stats(self):
+        '''Return the DedupStats of the store.'''
+
+        blobs = links = logical_size = physical_size = 0
+        for blob in self._blobs():
+            st = os.stat(blob)
+            blobs += 1
+            links += st.st_nlink - 1
+            logical_size += st.st_size * (st.st_nlink - 1)
+            physical_size += st.st_size
+        return DedupStats(blobs, links, logical_size, physical_size)
@@ -0,0 +1,103 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+
+
+class ContentStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filesdir = os.path.join(self.tempdir, 'files')
+        os.mkdir(self.filesdir)
+        self.store = morphlib.contentstore.ContentStore(
+            os.path.join(self.tempdir, 'cas'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, basename, data):
+        filename = os.path.join(self.filesdir, basename)
+        with open(filename, 'w') as f:
+            f.write(data)
+        return filename
+
+    def test_names_blobs_by_their_contents(self):
+        filename = self.write('foo', 'data')
+        digest = self.store.add(filename)
+        self.assertEqual(digest, hashlib.sha256('data').hexdigest())
+        blob = self.store.blob_filename(digest)
+        self.assertEqual(os.path.dirname(blob),
+                         os.path.join(self.tempdir, 'cas', digest[:2]))
+        self.assertTrue(os.path.samefile(blob, filename))
+
+    def test_links_files_with_the_same_contents_to_one_blob(self):
+        foo = self.write('foo', 'data')
+        bar = self.write('bar', 'data')
+        self.assertEqual(self.store.add(foo), self.store.add(bar))
+        self.assertTrue(os.path.samefile(foo, bar))
+        with open(bar) as f:
+            self.assertEqual(f.read(), 'data')
+        self.assertEqual(sorted(os.listdir(self.filesdir)), ['bar', 'foo'])
+
+    def test_keeps_files_with_other_contents_apart(self):
+        foo = self.write('foo', 'data')
+        bar = self.write('bar', 'other data')
+        self.assertNotEqual(self.store.add(foo), self.store.add(bar))
+        self.assertFalse(os.path.samefile(foo, bar))
+
+    def test_adds_a_file_twice_harmlessly(self):
+        foo = self.write('foo', 'data')
+        self.assertEqual(self.store.add(foo), self.store.add(foo))
+        self.assertEqual(self.store.stats().links, 1)
+
+    def test_releases_blobs_only_once_no_file_shares_them(self):
+        foo = self.write('foo', 'data')
+        bar = self.write('bar', 'data')
+        digest = self.store.add(foo)
+        self.store.add(bar)
+        os.remove(foo)
+        self.assertEqual(self.store.release(digest), 0)
+        os.remove(bar)
+        self.assertEqual(self.store.release(digest), 4)
+        self.assertFalse(os.path.exists(self.store.blob_filename(digest)))
+        self.assertEqual(self.store.release(digest), 0)
+
+    def test_collects_every_unshared_blob(self):
+        foo = self.write('foo', 'data')
+        bar = self.write('bar', 'other data')
+        empty = self.write('empty', '')
+        for filename in (foo, bar, empty):
+            self.store.add(filename)
+        os.remove(bar)
+        os.remove(empty)
+        self.assertEqual(self.store.collect(), (2, 10))
+        self.assertEqual(self.store.stats().blobs, 1)
+
+    def test_reports_dedup_ratio(self):
+        self.assertEqual(self.store.stats().ratio, 1.0)
+        for basename in ('foo', 'bar', 'baz'):
+            self.store.add(self.write(basename, 'data'))
+        self.store.add(self.write('other', 'other'))
+        stats = self.store.stats()
+        self.assertEqual(stats, (2, 4, 17, 9))
+        self.assertAlmostEqual(stats.ratio, 17 / 9.0)
@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2014  Codethink Limited
+# Copyright (C) 2011-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -19,9 +19,12 @@ import ConfigParser
 import logging
 import os
 import re
+import shutil
 import string
 import StringIO
 import sys
+import tempfile
+import time
 
 import morphlib
 
@@ -265,6 +268,52 @@ def copy_repository(runcmd, repo, destdir, is_mirror=True):
     gitcmd(runcmd, 'remote', 'update', 'origin', '--prune', cwd=destdir)
 
 
+def export_tree(runcmd, repo, ref, destdir, mtime=None):
+    '''Write the files of a commit in a cached repository into destdir.
+
+    Only the tree of the commit is written; there is no .git directory
+    and no history. A temporary index is filled from the tree and checked
+    out, so files are as a checkout would leave them, with attributes
+    from .gitattributes applied. Every file and directory written gets
+    ``mtime`` as its modification time, or the current time.
+
+    '''
+
+    if mtime is None:
+        mtime = time.time()
+    gitdir = os.path.join(repo, '.git')
+    if not os.path.isdir(gitdir):
+        gitdir = repo
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        env = dict(os.environ)
+        env['GIT_DIR'] = gitdir
+        env['GIT_WORK_TREE'] = destdir
+        env['GIT_INDEX_FILE'] = os.path.join(tempdir, 'index')
+        gitcmd(runcmd, 'read-tree', ref, env=env, cwd=destdir)
+        gitcmd(runcmd, 'checkout-index', '--all', '--force',
+               env=env, cwd=destdir)
+        files = gitcmd(runcmd, 'ls-files', '-z', env=env, cwd=destdir)
+    finally:
+        shutil.rmtree(tempdir)
+
+    # Set the times from the list of files, rather than walking the tree.
+    dirnames = set([''])
+    for filename in files.split('\0'):
+        if not filename:
+            continue
+        pathname = os.path.join(destdir, filename)
+        if not os.path.islink(pathname):
+            os.utime(pathname, (mtime, mtime))
+        dirname = os.path.dirname(filename)
+        while dirname not in dirnames:
+            dirnames.add(dirname)
+            dirname = os.path.dirname(dirname)
+    for dirname in dirnames:
+        os.utime(os.path.join(destdir, dirname), (mtime, mtime))
+
+
 def reset_workdir(runcmd, gitdir):
     '''Removes any differences between the current commit '''
     '''and the status of the working directory'''
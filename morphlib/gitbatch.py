@@ -0,0 +1,244 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Read objects from git repositories without running git for each one.'''
+
+
+import collections
+import logging
+import os
+import subprocess
+import threading
+
+import cliapp
+
+
+class ObjectReaderError(cliapp.AppException):
+
+    def __init__(self, dirname, msg):
+        cliapp.AppException.__init__(
+            self, 'Failed to read objects from git repository %s: %s' %
+            (dirname, msg))
+
+
+class _ProcessLimit(object):
+
+    '''Keep at most ``limit`` git processes running.
+
+    Each repository a run reads from gets its own processes, which are
+    kept until they are stopped, each with pipes open to it. Once more
+    than ``limit`` are running, the ones used least recently are stopped,
+    and are started again if they are needed. Processes that are in use
+    by another thread are left running.
+
+    '''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._running = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._running)
+
+    def used(self, process):
+        '''Record that a process is running and has just been used.'''
+
+        with self._lock:
+            self._running.pop(process, None)
+            self._running[process] = True
+            excess = len(self._running) - self.limit
+            victims = [p for p in self._running if p is not process]
+            victims = victims[:max(excess, 0)]
+        for victim in victims:
+            if victim.lock.acquire(False):
+                try:
+                    victim.stop()
+                finally:
+                    victim.lock.release()
+
+    def stopped(self, process):
+        with self._lock:
+            self._running.pop(process, None)
+
+
+# Two processes, with two pipes each, for each of the last 16 repositories
+# read from.
+processes = _ProcessLimit(32)
+
+
+class _BatchProcess(object):
+
+    '''One ``git cat-file`` process in batch mode, and a lock for it.'''
+
+    def __init__(self, dirname, option, limit=None):
+        self.dirname = dirname
+        self.option = option
+        self.lock = threading.Lock()
+        self.process = None
+        self.limit = processes if limit is None else limit
+
+    def _start(self):
+        env = dict(os.environ)
+        # See morphlib.git.gitcmd.
+        env['GIT_NO_REPLACE_OBJECTS'] = '1'
+        logging.debug('Starting git cat-file %s in %s' %
+                      (self.option, self.dirname))
+        self.process = subprocess.Popen(
+            ['git', 'cat-file', self.option], cwd=self.dirname, env=env,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def stop(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+                self.process.stdout.close()
+            except IOError: # pragma: no cover
+                pass
+            self.process.wait()
+            self.process = None
+        self.limit.stopped(self)
+
+    def _request(self, spec):
+        if self.process is None:
+            self._start()
+        self.process.stdin.write(spec + '\n')
+        self.process.stdin.flush()
+        header = self.process.stdout.readline()
+        if not header.endswith('\n'):
+            raise IOError('git cat-file exited unexpectedly')
+        # The spec is repeated in these, and may contain spaces itself.
+        if header.endswith((' missing\n', ' ambiguous\n')):
+            return None
+        sha1, kind, size = header.split()
+        contents = None
+        if self.option == '--batch':
+            size = int(size)
+            contents = self.process.stdout.read(size + 1)
+            if len(contents) != size + 1:
+                raise IOError('git cat-file exited unexpectedly')
+            contents = contents[:-1]
+        return sha1, kind, contents
+
+    def request(self, spec):
+        '''Ask git about an object, restarting git if it has failed.'''
+
+        if '\n' in spec:
+            raise ObjectReaderError(self.dirname,
+                                    'Invalid object name %r' % spec)
+        with self.lock:
+            for attempt in (1, 2):
+                try:
+                    result = self._request(spec)
+                    self.limit.used(self)
+                    return result
+                except (IOError, OSError), e:
+                    logging.warning('git cat-file %s in %s failed: %s' %
+                                    (self.option, self.dirname, e))
+                    self.stop()
+            raise ObjectReaderError(self.dirname, str(e))
+
+
+class ObjectReader(object):
+
+    '''Read objects from a git repository through long-running processes.
+
+    A ``git cat-file --batch-check`` and a ``git cat-file --batch`` process
+    are started the first time they are needed, and are then used for all
+    lookups, from any thread, until ``close`` is called. If one of them
+    fails it is restarted. Only a few readers keep their processes
+    running at once, as many repositories may be read from in one run;
+    see ``processes``.
+
+    Objects are named with anything ``git rev-parse`` accepts, for example
+    ``master^{tree}`` or ``SHA1:path/to/file``.
+
+    '''
+
+    def __init__(self, dirname, limit=None):
+        self.dirname = dirname
+        self._check = _BatchProcess(dirname, '--batch-check', limit)
+        self._batch = _BatchProcess(dirname, '--batch', limit)
+
+    def close(self):
+        '''Stop the git processes. They are started again when needed.'''
+
+        self._check.stop()
+        self._batch.stop()
+
+    def info(self, spec):
+        '''Return the sha1 and type of an object, or None if it is missing.'''
+
+        result = self._check.request(spec)
+        if result is None:
+            return None
+        sha1, kind, contents = result
+        return sha1, kind
+
+    def read(self, spec):
+        '''Return the sha1, type and contents of an object, or None.'''
+
+        return self._batch.request(spec)
+
+    def tree_entries(self, spec):
+        '''Return the entries of a tree, or None if it is missing.
+
+        Each entry is a tuple of the mode, type, sha1 and name, as listed
+        by ``git ls-tree``. A commit can be given instead of its tree.
+
+        '''
+
+        result = self.read('%s^{tree}' % spec)
+        if result is None:
+            return None
+        sha1, kind, data = result
+        entries = []
+        pos = 0
+        while pos < len(data):
+            space = data.index(' ', pos)
+            nul = data.index('\0', space)
+            mode = data[pos:space].rjust(6, '0')
+            name = data[space+1:nul]
+            sha1 = data[nul+1:nul+21].encode('hex')
+            if mode == '040000':
+                kind = 'tree'
+            elif mode == '160000':
+                kind = 'commit'
+            else:
+                kind = 'blob'
+            entries.append((mode, kind, sha1, name))
+            pos = nul + 21
+        return entries
+
+    def list_files(self, spec, recurse=True):
+        '''List the names of files in a tree, as ``git ls-tree`` would.
+
+        With recurse, subtrees are listed instead of named, as with
+        the -r option.
+
+        '''
+
+        entries = self.tree_entries(spec)
+        if entries is None:
+            return None
+        result = []
+        for mode, kind, sha1, name in entries:
+            if recurse and kind == 'tree':
+                result.extend('%s/%s' % (name, x)
+                              for x in self.list_files(sha1))
+            else:
+                result.append(name)
+        return result
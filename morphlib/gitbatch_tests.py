@@ -0,0 +1,167 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+import StringIO
+
+import morphlib
+
+
+class FakeProcess(object):
+
+    '''A git cat-file process that exits after writing some output.'''
+
+    def __init__(self, output):
+        self.stdin = StringIO.StringIO()
+        self.stdout = StringIO.StringIO(output)
+
+    def wait(self):
+        return 1
+
+
+class ObjectReaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dirname = os.path.join(self.tempdir, 'repo')
+        os.makedirs(os.path.join(self.dirname, 'dir', 'subdir'))
+        with open(os.path.join(self.dirname, 'foo'), 'w') as f:
+            f.write('foo contents\n')
+        with open(os.path.join(self.dirname, 'dir', 'subdir', 'bar'),
+                  'w') as f:
+            f.write('')
+        os.symlink('foo', os.path.join(self.dirname, 'link'))
+        self.git('init', '-q')
+        self.git('add', '.')
+        self.git('-c', 'user.name=Test', '-c', 'user.email=test@example.com',
+                 'commit', '-q', '-m', 'Initial commit')
+        self.reader = morphlib.gitbatch.ObjectReader(self.dirname)
+
+    def tearDown(self):
+        self.reader.close()
+        shutil.rmtree(self.tempdir)
+
+    def git(self, *args):
+        return subprocess.check_output(['git'] + list(args), cwd=self.dirname)
+
+    def test_resolves_refs(self):
+        commit = self.git('rev-parse', 'HEAD').strip()
+        tree = self.git('rev-parse', 'HEAD^{tree}').strip()
+        self.assertEqual(self.reader.info('HEAD'), (commit, 'commit'))
+        self.assertEqual(self.reader.info('HEAD^{tree}'), (tree, 'tree'))
+
+    def test_returns_none_for_missing_objects(self):
+        self.assertEqual(self.reader.info('no-such-ref'), None)
+        self.assertEqual(self.reader.read('HEAD:no-such-file'), None)
+        self.assertEqual(self.reader.tree_entries('no-such-ref'), None)
+
+    def test_reads_file_contents(self):
+        sha1, kind, contents = self.reader.read('HEAD:foo')
+        self.assertEqual(kind, 'blob')
+        self.assertEqual(contents, 'foo contents\n')
+        self.assertEqual(self.reader.read('HEAD:dir/subdir/bar')[2], '')
+
+    def test_lists_tree_entries_like_ls_tree(self):
+        expected = []
+        for line in self.git('ls-tree', 'HEAD').splitlines():
+            info, name = line.split('\t')
+            expected.append(tuple(info.split()) + (name,))
+        self.assertEqual(self.reader.tree_entries('HEAD'), expected)
+
+    def test_lists_files_like_ls_tree(self):
+        self.assertEqual(self.reader.list_files('HEAD'),
+                         ['dir/subdir/bar', 'foo', 'link'])
+        self.assertEqual(self.reader.list_files('HEAD', recurse=False),
+                         ['dir', 'foo', 'link'])
+
+    def test_returns_none_for_missing_names_with_spaces(self):
+        self.assertEqual(self.reader.info('HEAD:a b missing'), None)
+        self.assertEqual(self.reader.read('HEAD:a 1 2'), None)
+
+    def test_lists_submodules_as_commits(self):
+        commit = self.git('rev-parse', 'HEAD').strip()
+        self.git('update-index', '--add', '--cacheinfo',
+                 '160000,%s,sub' % commit)
+        tree = self.git('write-tree').strip()
+        self.assertIn(('160000', 'commit', commit, 'sub'),
+                      self.reader.tree_entries(tree))
+        self.assertIn('sub', self.reader.list_files(tree))
+
+    def test_does_not_list_missing_trees(self):
+        self.assertEqual(self.reader.list_files('no-such-ref'), None)
+
+    def test_restarts_git_after_missing_header(self):
+        self.reader._batch.process = FakeProcess('')
+        self.assertEqual(self.reader.read('HEAD:foo')[2], 'foo contents\n')
+
+    def test_restarts_git_after_short_contents(self):
+        self.reader._batch.process = FakeProcess('%s blob 13\nfoo' %
+                                                 ('0' * 40))
+        self.assertEqual(self.reader.read('HEAD:foo')[2], 'foo contents\n')
+
+    def test_fails_when_git_cannot_be_started(self):
+        reader = morphlib.gitbatch.ObjectReader(
+            os.path.join(self.tempdir, 'missing'))
+        self.assertRaises(morphlib.gitbatch.ObjectReaderError,
+                          reader.info, 'HEAD')
+
+    def test_restarts_git_after_failure(self):
+        self.reader.read('HEAD:foo')
+        self.reader._batch.process.kill()
+        self.reader._batch.process.wait()
+        self.assertEqual(self.reader.read('HEAD:foo')[2], 'foo contents\n')
+
+    def test_rejects_names_with_newlines(self):
+        self.assertRaises(morphlib.gitbatch.ObjectReaderError,
+                          self.reader.info, 'HEAD\nHEAD')
+
+    def test_stops_least_recently_used_processes_over_the_limit(self):
+        limit = morphlib.gitbatch._ProcessLimit(2)
+        readers = [morphlib.gitbatch.ObjectReader(self.dirname, limit)
+                   for i in xrange(3)]
+        try:
+            for reader in readers:
+                reader.info('HEAD')
+            self.assertEqual(len(limit), 2)
+            self.assertEqual(readers[0]._check.process, None)
+            readers[0].info('HEAD')
+            self.assertEqual(readers[1]._check.process, None)
+            self.assertNotEqual(readers[2]._check.process, None)
+            self.assertEqual(readers[1].read('HEAD:foo')[2],
+                             'foo contents\n')
+            self.assertEqual(len(limit), 2)
+        finally:
+            for reader in readers:
+                reader.close()
+        self.assertEqual(len(limit), 0)
+
+    def test_leaves_processes_in_use_running(self):
+        limit = morphlib.gitbatch._ProcessLimit(1)
+        busy = morphlib.gitbatch.ObjectReader(self.dirname, limit)
+        other = morphlib.gitbatch.ObjectReader(self.dirname, limit)
+        try:
+            busy.info('HEAD')
+            with busy._check.lock:
+                other.info('HEAD')
+            self.assertNotEqual(busy._check.process, None)
+            self.assertEqual(len(limit), 2)
+        finally:
+            busy.close()
+            other.close()
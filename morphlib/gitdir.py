@@ -1,4 +1,4 @@
-# Copyright (C) 2013-2015  Codethink Limited
+# Copyright (C) 2013-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -381,6 +381,7 @@ class GitDirectory(object):
 
         self.dirname = dirname
         self._config = {}
+        self._objects = morphlib.gitbatch.ObjectReader(dirname)
 
         self._ensure_is_git_repo()
 
@@ -458,14 +459,20 @@ class GitDirectory(object):
         blob_id = '%s:%s' % (ref, filename)
         return self.get_blob_contents(blob_id)
 
-    def get_blob_contents(self, blob_id): # pragma: no cover
+    def _read_object(self, object_id, kind):
+        result = self._objects.read(object_id)
+        if result is None or result[1] != kind:
+            raise cliapp.AppException('%s is not a %s in repo %s' %
+                                      (object_id, kind, self))
+        return result[2]
+
+    def get_blob_contents(self, blob_id):
         '''Get file contents from git by ID'''
-        return morphlib.git.gitcmd(self._runcmd, 'cat-file', 'blob', blob_id)
+        return self._read_object(blob_id, 'blob')
 
-    def get_commit_contents(self, commit_id): # pragma: no cover
+    def get_commit_contents(self, commit_id):
         '''Get commit contents from git by ID'''
-        return morphlib.git.gitcmd(self._runcmd, 'cat-file', 'commit',
-                                   commit_id)
+        return self._read_object(commit_id, 'commit')
 
     def update_submodules(self, app): # pragma: no cover
         '''Change .gitmodules URLs, and checkout submodules.'''
@@ -506,6 +513,9 @@ class GitDirectory(object):
 
     def update_remotes(self, echo_stderr=False): # pragma: no cover
         '''Run "git remote update --prune".'''
+        # The object readers may not see objects or refs that are added
+        # by the update.
+        self._objects.close()
         morphlib.git.gitcmd(self._runcmd, 'remote', 'update', '--prune',
                             echo_stderr=echo_stderr)
 
@@ -531,11 +541,10 @@ class GitDirectory(object):
             return self._list_files_in_ref(ref, recurse)
 
     def _rev_parse(self, ref):
-        try:
-            return morphlib.git.gitcmd(self._runcmd, 'rev-parse',
-                                       '--verify', ref).strip()
-        except cliapp.AppException as e:
+        info = self._objects.info(ref)
+        if info is None:
             raise InvalidRefError(self, ref)
+        return info[0]
 
     def disambiguate_ref(self, ref): # pragma: no cover
         try:
@@ -591,17 +600,7 @@ class GitDirectory(object):
 
     def _list_files_in_ref(self, ref, recurse=True):
         tree = self.resolve_ref_to_tree(ref)
-
-        command = ['ls-tree', '--name-only', '-z']
-        if recurse:
-            command.append('-r')
-        command.append(tree)
-
-        output = morphlib.git.gitcmd(self._runcmd, *command)
-        # ls-tree appends \0 instead of interspersing, so we need to
-        # strip the trailing \0 before splitting
-        paths = output.strip('\0').split('\0')
-        return paths
+        return self._objects.list_files(tree, recurse)
 
     def read_file(self, filename, ref=None):
         '''Attempts to read a file, from the working tree or a given ref.
@@ -629,10 +628,11 @@ class GitDirectory(object):
         if ref is None:
             filepath = os.path.join(self.dirname, filename.lstrip('/'))
             return os.path.islink(filepath)
-        tree_entry = morphlib.git.gitcmd(self._runcmd, 'ls-tree', ref,
-                                         filename)
-        file_mode = tree_entry.split(' ', 1)[0]
-        return file_mode == '120000'
+        dirname, basename = os.path.split(filename.strip('/'))
+        entries = self._objects.tree_entries(
+            '%s:%s' % (ref, dirname) if dirname else ref) or []
+        return any(mode == '120000' and name == basename
+                   for mode, kind, sha1, name in entries)
 
     @property
     def HEAD(self):
@@ -0,0 +1,124 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import json
+import logging
+import os
+
+import morphlib
+
+
+class JsonStore(object):
+
+    '''Keep tables of entries in a JSON file between runs of morph.
+
+    The file has a header, and a dict for each of the named ``tables``.
+    Entries are only valid for the header they were saved with, so the
+    tables are loaded empty if the header has changed, except for the
+    ``unversioned`` ones, whose entries do not depend on it. A file that
+    cannot be read or parsed is treated as empty.
+
+    Entries that are looked up or added are always kept when the store
+    is saved. Other entries are kept too, until a table has
+    ``max_entries``. Several runs of morph can use the same file at
+    once, so ``save`` reads it again and keeps what the others saved
+    since it was loaded, rather than overwriting it.
+
+    '''
+
+    def __init__(self, filename, header, tables, max_entries,
+                 unversioned=()):
+        self.filename = filename
+        self.header = header
+        self.tables = list(tables) + list(unversioned)
+        self.unversioned = set(unversioned)
+        self.max_entries = max_entries
+        self._old = self._load()
+        self._new = dict((table, {}) for table in self.tables)
+
+    def _load(self):
+        tables = dict((table, {}) for table in self.tables)
+        try:
+            with open(self.filename) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError), e:
+            logging.debug('Not using %s: %s' % (self.filename, e))
+            return tables
+        if not isinstance(data, dict):
+            logging.debug('Not using %s: not a JSON object' % self.filename)
+            return tables
+        current = data.get('header') == self.header
+        if not current:
+            logging.debug('Entries in %s are out of date, ignoring them' %
+                          self.filename)
+        for table in self.tables:
+            entries = data.get(table)
+            if isinstance(entries, dict) and \
+               (current or table in self.unversioned):
+                tables[table] = entries
+        return tables
+
+    def get(self, table, key):
+        '''Return the entry for key in a table, or None.'''
+
+        value = self._new[table].get(key)
+        if value is None:
+            value = self._old[table].get(key)
+            if value is not None:
+                self._new[table][key] = value
+        return value
+
+    def has(self, table, key):
+        return key in self._new[table] or key in self._old[table]
+
+    def put(self, table, key, value):
+        self._new[table][key] = value
+
+    def entries(self, table):
+        '''Return a dict of every entry in a table.'''
+
+        result = dict(self._old[table])
+        result.update(self._new[table])
+        return result
+
+    def _merge(self, new, *older):
+        result = dict(new)
+        for entries in older:
+            for key, value in entries.iteritems():
+                if len(result) >= self.max_entries:
+                    return result
+                result.setdefault(key, value)
+        return result
+
+    def save(self):
+        '''Write the store to disk, with what others have saved to it.'''
+
+        saved = self._load()
+        data = {'header': self.header}
+        for table in self.tables:
+            data[table] = self._merge(self._new[table], saved[table],
+                                      self._old[table])
+
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        f = morphlib.savefile.SaveFile(self.filename, 'w')
+        try:
+            json.dump(data, f)
+        except BaseException:
+            f.abort()
+            raise
+        f.close()
@@ -0,0 +1,140 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+
+
+class JsonStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'cache', 'store.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def new_store(self, header=1, max_entries=10):
+        return morphlib.jsonstore.JsonStore(
+            self.filename, header, ['versioned'], max_entries,
+            unversioned=['unversioned'])
+
+    def write(self, text):
+        os.makedirs(os.path.dirname(self.filename))
+        with open(self.filename, 'w') as f:
+            f.write(text)
+
+    def test_starts_empty_without_a_file(self):
+        store = self.new_store()
+        self.assertEqual(store.get('versioned', 'key'), None)
+        self.assertFalse(store.has('versioned', 'key'))
+
+    def test_remembers_entries_after_save(self):
+        store = self.new_store()
+        store.put('versioned', 'key', 'value')
+        store.put('unversioned', 'key', 'other')
+        self.assertTrue(store.has('versioned', 'key'))
+        store.save()
+        store = self.new_store()
+        self.assertTrue(store.has('versioned', 'key'))
+        self.assertEqual(store.get('versioned', 'key'), 'value')
+        self.assertEqual(store.get('unversioned', 'key'), 'other')
+
+    def test_lists_loaded_and_added_entries(self):
+        store = self.new_store()
+        store.put('versioned', 'old', 1)
+        store.put('versioned', 'changed', 2)
+        store.save()
+        store = self.new_store()
+        store.put('versioned', 'changed', 3)
+        store.put('versioned', 'new', 4)
+        self.assertEqual(store.entries('versioned'),
+                         {'old': 1, 'changed': 3, 'new': 4})
+
+    def test_keeps_only_unversioned_entries_if_header_changes(self):
+        store = self.new_store()
+        store.put('versioned', 'key', 'value')
+        store.put('unversioned', 'key', 'other')
+        store.save()
+        store = self.new_store(header=2)
+        self.assertEqual(store.get('versioned', 'key'), None)
+        self.assertEqual(store.get('unversioned', 'key'), 'other')
+
+    def test_ignores_corrupt_file(self):
+        self.write('{not json')
+        store = self.new_store()
+        self.assertEqual(store.get('unversioned', 'key'), None)
+        store.put('versioned', 'key', 'value')
+        store.save()
+        self.assertEqual(self.new_store().get('versioned', 'key'), 'value')
+
+    def test_ignores_file_without_an_object(self):
+        self.write('[]')
+        self.assertEqual(self.new_store().get('unversioned', 'key'), None)
+
+    def test_ignores_tables_that_are_not_objects(self):
+        self.write('{"header": 1, "versioned": [], "unversioned": {"a": 1}}')
+        store = self.new_store()
+        self.assertEqual(store.get('versioned', 'a'), None)
+        self.assertEqual(store.get('unversioned', 'a'), 1)
+
+    def test_keeps_entries_saved_by_others_since_loading(self):
+        first = self.new_store()
+        second = self.new_store()
+        first.put('versioned', 'first', 1)
+        first.save()
+        second.put('versioned', 'second', 2)
+        second.save()
+        store = self.new_store()
+        self.assertEqual(store.get('versioned', 'first'), 1)
+        self.assertEqual(store.get('versioned', 'second'), 2)
+
+    def test_prefers_its_own_entries_to_those_saved_by_others(self):
+        first = self.new_store()
+        second = self.new_store()
+        first.put('versioned', 'key', 1)
+        first.save()
+        second.put('versioned', 'key', 2)
+        second.save()
+        self.assertEqual(self.new_store().get('versioned', 'key'), 2)
+
+    def test_keeps_used_entries_before_old_ones(self):
+        store = self.new_store()
+        store.put('versioned', 'old', 1)
+        store.put('versioned', 'used', 2)
+        store.save()
+        store = self.new_store(max_entries=1)
+        store.get('versioned', 'used')
+        store.put('versioned', 'new', 3)
+        store.save()
+        store = self.new_store()
+        self.assertEqual(store.get('versioned', 'old'), None)
+        self.assertEqual(store.get('versioned', 'used'), 2)
+        self.assertEqual(store.get('versioned', 'new'), 3)
+
+    def test_leaves_file_alone_if_entries_cannot_be_written(self):
+        store = self.new_store()
+        store.put('versioned', 'key', 'value')
+        store.save()
+        store.put('versioned', 'bad', object())
+        self.assertRaises(TypeError, store.save)
+        self.assertEqual(os.listdir(os.path.dirname(self.filename)),
+                         ['store.json'])
+        self.assertEqual(self.new_store().get('versioned', 'key'), 'value')
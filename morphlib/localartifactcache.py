@@ -1,4 +1,4 @@
-# Copyright (C) 2012, 2013, 2014  Codethink Limited
+# Copyright (C) 2012, 2013, 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -15,12 +15,223 @@
 
 
 import collections
+import contextlib
+import errno
+import fcntl
+import logging
 import os
+import sqlite3
+import threading
 import time
 
 import morphlib
 
 
+def split_basename(basename):
+    '''Split the name of a file in the cache into a cache key and the rest.
+
+    Files that are not named after a cache key, such as ones left over
+    while they were being saved, are their own cache key.
+
+    '''
+
+    cache_key, dot, name = basename.partition('.')
+    return cache_key, name
+
+
+CacheEntry = collections.namedtuple(
+    'CacheEntry', ('cache_key', 'artifacts', 'last_used', 'size', 'uses'))
+
+
+class EvictionReport(collections.namedtuple(
+        'EvictionReport',
+        ('removed', 'bytes_reclaimed', 'uses', 'uses_kept'))):
+
+    '''What evicting from a local artifact cache did.
+
+    ``removed`` lists the cache keys removed and ``bytes_reclaimed`` is
+    the size of their files. ``uses`` counts the times files of the cache
+    were used, as recorded in its index, and ``uses_kept`` the times
+    files that are still in the cache were.
+
+    '''
+
+    @property
+    def hit_rate_kept(self):
+        '''The share of the recorded uses that the cache could still serve.'''
+
+        if self.uses == 0:
+            return 1.0
+        return float(self.uses_kept) / self.uses
+
+
+class LocalArtifactCacheIndex(object):
+
+    '''An index of the files in a local artifact cache directory.
+
+    For every file, the index holds the cache key it is named after,
+    the rest of its name, its size, when it was last used, how many
+    times it has been used since it was saved, and the digest of its
+    contents if it was added to a content store. It is
+    kept in an SQLite database, so that morph processes sharing the
+    cache also share the index, and each thread gets its own connection
+    to it.
+
+    The index is updated by the LocalArtifactCache as it adds, uses and
+    removes files. It is made from what is on disk when the database is
+    new, and can be made again with ``rebuild``. Files found on disk
+    when they are used are added to it.
+
+    '''
+
+    format_version = 3
+
+    def __init__(self, dirname, filename):
+        self.dirname = dirname
+        self.filename = filename
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.filename, timeout=60,
+                                   isolation_level=None)
+            conn.text_factory = str
+            # The index can be made again from the files, so it is not
+            # worth waiting for the disk on every change.
+            conn.execute('PRAGMA synchronous = OFF')
+            if self._version(conn) != self.format_version:
+                with self._transaction(conn):
+                    # Another process may have made it meanwhile.
+                    if self._version(conn) != self.format_version:
+                        self._create(conn)
+                        self._rebuild(conn)
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _version(conn):
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _transaction(conn):
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException: # pragma: no cover
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _create(self, conn):
+        conn.execute('DROP TABLE IF EXISTS files')
+        conn.execute('CREATE TABLE files (basename TEXT PRIMARY KEY, '
+                     'cache_key TEXT NOT NULL, name TEXT NOT NULL, '
+                     'size INTEGER NOT NULL, last_used REAL NOT NULL, '
+                     'uses INTEGER NOT NULL, digest TEXT)')
+        conn.execute('CREATE INDEX files_cache_key ON files (cache_key)')
+        conn.execute('PRAGMA user_version = %d' % self.format_version)
+
+    def _row(self, basename):
+        try:
+            st = os.stat(os.path.join(self.dirname, basename))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise # pragma: no cover
+            return None
+        cache_key, name = split_basename(basename)
+        return (basename, cache_key, name, st.st_size, st.st_mtime, 0, None)
+
+    def _rebuild(self, conn):
+        conn.execute('DELETE FROM files')
+        rows = (self._row(basename) for basename in os.listdir(self.dirname)
+                if os.path.isfile(os.path.join(self.dirname, basename)))
+        conn.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         (row for row in rows if row is not None))
+
+    def rebuild(self):
+        '''Make the index again from the files on disk.'''
+
+        conn = self._connection()
+        with self._transaction(conn):
+            self._rebuild(conn)
+
+    def add(self, basename, uses=0, digest=None):
+        '''Add or update the entry of a file, marking it as just used.
+
+        The count of uses of the file goes up by ``uses``. The digest of
+        its contents is kept unless a new one is given.
+
+        '''
+
+        row = self._row(basename)
+        if row is not None:
+            self._connection().execute(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, '
+                'COALESCE((SELECT uses FROM files WHERE basename = ?), 0) '
+                '+ ?, COALESCE(?, (SELECT digest FROM files '
+                'WHERE basename = ?)))',
+                row[:4] + (time.time(), basename, uses, digest, basename))
+
+    def remove(self, basenames):
+        '''Remove the entries of some files.'''
+
+        self._connection().executemany(
+            'DELETE FROM files WHERE basename = ?',
+            ((basename,) for basename in basenames))
+
+    def clear(self):
+        '''Remove every entry.'''
+
+        self._connection().execute('DELETE FROM files')
+
+    def digests(self, cache_key):
+        '''Return the digests of the contents of the files of a cache key.'''
+
+        return [digest for (digest,) in self._connection().execute(
+            'SELECT DISTINCT digest FROM files '
+            'WHERE cache_key = ? AND digest IS NOT NULL', (cache_key,))]
+
+    def files(self, cache_key):
+        '''Return the names of the files of a cache key.'''
+
+        return [basename for (basename,) in self._connection().execute(
+            'SELECT basename FROM files WHERE cache_key = ? '
+            'ORDER BY basename', (cache_key,))]
+
+    def entries(self):
+        '''Return a CacheEntry for each cache key in the index.'''
+
+        entries = {}
+        for cache_key, name, size, last_used, uses in \
+                self._connection().execute('SELECT cache_key, name, size, '
+                                           'last_used, uses FROM files'):
+            entry = entries.get(cache_key)
+            if entry is None:
+                entry = entries[cache_key] = [set(), last_used, 0, 0]
+            entry[0].add(name)
+            entry[1] = max(entry[1], last_used)
+            entry[2] += size
+            entry[3] += uses
+        return [CacheEntry(cache_key, *entry)
+                for cache_key, entry in entries.iteritems()]
+
+
+class _CacheSaveFile(morphlib.savefile.SaveFile):
+
+    '''A SaveFile that tells the cache about the file once it is saved.'''
+
+    def __init__(self, cache, filename, *args, **kwargs):
+        morphlib.savefile.SaveFile.__init__(self, filename, *args, **kwargs)
+        self._cache = cache
+
+    def close(self):
+        ret = morphlib.savefile.SaveFile.close(self)
+        self._cache.record_file(self.real_filename)
+        return ret
+
+
 class LocalArtifactCache(object):
     '''Abstraction over the local artifact cache
 
@@ -43,26 +254,93 @@ class LocalArtifactCache(object):
 
        Since the cleanup logic will be complicated for other reasons it makes
        sense to put the complication there.
+
+       If an index filename is given, the cache keeps an index of its files
+       in it, so that listing the cache and removing cache keys does not
+       need to look at every file in the cache.
+
+       If max_size is more than 0, the least recently used cache keys are
+       evicted as files are saved, to keep the cache under max_size bytes.
+       This is done each time about a tenth of max_size has been saved, and
+       makes room for the next tenth, so the cost is spread over the puts.
+       Builds pin the cache keys they need so that they are not evicted
+       from under them. Pins are shared locks on files in pins_dirname, so
+       they are seen by every process using the cache; without it, cache
+       keys cannot be pinned.
+
+       If a content store directory is given, and dedup is true, each file
+       saved in the cache is added to a ContentStore there, so that files
+       with the same contents share one copy. The store must be on the
+       same file system as the cache. Once the files sharing a copy are
+       removed, the copy is removed too. Sizes in the index and max_size
+       count each file in full, whether it shares its contents or not.
        '''
 
-    def __init__(self, cachefs):
+    def __init__(self, cachefs, index_filename=None, max_size=0,
+                 pins_dirname=None, cas_dirname=None, dedup=False):
         self.cachefs = cachefs
+        self.index = None
+        if index_filename is not None:
+            self.index = LocalArtifactCacheIndex(self._join('/'),
+                                                 index_filename)
+        self.max_size = max_size
+        self.pins_dirname = pins_dirname
+        self.cas = None
+        if cas_dirname is not None:
+            self.cas = morphlib.contentstore.ContentStore(cas_dirname)
+        self.dedup = dedup and self.cas is not None
+        self._unchecked_size = 0
+        self._unchecked_lock = threading.Lock()
+
+    def _save_file(self, filename):
+        return _CacheSaveFile(self, filename, mode='w')
+
+    def _use(self, filename):
+        os.utime(filename, None)
+        if self.index is not None:
+            self.index.add(os.path.basename(filename), uses=1)
 
     def put(self, artifact):
         filename = self.artifact_filename(artifact)
-        return morphlib.savefile.SaveFile(filename, mode='w')
+        return self._save_file(filename)
 
     def put_artifact_metadata(self, artifact, name):
         filename = self._artifact_metadata_filename(artifact, name)
-        return morphlib.savefile.SaveFile(filename, mode='w')
+        return self._save_file(filename)
 
     def put_source_metadata(self, source, cachekey, name):
         filename = self._source_metadata_filename(source, cachekey, name)
-        return morphlib.savefile.SaveFile(filename, mode='w')
+        return self._save_file(filename)
+
+    def record_file(self, filename):
+        '''Note a file put in the cache directory without using put.'''
+
+        digest = None
+        if self.dedup:
+            digest = self.cas.add(filename)
+        if self.index is not None:
+            self.index.add(os.path.basename(filename), digest=digest)
+        if self.max_size > 0:
+            self._account(os.path.getsize(filename))
+
+    def _account(self, size):
+        slack = self.max_size // 10
+        with self._unchecked_lock:
+            self._unchecked_size += size
+            if self._unchecked_size < slack:
+                return
+            self._unchecked_size = 0
+        report = self.evict(self.max_size - slack)
+        if report.removed:
+            logging.info('Evicted %d sources from the artifact cache, '
+                         'reclaiming %d bytes and keeping %.1f%% of the '
+                         'recorded hits' %
+                         (len(report.removed), report.bytes_reclaimed,
+                          100 * report.hit_rate_kept))
 
     def _has_file(self, filename):
         if os.path.exists(filename):
-            os.utime(filename, None)
+            self._use(filename)
             return True
         return False
 
@@ -80,12 +358,12 @@ class LocalArtifactCache(object):
 
     def get(self, artifact):
         filename = self.artifact_filename(artifact)
-        os.utime(filename, None)
+        self._use(filename)
         return open(filename)
 
     def get_artifact_metadata(self, artifact, name):
         filename = self._artifact_metadata_filename(artifact, name)
-        os.utime(filename, None)
+        self._use(filename)
         return open(filename)
 
     def get_source_metadata_filename(self, source, cachekey, name):
@@ -93,7 +371,7 @@ class LocalArtifactCache(object):
 
     def get_source_metadata(self, source, cachekey, name):
         filename = self._source_metadata_filename(source, cachekey, name)
-        os.utime(filename, None)
+        self._use(filename)
         return open(filename)
 
     def _join(self, basename):
@@ -123,6 +401,51 @@ class LocalArtifactCache(object):
          '''
         for filename in self.cachefs.walkfiles():
             self.cachefs.remove(filename)
+        if self.index is not None:
+            self.index.clear()
+        if self.cas is not None:
+            self.cas.collect()
+
+    def rebuild_index(self):
+        '''Make the index of the cache again from the files on disk.
+
+        The index forgets which contents the files share in the content
+        store, so the shared copies are then only removed by its
+        ``collect``, as gc does.
+
+        '''
+
+        if self.index is not None:
+            self.index.rebuild()
+
+    def _walk_entries(self):
+        entries = {}
+        for filename in self.cachefs.walkfiles():
+            cache_key, name = split_basename(filename.lstrip('/'))
+            info = self.cachefs.getinfo(filename)
+            mtime = time.mktime(info['modified_time'].timetuple())
+            entry = entries.get(cache_key)
+            if entry is None:
+                entry = entries[cache_key] = [set(), mtime, 0, 0]
+            entry[0].add(name)
+            entry[1] = max(entry[1], mtime)
+            entry[2] += info['size']
+        return [CacheEntry(cache_key, *entry)
+                for cache_key, entry in entries.iteritems()]
+
+    def list_entries(self):
+        '''Return a CacheEntry for each cache key in the cache.
+
+        Each entry has the cache key, the set of the rest of the names
+        of its files, when any of them was last used, the total size of
+        the files, and how many times they have been used. Uses are only
+        counted by the index.
+
+        '''
+
+        if self.index is not None:
+            return self.index.entries()
+        return self._walk_entries()
 
     def list_contents(self):
         '''Return the set of sources cached and related information.
@@ -130,22 +453,125 @@ class LocalArtifactCache(object):
            returns a [(cache_key, set(artifacts), last_used)]
 
         '''
-        CacheInfo = collections.namedtuple('CacheInfo', ('artifacts', 'mtime'))
-        contents = collections.defaultdict(lambda: CacheInfo(set(), 0))
-        for filename in self.cachefs.walkfiles():
-            cachekey = filename[:63]
-            artifact = filename[65:]
-            artifacts, max_mtime = contents[cachekey]
-            artifacts.add(artifact)
-            art_info = self.cachefs.getinfo(filename)
-            time_t = art_info['modified_time'].timetuple()
-            contents[cachekey] = CacheInfo(artifacts,
-                                           max(max_mtime, time.mktime(time_t)))
-        return ((cache_key, info.artifacts, info.mtime)
-                for cache_key, info in contents.iteritems())
+        return ((entry.cache_key, entry.artifacts, entry.last_used)
+                for entry in self.list_entries())
+
+    def list_files(self, cachekey):
+        '''Return the names of the files cached for a cache key.'''
+
+        if self.index is not None:
+            return self.index.files(cachekey)
+        return sorted(filename.lstrip('/')
+                      for filename in self.cachefs.walkfiles()
+                      if split_basename(filename.lstrip('/'))[0] == cachekey)
 
     def remove(self, cachekey):
         '''Remove all artifacts associated with the given cachekey.'''
-        for filename in (x for x in self.cachefs.walkfiles()
-                         if x.startswith(cachekey)):
-            self.cachefs.remove(filename)
+        basenames = self.list_files(cachekey)
+        digests = []
+        if self.index is not None and self.cas is not None:
+            digests = self.index.digests(cachekey)
+        for basename in basenames:
+            try:
+                os.remove(self._join(basename))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise # pragma: no cover
+        if self.index is not None:
+            self.index.remove(basenames)
+        if self.cas is not None:
+            # Without an index, the contents of the files are not known.
+            if self.index is None:
+                self.cas.collect()
+            for digest in digests:
+                self.cas.release(digest)
+
+    def _pin_filename(self, cachekey):
+        return os.path.join(self.pins_dirname, '%s.pin' % cachekey)
+
+    def _lock_pin(self, cachekey, operation):
+        '''Open and lock the pin file of a cache key.
+
+        Return the open file, or None if the lock was not free and
+        operation asked not to wait for it.
+
+        '''
+
+        try:
+            os.makedirs(self.pins_dirname)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise # pragma: no cover
+        filename = self._pin_filename(cachekey)
+        while True:
+            f = open(filename, 'a')
+            try:
+                fcntl.flock(f.fileno(), operation)
+            except IOError as e:
+                f.close()
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise # pragma: no cover
+                return None
+            # The cache key may have been evicted, and the pin file
+            # removed, while this waited for the lock.
+            try:
+                if os.path.samestat(os.fstat(f.fileno()), os.stat(filename)):
+                    return f
+            except OSError as e: # pragma: no cover
+                if e.errno != errno.ENOENT:
+                    raise
+            f.close() # pragma: no cover
+
+    @contextlib.contextmanager
+    def pin(self, cachekeys):
+        '''Stop some cache keys from being evicted while in this block.'''
+
+        pins = []
+        try:
+            if self.pins_dirname is not None:
+                for cachekey in set(cachekeys):
+                    pins.append(self._lock_pin(cachekey, fcntl.LOCK_SH))
+            yield
+        finally:
+            for f in pins:
+                f.close()
+
+    def remove_unpinned(self, cachekey):
+        '''Remove the artifacts of a cache key unless it is pinned.
+
+        Return True if they were removed.
+
+        '''
+
+        if self.pins_dirname is None:
+            self.remove(cachekey)
+            return True
+        f = self._lock_pin(cachekey, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if f is None:
+            return False
+        with f:
+            self.remove(cachekey)
+            os.remove(self._pin_filename(cachekey))
+        return True
+
+    def evict(self, max_size):
+        '''Remove the least recently used cache keys to fit in max_size.
+
+        Pinned cache keys are kept. Return an EvictionReport.
+
+        '''
+
+        entries = sorted(self.list_entries(), key=lambda e: e.last_used)
+        size = sum(entry.size for entry in entries)
+        uses = sum(entry.uses for entry in entries)
+        removed = []
+        reclaimed = 0
+        uses_kept = uses
+        for entry in entries:
+            if size - reclaimed <= max_size:
+                break
+            if self.remove_unpinned(entry.cache_key):
+                removed.append(entry.cache_key)
+                reclaimed += entry.size
+                uses_kept -= entry.uses
+        return EvictionReport(removed, reclaimed, uses, uses_kept)
@@ -1,4 +1,4 @@
-# Copyright (C) 2012,2014  Codethink Limited
+# Copyright (C) 2012,2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -14,8 +14,12 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
-import unittest
 import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
 
 import fs.tempfs
 
@@ -190,3 +194,378 @@ class LocalArtifactCacheTests(unittest.TestCase):
         cache.remove(key)
 
         self.assertEqual(len(list(cache.list_contents())), 0)
+
+
+class FakeSource(object):
+
+    def __init__(self, cache_key):
+        self.cache_key = cache_key
+
+    def basename(self):
+        return '%s.chunk' % self.cache_key
+
+
+class IndexedLocalArtifactCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempfs = fs.tempfs.TempFS()
+        self.tempdir = tempfile.mkdtemp()
+        self.index_filename = os.path.join(self.tempdir, 'index.sqlite')
+        self.cache = self.new_cache()
+        self.foo = FakeSource('a' * 64)
+        self.bar = FakeSource('b' * 64)
+        self.foo_bins = morphlib.artifact.Artifact(self.foo, 'foo-bins')
+        self.foo_devel = morphlib.artifact.Artifact(self.foo, 'foo-devel')
+        self.bar_bins = morphlib.artifact.Artifact(self.bar, 'bar-bins')
+
+    def tearDown(self):
+        self.tempfs.close()
+        shutil.rmtree(self.tempdir)
+
+    def new_cache(self):
+        return morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs, self.index_filename)
+
+    def put(self, artifact, data='data'):
+        with self.cache.put(artifact) as f:
+            f.write(data)
+
+    def contents(self, cache=None):
+        return sorted((cache or self.cache).list_contents())
+
+    def fail_to_walk(self):
+        def walkfiles():
+            raise AssertionError('cache directory should not be walked')
+        self.tempfs.walkfiles = walkfiles
+
+    def test_lists_whole_cache_keys_without_walking_the_cache(self):
+        self.put(self.foo_bins)
+        self.put(self.foo_devel)
+        with self.cache.put_source_metadata(self.foo, self.foo.cache_key,
+                                            'meta') as f:
+            f.write('{}')
+        self.fail_to_walk()
+        [(cache_key, artifacts, last_used)] = self.contents()
+        self.assertEqual(cache_key, 'a' * 64)
+        self.assertEqual(artifacts, set(['chunk.foo-bins', 'chunk.foo-devel',
+                                         'meta']))
+
+    def test_lists_files_and_sizes_of_cache_keys(self):
+        self.put(self.foo_bins, 'twelve bytes')
+        self.put(self.foo_devel, 'four')
+        self.put(self.bar_bins)
+        self.assertEqual(self.cache.list_files('a' * 64),
+                         [self.foo_bins.basename(),
+                          self.foo_devel.basename()])
+        sizes = dict((e.cache_key, e.size)
+                     for e in self.cache.list_entries())
+        self.assertEqual(sizes, {'a' * 64: 16, 'b' * 64: 4})
+
+    def test_does_not_index_aborted_files(self):
+        self.cache.put(self.foo_bins).abort()
+        self.assertEqual(self.contents(), [])
+
+    def test_removes_only_the_files_of_a_cache_key(self):
+        self.put(self.foo_bins)
+        self.put(self.foo_devel)
+        self.put(self.bar_bins)
+        self.fail_to_walk()
+        self.cache.remove('a' * 64)
+        self.assertEqual([e[0] for e in self.contents()], ['b' * 64])
+        self.assertFalse(self.cache.has(self.foo_bins))
+        self.assertTrue(self.cache.has(self.bar_bins))
+
+    def test_ignores_files_already_gone_when_removing(self):
+        self.put(self.foo_bins)
+        os.remove(self.cache.artifact_filename(self.foo_bins))
+        self.cache.remove('a' * 64)
+        self.assertEqual(self.contents(), [])
+
+    def test_marks_files_as_used(self):
+        self.put(self.foo_bins)
+        self.put(self.bar_bins)
+        before = dict((e[0], e[2]) for e in self.contents())
+        time.sleep(0.01)
+        self.cache.get(self.foo_bins).close()
+        after = dict((e[0], e[2]) for e in self.contents())
+        self.assertTrue(after['a' * 64] > before['a' * 64])
+        self.assertEqual(after['b' * 64], before['b' * 64])
+
+    def test_indexes_files_put_there_by_other_means(self):
+        self.assertEqual(self.contents(), [])
+        filename = self.cache.get_source_metadata_filename(
+            self.foo, self.foo.cache_key, 'build-log')
+        with open(filename, 'w') as f:
+            f.write('log')
+        self.assertEqual(self.contents(), [])
+        self.cache.record_file(filename)
+        self.assertEqual(self.contents()[0][1], set(['build-log']))
+
+    def test_ignores_missing_files_when_recording(self):
+        self.cache.record_file(self.cache.artifact_filename(self.foo_bins))
+        self.assertEqual(self.contents(), [])
+
+    def test_makes_index_from_existing_files(self):
+        unindexed = morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs)
+        with unindexed.put(self.foo_bins) as f:
+            f.write('data')
+        with open(os.path.join(self.tempfs.getsyspath('/'), 'tmpXYZ'),
+                  'w'):
+            pass
+        os.mkdir(os.path.join(self.tempfs.getsyspath('/'), 'cas'))
+        cache = morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs, os.path.join(self.tempdir, 'new.sqlite'))
+        self.assertEqual(sorted(e[0] for e in cache.list_contents()),
+                         ['a' * 64, 'tmpXYZ'])
+
+    def test_rebuilds_index_from_disk(self):
+        self.put(self.foo_bins)
+        os.remove(self.cache.artifact_filename(self.foo_bins))
+        unindexed = morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs)
+        with unindexed.put(self.bar_bins) as f:
+            f.write('data')
+        self.cache.rebuild_index()
+        self.assertEqual([e[0] for e in self.contents()], ['b' * 64])
+
+    def test_clears_index(self):
+        self.put(self.foo_bins)
+        self.cache.clear()
+        self.assertEqual(self.contents(), [])
+
+    def test_shares_index_between_caches_and_threads(self):
+        self.put(self.foo_bins)
+        other = self.new_cache()
+        thread = threading.Thread(target=self.put, args=(self.bar_bins,))
+        thread.start()
+        thread.join()
+        self.assertEqual([e[0] for e in self.contents(other)],
+                         ['a' * 64, 'b' * 64])
+
+    def test_lists_whole_cache_keys_without_an_index(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(self.tempfs)
+        with cache.put(self.foo_bins) as f:
+            f.write('data')
+        self.assertEqual([e[0] for e in cache.list_contents()], ['a' * 64])
+        self.assertEqual([e.size for e in cache.list_entries()], [4])
+        self.assertEqual(cache.list_files('a' * 64),
+                         [self.foo_bins.basename()])
+        cache.remove('a' * 64)
+        self.assertEqual(list(cache.list_contents()), [])
+        cache.rebuild_index()
+
+
+class EvictingLocalArtifactCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempfs = fs.tempfs.TempFS()
+        self.tempdir = tempfile.mkdtemp()
+        self.index_filename = os.path.join(self.tempdir, 'index.sqlite')
+        self.pins_dirname = os.path.join(self.tempdir, 'pins')
+        self.cache = self.new_cache()
+        self.artifacts = [self.artifact(i) for i in xrange(3)]
+        self.foo, self.bar, self.baz = self.artifacts
+        for artifact in self.artifacts:
+            self.put(artifact)
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.tempfs.close()
+        shutil.rmtree(self.tempdir)
+
+    def new_cache(self, max_size=0):
+        return morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs, self.index_filename, max_size=max_size,
+            pins_dirname=self.pins_dirname)
+
+    def artifact(self, i):
+        source = FakeSource('%064x' % i)
+        return morphlib.artifact.Artifact(source, 'bins')
+
+    def put(self, artifact, cache=None):
+        with (cache or self.cache).put(artifact) as f:
+            f.write('data')
+
+    def cached(self, cache=None):
+        entries = (cache or self.cache).list_entries()
+        return sorted(entry.cache_key for entry in entries)
+
+    def key(self, artifact):
+        return artifact.source.cache_key
+
+    def test_counts_uses_of_files(self):
+        self.cache.has(self.foo)
+        self.cache.has(self.foo)
+        self.cache.get(self.foo).close()
+        self.cache.has(self.bar)
+        uses = dict((e.cache_key, e.uses) for e in self.cache.list_entries())
+        self.assertEqual(uses, {self.key(self.foo): 3,
+                                self.key(self.bar): 1,
+                                self.key(self.baz): 0})
+
+    def test_evicts_least_recently_used_first(self):
+        self.cache.get(self.foo).close()
+        report = self.cache.evict(8)
+        self.assertEqual(report.removed, [self.key(self.bar)])
+        self.assertEqual(report.bytes_reclaimed, 4)
+        self.assertEqual(self.cached(),
+                         [self.key(self.foo), self.key(self.baz)])
+        self.assertFalse(self.cache.has(self.bar))
+
+    def test_does_nothing_when_the_cache_fits(self):
+        report = self.cache.evict(12)
+        self.assertEqual(report.removed, [])
+        self.assertEqual(report.bytes_reclaimed, 0)
+        self.assertEqual(len(self.cached()), 3)
+
+    def test_reports_the_hits_it_keeps(self):
+        self.cache.has(self.foo)
+        for i in xrange(3):
+            self.cache.has(self.baz)
+        report = self.cache.evict(4)
+        self.assertEqual(report.removed,
+                         [self.key(self.bar), self.key(self.foo)])
+        self.assertEqual((report.uses, report.uses_kept), (4, 3))
+        self.assertEqual(report.hit_rate_kept, 0.75)
+
+    def test_keeps_whole_hit_rate_without_recorded_hits(self):
+        report = self.cache.evict(0)
+        self.assertEqual(len(report.removed), 3)
+        self.assertEqual(report.hit_rate_kept, 1.0)
+
+    def test_does_not_evict_pinned_cache_keys(self):
+        with self.cache.pin([self.key(self.foo), self.key(self.foo)]):
+            report = self.cache.evict(4)
+            self.assertEqual(report.removed,
+                             [self.key(self.bar), self.key(self.baz)])
+        self.assertEqual(self.cached(), [self.key(self.foo)])
+        self.assertEqual(self.cache.evict(0).removed, [self.key(self.foo)])
+
+    def test_pins_are_seen_by_other_caches(self):
+        other = self.new_cache()
+        with self.cache.pin([self.key(self.bar)]):
+            self.assertFalse(other.remove_unpinned(self.key(self.bar)))
+            self.assertEqual(other.evict(0).removed,
+                             [self.key(self.foo), self.key(self.baz)])
+        self.assertEqual(self.cached(other), [self.key(self.bar)])
+
+    def test_removes_pin_files_of_evicted_cache_keys(self):
+        with self.cache.pin([self.key(self.foo)]):
+            pass
+        self.assertEqual(os.listdir(self.pins_dirname),
+                         ['%s.pin' % self.key(self.foo)])
+        self.assertTrue(self.cache.remove_unpinned(self.key(self.foo)))
+        self.assertEqual(os.listdir(self.pins_dirname), [])
+        with self.cache.pin([self.key(self.foo)]):
+            self.assertFalse(self.cache.remove_unpinned(self.key(self.foo)))
+
+    def test_evicts_as_artifacts_are_put(self):
+        cache = self.new_cache(max_size=100)
+        artifacts = [self.artifact(i) for i in xrange(3, 43)]
+        with cache.pin([self.key(self.foo)]):
+            for artifact in artifacts:
+                self.put(artifact, cache)
+                self.assertTrue(
+                    sum(e.size for e in cache.list_entries()) <= 100)
+        cached = self.cached(cache)
+        self.assertTrue(self.key(self.foo) in cached)
+        self.assertTrue(self.key(artifacts[-1]) in cached)
+        self.assertFalse(self.key(artifacts[0]) in cached)
+
+    def test_removes_without_pins_directory(self):
+        cache = morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs, self.index_filename)
+        with cache.pin([self.key(self.foo)]):
+            self.assertTrue(cache.remove_unpinned(self.key(self.foo)))
+        self.assertEqual(cache.evict(4).removed, [self.key(self.bar)])
+        self.assertFalse(os.path.exists(self.pins_dirname))
+
+
+class DedupLocalArtifactCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempfs = fs.tempfs.TempFS()
+        self.tempdir = tempfile.mkdtemp()
+        self.index_filename = os.path.join(self.tempdir, 'index.sqlite')
+        self.cas_dirname = os.path.join(self.tempdir, 'cas')
+        self.cache = self.new_cache()
+        self.foo = morphlib.artifact.Artifact(FakeSource('a' * 64), 'bins')
+        self.bar = morphlib.artifact.Artifact(FakeSource('b' * 64), 'bins')
+
+    def tearDown(self):
+        self.tempfs.close()
+        shutil.rmtree(self.tempdir)
+
+    def new_cache(self, index_filename=True, dedup=True):
+        if index_filename is True:
+            index_filename = self.index_filename
+        return morphlib.localartifactcache.LocalArtifactCache(
+            self.tempfs, index_filename, cas_dirname=self.cas_dirname,
+            dedup=dedup)
+
+    def put(self, artifact, data='data', cache=None):
+        with (cache or self.cache).put(artifact) as f:
+            f.write(data)
+        return (cache or self.cache).artifact_filename(artifact)
+
+    def blobs(self):
+        return self.cache.cas.stats().blobs
+
+    def test_stores_the_same_contents_once(self):
+        foo = self.put(self.foo)
+        bar = self.put(self.bar)
+        self.assertTrue(os.path.samefile(foo, bar))
+        stats = self.cache.cas.stats()
+        self.assertEqual((stats.blobs, stats.links), (1, 2))
+        self.assertEqual(stats.ratio, 2.0)
+        with self.cache.get(self.bar) as f:
+            self.assertEqual(f.read(), 'data')
+
+    def test_keeps_different_contents_apart(self):
+        foo = self.put(self.foo)
+        bar = self.put(self.bar, 'other data')
+        self.assertFalse(os.path.samefile(foo, bar))
+        self.assertEqual(self.blobs(), 2)
+
+    def test_stores_files_recorded_after_the_fact(self):
+        filename = self.cache.get_source_metadata_filename(
+            self.foo.source, self.foo.source.cache_key, 'build-log')
+        with open(filename, 'w') as f:
+            f.write('data')
+        self.cache.record_file(filename)
+        self.assertTrue(os.path.samefile(filename, self.put(self.bar)))
+
+    def test_only_dedups_when_asked(self):
+        cache = self.new_cache(dedup=False)
+        foo = self.put(self.foo, cache=cache)
+        bar = self.put(self.bar, cache=cache)
+        self.assertFalse(os.path.samefile(foo, bar))
+        self.assertEqual(self.blobs(), 0)
+
+    def test_removes_copies_once_nothing_shares_them(self):
+        self.put(self.foo)
+        self.put(self.bar)
+        self.cache.remove(self.foo.source.cache_key)
+        self.assertEqual(self.blobs(), 1)
+        self.cache.remove(self.bar.source.cache_key)
+        self.assertEqual(self.blobs(), 0)
+
+    def test_evicts_copies(self):
+        self.put(self.foo)
+        self.put(self.bar, 'other data')
+        self.cache.evict(0)
+        self.assertEqual(self.blobs(), 0)
+
+    def test_removes_copies_without_an_index(self):
+        cache = self.new_cache(index_filename=None)
+        self.put(self.foo, cache=cache)
+        cache.remove(self.foo.source.cache_key)
+        self.assertEqual(self.blobs(), 0)
+
+    def test_removes_copies_when_cleared(self):
+        cache = self.new_cache(index_filename=None)
+        self.put(self.foo, cache=cache)
+        self.put(self.bar, cache=cache)
+        cache.clear()
+        self.assertEqual(self.blobs(), 0)
@@ -0,0 +1,130 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import copy
+import json
+import re
+
+import morphlib
+
+
+def _strings_to_str(obj):
+    '''Turn unicode strings that are plain ASCII back into str.
+
+    The YAML parser returns str for ASCII text, so loaded morphologies
+    should look the same as freshly parsed ones.
+
+    '''
+
+    if isinstance(obj, unicode):
+        try:
+            return obj.encode('ascii')
+        except UnicodeEncodeError:
+            return obj
+    elif isinstance(obj, list):
+        return [_strings_to_str(x) for x in obj]
+    elif isinstance(obj, dict):
+        return dict((_strings_to_str(k), _strings_to_str(v))
+                    for k, v in obj.iteritems())
+    return obj
+
+
+class MorphologyCache(object):
+
+    '''Remember parsed morphologies and commit trees between runs of morph.
+
+    The contents of a file at a given commit never change, so a
+    morphology that has been loaded, validated and had its defaults set
+    can be stored under the repo, commit sha1 and filename it was read
+    from. The stored morphologies depend on the version of morph that
+    loaded them, so they are ignored if ``version`` has changed since
+    the cache was saved.
+
+    The tree sha1 of each commit is stored too, so that refs which are
+    already sha1s do not need to be resolved at all.
+
+    Everything is stored in one JSON file, which is written by ``save``.
+
+    '''
+
+    format_version = 1
+
+    def __init__(self, filename, version, max_entries=20000):
+        self.filename = filename
+        self.hits = 0
+        self.misses = 0
+        header = {
+            'format': self.format_version,
+            'version': version,
+        }
+        self._store = morphlib.jsonstore.JsonStore(
+            filename, header, ['morphologies'], max_entries,
+            unversioned=['trees'])
+
+    @staticmethod
+    def _key(*args):
+        return json.dumps(args)
+
+    def has_morphology(self, reponame, sha1, filename):
+        return self._store.has('morphologies',
+                               self._key(reponame, sha1, filename))
+
+    def get_morphology(self, reponame, sha1, filename):
+        '''Return a new copy of a stored morphology, or None.'''
+
+        stored = self._store.get('morphologies',
+                                 self._key(reponame, sha1, filename))
+        if stored is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        morph = morphlib.morphology.Morphology(
+            _strings_to_str(stored['data']))
+        morph.filename = _strings_to_str(stored['filename'])
+        return morph
+
+    def put_morphology(self, reponame, sha1, filename, morph):
+        '''Store a morphology read from a file in a commit.'''
+
+        self._store.put('morphologies', self._key(reponame, sha1, filename), {
+            'filename': morph.filename,
+            'data': copy.deepcopy(morph.data),
+        })
+
+    @staticmethod
+    def is_sha1(ref):
+        return re.match('^[0-9a-f]{40}$', ref) is not None
+
+    def get_tree(self, reponame, commit):
+        '''Return the tree sha1 of a commit, or None if it is not known.'''
+
+        tree = self._store.get('trees', self._key(reponame, commit))
+        if tree is not None:
+            return str(tree)
+        return None
+
+    def put_tree(self, reponame, commit, tree):
+        self._store.put('trees', self._key(reponame, commit), tree)
+
+    def save(self):
+        '''Write the cache to disk.
+
+        Entries used or added since the cache was loaded are always kept.
+        Older ones are kept too, until there are max_entries of each.
+
+        '''
+
+        self._store.save()
@@ -0,0 +1,115 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import morphlib
+
+
+class MorphologyCacheTests(unittest.TestCase):
+
+    sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+    tree = 'ecd7a325095a0d19b8c3d76f578d85b979461d41'
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tempdir, 'cache', 'morphs.json')
+        self.morph = morphlib.morphology.Morphology({
+            'name': 'foo',
+            'kind': 'chunk',
+            'build-commands': ['make'],
+        })
+        self.morph.filename = 'foo.morph'
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def new_cache(self, version='1', **kwargs):
+        return morphlib.morphologycache.MorphologyCache(
+            self.filename, version, **kwargs)
+
+    def test_starts_empty_without_a_file(self):
+        cache = self.new_cache()
+        self.assertEqual(
+            cache.get_morphology('repo', self.sha1, 'foo.morph'), None)
+        self.assertEqual(cache.get_tree('repo', self.sha1), None)
+        self.assertEqual(cache.misses, 1)
+
+    def test_remembers_morphologies_after_save(self):
+        cache = self.new_cache()
+        cache.put_morphology('repo', self.sha1, 'foo.morph', self.morph)
+        cache.save()
+        cache = self.new_cache()
+        self.assertTrue(cache.has_morphology('repo', self.sha1, 'foo.morph'))
+        morph = cache.get_morphology('repo', self.sha1, 'foo.morph')
+        self.assertEqual(morph, self.morph)
+        self.assertEqual(morph.filename, 'foo.morph')
+        self.assertEqual(type(morph['name']), str)
+        self.assertEqual(cache.hits, 1)
+
+    def test_returns_a_new_copy_each_time(self):
+        cache = self.new_cache()
+        cache.put_morphology('repo', self.sha1, 'foo.morph', self.morph)
+        self.morph['build-commands'].append('changed')
+        morph = cache.get_morphology('repo', self.sha1, 'foo.morph')
+        morph['build-commands'].append('changed again')
+        morph = cache.get_morphology('repo', self.sha1, 'foo.morph')
+        self.assertEqual(morph['build-commands'], ['make'])
+
+    def test_keeps_non_ascii_text(self):
+        self.morph['description'] = u'caf\xe9'
+        cache = self.new_cache()
+        cache.put_morphology('repo', self.sha1, 'foo.morph', self.morph)
+        cache.save()
+        morph = self.new_cache().get_morphology(
+            'repo', self.sha1, 'foo.morph')
+        self.assertEqual(morph['description'], u'caf\xe9')
+
+    def test_forgets_morphologies_but_not_trees_if_version_changes(self):
+        cache = self.new_cache()
+        cache.put_morphology('repo', self.sha1, 'foo.morph', self.morph)
+        cache.put_tree('repo', self.sha1, self.tree)
+        cache.save()
+        cache = self.new_cache(version='2')
+        self.assertEqual(
+            cache.get_morphology('repo', self.sha1, 'foo.morph'), None)
+        self.assertEqual(cache.get_tree('repo', self.sha1), self.tree)
+
+    def test_ignores_corrupt_file(self):
+        os.makedirs(os.path.dirname(self.filename))
+        with open(self.filename, 'w') as f:
+            f.write('{not json')
+        cache = self.new_cache()
+        self.assertEqual(cache.get_tree('repo', self.sha1), None)
+
+    def test_keeps_used_entries_before_old_ones(self):
+        cache = self.new_cache()
+        cache.put_tree('repo', 'old', 'tree1')
+        cache.put_tree('repo', 'used', 'tree2')
+        cache.save()
+        cache = self.new_cache(max_entries=1)
+        cache.get_tree('repo', 'used')
+        cache.save()
+        cache = self.new_cache()
+        self.assertEqual(cache.get_tree('repo', 'old'), None)
+        self.assertEqual(cache.get_tree('repo', 'used'), 'tree2')
+
+    def test_recognises_sha1s(self):
+        self.assertTrue(self.new_cache().is_sha1(self.sha1))
+        self.assertFalse(self.new_cache().is_sha1('master'))
@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import logging
 import os
 
 import morphlib
@@ -42,17 +43,76 @@ class MorphologyFactory(object):
     '''A way of creating morphologies which will provide a default'''
 
     def __init__(self, local_repo_cache, remote_repo_cache=None,
-                 status_cb=None):
+                 status_cb=None, morphology_cache=None):
         self._lrc = local_repo_cache
         self._rrc = remote_repo_cache
+        self._cache = morphology_cache
+        self._loader = morphlib.morphloader.MorphologyLoader()
 
         null_status_function = lambda **kwargs: None
         self.status = status_cb or null_status_function
 
+        self._prefetched = {}
+
+    def prefetch(self, keys):
+        '''Read many morphology files from the remote repo cache at once.
+
+        ``keys`` is a list of (reponame, sha1, filename) tuples. Those in
+        repos that are not in the local repo cache are fetched with a
+        single request, and used by later calls to ``get_morphology``.
+        If the request fails, they are read one by one as usual instead.
+
+        '''
+
+        if self._rrc is None:
+            return
+        wanted = [key for key in set(keys)
+                  if key not in self._prefetched
+                  and not self._lrc.has_repo(key[0])
+                  and not self._is_cached(*key)]
+        if wanted:
+            self.status(msg='Retrieving %(count)d morphologies from the '
+                            'remote git cache',
+                        count=len(wanted), chatty=True)
+            try:
+                self._prefetched.update(self._rrc.cat_files(wanted))
+            except Exception, e:
+                logging.warning('Caught (and ignored) exception: %s' %
+                                str(e))
+
+    def _is_cached(self, reponame, sha1, filename):
+        return (self._cache is not None and
+                self._cache.is_sha1(sha1) and
+                self._cache.has_morphology(reponame, sha1, filename))
+
     def get_morphology(self, reponame, sha1, filename):
+        '''Load a morphology from a file in a commit of a repo.
+
+        If a morphology cache was given, morphologies are stored in it
+        and read from it where possible.
+
+        '''
+
+        if self._cache is None or not self._cache.is_sha1(sha1):
+            return self._load_morphology(reponame, sha1, filename)
+        morph = self._cache.get_morphology(reponame, sha1, filename)
+        if morph is None:
+            morph = self._load_morphology(reponame, sha1, filename)
+            self._cache.put_morphology(reponame, sha1, filename, morph)
+        return morph
+
+    def _load_morphology(self, reponame, sha1, filename):
         morph_name = os.path.splitext(os.path.basename(filename))[0]
-        loader = morphlib.morphloader.MorphologyLoader()
-        if self._lrc.has_repo(reponame):
+        loader = self._loader
+        key = (reponame, sha1, filename)
+        if key in self._prefetched:
+            text = self._prefetched.pop(key)
+            if text is None:
+                morph = None
+                file_list = self._rrc.ls_tree(reponame, sha1)
+            else:
+                morph = loader.load_from_string(text)
+        elif self._lrc.has_repo(reponame):
             self.status(msg="Looking for %s in local repo cache" % filename,
                         chatty=True)
             try:
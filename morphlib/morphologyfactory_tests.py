@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -14,6 +14,9 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import os
+import shutil
+import tempfile
 import unittest
 
 import morphlib
@@ -37,6 +40,16 @@ class FakeRemoteRepoCache(object):
     def ls_tree(self, reponame, sha1):
         return []
 
+    def cat_files(self, triplets):
+        result = {}
+        for reponame, sha1, filename in triplets:
+            if filename.startswith('missing'):
+                result[reponame, sha1, filename] = None
+            else:
+                result[reponame, sha1, filename] = \
+                    self.cat_file(reponame, sha1, filename)
+        return result
+
 
 class FakeLocalRepo(object):
 
@@ -279,3 +292,79 @@ class MorphologyFactoryTests(unittest.TestCase):
             morphlib.morphloader.EmptyStratumError,
             self.mf.get_morphology, 'reponame', 'sha1', 'stratum-empty.morph')
 
+
+    def test_uses_prefetched_remote_morphologies(self):
+        self.lrc.has_repo = self.doesnothaverepo
+        self.mf.prefetch([('reponame', 'sha1', 'remote-chunk.morph')])
+        self.rrc.cat_file = self.noremotefile
+        morph = self.mf.get_morphology('reponame', 'sha1',
+                                       'remote-chunk.morph')
+        self.assertEqual('remote-chunk', morph['name'])
+
+    def test_autodetects_prefetched_missing_morphology(self):
+        self.lrc.has_repo = self.doesnothaverepo
+        self.rrc.ls_tree = self.autotoolsbuildsystem
+        self.mf.prefetch([('reponame', 'sha1', 'missing.morph')])
+        self.rrc.cat_file = self.noremotefile
+        morph = self.mf.get_morphology('reponame', 'sha1', 'missing.morph')
+        self.assertEqual('missing', morph['name'])
+
+    def test_reads_files_one_by_one_when_prefetch_fails(self):
+        self.lrc.has_repo = self.doesnothaverepo
+        self.rrc.cat_files = self.noremotefile
+        self.mf.prefetch([('reponame', 'sha1', 'remote-chunk.morph')])
+        morph = self.mf.get_morphology('reponame', 'sha1',
+                                       'remote-chunk.morph')
+        self.assertEqual('remote-chunk', morph['name'])
+
+    def test_does_not_prefetch_without_remote(self):
+        self.lrc.has_repo = self.doesnothaverepo
+        self.lmf.prefetch([('reponame', 'sha1', 'chunk.morph')])
+        self.assertRaises(NotcachedError, self.lmf.get_morphology,
+                          'reponame', 'sha1', 'chunk.morph')
+
+    def test_does_not_prefetch_from_local_repos(self):
+        self.rrc.cat_files = self.noremotefile
+        self.mf.prefetch([('reponame', 'sha1', 'chunk.morph')])
+        self.lr.list_files = self.localmorph
+        morph = self.mf.get_morphology('reponame', 'sha1', 'chunk.morph')
+        self.assertEqual('chunk', morph['name'])
+
+
+class CachingMorphologyFactoryTests(unittest.TestCase):
+
+    sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cache = morphlib.morphologycache.MorphologyCache(
+            os.path.join(self.tempdir, 'morphs.json'), '1')
+        self.lr = FakeLocalRepo()
+        self.lrc = FakeLocalRepoCache(self.lr)
+        self.rrc = FakeRemoteRepoCache()
+        self.mf = MorphologyFactory(self.lrc, self.rrc,
+                                    morphology_cache=self.cache)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def nolocalfile(self, *args):
+        raise AssertionError('Morphology was read again')
+
+    def test_reads_morphology_only_once(self):
+        first = self.mf.get_morphology('reponame', self.sha1, 'chunk.morph')
+        self.lr.read_file = self.nolocalfile
+        second = self.mf.get_morphology('reponame', self.sha1, 'chunk.morph')
+        self.assertEqual(first, second)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_does_not_cache_named_refs(self):
+        self.mf.get_morphology('reponame', 'master', 'chunk.morph')
+        self.assertFalse(
+            self.cache.has_morphology('reponame', 'master', 'chunk.morph'))
+
+    def test_does_not_prefetch_cached_morphologies(self):
+        self.lrc.has_repo = lambda reponame: False
+        self.mf.get_morphology('reponame', self.sha1, 'chunk.morph')
+        self.rrc.cat_files = self.nolocalfile
+        self.mf.prefetch([('reponame', self.sha1, 'chunk.morph')])
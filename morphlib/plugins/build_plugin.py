@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2015  Codethink Limited
+# Copyright (C) 2012-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -135,6 +135,14 @@ class BuildPlugin(cliapp.Plugin):
         The location of the resulting system image artifact is printed
         at the end of the build output.
 
+        With `--plan`, nothing is built. Instead, every source of the
+        system is listed with whether it is in the local artifact cache,
+        in the remote one, or needs building, and how long building it
+        took the last time. The time the whole build is likely to take,
+        and the chain of sources that limits how fast it can be with any
+        number of concurrent builds, are shown at the end. Use
+        `--plan-format=json` to get the plan as JSON.
+
         If the 'local-changes' setting is set to 'include', you do not need
         to commit your changes before building. Morph does that for you, in a
         temporary branch for each build. Note that any system produced this way
@@ -165,7 +173,9 @@ class BuildPlugin(cliapp.Plugin):
         ws = morphlib.workspace.open('.')
         sb = morphlib.sysbranchdir.open_from_within('.')
 
-        if self.use_distbuild:
+        # Planning only looks at the artifact caches, so it is done here
+        # even for a distributed build.
+        if self.use_distbuild and not self.app.settings['plan']:
             addr = self.app.settings['controller-initiator-address']
             port = self.app.settings['controller-initiator-port']
 
@@ -1,6 +1,6 @@
 # distbuild_plugin.py -- Morph distributed build plugin
 #
-# Copyright (C) 2014  Codethink Limited
+# Copyright (C) 2014, 2026  Codethink Limited
 # 
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -17,8 +17,9 @@
 
 
 import cliapp
+import json
 import logging
-import re
+import os
 import sys
 
 import morphlib
@@ -89,7 +90,8 @@ class WorkerBuild(cliapp.Plugin):
         '''Internal use only: Build an artifact in a worker.
         
         All build dependencies are assumed to have been built already
-        and available in the local or remote artifact cache.
+        and available in the local or remote artifact cache, or from the
+        other workers the controller says hold them.
         
         '''
         
@@ -97,25 +99,39 @@ class WorkerBuild(cliapp.Plugin):
 
         serialized = sys.stdin.readline()
         artifact = distbuild.deserialise_artifact(serialized)
+
+        # The controller may follow the artifact with the other workers
+        # that hold the artifacts it depends on.
+        locations = sys.stdin.read().strip()
+        locations = json.loads(locations) if locations else {}
         
         bc = morphlib.buildcommand.BuildCommand(self.app)
+        if bc.rac is not None and locations:
+            bc.rac = morphlib.tieredartifactcache.TieredArtifactCache(
+                bc.rac, locations)
 
         # Now, before we start the build, we garbage collect the caches
         # to ensure we have room.  First we remove all system artifacts
         # since we never need to recover those from workers post-hoc
         for cachekey, artifacts, last_used in bc.lac.list_contents():
-            if any(self.is_system_artifact(f) for f in artifacts):
+            if any(self.is_system_artifact(name) for name in artifacts):
                 logging.debug("Removing all artifacts for system %s" %
                         cachekey)
                 bc.lac.remove(cachekey)
 
-        self.app.subcommands['gc']([])
+        # With a size limit, the local artifact cache evicts as the build
+        # adds to it, keeping what the build needs, so a full gc is only
+        # needed when there is no limit.
+        if self.app.settings['cachedir-artifact-max-size'] == 0:
+            self.app.subcommands['gc']([])
 
         arch = artifact.arch
         bc.build_source(artifact.source, bc.new_build_env(arch))
 
-    def is_system_artifact(self, filename):
-        return re.match(r'^[0-9a-fA-F]{64}\.system\.', filename)
+    def is_system_artifact(self, name):
+        # The names listed for a cache key are the rest of the file names,
+        # after the cache key and a dot.
+        return name.startswith('system.')
 
 class WorkerDaemon(cliapp.Plugin):
 
@@ -226,6 +242,21 @@ class ControllerDaemon(cliapp.Plugin):
             metavar='FILENAME',
             default='morph',
             group=group_distbuild)
+        self.app.settings.string(
+            ['controller-build-history'],
+            'remember how long each source took to build in FILE, and '
+                'start the builds with the longest chain of builds after '
+                'them first (default: build-history.json in the cache '
+                'directory)',
+            metavar='FILE',
+            default='',
+            group=group_distbuild)
+        self.app.settings.boolean(
+            ['controller-no-peer-fetch'],
+            'do not tell workers which other workers hold the artifacts '
+                'they need, so that they fetch them all from the shared '
+                'cache',
+            group=group_distbuild)
 
         self.app.add_subcommand(
             'controller-daemon', self.controller_daemon, arg_synopsis='')
@@ -245,6 +276,15 @@ class ControllerDaemon(cliapp.Plugin):
         worker_cache_server_port = \
             self.app.settings['worker-cache-server-port']
         morph_instance = self.app.settings['morph-instance']
+        # Build steps finish on the main loop, so the history is written
+        # at most once a minute while building, and when a build ends.
+        build_history = morphlib.buildplan.BuildHistory(
+            self.app.settings['controller-build-history'] or
+            os.path.join(self.app.settings['cachedir'], 'build-history.json'),
+            save_interval=60)
+        artifact_locations = None
+        if not self.app.settings['controller-no-peer-fetch']:
+            artifact_locations = distbuild.ArtifactLocations()
 
         listener_specs = [
             # address, port, class to initiate on connection, class init args
@@ -254,7 +294,7 @@ class ControllerDaemon(cliapp.Plugin):
             ('controller-initiator-address', 'controller-initiator-port',
              'controller-initiator-port-file',
              distbuild.InitiatorConnection, 
-             [artifact_cache_server, morph_instance]),
+             [artifact_cache_server, morph_instance, build_history]),
         ]
 
         loop = distbuild.MainLoop()
@@ -280,7 +320,7 @@ class ControllerDaemon(cliapp.Plugin):
             cm = distbuild.ConnectionMachine(
                 addr, port, distbuild.WorkerConnection, 
                 [writeable_cache_server, worker_cache_server_port,
-                 morph_instance])
+                 morph_instance, artifact_locations])
             loop.add_state_machine(cm)
 
         loop.run()
@@ -334,5 +374,8 @@ class GraphStateMachines(cliapp.Plugin):
     def add_state_machine(self, sm):
         pass
 
+    def add_interest(self, *args, **kwargs):
+        pass
+
     def status(self, *args, **kwargs):
         pass
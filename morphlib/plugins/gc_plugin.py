@@ -1,4 +1,4 @@
-# Copyright (C) 2013-2014  Codethink Limited
+# Copyright (C) 2013-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -19,7 +19,6 @@ import os
 import shutil
 import time
 
-import fs.osfs
 import cliapp
 
 import morphlib
@@ -49,7 +48,18 @@ class GCPlugin(cliapp.Plugin):
     def gc(self, args):
         '''Make space by removing unused files.
 
-           This command removes all artifacts older than
+           If --cachedir-artifact-max-size is set, this command first
+           removes the least recently used artifacts until the local
+           artifact cache fits in that size, and reports how much space
+           that reclaimed and how many of the recorded cache hits the
+           artifacts it kept account for.
+
+           It removes the copies of artifact contents that no artifact
+           shares any more from the content store that
+           --cachedir-artifact-dedup uses, and reports how much the
+           store saves.
+
+           It then removes all artifacts older than
            --cachedir-artifact-delete-older-than if the file system
            that holds the cache directory has less than --cachedir-min-space
            bytes free.
@@ -83,7 +93,7 @@ class GCPlugin(cliapp.Plugin):
         # assumes that they exist in various places.
         self.app.status(msg='Cleaning up temp dir %(temp_path)s',
                         temp_path=temp_path, chatty=True)
-        for subdir in ('deployments', 'failed', 'chunks'):
+        for subdir in ('deployments', 'failed', 'staging-pool', 'chunks'):
             if morphlib.util.get_bytes_free_in_path(temp_path) >= min_space:
                 self.app.status(msg='Not Removing subdirectory '
                                     '%(subdir)s, enough space already cleared',
@@ -117,17 +127,43 @@ class GCPlugin(cliapp.Plugin):
         return always, [cachekey for cachekey, mtime
                         in sorted(maybe, key=lambda x: x[1])]
 
+    def evict_cachedir(self, lac, cache_path, max_size):
+        report = lac.evict(max_size)
+        self.app.status(msg='Removed %(removed)d least recently used sources '
+                            'from %(cache_path)s, reclaiming %(bytes)d bytes '
+                            'and keeping %(hit_rate).1f%% of the recorded '
+                            'cache hits',
+                        removed=len(report.removed), cache_path=cache_path,
+                        bytes=report.bytes_reclaimed,
+                        hit_rate=100 * report.hit_rate_kept)
+
+    def cleanup_content_store(self, lac):
+        removed, freed = lac.cas.collect()
+        stats = lac.cas.stats()
+        if removed == 0 and stats.blobs == 0:
+            return
+        self.app.status(msg='Removed %(removed)d unshared copies from '
+                            '%(dirname)s, reclaiming %(freed)d bytes; '
+                            '%(links)d artifact files share %(blobs)d copies, '
+                            'a dedup ratio of %(ratio).2f',
+                        removed=removed, dirname=lac.cas.dirname,
+                        freed=freed, links=stats.links, blobs=stats.blobs,
+                        ratio=stats.ratio)
+
     def cleanup_cachedir(self, cache_path, min_space):
         def sufficient_free():
             free = morphlib.util.get_bytes_free_in_path(cache_path)
             return (free >= min_space)
+        max_size = self.app.settings['cachedir-artifact-max-size']
+        lac = morphlib.util.new_local_artifact_cache(cache_path, max_size)
+        if max_size > 0:
+            self.evict_cachedir(lac, cache_path, max_size)
+        self.cleanup_content_store(lac)
         if sufficient_free():
             self.app.status(msg='Not cleaning up cachedir, '
                                 'sufficient space already cleared',
                             chatty=True)
             return
-        lac = morphlib.localartifactcache.LocalArtifactCache(
-            fs.osfs.OSFS(os.path.join(cache_path, 'artifacts')))
         max_age, min_age = self.calculate_delete_range()
         logging.debug('Must remove artifacts older than timestamp %d'
                       % max_age)
@@ -138,12 +174,12 @@ class GCPlugin(cliapp.Plugin):
         logging.debug('Must remove artifacts %s' % repr(always_delete))
         logging.debug('Can remove artifacts %s' % repr(may_delete))
 
-        # Remove all old artifacts
+        # Remove all old artifacts that no running build needs
         for cachekey in always_delete:
             self.app.status(msg='Removing source %(cachekey)s',
                             cachekey=cachekey, chatty=True)
-            lac.remove(cachekey)
-            removed += 1
+            if lac.remove_unpinned(cachekey):
+                removed += 1
 
         # Maybe remove remaining middle-aged artifacts
         for cachekey in may_delete:
@@ -155,8 +191,8 @@ class GCPlugin(cliapp.Plugin):
                 break
             self.app.status(msg='Removing source %(cachekey)s',
                             cachekey=cachekey, chatty=True)
-            lac.remove(cachekey)
-            removed += 1
+            if lac.remove_unpinned(cachekey):
+                removed += 1
 
         if sufficient_free():
             self.app.status(msg='Made sufficient space in %(cache_path)s '
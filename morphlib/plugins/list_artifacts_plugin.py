@@ -1,4 +1,4 @@
-# Copyright (C) 2014  Codethink Limited
+# Copyright (C) 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -45,7 +45,8 @@ class ListArtifactsPlugin(cliapp.Plugin):
         outputs the union of the build graphs of all the systems passed in.
 
         The output includes any meta-artifacts such as .meta and .build-log
-        files.
+        files, and any other files the local artifact cache holds for the
+        sources in the build graph.
 
         '''
 
@@ -59,6 +60,8 @@ class ListArtifactsPlugin(cliapp.Plugin):
                                args[2:])
 
         self.lrc, self.rrc = morphlib.util.new_repo_caches(self.app)
+        self.lac, self.rac = morphlib.util.new_artifact_caches(
+            self.app.settings)
         self.resolver = morphlib.artifactresolver.ArtifactResolver()
 
         artifact_files = set()
@@ -87,7 +90,9 @@ class ListArtifactsPlugin(cliapp.Plugin):
         source_pool = morphlib.sourceresolver.create_source_pool(
             self.lrc, self.rrc, repo, ref, system_filename,
             update_repos = not self.app.settings['no-git-update'],
-            status_cb=self.app.status)
+            status_cb=self.app.status,
+            morphology_cache=morphlib.util.new_morphology_cache(
+                self.app.settings))
 
         self.app.status(
             msg='Resolving artifacts for %s' % system_filename, chatty=True)
@@ -106,12 +111,15 @@ class ListArtifactsPlugin(cliapp.Plugin):
             msg='Computing cache keys for %s' % system_filename, chatty=True)
         build_env = morphlib.buildenvironment.BuildEnvironment(
             self.app.settings, system_artifact.source.morphology['arch'])
-        ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env)
+        store = morphlib.util.new_cache_key_store(self.app.settings)
+        ckc = morphlib.cachekeycomputer.CacheKeyComputer(build_env, store)
 
         for source in set(a.source for a in system_artifact.walk()):
             source.cache_key = ckc.compute_key(source)
             source.cache_id = ckc.get_cache_id(source)
 
+        store.save()
+
         artifact_files = set()
         for artifact in system_artifact.walk():
 
@@ -127,4 +135,8 @@ class ListArtifactsPlugin(cliapp.Plugin):
             if artifact.source.morphology['kind'] == 'chunk':
                 artifact_files.add('%s.build-log' % artifact.source.cache_key)
 
+        for cache_key in set(a.source.cache_key
+                             for a in system_artifact.walk()):
+            artifact_files.update(self.lac.list_files(cache_key))
+
         return artifact_files
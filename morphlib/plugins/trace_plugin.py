@@ -0,0 +1,122 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import json
+import logging
+import os
+
+import cliapp
+
+import morphlib
+
+
+class TracePlugin(cliapp.Plugin):
+
+    def enable(self):
+        self.app.add_subcommand('trace-summary', self.trace_summary,
+                                arg_synopsis='[TRACE|DIR]...')
+        self.app.settings.integer(['trace-summary-limit'],
+                                  'show only the N spans that took the '
+                                  'most time in trace-summary, or all of '
+                                  'them if N is 0',
+                                  metavar='N', default=0)
+        self.app.settings.string(['trace-summary-merge'],
+                                 'write the traces read by trace-summary '
+                                 'into FILE as one trace, with a process '
+                                 'for each build',
+                                 metavar='FILE', default='')
+
+    def disable(self):
+        pass
+
+    def trace_summary(self, args):
+        '''Show where the time of many builds went.
+
+        Every build records a trace of the phases it went through in the
+        local artifact cache, next to the build log, with a `.trace`
+        suffix. Failed builds record one too, in which the span that
+        failed has an `error` argument. The traces are in the trace event
+        format used by chrome://tracing and other trace viewers, which
+        can show a single build.
+
+        This command reads many traces and adds up the time spent in
+        each kind of span, such as `install-chunk`, `configure-command`
+        or `write-tarball`, over all of them. The time nested spans took
+        is taken away from the self time of the span they are in, so the
+        self times add up to the total time of the builds.
+
+        Command line arguments:
+
+        * `TRACE` is a trace file to read.
+        * `DIR` is a directory; every `.trace` file in it is read.
+
+        With no arguments, every trace in the local artifact cache is
+        read.
+
+        '''
+
+        if not args:
+            args = [os.path.join(self.app.settings['cachedir'], 'artifacts')]
+
+        summary = morphlib.tracing.Summary()
+        merged = []
+        for filename in self._trace_files(args):
+            try:
+                with open(filename) as f:
+                    events = morphlib.tracing.read_trace(f)
+            except (IOError, ValueError) as e:
+                logging.warning('Skipping trace %s: %s' % (filename, e))
+                continue
+            summary.add(events)
+            merged.extend(self._renumbered(events, summary.traces,
+                                           os.path.basename(filename)))
+
+        if summary.traces == 0:
+            raise cliapp.AppException('No traces found in %s' %
+                                      ', '.join(args))
+
+        self.app.output.write('%d builds\n' % summary.traces)
+        limit = self.app.settings['trace-summary-limit'] or None
+        for line in summary.format(limit=limit):
+            self.app.output.write(line + '\n')
+
+        if self.app.settings['trace-summary-merge']:
+            with morphlib.savefile.SaveFile(
+                    self.app.settings['trace-summary-merge'], 'w') as f:
+                json.dump({'traceEvents': merged, 'displayTimeUnit': 'ms'},
+                          f, indent=1, sort_keys=True)
+
+    def _trace_files(self, args):
+        for arg in args:
+            if os.path.isdir(arg):
+                for basename in sorted(os.listdir(arg)):
+                    if basename.endswith('.trace'):
+                        yield os.path.join(arg, basename)
+            else:
+                yield arg
+
+    def _renumbered(self, events, pid, name):
+        '''Put the events of one trace in a process of their own.'''
+
+        for event in events:
+            if event.get('name') == 'build-source':
+                name = event.get('args', {}).get('name', name)
+        yield {'name': 'process_name', 'ph': 'M', 'pid': pid,
+               'args': {'name': name}}
+        for event in events:
+            event = dict(event)
+            event['pid'] = pid
+            yield event
@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -15,7 +15,12 @@
 
 
 import cliapp
+import httplib
+import json
 import logging
+import socket
+import threading
+import time
 import urllib
 import urllib2
 import urlparse
@@ -56,18 +61,68 @@ class GetSourceMetadataError(GetError):
 
 class RemoteArtifactCache(object):
 
-    def __init__(self, server_url):
+    '''Client for the artifacts of a morph-cache-server.
+
+    What the server has is remembered, so it is asked about each file
+    as few times as possible. A file the server has is never changed, so
+    that is remembered for as long as this object lives. A file it does
+    not have may be uploaded by a build at any time, so that is only
+    remembered for ``negative_ttl`` seconds.
+
+    Requests wait for the server for up to ``timeout`` seconds, or as
+    long as the socket module's default timeout if that is None.
+
+    '''
+
+    negative_ttl = 30
+
+    def __init__(self, server_url, timeout=None):
         self.server_url = server_url
+        self.timeout = timeout
+        self._present = set()
+        self._absent = {}
+        self._presence_lock = threading.Lock()
+
+    def _known(self, filename):
+        '''Return whether the server is known to have a file, or None.'''
+
+        with self._presence_lock:
+            if filename in self._present:
+                return True
+            checked = self._absent.get(filename)
+            if checked is not None and \
+                    self._now() - checked < self.negative_ttl:
+                return False
+        return None
+
+    def _remember(self, present=(), absent=()):
+        with self._presence_lock:
+            now = self._now()
+            for filename in present:
+                self._present.add(filename)
+                self._absent.pop(filename, None)
+            for filename in absent:
+                self._absent[filename] = now
+
+    def _has_remembered_file(self, filename):
+        known = self._known(filename)
+        if known is None:
+            known = self._has_file(filename)
+            if known:
+                self._remember(present=[filename])
+            else:
+                self._remember(absent=[filename])
+        return known
 
     def has(self, artifact):
-        return self._has_file(artifact.basename())
+        return self._has_remembered_file(artifact.basename())
 
     def has_artifact_metadata(self, artifact, name):
-        return self._has_file(artifact.metadata_basename(name))
+        return self._has_remembered_file(artifact.metadata_basename(name))
 
     def has_source_metadata(self, source, cachekey, name):
         filename = '%s.%s' % (cachekey, name)
-        return self._has_file(filename)
+        return self._has_remembered_file(filename)
 
     def get(self, artifact, log=logging.error):
         try:
@@ -90,12 +145,172 @@ class RemoteArtifactCache(object):
         except urllib2.URLError:
             raise GetSourceMetadataError(self, source, cachekey, name)
 
+    def has_files(self, filenames, assume_present=True):
+        '''Return the set of the given filenames that the cache has.
+
+        This asks the cache about all the files it is not known to have
+        or lack in one request. If the request fails, those files are
+        assumed to be present, so that fetching them reports the real
+        error, unless ``assume_present`` is false, when they are assumed
+        to be missing.
+
+        '''
+        present = set()
+        unknown = []
+        for filename in sorted(set(filenames)):
+            known = self._known(filename)
+            if known:
+                present.add(filename)
+            elif known is None:
+                unknown.append(filename)
+        if not unknown:
+            return present
+        try:
+            answers = self._has_files(unknown)
+        except (urllib2.URLError, httplib.HTTPException, socket.error,
+                ValueError), e:
+            logging.warning('Could not check for %d files in the artifact '
+                            'cache %s: %s' % (len(unknown), self, e))
+            if assume_present:
+                return present.union(unknown)
+            return present
+        found = set(f for f in unknown if answers.get(f))
+        self._remember(present=found,
+                       absent=[f for f in unknown if f not in found])
+        return present | found
+
+    def fetch_files(self, groups, connections=1, log=logging.error):
+        '''Download groups of files into the local cache.
+
+        ``groups`` is a list of lists of ``(filename, open_local)`` pairs,
+        where ``open_local`` is called with no arguments to open the file
+        to write to, such as ``LocalArtifactCache.put``. The files of a
+        group are fetched atomically: if any of them fails, the local files
+        of that group are aborted, otherwise they are all closed.
+
+        Up to ``connections`` groups are downloaded at once, each worker
+        reusing one persistent HTTP connection for all the files it fetches.
+
+        Return the number of bytes downloaded and the list of groups that
+        could not be fetched.
+
+        '''
+        pending = list(reversed(list(enumerate(groups))))
+        failed = []
+        fetched = [0]
+        lock = threading.Lock()
+
+        def worker():
+            connection = self._open_connection()
+            try:
+                while True:
+                    with lock:
+                        if not pending:
+                            return
+                        index, group = pending.pop()
+                    try:
+                        size = self._fetch_group(connection, group)
+                    except (urllib2.URLError, httplib.HTTPException,
+                            socket.error, EnvironmentError), e:
+                        log(str(e))
+                        with lock:
+                            failed.append((index, group))
+                    else:
+                        with lock:
+                            fetched[0] += size
+            finally:
+                self._close_connection(connection)
+
+        threads = [threading.Thread(target=worker)
+                   for i in xrange(max(1, min(connections, len(groups))))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return fetched[0], [group for index, group in sorted(failed)]
+
+    def _fetch_group(self, connection, group):
+        size = 0
+        locals = []
+        try:
+            for filename, open_local in group:
+                remote = self._get_file_on_connection(connection, filename)
+                local = open_local()
+                locals.append(local)
+                while True:
+                    data = remote.read(64 * 1024)
+                    if not data:
+                        break
+                    local.write(data)
+                    size += len(data)
+                remote.close()
+        except BaseException:
+            for local in locals:
+                local.abort()
+            raise
+        else:
+            for local in locals:
+                local.close()
+        self._remember(present=[filename for filename, open_local in group])
+        return size
+
+    def _has_files(self, filenames):  # pragma: no cover
+        url = urlparse.urljoin(self._server_url_with_slash(), '/1.0/artifacts')
+        logging.debug('RemoteArtifactCache._has_files: url=%s, %d files' %
+                      (url, len(filenames)))
+        request = urllib2.Request(url, json.dumps(filenames),
+                                  {'Content-Type': 'application/json'})
+        return json.load(urllib2.urlopen(request, **self._timeout_args()))
+
+    def _open_connection(self):  # pragma: no cover
+        parts = urlparse.urlsplit(self.server_url)
+        if parts.scheme == 'https':
+            return httplib.HTTPSConnection(parts.hostname, parts.port,
+                                           **self._timeout_args())
+        return httplib.HTTPConnection(parts.hostname, parts.port,
+                                      **self._timeout_args())
+
+    def _close_connection(self, connection):  # pragma: no cover
+        connection.close()
+
+    def _get_file_on_connection(self, connection,
+                                filename):  # pragma: no cover
+        url = self._request_url(filename)
+        path = self._request_path(filename)
+        logging.debug('RemoteArtifactCache._get_file_on_connection: url=%s' %
+                      url)
+        for retry in (True, False):
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                break
+            except (httplib.BadStatusLine, socket.error):
+                # The server may have closed an idle keep-alive connection,
+                # so try once more with a new one.
+                connection.close()
+                if not retry:
+                    raise
+        if response.status != 200:
+            response.read()
+            raise urllib2.URLError('%s: HTTP %d %s' %
+                                   (url, response.status, response.reason))
+        return response
+
+    def _timeout_args(self):  # pragma: no cover
+        if self.timeout is None:
+            return {}
+        return {'timeout': self.timeout}
+
+    def _now(self):  # pragma: no cover
+        return time.time()
+
     def _has_file(self, filename):  # pragma: no cover
         url = self._request_url(filename)
         logging.debug('RemoteArtifactCache._has_file: url=%s' % url)
         request = HeadRequest(url)
         try:
-            urllib2.urlopen(request)
+            urllib2.urlopen(request, **self._timeout_args())
             return True
         except (urllib2.HTTPError, urllib2.URLError):
             return False
@@ -103,15 +318,20 @@ class RemoteArtifactCache(object):
     def _get_file(self, filename):  # pragma: no cover
         url = self._request_url(filename)
         logging.debug('RemoteArtifactCache._get_file: url=%s' % url)
-        return urllib2.urlopen(url)
+        return urllib2.urlopen(url, **self._timeout_args())
 
-    def _request_url(self, filename):  # pragma: no cover
+    def _server_url_with_slash(self):  # pragma: no cover
         server_url = self.server_url
         if not server_url.endswith('/'):
             server_url += '/'
+        return server_url
+
+    def _request_path(self, filename):  # pragma: no cover
+        return '/1.0/artifacts?filename=%s' % urllib.quote(filename)
+
+    def _request_url(self, filename):  # pragma: no cover
         return urlparse.urljoin(
-            server_url, '/1.0/artifacts?filename=%s' % 
-            urllib.quote(filename))
+            self._server_url_with_slash(), self._request_path(filename))
 
     def __str__(self):  # pragma: no cover
         return self.server_url
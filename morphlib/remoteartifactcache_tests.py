@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -47,21 +47,19 @@ class RemoteArtifactCacheTests(unittest.TestCase):
                                                'chunk.morph', 'sha1',
                                                'tree', morph)
         self.source, = sources
+        self.source.cache_key = 'CHUNK'
         self.runtime_artifact = morphlib.artifact.Artifact(
             self.source, 'chunk-runtime')
-        self.runtime_artifact.cache_key = 'CHUNK'
         self.devel_artifact = morphlib.artifact.Artifact(
             self.source, 'chunk-devel')
-        self.devel_artifact.cache_key = 'CHUNK'
         self.doc_artifact = morphlib.artifact.Artifact(
             self.source, 'chunk-doc')
-        self.doc_artifact.cache_key = 'CHUNK'
 
         self.existing_files = set([
             self.runtime_artifact.basename(),
             self.devel_artifact.basename(),
             self.runtime_artifact.metadata_basename('meta'),
-            '%s.%s' % (self.runtime_artifact.cache_key, 'meta'),
+            '%s.%s' % (self.source.cache_key, 'meta'),
         ])
 
         self.server_url = 'http://foo.bar:8080'
@@ -69,10 +67,18 @@ class RemoteArtifactCacheTests(unittest.TestCase):
             self.server_url)
         self.cache._has_file = self._has_file
         self.cache._get_file = self._get_file
+        self.cache._has_files = self._has_files
+        self.cache._open_connection = lambda: None
+        self.cache._close_connection = lambda connection: None
+        self.cache._get_file_on_connection = (
+            lambda connection, filename: self._get_file(filename))
 
     def _has_file(self, filename):
         return filename in self.existing_files
 
+    def _has_files(self, filenames):
+        return dict((f, f in self.existing_files) for f in filenames)
+
     def _get_file(self, filename):
         if filename in self.existing_files:
             return StringIO.StringIO('%s' % filename)
@@ -102,13 +108,13 @@ class RemoteArtifactCacheTests(unittest.TestCase):
     def test_has_existing_source_metadata(self):
         self.assertTrue(self.cache.has_source_metadata(
             self.runtime_artifact.source,
-            self.runtime_artifact.cache_key,
+            self.source.cache_key,
             'meta'))
 
     def test_does_not_have_non_existent_source_metadata(self):
         self.assertFalse(self.cache.has_source_metadata(
             self.runtime_artifact.source,
-            self.runtime_artifact.cache_key,
+            self.source.cache_key,
             'non-existent-meta'))
 
     def test_get_existing_artifact(self):
@@ -144,21 +150,172 @@ class RemoteArtifactCacheTests(unittest.TestCase):
     def test_get_existing_source_metadata(self):
         handle = self.cache.get_source_metadata(
             self.runtime_artifact.source,
-            self.runtime_artifact.cache_key,
+            self.source.cache_key,
             'meta')
         data = handle.read()
         self.assertEqual(
-            data, '%s.%s' % (self.runtime_artifact.cache_key, 'meta'))
+            data, '%s.%s' % (self.source.cache_key, 'meta'))
 
     def test_fails_to_get_non_existent_source_metadata(self):
         self.assertRaises(
             morphlib.remoteartifactcache.GetSourceMetadataError,
             self.cache.get_source_metadata,
             self.runtime_artifact.source,
-            self.runtime_artifact.cache_key,
+            self.source.cache_key,
             'non-existent-meta')
 
     def test_escapes_pluses_in_request_urls(self):
         returned_url = self.cache._request_url('gtk+')
         correct_url = '%s/1.0/artifacts?filename=gtk%%2B' % self.server_url
         self.assertEqual(returned_url, correct_url)
+
+    def test_has_files_returns_only_existing_files(self):
+        self.assertEqual(
+            self.cache.has_files([self.runtime_artifact.basename(),
+                                  self.doc_artifact.basename()]),
+            set([self.runtime_artifact.basename()]))
+
+    def test_has_files_of_nothing_is_empty(self):
+        self.assertEqual(self.cache.has_files([]), set())
+
+    def test_has_files_assumes_presence_if_request_fails(self):
+        def fail(filenames):
+            raise urllib2.URLError('foo')
+        self.cache._has_files = fail
+        self.assertEqual(
+            self.cache.has_files([self.doc_artifact.basename()]),
+            set([self.doc_artifact.basename()]))
+
+    def test_fetch_files_stores_all_files_of_groups(self):
+        locals = {}
+        def opener(filename):
+            return lambda: locals.setdefault(filename, FakeLocalFile())
+        names = [self.runtime_artifact.basename(),
+                 self.devel_artifact.basename()]
+        groups = [[(name, opener(name))] for name in names]
+        size, failed = self.cache.fetch_files(groups, connections=2)
+        self.assertEqual(failed, [])
+        self.assertEqual(size, sum(len(name) for name in names))
+        for name in names:
+            self.assertTrue(locals[name].closed)
+            self.assertEqual(locals[name].getvalue(), name)
+
+    def test_fetch_files_aborts_whole_group_on_failure(self):
+        runtime = FakeLocalFile()
+        doc = FakeLocalFile()
+        devel = FakeLocalFile()
+        bad_group = [(self.runtime_artifact.basename(), lambda: runtime),
+                     (self.doc_artifact.basename(), lambda: doc)]
+        good_group = [(self.devel_artifact.basename(), lambda: devel)]
+        size, failed = self.cache.fetch_files(
+            [bad_group, good_group], connections=1, log=lambda *args: None)
+        self.assertEqual(failed, [bad_group])
+        self.assertTrue(runtime.aborted)
+        self.assertFalse(runtime.closed)
+        self.assertTrue(devel.closed)
+
+
+class RemoteArtifactCachePresenceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.existing_files = set(['foo', 'bar'])
+        self.asked = []
+        self.now = 1000
+        self.cache = morphlib.remoteartifactcache.RemoteArtifactCache(
+            'http://foo.bar:8080')
+        self.cache._now = lambda: self.now
+        self.cache._has_file = self._has_file
+        self.cache._has_files = self._has_files
+        self.cache._open_connection = lambda: None
+        self.cache._close_connection = lambda connection: None
+        self.cache._get_file_on_connection = (
+            lambda connection, filename: StringIO.StringIO(filename))
+
+    def _has_file(self, filename):
+        self.asked.append([filename])
+        return filename in self.existing_files
+
+    def _has_files(self, filenames):
+        self.asked.append(list(filenames))
+        return dict((f, f in self.existing_files) for f in filenames)
+
+    def test_remembers_files_the_cache_has(self):
+        self.assertEqual(self.cache.has_files(['foo', 'bar', 'baz']),
+                         set(['foo', 'bar']))
+        self.existing_files.clear()
+        self.now += 3600
+        self.assertEqual(self.cache.has_files(['bar', 'foo']),
+                         set(['foo', 'bar']))
+        self.assertEqual(self.asked, [['bar', 'baz', 'foo']])
+
+    def test_only_asks_about_files_it_does_not_know(self):
+        self.cache.has_files(['foo', 'baz'])
+        self.assertEqual(self.cache.has_files(['foo', 'bar', 'baz']),
+                         set(['foo', 'bar']))
+        self.assertEqual(self.asked, [['baz', 'foo'], ['bar']])
+
+    def test_remembers_missing_files_for_a_while(self):
+        self.assertEqual(self.cache.has_files(['baz']), set())
+        self.existing_files.add('baz')
+        self.now += self.cache.negative_ttl - 1
+        self.assertEqual(self.cache.has_files(['baz']), set())
+        self.now += 1
+        self.assertEqual(self.cache.has_files(['baz']), set(['baz']))
+        self.assertEqual(self.asked, [['baz'], ['baz']])
+
+    def test_shares_what_it_knows_with_single_checks(self):
+        self.cache.has_files(['foo', 'baz'])
+        self.assertTrue(self.cache._has_remembered_file('foo'))
+        self.assertFalse(self.cache._has_remembered_file('baz'))
+        self.assertTrue(self.cache._has_remembered_file('bar'))
+        self.assertTrue(self.cache._has_remembered_file('bar'))
+        self.assertEqual(self.cache.has_files(['bar']), set(['bar']))
+        self.assertEqual(self.asked, [['baz', 'foo'], ['bar']])
+
+    def test_remembers_missing_files_from_single_checks(self):
+        self.assertFalse(self.cache._has_remembered_file('baz'))
+        self.assertEqual(self.cache.has_files(['baz']), set())
+        self.assertEqual(self.asked, [['baz']])
+
+    def test_does_not_remember_failed_checks(self):
+        def fail(filenames):
+            raise urllib2.URLError('foo')
+        self.cache._has_files = fail
+        self.assertEqual(self.cache.has_files(['baz']), set(['baz']))
+        self.cache._has_files = self._has_files
+        self.assertEqual(self.cache.has_files(['baz']), set())
+
+    def test_can_assume_files_are_missing_if_checks_fail(self):
+        self.cache.has_files(['foo'])
+        def fail(filenames):
+            raise urllib2.URLError('foo')
+        self.cache._has_files = fail
+        self.assertEqual(
+            self.cache.has_files(['foo', 'bar'], assume_present=False),
+            set(['foo']))
+
+    def test_remembers_fetched_files(self):
+        local = FakeLocalFile()
+        size, failed = self.cache.fetch_files([[('baz', lambda: local)]])
+        self.assertEqual(failed, [])
+        self.assertEqual(self.cache.has_files(['baz']), set(['baz']))
+        self.assertEqual(self.asked, [])
+
+
+class FakeLocalFile(StringIO.StringIO):
+
+    def __init__(self):
+        StringIO.StringIO.__init__(self)
+        self.aborted = False
+
+    def abort(self):
+        self.aborted = True
+
+    def close(self):
+        self.value = self.getvalue()
+        StringIO.StringIO.close(self)
+
+    def getvalue(self):
+        if self.closed:
+            return self.value
+        return StringIO.StringIO.getvalue(self)
@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import base64
 import cliapp
 import json
 import logging
@@ -78,6 +79,55 @@ class RemoteRepoCache(object):
             logging.error('Caught exception: %s' % str(e))
             raise LsTreeError(repo_name, ref)
 
+    def resolve_refs(self, pairs):
+        '''Resolve many (repo_name, ref) pairs in one request.
+
+        Return a dict mapping each pair that could be resolved to its
+        commit and tree sha1s. Pairs that could not be resolved are left
+        out.
+
+        '''
+
+        pairs = list(pairs)
+        if not pairs:
+            return {}
+        urls = dict((repo_name, self._resolver.pull_url(repo_name))
+                    for repo_name, ref in pairs)
+        info = self._resolve_refs_for_repo_urls(
+            [(urls[repo_name], ref) for repo_name, ref in pairs])
+        result = {}
+        for (repo_name, ref), item in zip(pairs, info):
+            if 'error' in item:
+                logging.debug('Failed to resolve %s %s: %s' %
+                              (repo_name, ref, item['error']))
+            else:
+                result[repo_name, ref] = (item['sha1'], item['tree'])
+        return result
+
+    def cat_files(self, triplets):
+        '''Read many files, given as (repo_name, ref, filename), at once.
+
+        Return a dict mapping each triplet to the contents of the file,
+        or None if the file does not exist.
+
+        '''
+
+        triplets = list(triplets)
+        if not triplets:
+            return {}
+        urls = dict((repo_name, self._resolver.pull_url(repo_name))
+                    for repo_name, ref, filename in triplets)
+        info = self._cat_files_for_repo_urls(
+            [(urls[repo_name], ref, filename)
+             for repo_name, ref, filename in triplets])
+        result = {}
+        for triplet, item in zip(triplets, info):
+            if 'error' in item:
+                result[triplet] = None
+            else:
+                result[triplet] = base64.b64decode(item['data'])
+        return result
+
     def _resolve_ref_for_repo_url(self, repo_url, ref):  # pragma: no cover
         data = self._make_request(
             'sha1s?repo=%s&ref=%s' % self._quote_strings(repo_url, ref))
@@ -94,13 +144,33 @@ class RemoteRepoCache(object):
         return self._make_request(
             'trees?repo=%s&ref=%s' % self._quote_strings(repo_url, ref))
 
+    def _resolve_refs_for_repo_urls(self, pairs):  # pragma: no cover
+        data = self._make_request(
+            'sha1s', [{'repo': repo_url, 'ref': ref}
+                      for repo_url, ref in pairs])
+        return json.loads(data)
+
+    def _cat_files_for_repo_urls(self, triplets):  # pragma: no cover
+        data = self._make_request(
+            'files', [{'repo': repo_url, 'ref': ref, 'filename': filename}
+                      for repo_url, ref, filename in triplets])
+        return json.loads(data)
+
     def _quote_strings(self, *args):  # pragma: no cover
         return tuple(urllib.quote(string) for string in args)
 
-    def _make_request(self, path):  # pragma: no cover
+    def _make_request(self, path, body=None):  # pragma: no cover
+        '''GET a path on the server, or POST body to it as JSON.'''
+
         server_url = self.server_url
         if not server_url.endswith('/'):
             server_url += '/'
         url = urlparse.urljoin(server_url, '/1.0/%s' % path)
-        handle = urllib2.urlopen(url)
+        if body is None:
+            handle = urllib2.urlopen(url)
+        else:
+            request = urllib2.Request(
+                url, json.dumps(body),
+                {'Content-Type': 'application/json'})
+            handle = urllib2.urlopen(request)
         return handle.read()
@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -14,6 +14,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 
+import base64
 import json
 import unittest
 import urllib2
@@ -40,6 +41,33 @@ class RemoteRepoCacheTests(unittest.TestCase):
             'tree': self.files[repo_url][sha1]
         })
 
+    def _resolve_refs_for_repo_urls(self, pairs):
+        self.requests.append(pairs)
+        result = []
+        for repo_url, ref in pairs:
+            try:
+                sha1 = self.sha1s[repo_url][ref]
+                result.append({'repo': repo_url, 'ref': ref,
+                               'sha1': sha1, 'tree': 'tree-' + sha1})
+            except KeyError:
+                result.append({'repo': repo_url, 'ref': ref,
+                               'error': 'Not found'})
+        return result
+
+    def _cat_files_for_repo_urls(self, triplets):
+        self.requests.append(triplets)
+        result = []
+        for repo_url, sha1, filename in triplets:
+            try:
+                data = base64.b64encode(
+                    self.files[repo_url][sha1][filename])
+                result.append({'repo': repo_url, 'ref': sha1,
+                               'filename': filename, 'data': data})
+            except KeyError:
+                result.append({'repo': repo_url, 'ref': sha1,
+                               'filename': filename, 'error': 'Not found'})
+        return result
+
     def setUp(self):
         self.sha1s = {
             'git://gitorious.org/baserock/morph': {
@@ -64,6 +92,10 @@ class RemoteRepoCacheTests(unittest.TestCase):
         self.cache._resolve_ref_for_repo_url = self._resolve_ref_for_repo_url
         self.cache._cat_file_for_repo_url = self._cat_file_for_repo_url
         self.cache._ls_tree_for_repo_url = self._ls_tree_for_repo_url
+        self.cache._resolve_refs_for_repo_urls = \
+            self._resolve_refs_for_repo_urls
+        self.cache._cat_files_for_repo_urls = self._cat_files_for_repo_urls
+        self.requests = []
 
     def test_sets_server_url(self):
         self.assertEqual(self.cache.server_url, self.server_url)
@@ -136,3 +168,30 @@ class RemoteRepoCacheTests(unittest.TestCase):
         self.assertRaises(morphlib.remoterepocache.LsTreeError,
                           self.cache.ls_tree, 'non-existent-repo',
                           'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9')
+
+    def test_resolves_many_refs_in_one_request(self):
+        sha1 = self.sha1s['git://gitorious.org/baserock/morph']['master']
+        result = self.cache.resolve_refs([('baserock:morph', 'master'),
+                                          ('baserock:morph', 'missing'),
+                                          ('non-existent-repo', 'master')])
+        self.assertEqual(result, {('baserock:morph', 'master'):
+                                  (sha1, 'tree-' + sha1)})
+        self.assertEqual(len(self.requests), 1)
+
+    def test_resolving_no_refs_makes_no_request(self):
+        self.assertEqual(self.cache.resolve_refs([]), {})
+        self.assertEqual(self.requests, [])
+
+    def test_cats_many_files_in_one_request(self):
+        sha1 = 'e28a23812eadf2fce6583b8819b9c5dbd36b9fb9'
+        result = self.cache.cat_files([('upstream:linux', sha1, 'linux.morph'),
+                                       ('upstream:linux', sha1, 'missing')])
+        self.assertEqual(result, {
+            ('upstream:linux', sha1, 'linux.morph'): 'linux morphology',
+            ('upstream:linux', sha1, 'missing'): None,
+        })
+        self.assertEqual(len(self.requests), 1)
+
+    def test_catting_no_files_makes_no_request(self):
+        self.assertEqual(self.cache.cat_files([]), {})
+        self.assertEqual(self.requests, [])
@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -36,18 +36,29 @@ class Source(object):
     * ``split_rules`` -- rules for splitting the source's produced artifacts
     * ``artifacts`` -- the set of artifacts this source produces.
 
+    Like artifacts, sources have slots instead of a ``__dict__``, and
+    the strings they share with other sources are interned. The slots
+    after ``artifacts`` are only set by the code that uses them.
+
     '''
 
+    __slots__ = ('name', 'repo', 'repo_name', 'original_ref', 'sha1',
+                 'tree', 'morphology', 'filename', 'cache_id', 'cache_key',
+                 'dependencies', 'split_rules', 'artifacts',
+                 '_dependency_set', 'build_mode', 'prefix',
+                 'cross_sources', 'native_sources')
+
     def __init__(self, name, repo_name, original_ref, sha1, tree, morphology,
             filename, split_rules):
-        self.name = name
+        intern_string = morphlib.util.intern_string
+        self.name = intern_string(name)
         self.repo = None
-        self.repo_name = repo_name
-        self.original_ref = original_ref
-        self.sha1 = sha1
-        self.tree = tree
+        self.repo_name = intern_string(repo_name)
+        self.original_ref = intern_string(original_ref)
+        self.sha1 = intern_string(sha1)
+        self.tree = intern_string(tree)
         self.morphology = morphology
-        self.filename = filename
+        self.filename = intern_string(filename)
         self.cache_id = None
         self.cache_key = None
         self.dependencies = []
@@ -68,9 +79,16 @@ class Source(object):
         return '%s.%s' % (self.cache_key, str(self.morphology['kind']))
 
     def add_dependency(self, artifact): # pragma: no cover
-        if artifact not in self.dependencies:
+        # The same artifacts as dependencies, for quick lookups while
+        # dependencies are added. It is only made when first needed, so
+        # that graphs made without add_dependency do not pay for it.
+        try:
+            dependency_set = self._dependency_set
+        except AttributeError:
+            dependency_set = self._dependency_set = set(self.dependencies)
+        if artifact not in dependency_set:
+            dependency_set.add(artifact)
             self.dependencies.append(artifact)
-        if self not in artifact.dependents:
             artifact.dependents.append(self)
 
     def depends_on(self, artifact): # pragma: no cover
@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -57,3 +57,31 @@ class SourceTests(unittest.TestCase):
 
     def test_sets_filename(self):
         self.assertEqual(self.source.filename, self.filename)
+
+    def test_has_no_attributes_besides_its_slots(self):
+        self.assertRaises(AttributeError, setattr, self.source, 'colour',
+                          'blue')
+
+    def test_interns_strings(self):
+        other, = morphlib.source.make_sources(
+            ''.join(['foo.', 'repo']), self.original_ref, self.filename,
+            self.sha1, self.tree, self.morphology)
+        self.assertTrue(other.repo_name is self.source.repo_name)
+
+    def test_shares_split_rules_of_identical_chunks(self):
+        other, = morphlib.source.make_sources(self.repo_name,
+                                              self.original_ref,
+                                              self.filename, self.sha1,
+                                              self.tree, self.morphology)
+        self.assertTrue(other.split_rules is self.source.split_rules)
+
+    def test_adds_each_dependency_once(self):
+        artifact = self.source.artifacts['foo-bins']
+        other, = morphlib.source.make_sources(self.repo_name,
+                                              self.original_ref,
+                                              self.filename, self.sha1,
+                                              self.tree, self.morphology)
+        other.add_dependency(artifact)
+        other.add_dependency(artifact)
+        self.assertEqual(other.dependencies, [artifact])
+        self.assertEqual(artifact.dependents, [other])
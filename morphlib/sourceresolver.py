@@ -1,4 +1,4 @@
-# Copyright (C) 2014  Codethink Limited
+# Copyright (C) 2014, 2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -47,20 +47,48 @@ class SourceResolver(object):
     '''
 
     def __init__(self, local_repo_cache, remote_repo_cache, update_repos,
-                 status_cb=None):
+                 status_cb=None, morphology_cache=None):
         self.lrc = local_repo_cache
         self.rrc = remote_repo_cache
+        self.cache = morphology_cache
 
         self.update = update_repos
 
         self.status = status_cb
 
+    def _cached_tree(self, reponame, ref):
+        '''Return the tree of ref if it is a sha1 with a known tree.'''
+
+        if self.cache is not None and self.cache.is_sha1(ref):
+            return self.cache.get_tree(reponame, ref)
+        return None
+
     def resolve_ref(self, reponame, ref):
         '''Resolves commit and tree sha1s of the ref in a repo and returns it.
 
         If update is True then this has the side-effect of updating
         or cloning the repository into the local repo cache.
+
+        If there is a morphology cache, refs that are sha1s of commits
+        with a known tree are not looked up at all, and the trees of
+        other commits are remembered in it.
         '''
+
+        tree = self._cached_tree(reponame, ref)
+        if tree is not None:
+            return ref, tree
+        absref, tree = self._resolve_ref(reponame, ref)
+        if self.cache is not None:
+            self.cache.put_tree(reponame, absref, tree)
+        return absref, tree
+
+    def _resolve_tree(self, repo, reponame, absref):
+        tree = None
+        if self.cache is not None:
+            tree = self.cache.get_tree(reponame, absref)
+        return tree or repo.resolve_ref_to_tree(absref)
+
+    def _resolve_ref(self, reponame, ref):
         absref = None
 
         if self.lrc.has_repo(reponame):
@@ -72,7 +100,7 @@ class SourceResolver(object):
             # If the user passed --no-git-update, and the ref is a SHA1 not
             # available locally, this call will raise an exception.
             absref = repo.resolve_ref_to_commit(ref)
-            tree = repo.resolve_ref_to_tree(absref)
+            tree = self._resolve_tree(repo, reponame, absref)
         elif self.rrc is not None:
             try:
                 absref, tree = self.rrc.resolve_ref(reponame, ref)
@@ -93,23 +121,71 @@ class SourceResolver(object):
             else:
                 repo = self.lrc.get_repo(reponame)
             absref = repo.resolve_ref_to_commit(ref)
-            tree = repo.resolve_ref_to_tree(absref)
+            tree = self._resolve_tree(repo, reponame, absref)
         return absref, tree
 
+    def resolve_refs(self, pairs):
+        '''Resolve many (reponame, ref) pairs to commit and tree sha1s.
+
+        Return a dict mapping each pair to its (commit, tree) tuple. Refs
+        in repos that are not in the local repo cache are resolved with a
+        single request to the remote repo cache, where possible. The rest
+        are resolved one by one, as ``resolve_ref`` does.
+
+        '''
+
+        pairs = list(collections.OrderedDict.fromkeys(pairs))
+        resolved = {}
+        for reponame, ref in pairs:
+            tree = self._cached_tree(reponame, ref)
+            if tree is not None:
+                resolved[reponame, ref] = (ref, tree)
+
+        if self.rrc is not None:
+            remote_pairs = [(reponame, ref) for reponame, ref in pairs
+                            if (reponame, ref) not in resolved
+                            and not self.lrc.has_repo(reponame)]
+            if remote_pairs:
+                try:
+                    remote = self.rrc.resolve_refs(remote_pairs)
+                    self.status(msg='Resolved %(count)d refs via remote '
+                                    'repo cache',
+                                count=len(remote), chatty=True)
+                    for (reponame, ref), (absref, tree) in \
+                            remote.iteritems():
+                        if self.cache is not None:
+                            self.cache.put_tree(reponame, absref, tree)
+                        resolved[reponame, ref] = (absref, tree)
+                except BaseException, e:
+                    logging.warning('Caught (and ignored) exception: %s' %
+                                    str(e))
+
+        for reponame, ref in pairs:
+            if (reponame, ref) not in resolved:
+                resolved[reponame, ref] = self.resolve_ref(reponame, ref)
+        return resolved
+
     def traverse_morphs(self, definitions_repo, definitions_ref,
                         system_filenames,
                         visit=lambda rn, rf, fn, arf, m: None,
                         definitions_original_ref=None):
         morph_factory = morphlib.morphologyfactory.MorphologyFactory(
-            self.lrc, self.rrc, self.status)
-        definitions_queue = collections.deque(system_filenames)
+            self.lrc, self.rrc, self.status, self.cache)
+        definitions_queue = list(system_filenames)
         chunk_in_definitions_repo_queue = []
         chunk_in_source_repo_queue = []
 
-        resolved_commits = {}
-        resolved_trees = {}
         resolved_morphologies = {}
 
+        def get_morphology(key):
+            if not key in resolved_morphologies:
+                resolved_morphologies[key] = morph_factory.get_morphology(*key)
+            return resolved_morphologies[key]
+
+        def prefetch(keys):
+            morph_factory.prefetch(
+                [key for key in keys if key not in resolved_morphologies])
+
         # Resolve the (repo, ref) pair for the definitions repo, cache result.
         definitions_absref, definitions_tree = self.resolve_ref(
             definitions_repo, definitions_ref)
@@ -117,68 +193,67 @@ class SourceResolver(object):
         if definitions_original_ref:
             definitions_ref = definitions_original_ref
 
+        # The system and strata are visited breadth first. Each level of
+        # the graph is one wave, whose morphologies are fetched together.
         while definitions_queue:
-            filename = definitions_queue.popleft()
-
-            key = (definitions_repo, definitions_absref, filename)
-            if not key in resolved_morphologies:
-                resolved_morphologies[key] = morph_factory.get_morphology(*key)
-            morphology = resolved_morphologies[key]
-
-            visit(definitions_repo, definitions_ref, filename,
-                  definitions_absref, definitions_tree, morphology)
-            if morphology['kind'] == 'cluster':
-                raise cliapp.AppException(
-                    "Cannot build a morphology of type 'cluster'.")
-            elif morphology['kind'] == 'system':
-                definitions_queue.extend(
-                    morphlib.util.sanitise_morphology_path(s['morph'])
-                    for s in morphology['strata'])
-            elif morphology['kind'] == 'stratum':
-                if morphology['build-depends']:
+            wave, definitions_queue = definitions_queue, []
+            prefetch(
+                (definitions_repo, definitions_absref, filename)
+                for filename in wave)
+
+            for filename in wave:
+                key = (definitions_repo, definitions_absref, filename)
+                morphology = get_morphology(key)
+
+                visit(definitions_repo, definitions_ref, filename,
+                      definitions_absref, definitions_tree, morphology)
+                if morphology['kind'] == 'cluster':
+                    raise cliapp.AppException(
+                        "Cannot build a morphology of type 'cluster'.")
+                elif morphology['kind'] == 'system':
                     definitions_queue.extend(
                         morphlib.util.sanitise_morphology_path(s['morph'])
-                        for s in morphology['build-depends'])
-                for c in morphology['chunks']:
-                    if 'morph' not in c:
-                        path = morphlib.util.sanitise_morphology_path(
-                            c.get('morph', c['name']))
-                        chunk_in_source_repo_queue.append(
-                            (c['repo'], c['ref'], path))
-                        continue
-                    chunk_in_definitions_repo_queue.append(
-                        (c['repo'], c['ref'], c['morph']))
+                        for s in morphology['strata'])
+                elif morphology['kind'] == 'stratum':
+                    if morphology['build-depends']:
+                        definitions_queue.extend(
+                            morphlib.util.sanitise_morphology_path(s['morph'])
+                            for s in morphology['build-depends'])
+                    for c in morphology['chunks']:
+                        if 'morph' not in c:
+                            path = morphlib.util.sanitise_morphology_path(
+                                c.get('morph', c['name']))
+                            chunk_in_source_repo_queue.append(
+                                (c['repo'], c['ref'], path))
+                            continue
+                        chunk_in_definitions_repo_queue.append(
+                            (c['repo'], c['ref'], c['morph']))
+
+        # All the chunks are one more wave: their refs are resolved, and
+        # then their morphologies fetched, together.
+        resolved = self.resolve_refs(
+            (repo, ref) for repo, ref, filename
+            in chunk_in_definitions_repo_queue + chunk_in_source_repo_queue)
+        prefetch(
+            [(definitions_repo, definitions_absref, filename)
+             for repo, ref, filename in chunk_in_definitions_repo_queue] +
+            [(repo, resolved[repo, ref][0], filename)
+             for repo, ref, filename in chunk_in_source_repo_queue])
 
         for repo, ref, filename in chunk_in_definitions_repo_queue:
-            if (repo, ref) not in resolved_trees:
-                commit_sha1, tree_sha1 = self.resolve_ref(repo, ref)
-                resolved_commits[repo, ref] = commit_sha1
-                resolved_trees[repo, commit_sha1] = tree_sha1
-            absref = resolved_commits[repo, ref]
-            tree = resolved_trees[repo, absref]
+            absref, tree = resolved[repo, ref]
             key = (definitions_repo, definitions_absref, filename)
-            if not key in resolved_morphologies:
-                resolved_morphologies[key] = morph_factory.get_morphology(*key)
-            morphology = resolved_morphologies[key]
-            visit(repo, ref, filename, absref, tree, morphology)
+            visit(repo, ref, filename, absref, tree, get_morphology(key))
 
         for repo, ref, filename in chunk_in_source_repo_queue:
-            if (repo, ref) not in resolved_trees:
-                commit_sha1, tree_sha1 = self.resolve_ref(repo, ref)
-                resolved_commits[repo, ref] = commit_sha1
-                resolved_trees[repo, commit_sha1] = tree_sha1
-            absref = resolved_commits[repo, ref]
-            tree = resolved_trees[repo, absref]
+            absref, tree = resolved[repo, ref]
             key = (repo, absref, filename)
-            if key not in resolved_morphologies:
-                resolved_morphologies[key] = morph_factory.get_morphology(*key)
-            morphology = resolved_morphologies[key]
-            visit(repo, ref, filename, absref, tree, morphology)
+            visit(repo, ref, filename, absref, tree, get_morphology(key))
 
 
 def create_source_pool(lrc, rrc, repo, ref, filename,
                        original_ref=None, update_repos=True,
-                       status_cb=None):
+                       status_cb=None, morphology_cache=None):
     '''Find all the sources involved in building a given system.
 
     Given a system morphology, this function will traverse the tree of stratum
@@ -192,6 +267,9 @@ def create_source_pool(lrc, rrc, repo, ref, filename,
     The 'lrc' and 'rrc' parameters specify the local and remote Git repository
     caches used for resolving the sources.
 
+    If a MorphologyCache is given as 'morphology_cache', morphologies and
+    commit trees are looked up in it, and it is saved afterwards.
+
     '''
     pool = morphlib.sourcepool.SourcePool()
 
@@ -202,8 +280,13 @@ def create_source_pool(lrc, rrc, repo, ref, filename,
         for source in sources:
             pool.add(source)
 
-    resolver = SourceResolver(lrc, rrc, update_repos, status_cb)
+    resolver = SourceResolver(lrc, rrc, update_repos, status_cb,
+                              morphology_cache)
     resolver.traverse_morphs(repo, ref, [filename],
                              visit=add_to_pool,
                              definitions_original_ref=original_ref)
+    if morphology_cache is not None:
+        logging.debug('Morphology cache: %d hits, %d misses' %
+                      (morphology_cache.hits, morphology_cache.misses))
+        morphology_cache.save()
     return pool
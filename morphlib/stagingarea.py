@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -20,7 +20,6 @@ import shutil
 import stat
 import cliapp
 from urlparse import urlparse
-import tempfile
 
 import morphlib
 
@@ -48,7 +47,9 @@ class StagingArea(object):
         self._bind_readonly_mount = None
 
         self.use_chroot = use_chroot
-        self.env = build_env.env
+        # Copy the environment, so that staging areas that exist at the same
+        # time do not share PREFIX and PATH.
+        self.env = dict(build_env.env)
         self.env.update(extra_env)
 
         if use_chroot:
@@ -101,83 +102,32 @@ class StagingArea(object):
         assert filename.startswith(dirname)
         return filename[len(dirname) - 1:]  # include leading slash
 
-    def hardlink_all_files(self, srcpath, destpath): # pragma: no cover
-        '''Hardlink every file in the path to the staging-area
-
-        If an exception is raised, the staging-area is indeterminate.
-
-        '''
-
-        file_stat = os.lstat(srcpath)
-        mode = file_stat.st_mode
-
-        if stat.S_ISDIR(mode):
-            # Ensure directory exists in destination, then recurse.
-            if not os.path.lexists(destpath):
-                os.makedirs(destpath)
-            dest_stat = os.stat(os.path.realpath(destpath))
-            if not stat.S_ISDIR(dest_stat.st_mode):
-                raise IOError('Destination not a directory. source has %s'
-                              ' destination has %s' % (srcpath, destpath))
-
-            for entry in os.listdir(srcpath):
-                self.hardlink_all_files(os.path.join(srcpath, entry),
-                                        os.path.join(destpath, entry))
-        elif stat.S_ISLNK(mode):
-            # Copy the symlink.
-            if os.path.lexists(destpath):
-                os.remove(destpath)
-            os.symlink(os.readlink(srcpath), destpath)
-
-        elif stat.S_ISREG(mode):
-            # Hardlink the file.
-            if os.path.lexists(destpath):
-                os.remove(destpath)
-            os.link(srcpath, destpath)
-
-        elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
-            # Block or character device. Put contents of st_dev in a mknod.
-            if os.path.lexists(destpath):
-                os.remove(destpath)
-            os.mknod(destpath, file_stat.st_mode, file_stat.st_rdev)
-            os.chmod(destpath, file_stat.st_mode)
-
-        else:
-            # Unsupported type.
-            raise IOError('Cannot extract %s into staging-area. Unsupported'
-                          ' type.' % srcpath)
-
     def install_artifact(self, handle):
         '''Install a build artifact into the staging area.
 
         We access the artifact via an open file handle. For now, we assume
         the artifact is a tarball.
 
+        The artifact is unpacked into the shared store of unpacked chunks
+        in the temporary directory, if it is not there already, and its
+        files are hardlinked from there.
+
         '''
 
-        chunk_cache_dir = os.path.join(self._app.settings['tempdir'], 'chunks')
-        unpacked_artifact = os.path.join(
-            chunk_cache_dir, os.path.basename(handle.name) + '.d')
-        if not os.path.exists(unpacked_artifact):
-            self._app.status(
-                msg='Unpacking chunk from cache %(filename)s',
-                filename=os.path.basename(handle.name))
-            savedir = tempfile.mkdtemp(dir=chunk_cache_dir)
-            try:
-                morphlib.bins.unpack_binary_from_file(
-                    handle, savedir + '/')
-            except BaseException, e: # pragma: no cover
-                shutil.rmtree(savedir)
-                raise
-            # TODO: This rename is not concurrency safe if two builds are
-            #       extracting the same chunk, one build will fail because
-            #       the other renamed its tempdir here first.
-            os.rename(savedir, unpacked_artifact)
-
-        if not os.path.exists(self.dirname):
-            self._mkdir(self.dirname)
-
-        self.hardlink_all_files(unpacked_artifact, self.dirname)
+        self.chunk_store().install(handle, self.dirname)
+
+    def chunk_store(self):
+        '''Return the store of unpacked chunks used by staging areas.'''
+
+        return morphlib.chunkstore.UnpackedChunkStore(
+            os.path.join(self._app.settings['tempdir'], 'chunks'),
+            self._app.settings['unpacked-chunks-max-size'],
+            status_cb=self._app.status)
+
+    def ldconfig(self):  # pragma: no cover
+        '''Update the dynamic linker cache of the staging area.'''
+
+        morphlib.builder.ldconfig(self._app.runcmd, self.dirname)
 
     def remove(self):
         '''Remove the entire staging area.
@@ -255,20 +205,14 @@ class StagingArea(object):
 
         ccache_dir = kwargs.pop('ccache_dir', None)
 
-        chroot_dir = self.dirname if self.use_chroot else '/'
+        chroot_dir = self._root_dir() if self.use_chroot else '/'
         temp_dir = kwargs["env"].get("TMPDIR", "/tmp")
 
-        staging_dirs = [self.builddirname, self.destdirname]
-        if self.use_chroot:
-            staging_dirs += ["dev", "proc", temp_dir.lstrip('/')]
-        do_not_mount_dirs = [os.path.join(self.dirname, d)
-                             for d in staging_dirs]
-        if not self.use_chroot:
-            do_not_mount_dirs += [temp_dir]
+        do_not_mount_dirs = self._writable_paths(temp_dir)
         logging.debug("Not mounting dirs %r" % do_not_mount_dirs)
 
         if self.use_chroot:
-            mounts = self.to_mount_in_staging
+            mounts = self._root_mounts() + list(self.to_mount_in_staging)
         else:
             mounts = [(os.path.join(self.dirname, target), type, source)
                        for target, type, source in self.to_mount_in_bootstrap]
@@ -276,7 +220,7 @@ class StagingArea(object):
 
         if ccache_dir and not self._app.settings['no-ccache']:
             ccache_target = os.path.join(
-                    self.dirname, kwargs['env']['CCACHE_DIR'].lstrip('/'))
+                    self._root_dir(), kwargs['env']['CCACHE_DIR'].lstrip('/'))
             binds = ((ccache_dir, ccache_target),)
         else:
             binds = ()
@@ -289,8 +233,9 @@ class StagingArea(object):
             binds=binds,
             writable_paths=do_not_mount_dirs)
 
+        tree_walker = self._root_walker() if self.use_chroot else None
         cmdline = morphlib.util.containerised_cmdline(
-            argv, **container_config)
+            argv, tree_walker=tree_walker, **container_config)
 
         if kwargs.get('logfile') != None:
             logfile = kwargs.pop('logfile')
@@ -309,6 +254,34 @@ class StagingArea(object):
             raise cliapp.AppException(
                 'In staging area %s: %s' % (self._failed_location(), msg))
 
+    def _writable_paths(self, temp_dir):
+        '''Return the paths commands in the staging area may write to.
+
+        Everything else is mounted read-only. The paths are as seen from
+        outside the chroot, under its root directory.
+
+        '''
+
+        staging_dirs = [d for d in (self.builddirname, self.destdirname) if d]
+        if not self.use_chroot:
+            return staging_dirs + [temp_dir]
+        staging_dirs = [self.relative(d) for d in staging_dirs]
+        staging_dirs += ['/dev', '/proc', temp_dir]
+        return [os.path.join(self._root_dir(), d.lstrip('/'))
+                for d in staging_dirs]
+
+    def _root_dir(self):  # pragma: no cover
+        '''Directory that is the root of the chroot, outside of it.'''
+        return self.dirname
+
+    def _root_mounts(self):  # pragma: no cover
+        '''Mounts needed to make up the root directory of the chroot.'''
+        return []
+
+    def _root_walker(self):  # pragma: no cover
+        '''Walk the root directory of the chroot, as commands see it.'''
+        return os.walk(self._root_dir())
+
     def _failed_location(self):  # pragma: no cover
         '''Path this staging area will be moved to if an error occurs.'''
         return os.path.join(self._app.settings['tempdir'], 'failed',
@@ -325,3 +298,255 @@ class StagingArea(object):
         os.rename(self.dirname, dest_dir)
         self.dirname = dest_dir
 
+
+class OverlayStagingArea(StagingArea):
+
+    '''A staging area that stacks unpacked chunks with overlayfs.
+
+    Rather than hardlinking every file of every chunk into one directory,
+    the chunks' trees in the unpacked chunk store are used as read-only
+    lower layers of an overlay filesystem. The overlay is mounted on
+    DIRNAME/root in the mount namespace of each command run in the
+    staging area, so setting up and removing the staging area takes the
+    same time however many chunks are installed.
+
+    Everything written goes to the upper layer, DIRNAME/upper, which is
+    what ``dirname`` refers to, so that the build and install directories
+    can be used from outside the chroot as usual.
+
+    Overlayfs accepts a limited number of lower layers. If more chunks
+    than that are installed, the earliest installed ones are hardlinked
+    into a single base layer, as the plain StagingArea would do.
+
+    Commands may only write to the same directories as in a plain
+    StagingArea. The overlay is not mounted outside the commands' mount
+    namespaces, so what to make read-only for them is found from the
+    layers rather than from DIRNAME/root.
+
+    This is only usable for chroot builds, and needs overlayfs support in
+    the kernel; see ``is_supported``.
+
+    '''
+
+    # The overlay mount options must fit in a page of memory, and
+    # overlayfs itself limits how many layers can be stacked.
+    max_layers = 300
+
+    def __init__(self, app, dirname, build_env, use_chroot=True,
+                 extra_env={}, extra_path=[]):
+        assert use_chroot
+        self.topdir = dirname
+        StagingArea.__init__(self, app, os.path.join(dirname, 'upper'),
+                             build_env, use_chroot, extra_env, extra_path)
+        self._layers = []
+        self._pins = []
+        self._layers_linked = 0
+        self._manifests = {}
+        # The mount points in the chroot need to exist in the upper layer,
+        # as the lower ones may not have them.
+        for d in ('upper/dev/shm', 'upper/proc', 'upper/tmp', 'work',
+                  'root', 'l/base'):
+            os.makedirs(os.path.join(dirname, d))
+
+    @staticmethod
+    def is_supported():  # pragma: no cover
+        '''Can overlay staging areas be used on this machine?'''
+        try:
+            with open('/proc/filesystems') as f:
+                return any(line.split()[-1] == 'overlay'
+                           for line in f if line.strip())
+        except IOError:
+            return False
+
+    def install_artifact(self, handle):
+        '''Add a chunk artifact as a new lower layer.'''
+
+        store = self.chunk_store()
+        tree = store.unpacked_tree(handle)
+        if store.max_size > 0:
+            self._pins.append(store.pin(tree))
+        self._layers.append(tree)
+
+    def _link_layers(self):
+        '''Make a numbered symlink in DIRNAME/l for each layer.
+
+        The names are kept short so the overlay mount options are too.
+        Layers beyond max_layers are hardlinked into DIRNAME/l/base.
+
+        '''
+
+        layersdir = os.path.join(self.topdir, 'l')
+        excess = len(self._layers) - self.max_layers
+        if excess > 0:
+            store = self.chunk_store()
+            for tree in self._layers[:excess]:
+                basename = os.path.basename(tree)[:-len('.d')]
+                store.link_tree(tree, store._read_manifest(basename),
+                                os.path.join(layersdir, 'base'))
+            self._layers = self._layers[excess:]
+            for i in xrange(self._layers_linked):
+                os.remove(os.path.join(layersdir, str(i)))
+            self._layers_linked = 0
+        for i in xrange(self._layers_linked, len(self._layers)):
+            os.symlink(self._layers[i], os.path.join(layersdir, str(i)))
+        self._layers_linked = len(self._layers)
+
+    def _root_dir(self):
+        return os.path.join(self.topdir, 'root')
+
+    def _root_mounts(self):
+        self._link_layers()
+        # The first lower layer is the top one, and the options are
+        # relative to the root directory.
+        names = [str(i) for i in reversed(xrange(len(self._layers)))]
+        names.append('base')
+        options = 'lowerdir=%s,upperdir=../upper,workdir=../work' % ':'.join(
+            '../l/%s' % name for name in names)
+        return [('', 'overlay', 'overlay', options)]
+
+    def _upper_layer(self):
+        return morphlib.systemassembly.OverlayUpperLayer(self.dirname)
+
+    def _list_disk_layer(self, layerdir, relname):
+        '''Return the kind of a path in a layer on disk, and its contents.
+
+        Whiteouts, which only the upper layer has, hide what the layers
+        below have at a path.
+
+        '''
+
+        upper = self._upper_layer()
+
+        def kind(filename):
+            st = os.lstat(filename)
+            if stat.S_ISDIR(st.st_mode):
+                return 'opaque' if upper.is_opaque(filename) else 'dir'
+            elif stat.S_ISLNK(st.st_mode):
+                return 'symlink'
+            elif upper.is_whiteout(filename, st):
+                return 'whiteout'
+            return 'file'
+
+        dirname = os.path.join(layerdir, relname)
+        if not os.path.lexists(dirname):
+            return None, {}
+        dir_kind = kind(dirname)
+        if dir_kind not in ('dir', 'opaque'):
+            return dir_kind, {}
+        return dir_kind, dict((name, kind(os.path.join(dirname, name)))
+                              for name in os.listdir(dirname))
+
+    def _list_chunk_layer(self, tree, relname):
+        '''Return the kind of a path in a chunk's tree, and its contents.
+
+        These come from the chunk's manifest, which is indexed by
+        directory the first time it is needed.
+
+        '''
+
+        index = self._manifests.get(tree)
+        if index is None:
+            basename = os.path.basename(tree)[:-len('.d')]
+            index = {'': {}}
+            for name, kind, mode, extra in \
+                    self.chunk_store().manifest(basename) or ():
+                parent, leaf = os.path.split(name)
+                index.setdefault(parent, {})[leaf] = kind
+                if kind == 'dir':
+                    index.setdefault(name, {})
+            self._manifests[tree] = index
+        if relname in index:
+            return 'dir', index[relname]
+        parent, leaf = os.path.split(relname)
+        return index.get(parent, {}).get(leaf), {}
+
+    def _list_root_dir(self, relname):
+        '''List a directory of the overlay, as subdirectories and others.
+
+        The layers are looked at from the top down. A path that is not a
+        directory in a layer hides everything the layers below have at
+        it, as does a directory made opaque. relname must be a directory
+        in the layer above, as it is when walking down from the root.
+
+        '''
+
+        layers = [lambda r: self._list_disk_layer(self.dirname, r)]
+        layers.extend(lambda r, tree=tree: self._list_chunk_layer(tree, r)
+                      for tree in reversed(self._layers))
+        base = os.path.join(self.topdir, 'l', 'base')
+        layers.append(lambda r: self._list_disk_layer(base, r))
+
+        entries = {}
+        for layer in layers:
+            kind, contents = layer(relname)
+            if kind is None:
+                continue
+            if kind not in ('dir', 'opaque'):
+                break
+            for name, entry_kind in contents.iteritems():
+                entries.setdefault(name, entry_kind)
+            if kind == 'opaque':
+                break
+
+        subdirs = sorted(name for name, kind in entries.iteritems()
+                         if kind in ('dir', 'opaque'))
+        others = sorted(name for name, kind in entries.iteritems()
+                        if kind not in ('dir', 'opaque', 'symlink',
+                                        'whiteout'))
+        return subdirs, others
+
+    def _root_walker(self):
+        '''Walk the root of the chroot, as commands see it, like os.walk.
+
+        The overlay is only mounted in the mount namespace of each
+        command, so the directories are listed from the layers instead.
+        Only the subdirectories left in the list given for a directory
+        are walked into, so only the directories that lead to the ones
+        commands may write to are listed when finding what to make
+        read-only. Symlinks are left out, as they cannot be mounted on.
+
+        '''
+
+        self._link_layers()
+        root = self._root_dir()
+        pending = ['']
+        while pending:
+            relname = pending.pop()
+            subdirs, others = self._list_root_dir(relname)
+            yield os.path.join(root, relname).rstrip('/'), subdirs, others
+            pending.extend(os.path.join(relname, name)
+                           for name in reversed(subdirs))
+
+    def ldconfig(self):  # pragma: no cover
+        '''Update the dynamic linker cache, from inside the chroot.
+
+        The libraries are only visible from inside the overlay, so the
+        chroot's own ldconfig is used.
+
+        '''
+
+        layers = self._layers + [os.path.join(self.topdir, 'l', 'base')]
+        if any(os.path.exists(os.path.join(d, 'etc', 'ld.so.conf'))
+               for d in layers):
+            logging.debug('Running ldconfig for %s' % self.topdir)
+            self.runcmd(['ldconfig'])
+
+    def _unpin(self):
+        for f in self._pins:
+            f.close()
+        self._pins = []
+
+    def remove(self):
+        self._unpin()
+        shutil.rmtree(self.topdir)
+
+    def _failed_location(self):
+        return os.path.join(self._app.settings['tempdir'], 'failed',
+                            os.path.basename(self.topdir))
+
+    def abort(self):
+        self._unpin()
+        dest_dir = self._failed_location()
+        os.rename(self.topdir, dest_dir)
+        self.topdir = dest_dir
+        self.dirname = os.path.join(dest_dir, 'upper')
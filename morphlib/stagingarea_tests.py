@@ -1,4 +1,4 @@
-# Copyright (C) 2012-2014  Codethink Limited
+# Copyright (C) 2012-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -46,6 +46,7 @@ class FakeApplication(object):
         self.settings = {
             'cachedir': cachedir,
             'tempdir': tempdir,
+            'unpacked-chunks-max-size': 0,
         }
         for leaf in ('chunks',):
             d = os.path.join(tempdir, leaf)
@@ -141,3 +142,200 @@ class StagingAreaTests(unittest.TestCase):
             object(), self.staging, self.build_env, use_chroot=False)
         filename = os.path.join(self.staging, 'foobar')
         self.assertEqual(sa.relative(filename), filename)
+
+    def test_lets_commands_write_only_to_staging_dirs(self):
+        source = FakeSource()
+        self.sa.chroot_open(source, False)
+        self.assertEqual(
+            self.sa._writable_paths('/tmp'),
+            [os.path.join(self.staging, d)
+             for d in ('le-name.build', 'le-name.inst', 'dev', 'proc',
+                       'tmp')])
+
+    def test_lets_non_isolated_commands_write_to_temp_dir(self):
+        sa = morphlib.stagingarea.StagingArea(
+            object(), self.staging, self.build_env, use_chroot=False)
+        sa.builddirname = os.path.join(self.staging, 'le-name.build')
+        self.assertEqual(sa._writable_paths('/var/tmp'),
+                         [sa.builddirname, '/var/tmp'])
+
+    def test_lets_overlay_commands_write_to_dirs_under_the_root(self):
+        sa = morphlib.stagingarea.OverlayStagingArea(
+            FakeApplication(self.cachedir, self.tempdir), self.staging,
+            self.build_env)
+        builddir, destdir = sa.chroot_open(FakeSource(), False)
+        self.assertEqual(builddir,
+                         os.path.join(self.staging, 'upper', 'le-name.build'))
+        self.assertEqual(
+            sa._writable_paths('/tmp'),
+            [os.path.join(self.staging, 'root', d)
+             for d in ('le-name.build', 'le-name.inst', 'dev', 'proc',
+                       'tmp')])
+
+
+class FakeUpperLayer(object):
+
+    def __init__(self, whiteouts=(), opaque=()):
+        self.whiteouts = set(whiteouts)
+        self.opaque = set(opaque)
+
+    def is_whiteout(self, filename, st):
+        return filename in self.whiteouts
+
+    def is_opaque(self, dirname):
+        return dirname in self.opaque
+
+
+class OverlayStagingAreaTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, 'cachedir')
+        os.makedirs(os.path.join(self.cachedir, 'artifacts'))
+        os.mkdir(os.path.join(self.tempdir, 'failed'))
+        self.staging = os.path.join(self.tempdir, 'staging')
+        self.sa = morphlib.stagingarea.OverlayStagingArea(
+            FakeApplication(self.cachedir, self.tempdir), self.staging,
+            FakeBuildEnvironment())
+        self.upper_layer = FakeUpperLayer()
+        self.sa._upper_layer = lambda: self.upper_layer
+        self.chunksdir = os.path.join(self.tempdir, 'chunks')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def install_chunk(self, name, files, symlinks={}):
+        chunkdir = os.path.join(self.tempdir, name)
+        for filename in files:
+            path = os.path.join(chunkdir, filename)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(filename)
+        for filename, target in symlinks.iteritems():
+            os.symlink(target, os.path.join(chunkdir, filename))
+        chunk_tar = os.path.join(self.tempdir, '%s.chunk.%s' % (name, name))
+        tf = tarfile.TarFile(name=chunk_tar, mode='w')
+        tf.add(chunkdir, arcname='.')
+        tf.close()
+        shutil.rmtree(chunkdir)
+        with open(chunk_tar, 'rb') as f:
+            self.sa.install_artifact(f)
+
+    def read_only_paths(self):
+        self.sa.chroot_open(FakeSource(), False)
+        root = self.sa._root_dir()
+        return sorted(
+            os.path.relpath(d, root) for d in morphlib.fsutils.invert_paths(
+                self.sa._root_walker(), self.sa._writable_paths('/tmp')))
+
+    def test_mounts_the_last_installed_chunk_on_top(self):
+        self.install_chunk('a', ['a'])
+        self.install_chunk('b', ['b'])
+        self.assertEqual(self.sa._root_mounts(), [(
+            '', 'overlay', 'overlay',
+            'lowerdir=../l/1:../l/0:../l/base,upperdir=../upper,'
+            'workdir=../work')])
+        layersdir = os.path.join(self.staging, 'l')
+        self.assertEqual(os.readlink(os.path.join(layersdir, '0')),
+                         os.path.join(self.chunksdir, 'a.chunk.a.d'))
+        self.assertEqual(os.readlink(os.path.join(layersdir, '1')),
+                         os.path.join(self.chunksdir, 'b.chunk.b.d'))
+
+    def test_links_chunks_installed_since_the_last_mount(self):
+        self.install_chunk('a', ['a'])
+        self.sa._root_mounts()
+        self.install_chunk('b', ['b'])
+        self.assertEqual(
+            self.sa._root_mounts()[0][3],
+            'lowerdir=../l/1:../l/0:../l/base,upperdir=../upper,'
+            'workdir=../work')
+
+    def test_links_the_earliest_chunks_into_the_base_layer(self):
+        self.sa.max_layers = 2
+        self.install_chunk('a', ['a'])
+        self.sa._root_mounts()
+        self.install_chunk('b', ['b'])
+        self.install_chunk('c', ['c'])
+        self.assertEqual(
+            self.sa._root_mounts()[0][3],
+            'lowerdir=../l/1:../l/0:../l/base,upperdir=../upper,'
+            'workdir=../work')
+        layersdir = os.path.join(self.staging, 'l')
+        self.assertEqual(sorted(os.listdir(layersdir)), ['0', '1', 'base'])
+        self.assertEqual(os.readlink(os.path.join(layersdir, '0')),
+                         os.path.join(self.chunksdir, 'b.chunk.b.d'))
+        self.assertEqual(os.listdir(os.path.join(layersdir, 'base')), ['a'])
+
+    def test_makes_everything_from_the_chunks_read_only(self):
+        self.install_chunk('a', ['usr/bin/a', 'etc/a.conf', 'init'],
+                           symlinks={'bin': 'usr/bin'})
+        self.install_chunk('b', ['usr/lib/libb.so', 'tmp/b'])
+        self.assertEqual(self.read_only_paths(),
+                         ['etc', 'init', 'usr'])
+
+    def test_makes_files_in_the_base_layer_read_only(self):
+        self.sa.max_layers = 1
+        self.install_chunk('a', ['sbin/a'])
+        self.install_chunk('b', ['usr/b'])
+        self.assertEqual(self.read_only_paths(), ['sbin', 'usr'])
+
+    def test_leaves_out_what_upper_layers_remove(self):
+        self.install_chunk('a', ['usr/a', 'etc/a', 'opt/a'])
+        self.install_chunk('b', ['etc'])
+        upper = os.path.join(self.staging, 'upper')
+        with open(os.path.join(upper, 'opt'), 'w'):
+            pass
+        self.upper_layer.whiteouts.add(os.path.join(upper, 'opt'))
+        self.assertEqual(self.read_only_paths(), ['etc', 'usr'])
+        self.assertEqual(self.sa._list_root_dir('opt'), ([], []))
+
+    def test_leaves_out_symlinks_in_the_upper_layer(self):
+        del self.sa._upper_layer
+        self.install_chunk('a', ['usr/a'])
+        upper = os.path.join(self.staging, 'upper')
+        os.symlink('usr', os.path.join(upper, 'link'))
+        with open(os.path.join(upper, 'file'), 'w'):
+            pass
+        self.assertEqual(self.read_only_paths(), ['file', 'usr'])
+
+    def test_does_not_look_below_opaque_directories(self):
+        self.install_chunk('a', ['usr/a', 'usr/lib/a', 'etc/a'])
+        upper = os.path.join(self.staging, 'upper')
+        os.makedirs(os.path.join(upper, 'usr', 'share'))
+        self.upper_layer.opaque.add(os.path.join(upper, 'usr'))
+        self.sa.chroot_open(FakeSource(), False)
+        subdirs, others = self.sa._list_root_dir('usr')
+        self.assertEqual((subdirs, others), (['share'], []))
+
+    def test_hides_directories_behind_files_in_higher_layers(self):
+        self.install_chunk('a', ['usr/lib/a'])
+        self.install_chunk('b', ['usr'])
+        self.assertEqual(self.sa._list_root_dir(''),
+                         (['dev', 'proc', 'tmp'], ['usr']))
+        self.assertEqual(self.sa._list_root_dir('usr'), ([], []))
+
+    def test_removes_everything(self):
+        self.install_chunk('a', ['a'])
+        self.sa.remove()
+        self.assertFalse(os.path.exists(self.staging))
+
+    def test_pins_chunks_while_in_use_if_the_store_has_a_limit(self):
+        self.sa._app.settings['unpacked-chunks-max-size'] = 1
+        self.install_chunk('a', ['a'])
+        self.install_chunk('b', ['b'])
+        self.assertEqual(sorted(os.listdir(self.chunksdir)), [
+            'a.chunk.a.d', 'a.chunk.a.lock', 'a.chunk.a.manifest',
+            'b.chunk.b.d', 'b.chunk.b.lock', 'b.chunk.b.manifest',
+            'index.json', 'index.lock'])
+        self.sa.remove()
+        self.sa.chunk_store().evict()
+        self.assertEqual(sorted(os.listdir(self.chunksdir)), [
+            'b.chunk.b.d', 'b.chunk.b.lock', 'b.chunk.b.manifest',
+            'index.json', 'index.lock'])
+
+    def test_moves_failed_staging_area_aside(self):
+        self.sa.abort()
+        failed = os.path.join(self.tempdir, 'failed', 'staging')
+        self.assertEqual(self.sa.dirname, os.path.join(failed, 'upper'))
+        self.assertTrue(os.path.isdir(self.sa.dirname))
@@ -0,0 +1,395 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Start staging areas from a pool of ones that were set up before.
+
+The chunks in one staging area are usually much the same as in the one
+for the chunk built before, so rather than hardlinking every chunk into
+an empty directory, a copy of an earlier staging area is made and only
+the chunks that differ are added or taken away.
+
+'''
+
+
+import contextlib
+import errno
+import fcntl
+import json
+import logging
+import os
+import posixpath
+import shutil
+import tempfile
+
+import morphlib
+
+
+def is_library_path(relname):
+    '''Might the path change what ldconfig puts in ld.so.cache?'''
+
+    basename = posixpath.basename(relname)
+    return '.so' in basename or relname.startswith('etc/ld.so.conf')
+
+
+class StagingPool(object):
+
+    '''Pristine staging roots, each with a known set of chunks installed.
+
+    Each root is kept in DIRNAME/ID.root, with the list of its chunks, in
+    the order they were installed in, in DIRNAME/ID.json. The roots are
+    made of hardlinks, and copies of them are made with ``cp -al``, so
+    a root takes up little space of its own, but it does keep the files
+    of its chunks from being freed when they are removed from the store
+    of unpacked chunks.
+
+    The pool keeps a copy of the manifest of every chunk in its roots in
+    DIRNAME/manifests, so it knows which files a chunk put in a root
+    without needing the chunk to be unpacked.
+
+    DIRNAME/ID.lock is locked shared while a root is copied, and
+    exclusively while it is removed. When there are more than
+    ``max_roots`` roots, or they add up to more than ``max_size`` bytes,
+    the least recently used ones are removed. A ``max_size`` of 0 means
+    there is no limit on size.
+
+    '''
+
+    def __init__(self, dirname, runcmd, max_roots, max_size=0,
+                 status_cb=None):
+        self.dirname = dirname
+        self.max_roots = max_roots
+        self.max_size = max_size
+        self._runcmd = runcmd
+        self.status = status_cb or (lambda **kwargs: None)
+        self.manifestdir = os.path.join(dirname, 'manifests')
+        if not os.path.exists(self.manifestdir):
+            os.makedirs(self.manifestdir)
+
+    def _path(self, root_id, suffix):
+        return os.path.join(self.dirname, root_id + suffix)
+
+    @contextlib.contextmanager
+    def _locked(self, root_id, operation):
+        with open(self._path(root_id, '.lock'), 'a') as f:
+            fcntl.flock(f.fileno(), operation)
+            try:
+                yield f
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def roots(self):
+        '''Return (root id, info) pairs for the roots in the pool.'''
+
+        result = []
+        for basename in sorted(os.listdir(self.dirname)):
+            if not basename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.dirname, basename)) as f:
+                    info = json.load(f)
+            except (IOError, OSError, ValueError):
+                continue
+            result.append((basename[:-len('.json')], info))
+        return result
+
+    def _manifest(self, basename):
+        return morphlib.chunkstore.read_manifest(
+            os.path.join(self.manifestdir, basename + '.manifest'))
+
+    def _candidates(self, roots, chunks, entries):
+        '''Return the roots chunks could be installed from, best first.
+
+        A root can be used if the chunks it shares with chunks are in the
+        same order. How good it is depends on how many entries of the
+        chunks it has to add or remove would have to be changed. Roots that
+        would need as many changes as installing everything are left out.
+
+        '''
+
+        wanted = set(chunks)
+        fresh = sum(entries[c] for c in chunks)
+        candidates = []
+        for root_id, info in roots:
+            have = set(info['chunks'])
+            if ([c for c in info['chunks'] if c in wanted] !=
+                    [c for c in chunks if c in have]):
+                continue
+            removed = [c for c in info['chunks'] if c not in wanted]
+            added = [c for c in chunks if c not in have]
+            cost = (sum(info['entries'].get(c, 0) for c in removed) +
+                    sum(entries[c] for c in added))
+            if cost < fresh:
+                candidates.append((cost, root_id, info, removed, added))
+        candidates.sort(key=lambda c: c[0])
+        return candidates
+
+    def install(self, chunks, destdir, unpack):
+        '''Make destdir hold chunks, starting from a root in the pool.
+
+        ``chunks`` is the list of chunk artifact basenames, in the order
+        they are installed in. The ``unpack`` function is given a basename
+        and returns the unpacked tree of the chunk and its manifest; it is
+        only called for the chunks that are in no root, and for those
+        whose files are needed.
+
+        Return None if no root is close enough to the chunks, and
+        destdir was not touched. Otherwise return a dict with the
+        manifests of the chunks, and whether ldconfig needs to be run
+        because the ld.so.cache copied from the root may be out of date.
+
+        '''
+
+        roots = self.roots()
+        if not roots:
+            return None
+        entries = {}
+        for root_id, info in roots:
+            entries.update(info['entries'])
+        unpacked = {}
+        for basename in chunks:
+            if basename not in entries:
+                unpacked[basename] = unpack(basename)
+                entries[basename] = len(unpacked[basename][1])
+
+        for cost, root_id, info, removed, added in \
+                self._candidates(roots, chunks, entries):
+            manifests = {}
+            for basename in chunks + removed:
+                if basename not in added:
+                    manifests[basename] = self._manifest(basename)
+            if any(m is None for m in manifests.itervalues()):
+                continue
+            trees = {}
+            for basename in added:
+                if basename not in unpacked:
+                    unpacked[basename] = unpack(basename)
+                trees[basename], manifests[basename] = unpacked[basename]
+
+            dirty = set()
+            for basename in added + removed:
+                dirty.update(e[0] for e in manifests[basename])
+            if self._conflicts(dirty, [manifests[c] for c in
+                                       chunks + removed]):
+                logging.debug('Staging root %s cannot be changed safely' %
+                              root_id)
+                continue
+
+            with self._locked(root_id, fcntl.LOCK_SH):
+                if not os.path.exists(self._path(root_id, '.json')):
+                    continue
+                self.status(msg='Copying staging root with %(same)d of '
+                                '%(total)d chunks already in it',
+                            same=len(chunks) - len(added),
+                            total=len(chunks), chatty=True)
+                self._copy(self._path(root_id, '.root'), destdir)
+            os.utime(self._path(root_id, '.json'), None)
+
+            def tree_for(basename):
+                if basename not in trees:
+                    trees[basename] = unpack(basename)[0]
+                return trees[basename]
+
+            self._change(destdir, chunks, manifests, dirty, tree_for)
+            cache = os.path.join(destdir, 'etc', 'ld.so.cache')
+            return {
+                'manifests': dict((c, manifests[c]) for c in chunks),
+                'ldconfig': (not os.path.exists(cache) or
+                             any(is_library_path(p) for p in dirty)),
+                'root': root_id,
+                'added': len(added),
+                'removed': len(removed),
+            }
+        return None
+
+    @staticmethod
+    def _conflicts(dirty, manifests):
+        '''Would changing the dirty paths of a copied root go wrong?
+
+        Paths are changed one by one, so a path that is a different kind
+        of entry in different chunks cannot be. That includes a symlink
+        to a directory that another chunk has files in, since manifests
+        list the directories files are in.
+
+        '''
+
+        kinds = {}
+        for manifest in manifests:
+            for relname, kind, mode, extra in manifest:
+                if relname in dirty:
+                    kinds.setdefault(relname, set()).add(kind)
+        return any(len(k) > 1 for k in kinds.itervalues())
+
+    def _copy(self, srcdir, destdir):
+        if os.path.exists(destdir):
+            os.rmdir(destdir)
+        self._runcmd(['cp', '-al', srcdir, destdir])
+
+    @staticmethod
+    def _change(destdir, chunks, manifests, dirty, tree_for):
+        '''Make the dirty paths in destdir what the chunks have there.'''
+
+        owners = {}
+        provided = set()
+        for basename in chunks:
+            for entry in manifests[basename]:
+                provided.add(entry[0])
+                if entry[0] in dirty:
+                    owners[entry[0]] = (basename, entry)
+
+        def remove(path):
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+
+        # Remove what no chunk has any more, the contents of directories
+        # before them. Symlinks left dangling by that, such as those
+        # ldconfig made for removed libraries, go too.
+        parents = set()
+        for relname in sorted(dirty - set(owners), reverse=True):
+            path = os.path.join(destdir, relname)
+            if os.path.isdir(path) and not os.path.islink(path):
+                try:
+                    os.rmdir(path)
+                except OSError as e:
+                    if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                        raise # pragma: no cover
+            elif os.path.lexists(path):
+                os.remove(path)
+            parents.add(posixpath.dirname(relname))
+        for parent in parents:
+            dirname = os.path.join(destdir, parent)
+            if not os.path.isdir(dirname):
+                continue
+            for name in os.listdir(dirname):
+                path = os.path.join(dirname, name)
+                if (posixpath.join(parent, name) not in provided and
+                        os.path.islink(path) and not os.path.exists(path)):
+                    os.remove(path)
+
+        # Put back what the last chunk to have each path has there,
+        # directories before their contents.
+        for relname in sorted(owners):
+            basename, (relname, kind, mode, extra) = owners[relname]
+            path = os.path.join(destdir, relname)
+            if kind == 'dir':
+                if os.path.isdir(path):
+                    continue
+                remove(path)
+                os.mkdir(path)
+                continue
+            remove(path)
+            if kind == 'symlink':
+                os.symlink(extra, path)
+            elif kind == 'file':
+                os.link(os.path.join(tree_for(basename), relname), path)
+            else: # pragma: no cover
+                os.mknod(path, mode, int(extra))
+                os.chmod(path, mode)
+
+    def add(self, srcdir, chunks, manifests):
+        '''Keep a copy of srcdir, which has chunks installed in it.
+
+        ``manifests`` maps each chunk to its manifest. Nothing is added
+        if there is a root with the same chunks already.
+
+        '''
+
+        if self.max_roots <= 0:
+            return
+        for root_id, info in self.roots():
+            if info['chunks'] == chunks:
+                os.utime(self._path(root_id, '.json'), None)
+                return
+
+        for basename in chunks:
+            filename = os.path.join(self.manifestdir,
+                                    basename + '.manifest')
+            if not os.path.exists(filename):
+                morphlib.chunkstore.write_manifest(filename,
+                                                   manifests[basename])
+
+        tempdir = tempfile.mkdtemp(dir=self.dirname, suffix='.tmp')
+        root_id = os.path.basename(tempdir)[:-len('.tmp')]
+        try:
+            root = os.path.join(tempdir, 'root')
+            self._copy(srcdir, root)
+            size = self._tree_size(root)
+            os.rename(root, self._path(root_id, '.root'))
+        finally:
+            shutil.rmtree(tempdir)
+        info = {
+            'chunks': chunks,
+            'entries': dict((c, len(manifests[c])) for c in chunks),
+            'size': size,
+        }
+        with morphlib.savefile.SaveFile(
+                self._path(root_id, '.json'), 'w') as f:
+            json.dump(info, f)
+        self.evict(keep=root_id)
+
+    @staticmethod
+    def _tree_size(root):
+        size = 0
+        for dirname, subdirs, basenames in os.walk(root):
+            for name in basenames:
+                size += os.lstat(os.path.join(dirname, name)).st_size
+        return size
+
+    def _last_used(self, root_id):
+        try:
+            return os.path.getmtime(self._path(root_id, '.json'))
+        except OSError: # pragma: no cover
+            return 0
+
+    def evict(self, keep=None):
+        '''Remove least recently used roots until the pool fits its caps.
+
+        Roots that are being copied are skipped. Manifests of chunks that
+        are in no root any more are removed too.
+
+        '''
+
+        roots = dict(self.roots())
+        count = len(roots)
+        total = sum(info.get('size', 0) for info in roots.itervalues())
+        for root_id in sorted(roots, key=self._last_used):
+            if count <= self.max_roots and (self.max_size <= 0 or
+                                            total <= self.max_size):
+                break
+            if root_id == keep:
+                continue
+            try:
+                with self._locked(root_id,
+                                  fcntl.LOCK_EX | fcntl.LOCK_NB):
+                    logging.debug('Removing staging root %s' % root_id)
+                    os.remove(self._path(root_id, '.json'))
+                    shutil.rmtree(self._path(root_id, '.root'))
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise # pragma: no cover
+                logging.debug('Staging root %s is in use' % root_id)
+                continue
+            os.remove(self._path(root_id, '.lock'))
+            count -= 1
+            total -= roots.pop(root_id).get('size', 0)
+
+        used = set()
+        for info in roots.itervalues():
+            used.update(info['chunks'])
+        for filename in os.listdir(self.manifestdir):
+            if filename[:-len('.manifest')] not in used:
+                os.remove(os.path.join(self.manifestdir, filename))
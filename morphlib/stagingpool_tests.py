@@ -0,0 +1,384 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import fcntl
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import morphlib
+
+
+def runcmd(argv):
+    subprocess.check_call(argv)
+
+
+class StagingPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.pooldir = os.path.join(self.tempdir, 'pool')
+        self.pool = morphlib.stagingpool.StagingPool(
+            self.pooldir, runcmd, max_roots=10)
+        self.chunks = {}
+        self.unpacked = []
+        self.counter = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def chunk(self, name, files=(), dirs=(), symlinks=()):
+        '''Make an unpacked chunk from lists of paths.
+
+        ``files`` is a list of paths, or of (path, contents) pairs, and
+        ``symlinks`` a list of (path, target) pairs.
+
+        '''
+
+        tree = os.path.join(self.tempdir, 'chunks', name)
+        os.makedirs(tree)
+        for d in dirs:
+            os.makedirs(os.path.join(tree, d))
+        for f in files:
+            path, contents = f if isinstance(f, tuple) else (f, name)
+            filename = os.path.join(tree, path)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename, 'w') as f:
+                f.write(contents)
+        for path, target in symlinks:
+            filename = os.path.join(tree, path)
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            os.symlink(target, filename)
+        manifest, size = \
+            morphlib.chunkstore.UnpackedChunkStore.make_manifest(tree)
+        self.chunks[name] = (tree, manifest)
+        return name
+
+    def unpack(self, name):
+        self.unpacked.append(name)
+        return self.chunks[name]
+
+    def new_dir(self):
+        self.counter += 1
+        return os.path.join(self.tempdir, 'staging%d' % self.counter)
+
+    def fresh(self, names, extra=None):
+        destdir = self.new_dir()
+        for name in names:
+            tree, manifest = self.chunks[name]
+            morphlib.chunkstore.UnpackedChunkStore.link_tree(
+                tree, manifest, destdir)
+        if extra:
+            extra(destdir)
+        return destdir
+
+    def add_root(self, names, extra=None):
+        destdir = self.fresh(names, extra)
+        self.pool.add(destdir, names,
+                      dict((n, self.chunks[n][1]) for n in names))
+        return destdir
+
+    def install(self, names):
+        destdir = self.new_dir()
+        os.mkdir(destdir)
+        self.unpacked = []
+        return destdir, self.pool.install(names, destdir, self.unpack)
+
+    def contents(self, root):
+        result = {}
+        for dirname, subdirs, basenames in os.walk(root):
+            for name in subdirs + basenames:
+                filename = os.path.join(dirname, name)
+                relname = os.path.relpath(filename, root)
+                if os.path.islink(filename):
+                    result[relname] = ('symlink', os.readlink(filename))
+                elif os.path.isdir(filename):
+                    result[relname] = ('dir', None)
+                else:
+                    result[relname] = ('file', os.lstat(filename).st_ino)
+        return result
+
+    def assertSameTree(self, got, expected):
+        self.assertEqual(self.contents(got), self.contents(expected))
+
+    def base_chunks(self):
+        self.chunk('fhs', dirs=['etc', 'usr/bin', 'usr/lib'],
+                   symlinks=[('bin', 'usr/bin')])
+        self.chunk('glibc', files=['usr/lib/libc.so.6', 'etc/ld.so.conf'])
+        self.chunk('make', files=['usr/bin/make'])
+        self.chunk('gcc', files=['usr/bin/gcc', 'usr/bin/cc',
+                                 'usr/lib/gcc/crt1.o'])
+
+    def test_does_nothing_without_roots(self):
+        self.base_chunks()
+        destdir, result = self.install(['fhs', 'glibc'])
+        self.assertEqual(result, None)
+        self.assertEqual(os.listdir(destdir), [])
+
+    def test_adds_chunks_to_copy_of_root(self):
+        self.base_chunks()
+        self.add_root(['fhs', 'glibc', 'make'])
+        destdir, result = self.install(['fhs', 'glibc', 'make', 'gcc'])
+        self.assertSameTree(destdir,
+                            self.fresh(['fhs', 'glibc', 'make', 'gcc']))
+        self.assertEqual(self.unpacked, ['gcc'])
+        self.assertEqual((result['added'], result['removed']), (1, 0))
+        self.assertEqual(sorted(result['manifests']),
+                         ['fhs', 'gcc', 'glibc', 'make'])
+
+    def test_removes_chunks_and_restores_what_they_replaced(self):
+        self.base_chunks()
+        self.chunk('newmake', files=['usr/bin/make', 'usr/share/mk/sys.mk'])
+        self.add_root(['fhs', 'glibc', 'make', 'newmake', 'gcc'])
+        destdir, result = self.install(['fhs', 'glibc', 'make', 'gcc'])
+        self.assertSameTree(destdir,
+                            self.fresh(['fhs', 'glibc', 'make', 'gcc']))
+        self.assertEqual(self.unpacked, ['make'])
+        self.assertFalse(os.path.exists(os.path.join(destdir, 'usr/share')))
+
+    def test_later_kept_chunk_wins_over_added_chunk(self):
+        self.base_chunks()
+        self.chunk('busybox', files=['usr/bin/make', 'usr/bin/sh'])
+        self.add_root(['fhs', 'glibc', 'make'])
+        destdir, result = self.install(['fhs', 'glibc', 'busybox', 'make'])
+        self.assertSameTree(destdir,
+                            self.fresh(['fhs', 'glibc', 'busybox', 'make']))
+
+    def test_adds_symlinks_of_added_chunks(self):
+        self.base_chunks()
+        self.chunk('bash', files=['usr/bin/bash'],
+                   symlinks=[('usr/bin/sh', 'bash')])
+        self.add_root(['fhs', 'glibc'])
+        destdir, result = self.install(['fhs', 'glibc', 'bash'])
+        self.assertEqual(os.readlink(os.path.join(destdir, 'usr/bin/sh')),
+                         'bash')
+        self.assertSameTree(destdir, self.fresh(['fhs', 'glibc', 'bash']))
+
+    def test_picks_closest_root(self):
+        self.base_chunks()
+        self.chunk('perl', files=['usr/bin/perl'])
+        self.add_root(['fhs', 'glibc'])
+        self.add_root(['fhs', 'glibc', 'make', 'gcc', 'perl'])
+        destdir, result = self.install(['fhs', 'glibc', 'make', 'gcc'])
+        self.assertEqual(result['removed'], 1)
+        self.assertSameTree(destdir,
+                            self.fresh(['fhs', 'glibc', 'make', 'gcc']))
+
+    def test_unpacks_chunks_from_other_roots_when_added(self):
+        self.base_chunks()
+        self.add_root(['fhs', 'glibc', 'make'])
+        self.add_root(['fhs', 'gcc'])
+        destdir, result = self.install(['fhs', 'glibc', 'make', 'gcc'])
+        self.assertEqual(self.unpacked, ['gcc'])
+        self.assertSameTree(destdir,
+                            self.fresh(['fhs', 'glibc', 'make', 'gcc']))
+
+    def test_skips_roots_with_chunks_in_another_order(self):
+        self.base_chunks()
+        self.add_root(['fhs', 'glibc', 'make', 'gcc'])
+        destdir, result = self.install(['fhs', 'glibc', 'gcc', 'make'])
+        self.assertEqual(result, None)
+
+    def test_skips_roots_that_are_no_closer_than_nothing(self):
+        self.base_chunks()
+        self.add_root(['make'])
+        destdir, result = self.install(['gcc'])
+        self.assertEqual(result, None)
+
+    def test_skips_roots_with_missing_manifests(self):
+        self.base_chunks()
+        self.add_root(['fhs', 'glibc', 'make'])
+        os.remove(os.path.join(self.pooldir, 'manifests',
+                               'glibc.manifest'))
+        destdir, result = self.install(['fhs', 'glibc', 'make', 'gcc'])
+        self.assertEqual(result, None)
+
+    def test_skips_roots_that_went_away(self):
+        self.base_chunks()
+        self.add_root(['fhs', 'glibc', 'make'])
+        real_locked = self.pool._locked
+        def locked(root_id, operation):
+            os.remove(self.pool._path(root_id, '.json'))
+            return real_locked(root_id, operation)
+        self.pool._locked = locked
+        destdir, result = self.install(['fhs', 'glibc', 'make', 'gcc'])
+        self.assertEqual(result, None)
+
+    def test_ignores_broken_root_info(self):
+        self.base_chunks()
+        with open(os.path.join(self.pooldir, 'broken.json'), 'w') as f:
+            f.write('{')
+        self.assertEqual(self.pool.roots(), [])
+
+    def test_does_not_change_paths_through_replaced_symlinks(self):
+        self.base_chunks()
+        self.chunk('compat', symlinks=[('lib', 'usr/lib')])
+        self.chunk('zlib', files=['lib/libz.so.1'])
+        self.add_root(['fhs', 'glibc', 'compat', 'zlib'])
+        destdir, result = self.install(['fhs', 'glibc', 'zlib'])
+        self.assertEqual(result, None)
+
+    def test_does_not_change_paths_of_different_kinds(self):
+        self.base_chunks()
+        self.chunk('odd', files=['usr/lib/gcc'])
+        self.add_root(['fhs', 'glibc', 'odd'])
+        destdir, result = self.install(['fhs', 'glibc', 'gcc'])
+        self.assertEqual(result, None)
+
+    def test_replaces_entries_not_from_chunks(self):
+        self.base_chunks()
+        self.chunk('opt', dirs=['opt'], files=['extra'])
+
+        def extra(destdir):
+            os.makedirs(os.path.join(destdir, 'extra', 'dir'))
+            with open(os.path.join(destdir, 'opt'), 'w'):
+                pass
+
+        self.add_root(['fhs', 'glibc', 'make'], extra)
+        destdir, result = self.install(['fhs', 'glibc', 'make', 'opt'])
+        self.assertSameTree(destdir,
+                            self.fresh(['fhs', 'glibc', 'make', 'opt']))
+
+    def test_keeps_directories_that_are_not_empty(self):
+        self.base_chunks()
+
+        def extra(destdir):
+            with open(os.path.join(destdir, 'usr/lib/gcc/cache'), 'w'):
+                pass
+
+        self.add_root(['fhs', 'glibc', 'gcc'], extra)
+        destdir, result = self.install(['fhs', 'glibc'])
+        self.assertEqual(os.listdir(os.path.join(destdir, 'usr/lib/gcc')),
+                         ['cache'])
+
+    def test_removes_dangling_library_symlinks(self):
+        self.base_chunks()
+        self.chunk('zlib', files=['usr/lib/libz.so.1.2.8'],
+                   symlinks=[('usr/lib/libz.so', 'libz.so.1.2.8')])
+
+        def ldconfig(destdir):
+            os.symlink('libz.so.1.2.8',
+                       os.path.join(destdir, 'usr/lib/libz.so.1'))
+            os.symlink('libc.so.6', os.path.join(destdir, 'usr/lib/libc.so'))
+            with open(os.path.join(destdir, 'etc/ld.so.cache'), 'w'):
+                pass
+
+        self.add_root(['fhs', 'glibc', 'make', 'zlib'], ldconfig)
+        destdir, result = self.install(['fhs', 'glibc', 'make'])
+        self.assertEqual(sorted(os.listdir(os.path.join(destdir, 'usr/lib'))),
+                         ['libc.so', 'libc.so.6'])
+        self.assertTrue(result['ldconfig'])
+
+    def test_reuses_ld_so_cache_when_libraries_are_unchanged(self):
+        self.base_chunks()
+
+        def ldconfig(destdir):
+            with open(os.path.join(destdir, 'etc/ld.so.cache'), 'w'):
+                pass
+
+        self.add_root(['fhs', 'glibc', 'make'], ldconfig)
+        destdir, result = self.install(['fhs', 'glibc', 'make', 'gcc'])
+        self.assertFalse(result['ldconfig'])
+        self.assertTrue(os.path.exists(
+            os.path.join(destdir, 'etc/ld.so.cache')))
+
+    def test_needs_ldconfig_without_ld_so_cache(self):
+        self.base_chunks()
+        self.add_root(['fhs', 'glibc', 'make'])
+        destdir, result = self.install(['fhs', 'glibc', 'make', 'gcc'])
+        self.assertTrue(result['ldconfig'])
+
+    def test_does_not_add_same_chunks_twice(self):
+        self.base_chunks()
+        self.add_root(['fhs', 'glibc'])
+        self.add_root(['fhs', 'glibc'])
+        self.assertEqual(len(self.pool.roots()), 1)
+
+    def test_does_not_add_when_disabled(self):
+        self.base_chunks()
+        self.pool.max_roots = 0
+        self.add_root(['fhs', 'glibc'])
+        self.assertEqual(self.pool.roots(), [])
+
+    def test_records_size_of_root(self):
+        self.base_chunks()
+        self.add_root(['fhs', 'glibc'])
+        [(root_id, info)] = self.pool.roots()
+        self.assertEqual(info['size'], len('glibc') * 2)
+        self.assertEqual(info['entries'], {'fhs': 5, 'glibc': 5})
+
+    def test_evicts_least_recently_used_roots(self):
+        self.base_chunks()
+        self.pool.max_roots = 2
+        self.add_root(['fhs'])
+        self.add_root(['fhs', 'glibc'])
+        self.install(['fhs', 'make'])
+        past = 1000000
+        for root_id, info in self.pool.roots():
+            if info['chunks'] == ['fhs', 'glibc']:
+                os.utime(self.pool._path(root_id, '.json'), (past, past))
+        self.add_root(['fhs', 'make'])
+        self.assertEqual(sorted(info['chunks']
+                                for root_id, info in self.pool.roots()),
+                         [['fhs'], ['fhs', 'make']])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.pooldir, 'manifests'))),
+            ['fhs.manifest', 'make.manifest'])
+        self.assertEqual(len([f for f in os.listdir(self.pooldir)
+                              if f.endswith('.root')]), 2)
+
+    def test_keeps_manifests_of_chunks_in_other_roots(self):
+        self.base_chunks()
+        self.pool.max_roots = 1
+        self.add_root(['fhs', 'glibc'])
+        self.add_root(['glibc', 'make'])
+        self.assertEqual([info['chunks']
+                          for root_id, info in self.pool.roots()],
+                         [['glibc', 'make']])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.pooldir, 'manifests'))),
+            ['glibc.manifest', 'make.manifest'])
+
+    def test_evicts_to_fit_size(self):
+        self.base_chunks()
+        self.pool.max_size = len('glibc') * 3
+        self.add_root(['glibc'])
+        self.add_root(['glibc', 'make'])
+        self.assertEqual([info['chunks']
+                          for root_id, info in self.pool.roots()],
+                         [['glibc', 'make']])
+
+    def test_does_not_evict_roots_in_use(self):
+        self.base_chunks()
+        self.pool.max_roots = 1
+        self.add_root(['fhs'])
+        [(root_id, info)] = self.pool.roots()
+        with open(self.pool._path(root_id, '.lock'), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+            self.add_root(['fhs', 'glibc'])
+        self.assertEqual(len(self.pool.roots()), 2)
+
+    def test_is_library_path(self):
+        self.assertTrue(morphlib.stagingpool.is_library_path(
+            'usr/lib/libc.so.6'))
+        self.assertTrue(morphlib.stagingpool.is_library_path(
+            'etc/ld.so.conf.d/foo.conf'))
+        self.assertFalse(morphlib.stagingpool.is_library_path(
+            'usr/bin/gcc'))
@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2012  Codethink Limited
+# Copyright (C) 2011-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -20,9 +20,13 @@ import datetime
 
 class Stopwatch(object):
 
-    def __init__(self):
+    '''Time named stages, optionally recording each as a trace span.'''
+
+    def __init__(self, tracer=None):
         self.ticks = {}
         self.context_stack = []
+        self.tracer = tracer
+        self._spans = []
 
     def tick(self, reference_object, name):
         if not reference_object in self.ticks:
@@ -63,9 +67,15 @@ class Stopwatch(object):
 
     def __enter__(self):
         self.start(self.context_stack[-1])
+        if self.tracer is not None:
+            span = self.tracer.span(self.context_stack[-1])
+            span.__enter__()
+            self._spans.append(span)
         return self
 
     def __exit__(self, *args):
+        if self.tracer is not None:
+            self._spans.pop().__exit__(*args)
         self.stop(self.context_stack[-1])
         self.context_stack.pop()
         return False  # cause any exception to be re-raised
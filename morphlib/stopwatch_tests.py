@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2012  Codethink Limited
+# Copyright (C) 2011-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -69,3 +69,12 @@ class StopwatchTests(unittest.TestCase):
         self.assertTrue(self.stopwatch.stop_time('bar') is not None)
         self.assertTrue(self.stopwatch.start_stop_seconds('foo') < 1.0)
         self.assertTrue(self.stopwatch.start_stop_seconds('bar') < 1.0)
+
+    def test_records_trace_spans(self):
+        tracer = morphlib.tracing.Tracer()
+        stopwatch = morphlib.stopwatch.Stopwatch(tracer)
+        with stopwatch('foo'):
+            with stopwatch('bar'):
+                pass
+        self.assertEqual(sorted(e['name'] for e in tracer.events),
+                         ['bar', 'foo'])
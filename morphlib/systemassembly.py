@@ -0,0 +1,447 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Write system tarballs from the chunk tarballs, not from an unpacked tree.
+
+Unpacking every chunk of a system and then reading the whole tree back
+to make the rootfs tarball writes and reads every byte twice. Instead,
+the members of the chunk tarballs are indexed in the order they would
+be unpacked, so that each path is known to come from the last chunk
+that has it, and the winning members are copied straight from the
+chunks into the system tarball.
+
+The system integration commands still need a real tree to run in, so
+one is made by hardlinking the chunks from the store of unpacked chunks
+used for staging areas. Only what changes in that tree while the
+commands run, and the metadata written into it, is read back from disk.
+The files in the tree are shared with the store, so the commands run on
+an overlay of it, and what they change is moved into the tree after.
+
+'''
+
+
+import copy
+import ctypes
+import ctypes.util
+import os
+import posixpath
+import shutil
+import stat
+import tarfile
+
+import cliapp
+
+import morphlib
+
+
+class CannotStreamError(cliapp.AppException):
+
+    '''The system tarball cannot be written from the chunks.
+
+    This is raised when the chunks would not unpack to a tree that the
+    index can describe, for example when a directory is replaced by a
+    file. The tarball is then written from the tree on disk instead.
+
+    '''
+
+    def __init__(self, msg):
+        cliapp.AppException.__init__(
+            self, 'Cannot stream system from chunks: %s' % msg)
+
+
+def member_kind(member):
+    '''Return the kind of entry a tar member unpacks to.'''
+
+    if member.isdir():
+        return 'dir'
+    elif member.issym():
+        return 'symlink'
+    elif member.isreg() or member.islnk():
+        return 'file'
+    elif member.ischr() or member.isblk():
+        return 'device'
+    else:
+        raise CannotStreamError('unsupported type of member %s' % member.name)
+
+
+def _normalise(name):
+    return posixpath.normpath('/' + name).lstrip('/')
+
+
+class PathIndex(object):
+
+    '''Where each path of a system comes from.
+
+    Tar members are added in the order the chunks are unpacked in. Each
+    path is mapped to the position of the chunk it was last written by,
+    the offset of the member in that chunk, the kind of entry, and for
+    hardlinks the path linked to. Symlinks to directories are followed,
+    as they are when unpacking, so paths are as they are on disk.
+
+    Directory members are kept, since they have no contents and can be
+    written before anything else.
+
+    '''
+
+    max_symlinks = 40
+
+    def __init__(self):
+        self.entries = {}
+        self.dirs = {}
+
+    def resolve(self, name, follow_last=False):
+        '''Return the path a member name unpacks to.
+
+        Symlinks are followed in the directories of the name, and with
+        follow_last in its last component too.
+
+        '''
+
+        parts = [p for p in _normalise(name).split('/') if p]
+        if not parts:
+            return ''
+        followed = 0
+        i = 0
+        while i < len(parts) - (0 if follow_last else 1):
+            prefix = '/'.join(parts[:i+1])
+            entry = self.entries.get(prefix)
+            if entry is None or entry[2] == 'dir':
+                i += 1
+                continue
+            if entry[2] != 'symlink':
+                raise CannotStreamError('%s is not a directory' % prefix)
+            followed += 1
+            if followed > self.max_symlinks:
+                raise CannotStreamError('too many symlinks in %s' % name)
+            target = entry[3]
+            if not target.startswith('/'):
+                target = posixpath.join('/'.join(parts[:i]), target)
+            parts = ([p for p in _normalise(target).split('/') if p] +
+                     parts[i+1:])
+            i = 0
+        return '/'.join(parts)
+
+    def add(self, position, member):
+        '''Record that a member of the chunk at position is unpacked.'''
+
+        path = self.resolve(member.name)
+        if not path:
+            return
+        kind = member_kind(member)
+        existing = self.entries.get(path)
+        if kind == 'dir':
+            if existing is not None and existing[2] == 'symlink':
+                # Unpacking onto a symlink to a directory keeps it.
+                target = self.entries.get(self.resolve(path, True))
+                if target is None or target[2] != 'dir':
+                    raise CannotStreamError(
+                        '%s is not a symlink to a directory' % path)
+                return
+            if existing is not None and existing[2] != 'dir':
+                raise CannotStreamError(
+                    '%s is replaced by a directory' % path)
+            self.dirs[path] = member
+            self.entries[path] = (position, member.offset, kind, None)
+            return
+
+        if existing is not None and existing[2] == 'dir':
+            raise CannotStreamError('directory %s is replaced' % path)
+        extra = None
+        if member.islnk():
+            extra = self.resolve(member.linkname)
+        elif member.issym():
+            extra = member.linkname
+        self.entries[path] = (position, member.offset, kind, extra)
+        self.dirs.pop(path, None)
+
+    def kinds(self):
+        return dict((path, entry[2])
+                    for path, entry in self.entries.iteritems())
+
+    def winners(self):
+        '''Return, for each chunk position, the paths of its members.
+
+        The result maps chunk positions to dicts from member offsets to
+        the path the member is written to.
+
+        '''
+
+        result = {}
+        for path, (position, offset, kind, extra) \
+                in self.entries.iteritems():
+            result.setdefault(position, {})[offset] = path
+        return result
+
+
+def snapshot(root):
+    '''Record the type and status of every entry under root.
+
+    Two snapshots of the same tree are equal for a path unless the entry
+    there was replaced or changed in between.
+
+    '''
+
+    result = {}
+    for dirname, subdirs, basenames in os.walk(root):
+        for name in subdirs + basenames:
+            filename = os.path.join(dirname, name)
+            st = os.lstat(filename)
+            mode = st.st_mode
+            target = None
+            if stat.S_ISDIR(mode):
+                kind = 'dir'
+            elif stat.S_ISLNK(mode):
+                kind = 'symlink'
+                target = os.readlink(filename)
+            elif stat.S_ISREG(mode):
+                kind = 'file'
+            elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode): # pragma: no cover
+                kind = 'device'
+            else:
+                kind = 'other'
+            result[os.path.relpath(filename, root)] = (
+                kind, st.st_ino, mode, st.st_uid, st.st_gid, st.st_size,
+                st.st_mtime, st.st_rdev, target)
+    return result
+
+
+class _CountingFile(object):
+
+    '''Count the bytes read from a file.'''
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.count += len(data)
+        return data
+
+
+class StreamingAssembler(object):
+
+    '''Write a system tarball from its chunks, in the order they unpack.
+
+    ``chunks`` is the list of chunk artifact references, in the order
+    they would be unpacked in. ``bytes_read`` and ``bytes_written`` add
+    up how much has been read from chunks and disk, and how much has
+    been written to the tarball.
+
+    '''
+
+    def __init__(self, local_artifact_cache, chunks):
+        self.lac = local_artifact_cache
+        self.chunks = chunks
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def _members(self, position):
+        f = self.lac.get(self.chunks[position])
+        counter = _CountingFile(f)
+        try:
+            with morphlib.bins.chunk_reader(counter) as tar:
+                for member in tar:
+                    yield tar, member
+        finally:
+            self.bytes_read += counter.count
+            f.close()
+
+    def index(self):
+        '''Index the members of every chunk, reading only their headers.'''
+
+        index = PathIndex()
+        for position in xrange(len(self.chunks)):
+            for tar, member in self._members(position):
+                index.add(position, member)
+        return index
+
+    def check(self, index, before, after):
+        '''Find what changed on disk and check the chunks can be used.
+
+        ``before`` is a snapshot of the tree once the chunks were linked
+        into it, and ``after`` one taken when it is ready to be written.
+        Return the set of paths that were changed or added, and the set
+        of paths that were removed.
+
+        '''
+
+        on_disk = dict((path, status[0])
+                       for path, status in before.iteritems())
+        if index.kinds() != on_disk:
+            different = sorted(set(index.kinds().items()) ^
+                               set(on_disk.items()))
+            raise CannotStreamError('chunks unpack differently from the '
+                                    'index, for example at %s' %
+                                    different[0][0])
+
+        changed = set(path for path, status in after.iteritems()
+                      if before.get(path) != status)
+        removed = set(before) - set(after)
+
+        # A hardlink can only be copied if the file it links to is copied
+        # before it, from the same chunk, and has not changed since.
+        for path, (position, offset, kind, extra) \
+                in index.entries.iteritems():
+            if kind != 'file' or extra is None:
+                continue
+            if path in changed or path in removed:
+                continue
+            target = index.entries.get(extra)
+            if (target is None or target[0] != position or
+                    target[1] >= offset or extra in changed or
+                    extra in removed):
+                raise CannotStreamError('hardlink %s to %s cannot be '
+                                        'copied' % (path, extra))
+
+        return changed, removed
+
+    def write(self, f, name, index, root, changed, removed, after):
+        '''Write the system tarball to f.
+
+        Directories come first, then the members of each chunk that are
+        in the system, then the files that were changed on disk.
+
+        '''
+
+        tar = tarfile.open(fileobj=f, mode='w', name=name)
+        try:
+            self._add_from_disk(tar, root, '.')
+            for path in sorted(p for p, status in after.iteritems()
+                               if status[0] == 'dir'):
+                if path in changed:
+                    self._add_from_disk(tar, root, path)
+                else:
+                    info = copy.copy(index.dirs[path])
+                    info.name = path
+                    tar.addfile(info)
+
+            winners = index.winners()
+            for position in xrange(len(self.chunks)):
+                if position not in winners:
+                    continue
+                paths = winners[position]
+                for chunk_tar, member in self._members(position):
+                    path = paths.get(member.offset)
+                    if (path is None or member.isdir() or
+                            path in changed or path in removed):
+                        continue
+                    info = copy.copy(member)
+                    info.name = path
+                    if member.islnk():
+                        info.linkname = index.entries[path][3]
+                    if member.isreg():
+                        tar.addfile(info, chunk_tar.extractfile(member))
+                        self.bytes_written += member.size
+                    else:
+                        tar.addfile(info)
+
+            for path in sorted(changed):
+                if after[path][0] != 'dir':
+                    self._add_from_disk(tar, root, path)
+        finally:
+            tar.close()
+
+    def _add_from_disk(self, tar, root, path):
+        filename = os.path.join(root, path)
+        info = tar.gettarinfo(filename, arcname=path)
+        if info.isreg():
+            with open(filename, 'rb') as f:
+                tar.addfile(info, f)
+            self.bytes_read += info.size
+            self.bytes_written += info.size
+        else:
+            tar.addfile(info)
+
+
+def _lgetxattr(filename, name):  # pragma: no cover
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    buf = ctypes.create_string_buffer(64)
+    size = libc.lgetxattr(filename, name, buf, len(buf))
+    if size < 0:
+        return None
+    return buf.raw[:size]
+
+
+def _remove(filename):
+    if os.path.isdir(filename) and not os.path.islink(filename):
+        shutil.rmtree(filename)
+    elif os.path.lexists(filename):
+        os.remove(filename)
+
+
+class OverlayUpperLayer(object):
+
+    '''The upper layer of an overlay filesystem, once it is unmounted.
+
+    Everything written through an overlay goes to its upper layer: a file
+    that is changed is first copied up whole, a path that is removed is
+    left as a whiteout, and a directory that is removed and made again
+    is marked opaque, hiding what the lower layer has in it.
+
+    ``merge_into`` applies these changes to the tree that was the lower
+    layer. Files are moved into it, replacing the entries it has rather
+    than writing to them, so that files hardlinked into the tree from
+    elsewhere are left as they were.
+
+    '''
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def is_whiteout(self, filename, st):
+        return stat.S_ISCHR(st.st_mode) and st.st_rdev == 0
+
+    def is_opaque(self, dirname):  # pragma: no cover
+        return _lgetxattr(dirname, 'trusted.overlay.opaque') == 'y'
+
+    def merge_into(self, root):
+        '''Move the changes in the upper layer into root.'''
+
+        dirs = []
+        for dirname, subdirs, basenames in os.walk(self.dirname):
+            target_dirname = os.path.normpath(os.path.join(
+                root, os.path.relpath(dirname, self.dirname)))
+            for name in sorted(subdirs + basenames):
+                filename = os.path.join(dirname, name)
+                target = os.path.join(target_dirname, name)
+                st = os.lstat(filename)
+                if self.is_whiteout(filename, st):
+                    _remove(target)
+                elif stat.S_ISDIR(st.st_mode):
+                    if (os.path.islink(target) or
+                            (os.path.lexists(target) and
+                             not os.path.isdir(target)) or
+                            self.is_opaque(filename)):
+                        _remove(target)
+                    if not os.path.lexists(target):
+                        os.mkdir(target)
+                    dirs.append((st, target))
+                else:
+                    if not os.path.islink(target) and os.path.isdir(target):
+                        shutil.rmtree(target)
+                    os.rename(filename, target)
+            # Only directories are left to walk into.
+            subdirs[:] = [d for d in subdirs
+                          if os.path.isdir(os.path.join(dirname, d)) and
+                          not os.path.islink(os.path.join(dirname, d))]
+
+        # Directories get the status they have in the upper layer once
+        # their contents are in place, so their times are kept.
+        for st, target in reversed(dirs):
+            os.chown(target, st.st_uid, st.st_gid)
+            os.chmod(target, stat.S_IMODE(st.st_mode))
+            os.utime(target, (st.st_atime, st.st_mtime))
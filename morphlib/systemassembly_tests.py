@@ -0,0 +1,421 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import os
+import shutil
+import stat
+import StringIO
+import tarfile
+import tempfile
+import unittest
+
+import morphlib
+
+
+def make_chunk(filename, entries):
+    '''Write a chunk tarball from (name, kind, data) tuples.'''
+
+    with tarfile.open(filename, 'w') as tar:
+        for name, kind, data in entries:
+            info = tarfile.TarInfo(name)
+            info.mtime = 683074800
+            if kind == 'dir':
+                info.type = tarfile.DIRTYPE
+                info.mode = 0755
+                tar.addfile(info)
+            elif kind == 'symlink':
+                info.type = tarfile.SYMTYPE
+                info.linkname = data
+                tar.addfile(info)
+            elif kind == 'hardlink':
+                info.type = tarfile.LNKTYPE
+                info.linkname = data
+                tar.addfile(info)
+            else:
+                info.mode = 0644
+                info.size = len(data)
+                tar.addfile(info, StringIO.StringIO(data))
+
+
+class FakeArtifactCache(object):
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def get(self, chunk):
+        return open(os.path.join(self.dirname, chunk), 'rb')
+
+
+class PathIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = morphlib.systemassembly.PathIndex()
+        self.offset = 0
+
+    def add(self, position, name, kind, data=''):
+        info = tarfile.TarInfo(name)
+        info.type = {
+            'dir': tarfile.DIRTYPE,
+            'symlink': tarfile.SYMTYPE,
+            'hardlink': tarfile.LNKTYPE,
+            'file': tarfile.REGTYPE,
+            'fifo': tarfile.FIFOTYPE,
+            'device': tarfile.CHRTYPE,
+        }[kind]
+        info.linkname = data
+        info.offset = self.offset
+        self.offset += 512
+        self.index.add(position, info)
+
+    def test_later_chunks_win(self):
+        self.add(0, 'bin', 'dir')
+        self.add(0, 'bin/sh', 'file')
+        self.add(1, './bin/', 'dir')
+        self.add(1, 'bin/sh', 'symlink', 'bash')
+        self.assertEqual(self.index.kinds(),
+                         {'bin': 'dir', 'bin/sh': 'symlink'})
+        self.assertEqual(self.index.entries['bin'][0], 1)
+        self.assertEqual(self.index.winners(),
+                         {1: {1024: 'bin', 1536: 'bin/sh'}})
+
+    def test_follows_symlinks_to_directories(self):
+        self.add(0, 'usr', 'dir')
+        self.add(0, 'usr/lib', 'dir')
+        self.add(0, 'lib', 'symlink', 'usr/lib')
+        self.add(1, 'lib', 'dir')
+        self.add(1, 'lib/libc.so', 'file')
+        self.add(1, 'lib/libc.so.6', 'hardlink', 'lib/libc.so')
+        self.assertEqual(self.index.kinds(), {
+            'usr': 'dir',
+            'usr/lib': 'dir',
+            'lib': 'symlink',
+            'usr/lib/libc.so': 'file',
+            'usr/lib/libc.so.6': 'file',
+        })
+        self.assertEqual(self.index.entries['usr/lib/libc.so.6'][3],
+                         'usr/lib/libc.so')
+
+    def test_follows_absolute_symlinks_without_leaving_root(self):
+        self.add(0, 'usr', 'dir')
+        self.add(0, 'lib', 'symlink', '/../usr')
+        self.assertEqual(self.index.resolve('lib/foo'), 'usr/foo')
+        self.assertEqual(self.index.resolve('lib', follow_last=True), 'usr')
+
+    def test_rejects_symlink_loops(self):
+        self.add(0, 'a', 'symlink', 'b')
+        self.add(0, 'b', 'symlink', 'a')
+        self.assertRaises(morphlib.systemassembly.CannotStreamError,
+                          self.index.resolve, 'a/foo')
+
+    def test_rejects_file_replacing_directory(self):
+        self.add(0, 'etc', 'dir')
+        self.assertRaises(morphlib.systemassembly.CannotStreamError,
+                          self.add, 1, 'etc', 'file')
+
+    def test_rejects_directory_replacing_file(self):
+        self.add(0, 'etc', 'file')
+        self.assertRaises(morphlib.systemassembly.CannotStreamError,
+                          self.add, 1, 'etc', 'dir')
+        self.assertRaises(morphlib.systemassembly.CannotStreamError,
+                          self.add, 1, 'etc/passwd', 'file')
+
+    def test_rejects_directory_onto_symlink_to_file(self):
+        self.add(0, 'etc', 'file')
+        self.add(0, 'conf', 'symlink', 'etc')
+        self.assertRaises(morphlib.systemassembly.CannotStreamError,
+                          self.add, 1, 'conf', 'dir')
+
+    def test_rejects_directory_onto_dangling_symlink(self):
+        self.add(0, 'conf', 'symlink', 'missing')
+        self.assertRaises(morphlib.systemassembly.CannotStreamError,
+                          self.add, 1, 'conf', 'dir')
+
+    def test_indexes_devices(self):
+        self.add(0, 'null', 'device')
+        self.assertEqual(self.index.kinds(), {'null': 'device'})
+
+    def test_rejects_unsupported_members(self):
+        self.assertRaises(morphlib.systemassembly.CannotStreamError,
+                          self.add, 0, 'fifo', 'fifo')
+
+    def test_ignores_root_directory(self):
+        self.add(0, '.', 'dir')
+        self.assertEqual(self.index.kinds(), {})
+
+
+class StreamingAssemblerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.tempdir, 'cache')
+        self.root = os.path.join(self.tempdir, 'root')
+        os.mkdir(self.cachedir)
+        self.store = morphlib.chunkstore.UnpackedChunkStore(
+            os.path.join(self.tempdir, 'store'))
+        os.mkdir(self.store.dirname)
+        self.lac = FakeArtifactCache(self.cachedir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def assemble(self, chunks, change_tree=lambda root: None):
+        for name, entries in chunks:
+            make_chunk(os.path.join(self.cachedir, name), entries)
+        names = [name for name, entries in chunks]
+        assembler = morphlib.systemassembly.StreamingAssembler(
+            self.lac, names)
+        index = assembler.index()
+        for name in names:
+            with self.lac.get(name) as f:
+                self.store.install(f, self.root)
+        before = morphlib.systemassembly.snapshot(self.root)
+        change_tree(self.root)
+        after = morphlib.systemassembly.snapshot(self.root)
+        changed, removed = assembler.check(index, before, after)
+        output = StringIO.StringIO()
+        assembler.write(output, 'system', index, self.root,
+                        changed, removed, after)
+        output.seek(0)
+        return assembler, tarfile.open(fileobj=output)
+
+    def contents(self, tar):
+        result = {}
+        for member in tar:
+            if member.isreg():
+                result[member.name] = tar.extractfile(member).read()
+            elif member.islnk():
+                result[member.name] = ('hardlink', member.linkname)
+            elif member.issym():
+                result[member.name] = ('symlink', member.linkname)
+            else:
+                result[member.name] = 'dir'
+        return result
+
+    def test_writes_what_unpacking_would_leave(self):
+        chunks = [
+            ('first', [
+                ('usr', 'dir', ''),
+                ('usr/lib', 'dir', ''),
+                ('lib', 'symlink', 'usr/lib'),
+                ('etc', 'dir', ''),
+                ('etc/motd', 'file', 'old motd'),
+                ('etc/issue', 'file', 'issue'),
+            ]),
+            ('second', [
+                ('lib', 'dir', ''),
+                ('lib/libfoo.so', 'file', 'foo library'),
+                ('lib/libfoo.so.1', 'hardlink', 'lib/libfoo.so'),
+                ('etc', 'dir', ''),
+                ('etc/motd', 'file', 'new motd'),
+            ]),
+        ]
+        assembler, tar = self.assemble(chunks)
+        self.assertEqual(self.contents(tar), {
+            '.': 'dir',
+            'usr': 'dir',
+            'usr/lib': 'dir',
+            'etc': 'dir',
+            'lib': ('symlink', 'usr/lib'),
+            'etc/motd': 'new motd',
+            'etc/issue': 'issue',
+            'usr/lib/libfoo.so': 'foo library',
+            'usr/lib/libfoo.so.1': ('hardlink', 'usr/lib/libfoo.so'),
+        })
+        self.assertEqual(assembler.bytes_written,
+                         len('new motd' + 'issue' + 'foo library'))
+
+    def test_reads_back_only_what_changed(self):
+        chunks = [
+            ('first', [
+                ('etc', 'dir', ''),
+                ('etc/motd', 'file', 'motd'),
+                ('etc/issue', 'file', 'issue'),
+                ('etc/hostname', 'file', 'hostname'),
+            ]),
+        ]
+
+        def change_tree(root):
+            with open(os.path.join(root, 'etc', 'motd.new'), 'w') as f:
+                f.write('changed motd')
+            os.rename(os.path.join(root, 'etc', 'motd.new'),
+                      os.path.join(root, 'etc', 'motd'))
+            os.remove(os.path.join(root, 'etc', 'issue'))
+            with open(os.path.join(root, 'etc', 'ld.so.cache'), 'w') as f:
+                f.write('cache')
+
+        assembler, tar = self.assemble(chunks, change_tree)
+        self.assertEqual(self.contents(tar), {
+            '.': 'dir',
+            'etc': 'dir',
+            'etc/motd': 'changed motd',
+            'etc/hostname': 'hostname',
+            'etc/ld.so.cache': 'cache',
+        })
+        with open(os.path.join(self.root, 'etc', 'hostname')) as f:
+            self.assertEqual(f.read(), 'hostname')
+
+    def test_skips_replaced_chunks_and_removed_links(self):
+        chunks = [
+            ('first', [('foo', 'file', 'old')]),
+            ('second', [
+                ('foo', 'file', 'new'),
+                ('bar', 'hardlink', 'foo'),
+            ]),
+        ]
+
+        def change_tree(root):
+            os.remove(os.path.join(root, 'bar'))
+
+        assembler, tar = self.assemble(chunks, change_tree)
+        self.assertEqual(self.contents(tar), {'.': 'dir', 'foo': 'new'})
+
+    def test_rejects_hardlink_to_replaced_file(self):
+        chunks = [
+            ('first', [
+                ('foo', 'file', 'old'),
+                ('bar', 'hardlink', 'foo'),
+            ]),
+            ('second', [
+                ('foo', 'file', 'new'),
+            ]),
+        ]
+        self.assertRaises(morphlib.systemassembly.CannotStreamError,
+                          self.assemble, chunks)
+
+    def test_rejects_tree_that_does_not_match_index(self):
+        make_chunk(os.path.join(self.cachedir, 'first'),
+                   [('foo', 'file', 'foo')])
+        assembler = morphlib.systemassembly.StreamingAssembler(
+            self.lac, ['first'])
+        index = assembler.index()
+        os.makedirs(os.path.join(self.root, 'bar'))
+        before = morphlib.systemassembly.snapshot(self.root)
+        self.assertRaises(morphlib.systemassembly.CannotStreamError,
+                          assembler.check, index, before, before)
+
+    def test_snapshot_records_kinds_of_entries(self):
+        os.makedirs(os.path.join(self.root, 'dir'))
+        os.symlink('dir', os.path.join(self.root, 'link'))
+        os.mkfifo(os.path.join(self.root, 'dir', 'fifo'))
+        result = morphlib.systemassembly.snapshot(self.root)
+        self.assertEqual(
+            dict((path, status[0]) for path, status in result.iteritems()),
+            {'dir': 'dir', 'link': 'symlink', 'dir/fifo': 'other'})
+        self.assertEqual(result['link'][-1], 'dir')
+
+
+class FakeWhiteoutStat(object):
+
+    st_mode = stat.S_IFCHR | 0000
+    st_rdev = 0
+
+
+class OverlayUpperLayerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.store = os.path.join(self.tempdir, 'store')
+        self.root = os.path.join(self.tempdir, 'root')
+        self.upper = os.path.join(self.tempdir, 'upper')
+        for d in (self.store, self.root, self.upper):
+            os.mkdir(d)
+        self.layer = morphlib.systemassembly.OverlayUpperLayer(self.upper)
+        # Whiteouts are device nodes, which need root to make, so the
+        # tests list the files that are to be taken as whiteouts instead.
+        self.whiteouts = set()
+        self.layer.is_whiteout = (
+            lambda filename, st: filename in self.whiteouts)
+        self.opaque = set()
+        self.layer.is_opaque = lambda dirname: dirname in self.opaque
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, dirname, path, data):
+        filename = os.path.join(dirname, path)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'w') as f:
+            f.write(data)
+        return filename
+
+    def read(self, path):
+        with open(os.path.join(self.root, path)) as f:
+            return f.read()
+
+    def link_from_store(self, path, data):
+        os.link(self.write(self.store, path.replace('/', '_'), data),
+                self.write(self.root, path, '') + '.new')
+        os.rename(os.path.join(self.root, path) + '.new',
+                  os.path.join(self.root, path))
+
+    def test_replaces_linked_files_without_changing_them(self):
+        self.link_from_store('etc/cache', 'old')
+        self.write(self.upper, 'etc/cache', 'new')
+        self.layer.merge_into(self.root)
+        self.assertEqual(self.read('etc/cache'), 'new')
+        with open(os.path.join(self.store, 'etc_cache')) as f:
+            self.assertEqual(f.read(), 'old')
+
+    def test_adds_new_files_and_directories(self):
+        self.write(self.upper, 'var/lib/new/file', 'data')
+        os.symlink('file', os.path.join(self.upper, 'var/lib/new/link'))
+        os.chmod(os.path.join(self.upper, 'var/lib/new'), 0700)
+        self.layer.merge_into(self.root)
+        self.assertEqual(self.read('var/lib/new/file'), 'data')
+        self.assertEqual(
+            os.readlink(os.path.join(self.root, 'var/lib/new/link')), 'file')
+        self.assertEqual(
+            os.stat(os.path.join(self.root, 'var/lib/new')).st_mode & 0777,
+            0700)
+
+    def test_removes_whited_out_paths(self):
+        self.link_from_store('etc/gone', 'data')
+        self.write(self.root, 'usr/share/gone/file', 'data')
+        for path in ('etc/gone', 'usr/share/gone'):
+            self.whiteouts.add(self.write(self.upper, path, ''))
+        self.layer.merge_into(self.root)
+        self.assertFalse(os.path.lexists(os.path.join(self.root, 'etc/gone')))
+        self.assertFalse(
+            os.path.lexists(os.path.join(self.root, 'usr/share/gone')))
+        self.assertTrue(os.path.exists(os.path.join(self.store, 'etc_gone')))
+
+    def test_empties_opaque_directories(self):
+        self.write(self.root, 'var/cache/old', 'data')
+        self.write(self.upper, 'var/cache/new', 'data')
+        self.opaque.add(os.path.join(self.upper, 'var/cache'))
+        self.layer.merge_into(self.root)
+        self.assertEqual(os.listdir(os.path.join(self.root, 'var/cache')),
+                         ['new'])
+
+    def test_replaces_entries_of_other_kinds(self):
+        self.write(self.root, 'dir/file', 'data')
+        self.write(self.root, 'file', 'data')
+        os.symlink('elsewhere', os.path.join(self.root, 'link'))
+        self.write(self.upper, 'dir', 'now a file')
+        self.write(self.upper, 'file/inside', 'now a directory')
+        self.write(self.upper, 'link/inside', 'now a directory')
+        self.layer.merge_into(self.root)
+        self.assertEqual(self.read('dir'), 'now a file')
+        self.assertEqual(self.read('file/inside'), 'now a directory')
+        self.assertEqual(self.read('link/inside'), 'now a directory')
+        self.assertFalse(os.path.islink(os.path.join(self.root, 'link')))
+
+    def test_only_takes_device_nodes_to_be_whiteouts(self):
+        layer = morphlib.systemassembly.OverlayUpperLayer(self.upper)
+        filename = self.write(self.upper, 'file', '')
+        self.assertFalse(layer.is_whiteout(filename, os.lstat(filename)))
+        self.assertTrue(layer.is_whiteout(filename, FakeWhiteoutStat()))
@@ -0,0 +1,219 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import logging
+import threading
+
+import morphlib
+
+
+class TieredArtifactCache(object):
+
+    '''Read artifacts from peers that hold them before the shared cache.
+
+    In distbuild, every worker serves its local artifact cache, so an
+    artifact built or fetched by one worker can be fetched by the others
+    from it rather than from the shared cache. ``locations`` maps cache
+    keys to the URLs of the cache servers of the peers that are thought
+    to hold their artifacts, best first, as the controller tells each
+    build. ``shared`` is the RemoteArtifactCache of the shared cache.
+
+    This works like a RemoteArtifactCache, as the remote cache of a
+    BuildCommand, which only asks it for what is missing from its local
+    cache. Each file is read from the first peer listed for its cache key
+    that has it, or else from the shared cache. The locations are only a
+    hint, so a peer that cannot be reached is taken not to have anything,
+    and anything that cannot be fetched from a peer is fetched from the
+    shared cache instead.
+
+    '''
+
+    # Peers are only worth waiting for as long as the shared cache
+    # takes to answer instead.
+    peer_timeout = 10
+
+    def __init__(self, shared, locations, new_cache=None):
+        self.shared = shared
+        self.locations = locations
+        self._new_cache = new_cache or self._new_peer
+        self._peers = {}
+        self._tiers = {}
+        self._lock = threading.Lock()
+
+    def _new_peer(self, url):  # pragma: no cover
+        return morphlib.remoteartifactcache.RemoteArtifactCache(
+            url, timeout=self.peer_timeout)
+
+    def _peer(self, url):
+        with self._lock:
+            if url not in self._peers:
+                self._peers[url] = self._new_cache(url)
+            return self._peers[url]
+
+    def _peer_urls(self, filename):
+        cache_key, name = morphlib.localartifactcache.split_basename(filename)
+        return self.locations.get(cache_key, ())
+
+    def has_files(self, filenames):
+        '''Return the set of the given filenames that any tier has.
+
+        The peers listed for the files are asked about them in turn, each
+        about the files not found on the peers before it, in one request
+        per peer. The shared cache is asked about the rest.
+
+        '''
+
+        wanted = set(filenames)
+        present = set(f for f in wanted if f in self._tiers)
+        rank = 0
+        while True:
+            by_peer = {}
+            for filename in wanted - present:
+                urls = self._peer_urls(filename)
+                if rank < len(urls):
+                    by_peer.setdefault(urls[rank], []).append(filename)
+            if not by_peer:
+                break
+            for url, peer_filenames in sorted(by_peer.iteritems()):
+                peer = self._peer(url)
+                found = peer.has_files(peer_filenames, assume_present=False)
+                for filename in found:
+                    self._tiers[filename] = peer
+                present.update(found)
+            rank += 1
+
+        rest = wanted - present
+        if rest:
+            found = self.shared.has_files(rest)
+            for filename in found:
+                self._tiers[filename] = self.shared
+            present.update(found)
+        return present
+
+    def _tier(self, group):
+        '''Return the cache to fetch a group of files from.
+
+        Groups are the files of one source, which all have the same cache
+        key, so this is the peer that has all of them, if there is one.
+
+        '''
+
+        tiers = set(self._tiers.get(filename, self.shared)
+                    for filename, open_local in group)
+        if len(tiers) == 1:
+            return tiers.pop()
+        return self.shared
+
+    def _forget(self, group):
+        for filename, open_local in group:
+            self._tiers.pop(filename, None)
+
+    def fetch_files(self, groups, connections=1, log=logging.error):
+        '''Download groups of files into the local cache.
+
+        This is like RemoteArtifactCache.fetch_files. Each group is
+        fetched from the tier found to have it by ``has_files``. Each
+        peer is fetched from with up to ``connections`` connections at
+        the same time as the others. The groups that cannot be fetched
+        from peers are then fetched from the shared cache.
+
+        '''
+
+        unknown = [filename for group in groups
+                   for filename, open_local in group
+                   if filename not in self._tiers]
+        if unknown:
+            self.has_files(unknown)
+
+        index = dict((id(group), i) for i, group in enumerate(groups))
+        by_tier = {}
+        for group in groups:
+            by_tier.setdefault(self._tier(group), []).append(group)
+        shared_groups = by_tier.pop(self.shared, [])
+
+        results = {}
+
+        def fetch(peer, peer_groups):
+            results[peer] = peer.fetch_files(peer_groups, connections,
+                                             log=logging.warning)
+
+        threads = [threading.Thread(target=fetch, args=item)
+                   for item in by_tier.iteritems()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        total = 0
+        for peer, (size, failed) in results.iteritems():
+            logging.info('Fetched %d bytes of artifacts from peer %s' %
+                         (size, peer))
+            total += size
+            for group in failed:
+                self._forget(group)
+            shared_groups.extend(failed)
+
+        failed = []
+        if shared_groups:
+            shared_groups.sort(key=lambda group: index[id(group)])
+            size, failed = self.shared.fetch_files(shared_groups,
+                                                   connections, log=log)
+            total += size
+        return total, failed
+
+    def _read(self, filename, read):
+        '''Read a file from the tier that has it.
+
+        ``read`` is called with the cache to read the file from. If it
+        fails for a peer, it is called with the shared cache.
+
+        '''
+
+        self.has_files([filename])
+        tier = self._tiers.get(filename, self.shared)
+        if tier is not self.shared:
+            try:
+                return read(tier)
+            except morphlib.remoteartifactcache.GetError:
+                self._tiers.pop(filename, None)
+        return read(self.shared)
+
+    def has(self, artifact):
+        return bool(self.has_files([artifact.basename()]))
+
+    def has_artifact_metadata(self, artifact, name):
+        return bool(self.has_files([artifact.metadata_basename(name)]))
+
+    def has_source_metadata(self, source, cachekey, name):
+        return bool(self.has_files(['%s.%s' % (cachekey, name)]))
+
+    def get(self, artifact, log=logging.error):
+        return self._read(artifact.basename(),
+                          lambda cache: cache.get(artifact, log=log))
+
+    def get_artifact_metadata(self, artifact, name, log=logging.error):
+        return self._read(
+            artifact.metadata_basename(name),
+            lambda cache: cache.get_artifact_metadata(artifact, name,
+                                                      log=log))
+
+    def get_source_metadata(self, source, cachekey, name):
+        return self._read(
+            '%s.%s' % (cachekey, name),
+            lambda cache: cache.get_source_metadata(source, cachekey, name))
+
+    def __str__(self):
+        return str(self.shared)
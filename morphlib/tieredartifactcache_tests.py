@@ -0,0 +1,212 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import StringIO
+import unittest
+import urllib2
+
+import morphlib
+
+
+class FakeArtifact(object):
+
+    def __init__(self, cache_key, name):
+        self.cache_key = cache_key
+        self.name = name
+
+    def basename(self):
+        return '%s.chunk.%s' % (self.cache_key, self.name)
+
+    def metadata_basename(self, name):
+        return '%s.%s' % (self.basename(), name)
+
+
+class FakeLocalFile(StringIO.StringIO):
+
+    def __init__(self):
+        StringIO.StringIO.__init__(self)
+        self.aborted = False
+        self.closed_ok = False
+
+    def abort(self):
+        self.aborted = True
+
+    def close(self):
+        self.closed_ok = True
+
+
+class FakeServer(object):
+
+    '''A cache server, reached through a RemoteArtifactCache.'''
+
+    def __init__(self, url, files):
+        self.url = url
+        self.files = dict(files)
+        self.asked = []
+        self.fetched = []
+        self.reachable = True
+        self.cache = morphlib.remoteartifactcache.RemoteArtifactCache(url)
+        self.cache._has_files = self._has_files
+        self.cache._has_file = lambda filename: filename in self.files
+        self.cache._get_file = self._get_file
+        self.cache._open_connection = lambda: None
+        self.cache._close_connection = lambda connection: None
+        self.cache._get_file_on_connection = (
+            lambda connection, filename: self._get_file(filename))
+
+    def _has_files(self, filenames):
+        if not self.reachable:
+            raise urllib2.URLError('unreachable')
+        self.asked.append(sorted(filenames))
+        return dict((f, f in self.files) for f in filenames)
+
+    def _get_file(self, filename):
+        if not self.reachable or filename not in self.files:
+            raise urllib2.URLError('%s: HTTP 404' % filename)
+        self.fetched.append(filename)
+        return StringIO.StringIO(self.files[filename])
+
+
+class TieredArtifactCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.shared = FakeServer('http://shared:8080/', {
+            'AAA.chunk.a': 'shared a',
+            'AAA.chunk.a.meta': 'shared a meta',
+            'BBB.chunk.b': 'shared b',
+            'CCC.chunk.c': 'shared c',
+            'CCC.meta': 'shared c meta',
+        })
+        self.peer1 = FakeServer('http://peer1:8080/', {
+            'AAA.chunk.a': 'peer1 a',
+            'AAA.chunk.a.meta': 'peer1 a meta',
+        })
+        self.peer2 = FakeServer('http://peer2:8080/', {
+            'AAA.chunk.a': 'peer2 a',
+            'BBB.chunk.b': 'peer2 b',
+        })
+        self.servers = dict((server.url, server) for server in
+                            (self.peer1, self.peer2))
+        self.locations = {
+            'AAA': ['http://peer1:8080/', 'http://peer2:8080/'],
+            'BBB': ['http://peer1:8080/', 'http://peer2:8080/'],
+        }
+        self.cache = morphlib.tieredartifactcache.TieredArtifactCache(
+            self.shared.cache, self.locations,
+            new_cache=lambda url: self.servers[url].cache)
+
+    def fetch(self, *filenames_of_groups):
+        locals = {}
+        groups = [[(filename, lambda f=filename:
+                                  locals.setdefault(f, FakeLocalFile()))
+                   for filename in filenames]
+                  for filenames in filenames_of_groups]
+        size, failed = self.cache.fetch_files(groups, connections=2,
+                                              log=lambda msg: None)
+        failed = [[filename for filename, open_local in group]
+                  for group in failed]
+        contents = dict((filename, local.getvalue())
+                        for filename, local in locals.iteritems()
+                        if local.closed_ok)
+        return size, failed, contents
+
+    def test_finds_files_on_the_first_peer_that_has_them(self):
+        self.assertEqual(
+            self.cache.has_files(['AAA.chunk.a', 'BBB.chunk.b',
+                                  'CCC.chunk.c', 'DDD.chunk.d']),
+            set(['AAA.chunk.a', 'BBB.chunk.b', 'CCC.chunk.c']))
+        self.assertEqual(self.peer1.asked, [['AAA.chunk.a', 'BBB.chunk.b']])
+        self.assertEqual(self.peer2.asked, [['BBB.chunk.b']])
+        self.assertEqual(self.shared.asked, [['CCC.chunk.c', 'DDD.chunk.d']])
+
+    def test_fetches_from_peers_before_the_shared_cache(self):
+        self.cache.has_files(['AAA.chunk.a', 'AAA.chunk.a.meta',
+                              'BBB.chunk.b', 'CCC.chunk.c'])
+        size, failed, contents = self.fetch(
+            ['AAA.chunk.a', 'AAA.chunk.a.meta'], ['BBB.chunk.b'],
+            ['CCC.chunk.c'])
+        self.assertEqual(failed, [])
+        self.assertEqual(contents, {
+            'AAA.chunk.a': 'peer1 a',
+            'AAA.chunk.a.meta': 'peer1 a meta',
+            'BBB.chunk.b': 'peer2 b',
+            'CCC.chunk.c': 'shared c',
+        })
+        self.assertEqual(size, sum(len(data) for data in contents.values()))
+        self.assertEqual(self.shared.fetched, ['CCC.chunk.c'])
+
+    def test_fetches_groups_split_between_peers_from_the_shared_cache(self):
+        self.peer1.files.pop('AAA.chunk.a')
+        size, failed, contents = self.fetch(
+            ['AAA.chunk.a', 'AAA.chunk.a.meta'])
+        self.assertEqual(contents, {
+            'AAA.chunk.a': 'shared a',
+            'AAA.chunk.a.meta': 'shared a meta',
+        })
+
+    def test_falls_back_to_the_shared_cache_when_a_peer_fails(self):
+        self.cache.has_files(['AAA.chunk.a', 'CCC.chunk.c'])
+        self.peer1.files.clear()
+        size, failed, contents = self.fetch(['CCC.chunk.c'], ['AAA.chunk.a'])
+        self.assertEqual(failed, [])
+        self.assertEqual(contents, {
+            'AAA.chunk.a': 'shared a',
+            'CCC.chunk.c': 'shared c',
+        })
+        self.assertEqual(self.shared.fetched, ['CCC.chunk.c', 'AAA.chunk.a'])
+
+    def test_takes_unreachable_peers_to_have_nothing(self):
+        self.peer1.reachable = False
+        self.assertEqual(self.cache.has_files(['AAA.chunk.a']),
+                         set(['AAA.chunk.a']))
+        size, failed, contents = self.fetch(['AAA.chunk.a'])
+        self.assertEqual(contents, {'AAA.chunk.a': 'peer2 a'})
+
+    def test_reports_groups_no_tier_has(self):
+        size, failed, contents = self.fetch(['AAA.chunk.a'], ['DDD.chunk.d'])
+        self.assertEqual(failed, [['DDD.chunk.d']])
+        self.assertEqual(contents, {'AAA.chunk.a': 'peer1 a'})
+
+    def test_uses_only_the_shared_cache_without_locations(self):
+        self.locations.clear()
+        size, failed, contents = self.fetch(['AAA.chunk.a'])
+        self.assertEqual(contents, {'AAA.chunk.a': 'shared a'})
+        self.assertEqual(self.peer1.asked + self.peer2.asked, [])
+
+    def test_checks_and_gets_single_files_through_the_tiers(self):
+        a = FakeArtifact('AAA', 'a')
+        c = FakeArtifact('CCC', 'c')
+        self.assertTrue(self.cache.has(a))
+        self.assertFalse(self.cache.has(FakeArtifact('DDD', 'd')))
+        self.assertTrue(self.cache.has_artifact_metadata(a, 'meta'))
+        self.assertTrue(self.cache.has_source_metadata(None, 'CCC', 'meta'))
+        self.assertEqual(self.cache.get(a).read(), 'peer1 a')
+        self.assertEqual(self.cache.get_artifact_metadata(a, 'meta').read(),
+                         'peer1 a meta')
+        self.assertEqual(self.cache.get(c).read(), 'shared c')
+        self.assertEqual(
+            self.cache.get_source_metadata(None, 'CCC', 'meta').read(),
+            'shared c meta')
+
+    def test_gets_single_files_from_the_shared_cache_when_a_peer_fails(self):
+        a = FakeArtifact('AAA', 'a')
+        self.assertTrue(self.cache.has(a))
+        self.peer1.files.clear()
+        self.assertEqual(self.cache.get(a, log=lambda msg: None).read(),
+                         'shared a')
+
+    def test_is_named_after_the_shared_cache(self):
+        self.assertEqual(str(self.cache), 'http://shared:8080/')
@@ -0,0 +1,196 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+'''Record where the time of a build goes, as nested spans.
+
+Traces are written in the trace event format, as JSON objects with a
+``traceEvents`` list of complete ("X") events, so they can be loaded
+into chrome://tracing, Perfetto and other trace viewers. Times in the
+events are in microseconds.
+
+'''
+
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class Tracer(object):
+
+    '''Record spans of time.
+
+    ``span`` is used as a context manager around each phase. It returns
+    a dict of arguments for the span, which the code being traced can
+    add to, for example with the number of bytes it read.
+
+    '''
+
+    def __init__(self, name=None, clock=time.time):
+        self.name = name
+        self.events = []
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, category='build', **kwargs):
+        args = dict(kwargs)
+        start = self._clock()
+        try:
+            yield args
+        except BaseException as e:
+            args['error'] = str(e)
+            raise
+        finally:
+            end = self._clock()
+            event = {
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': int(start * 1000000),
+                'dur': int((end - start) * 1000000),
+                'pid': os.getpid(),
+                'tid': threading.current_thread().ident,
+                'args': args,
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def trace(self):
+        '''Return the trace as a JSON-serialisable dict.'''
+
+        with self._lock:
+            events = sorted(self.events, key=lambda e: (e['ts'], -e['dur']))
+        result = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+        if self.name is not None:
+            result['otherData'] = {'name': self.name}
+        return result
+
+    def write(self, f):
+        json.dump(self.trace(), f, indent=1, sort_keys=True)
+        f.write('\n')
+
+
+class NullTracer(object):
+
+    '''A tracer that records nothing, for code run without tracing.'''
+
+    name = None
+
+    @contextlib.contextmanager
+    def span(self, name, category='build', **kwargs):
+        yield dict(kwargs)
+
+
+def read_trace(f):
+    '''Return the events of a trace read from an open file.
+
+    Both the object form written by Tracer and a bare list of events
+    are accepted, as trace viewers do.
+
+    '''
+
+    trace = json.load(f)
+    if isinstance(trace, dict):
+        return trace.get('traceEvents', [])
+    return trace
+
+
+def self_times(events):
+    '''Return (event, seconds) pairs for each complete event.
+
+    The time of an event is its own: the time of the events nested
+    inside it, in the same thread, is taken away.
+
+    '''
+
+    threads = {}
+    for event in events:
+        if event.get('ph') != 'X':
+            continue
+        key = (event.get('pid'), event.get('tid'))
+        threads.setdefault(key, []).append(event)
+
+    result = []
+    for thread_events in threads.itervalues():
+        thread_events.sort(key=lambda e: (e['ts'], -e['dur']))
+        own = [e['dur'] for e in thread_events]
+        stack = []
+        for i, event in enumerate(thread_events):
+            while stack and (thread_events[stack[-1]]['ts'] +
+                             thread_events[stack[-1]]['dur'] <= event['ts']):
+                stack.pop()
+            if stack:
+                own[stack[-1]] -= event['dur']
+            stack.append(i)
+        for event, dur in zip(thread_events, own):
+            result.append((event, max(dur, 0) / 1000000.0))
+    return result
+
+
+class Summary(object):
+
+    '''Add up the time spent in each kind of span over many traces.
+
+    For every span name, ``stats`` holds a dict with the number of
+    spans, their total and own time in seconds, and the longest one.
+
+    '''
+
+    def __init__(self):
+        self.stats = {}
+        self.traces = 0
+
+    def add(self, events):
+        self.traces += 1
+        for event, own in self_times(events):
+            stats = self.stats.setdefault(event['name'], {
+                'count': 0,
+                'total': 0.0,
+                'self': 0.0,
+                'max': 0.0,
+            })
+            seconds = event['dur'] / 1000000.0
+            stats['count'] += 1
+            stats['total'] += seconds
+            stats['self'] += own
+            stats['max'] = max(stats['max'], seconds)
+
+    def rows(self, key='self'):
+        '''Return (name, stats) pairs, the most time first.'''
+
+        return sorted(self.stats.iteritems(),
+                      key=lambda (name, stats): (-stats[key], name))
+
+    def format(self, key='self', limit=None):
+        '''Return the summary as lines of a table.'''
+
+        total = sum(stats['self'] for stats in self.stats.itervalues())
+        lines = ['%-32s %7s %11s %11s %6s %10s' %
+                 ('SPAN', 'COUNT', 'TOTAL (s)', 'SELF (s)', 'SELF%',
+                  'MAX (s)')]
+        rows = self.rows(key)
+        if limit is not None:
+            rows = rows[:limit]
+        for name, stats in rows:
+            lines.append('%-32s %7d %11.2f %11.2f %5.1f%% %10.2f' %
+                         (name[:32], stats['count'], stats['total'],
+                          stats['self'],
+                          100.0 * stats['self'] / total if total else 0.0,
+                          stats['max']))
+        return lines
@@ -0,0 +1,140 @@
+# Copyright (C) 2026  Codethink Limited
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+import json
+import StringIO
+import unittest
+
+import morphlib
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def event(name, ts, dur, tid=1):
+    return {'name': name, 'ph': 'X', 'ts': ts, 'dur': dur,
+            'pid': 1, 'tid': tid}
+
+
+class TracerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.tracer = morphlib.tracing.Tracer('foo', clock=self.clock)
+
+    def test_records_nested_spans(self):
+        with self.tracer.span('build', kind='chunk') as args:
+            self.clock.advance(1)
+            with self.tracer.span('configure-command', category='command'):
+                self.clock.advance(2)
+            args['bytes'] = 42
+        trace = self.tracer.trace()
+        self.assertEqual(trace['otherData'], {'name': 'foo'})
+        events = trace['traceEvents']
+        self.assertEqual([(e['name'], e['cat'], e['ts'], e['dur'], e['ph'])
+                          for e in events],
+                         [('build', 'build', 100000000, 3000000, 'X'),
+                          ('configure-command', 'command', 101000000,
+                           2000000, 'X')])
+        self.assertEqual(events[0]['args'], {'kind': 'chunk', 'bytes': 42})
+
+    def test_records_errors(self):
+        def fail():
+            with self.tracer.span('build'):
+                raise Exception('oops')
+        self.assertRaises(Exception, fail)
+        self.assertEqual(self.tracer.events[0]['args'], {'error': 'oops'})
+
+    def test_writes_trace_that_can_be_read_back(self):
+        with self.tracer.span('build'):
+            pass
+        f = StringIO.StringIO()
+        self.tracer.write(f)
+        f.seek(0)
+        events = morphlib.tracing.read_trace(f)
+        self.assertEqual([e['name'] for e in events], ['build'])
+
+    def test_reads_bare_lists_of_events(self):
+        f = StringIO.StringIO(json.dumps([event('build', 0, 1)]))
+        self.assertEqual(morphlib.tracing.read_trace(f),
+                         [event('build', 0, 1)])
+
+    def test_unnamed_trace_has_no_other_data(self):
+        self.assertEqual(morphlib.tracing.Tracer().trace(),
+                         {'traceEvents': [], 'displayTimeUnit': 'ms'})
+
+    def test_null_tracer_records_nothing(self):
+        tracer = morphlib.tracing.NullTracer()
+        with tracer.span('build', kind='chunk') as args:
+            self.assertEqual(args, {'kind': 'chunk'})
+
+
+class SummaryTests(unittest.TestCase):
+
+    def test_self_time_excludes_nested_spans(self):
+        events = [
+            event('build', 0, 10000000),
+            event('configure', 1000000, 2000000),
+            event('make', 4000000, 5000000),
+            event('make', 5000000, 1000000),
+            event('other-thread', 0, 3000000, tid=2),
+            {'name': 'process_name', 'ph': 'M', 'pid': 1},
+        ]
+        result = dict((e['name'] + str(e['ts']), seconds)
+                      for e, seconds in morphlib.tracing.self_times(events))
+        self.assertEqual(result, {
+            'build0': 3.0,
+            'configure1000000': 2.0,
+            'make4000000': 4.0,
+            'make5000000': 1.0,
+            'other-thread0': 3.0,
+        })
+
+    def test_adds_up_spans_over_traces(self):
+        summary = morphlib.tracing.Summary()
+        summary.add([event('build', 0, 4000000),
+                     event('install-chunk', 0, 1000000)])
+        summary.add([event('build', 0, 2000000),
+                     event('install-chunk', 0, 2000000)])
+        self.assertEqual(summary.traces, 2)
+        self.assertEqual(summary.stats['install-chunk'], {
+            'count': 2, 'total': 3.0, 'self': 3.0, 'max': 2.0})
+        self.assertEqual(summary.stats['build'], {
+            'count': 2, 'total': 6.0, 'self': 3.0, 'max': 4.0})
+        self.assertEqual([name for name, stats in summary.rows('total')],
+                         ['build', 'install-chunk'])
+        lines = summary.format(limit=1)
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('SPAN'))
+        self.assertTrue(lines[1].startswith('build'))
+        self.assertTrue('50.0%' in lines[1])
+
+    def test_formats_empty_summary(self):
+        self.assertEqual(len(morphlib.tracing.Summary().format()), 1)
+
+    def test_formats_spans_that_took_no_time(self):
+        summary = morphlib.tracing.Summary()
+        summary.add([event('build', 0, 0)])
+        self.assertTrue('0.0%' in summary.format()[1])
@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2015  Codethink Limited
+# Copyright (C) 2011-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -81,6 +81,20 @@ def sanitise_morphology_path(morph_name):
         return morph_name
 
 
+def intern_string(string):
+    '''Return ``string``, or an equal string that is already in use.
+
+    Names, refs and SHA1s are repeated all over a build graph, and
+    interning them keeps one copy of each. Only byte strings can be
+    interned, so anything else is returned as it is.
+
+    '''
+
+    if type(string) is str:
+        return intern(string)
+    return string
+
+
 def make_concurrency(cores=None):
     '''Return the number of concurrent jobs for make.
 
@@ -120,6 +134,19 @@ def get_git_resolve_cache_server(settings): # pragma: no cover
     return None
 
 
+def new_local_artifact_cache(cachedir, max_size=0,
+                             dedup=False):  # pragma: no cover
+    '''Create the local artifact cache in cachedir, with its index.'''
+
+    return morphlib.localartifactcache.LocalArtifactCache(
+        fs.osfs.OSFS(os.path.join(cachedir, 'artifacts')),
+        os.path.join(cachedir, 'artifacts-index.sqlite'),
+        max_size=max_size,
+        pins_dirname=os.path.join(cachedir, 'artifact-pins'),
+        cas_dirname=os.path.join(cachedir, 'artifacts-cas'),
+        dedup=dedup)
+
+
 def new_artifact_caches(settings):  # pragma: no cover
     '''Create new objects for local and remote artifact caches.
 
@@ -132,8 +159,9 @@ def new_artifact_caches(settings):  # pragma: no cover
     if not os.path.exists(artifact_cachedir):
         os.mkdir(artifact_cachedir)
 
-    lac = morphlib.localartifactcache.LocalArtifactCache(
-            fs.osfs.OSFS(artifact_cachedir))
+    lac = new_local_artifact_cache(
+        cachedir, settings['cachedir-artifact-max-size'],
+        settings['cachedir-artifact-dedup'])
 
     rac_url = get_artifact_cache_server(settings)
     rac = None
@@ -142,6 +170,30 @@ def new_artifact_caches(settings):  # pragma: no cover
     return lac, rac
 
 
+def new_cache_key_store(settings):  # pragma: no cover
+    '''Create the store of cache keys computed by earlier runs.'''
+
+    ckc = morphlib.cachekeycomputer.CacheKeyComputer
+    return morphlib.cachekeystore.CacheKeyStore(
+        os.path.join(create_cachedir(settings), 'cache-keys.json'),
+        ckc.metadata_version, ckc.env_keys)
+
+
+def new_build_history(settings):  # pragma: no cover
+    '''Create the history of how long earlier builds took.'''
+
+    return morphlib.buildplan.BuildHistory(
+        os.path.join(create_cachedir(settings), 'build-history.json'))
+
+
+def new_morphology_cache(settings):  # pragma: no cover
+    '''Create the cache of morphologies loaded by earlier runs.'''
+
+    return morphlib.morphologycache.MorphologyCache(
+        os.path.join(create_cachedir(settings), 'morphologies.json'),
+        morphlib.gitversion.version)
+
+
 def combine_aliases(app):  # pragma: no cover
     '''Create a full repo-alias set from the app's settings.
 
@@ -527,6 +579,10 @@ def unshared_cmdline(args, root='/', mounts=()): # pragma: no cover
     listed in 'mounts', and mounts done by that command can only be seen
     by that subprocess and its children. When the subprocess exits all
     of its mounts will be unmounted.
+
+    Each mount is a (mount_point, mount_type, source) triple, optionally
+    followed by a string of mount options. The mounts are done in order,
+    from inside 'root', so options may use paths relative to it.
     
     '''
     # We need to do mounts in a different namespace. Unfortunately
@@ -553,18 +609,26 @@ def unshared_cmdline(args, root='/', mounts=()): # pragma: no cover
             mount_point="$1"
             mount_type="$2"
             mount_source="$3"
-            shift 3
+            mount_options="$4"
+            shift 4
             path="$root/$mount_point"
-            mount -t "$mount_type" "$mount_source" "$path"
+            if [ -n "$mount_options" ]; then
+                (cd "$root" && mount -t "$mount_type" -o "$mount_options" \
+                                     "$mount_source" "$path")
+            else
+                mount -t "$mount_type" "$mount_source" "$path"
+            fi
             ;;
         esac
     done
     ''')
-    for mount_point, mount_type, source in mounts:
+    for mount in mounts:
+        mount_point, mount_type, source = mount[:3]
+        options = mount[3] if len(mount) > 3 else ''
         path = os.path.join(root, mount_point)
         if not os.path.exists(path):
             os.makedirs(path)
-        cmdargs.extend((mount_point, mount_type, source))
+        cmdargs.extend((mount_point, mount_type, source, options))
     cmdargs.append('--')
 
     command += textwrap.dedent(r'''
@@ -581,13 +645,17 @@ def unshared_cmdline(args, root='/', mounts=()): # pragma: no cover
 
 def containerised_cmdline(args, cwd='.', root='/', binds=(),
                           mount_proc=False, unshare_net=False,
-                          writable_paths=None, **kwargs): # pragma: no cover
+                          writable_paths=None, tree_walker=None,
+                          **kwargs): # pragma: no cover
     '''
     Describe how to run 'args' inside a linux-user-chroot container.
     
     The subprocess will only be permitted to write to the paths we
     specifically allow it to write to, listed in 'writeable paths'. All
-    other locations in the file system will be read-only.
+    other locations in the file system will be read-only. They are found
+    by walking 'root' with os.walk, or with 'tree_walker' if the root
+    the command sees is not on disk yet, such as when it is mounted by
+    one of the 'mounts'.
     
     The 'root' parameter allows running the command in a chroot, allowing
     the host file system to be hidden completely except for the paths
@@ -600,7 +668,8 @@ def containerised_cmdline(args, cwd='.', root='/', binds=(),
     
     The 'mounts' parameter allows mounting of arbitrary file-systems,
     such as tmpfs, before running commands, by setting it to a list of
-    (mount_point, mount_type, source) triples.
+    (mount_point, mount_type, source) triples, or of quadruples which
+    also give the mount options.
     
     The subprocess will be run in a separate mount namespace. It can
     optionally be run in a separate network namespace too by setting
@@ -619,7 +688,9 @@ def containerised_cmdline(args, cwd='.', root='/', binds=(),
     for src, dst in binds:
         # linux-user-chroot's mount target paths are relative to the chroot
         cmdargs.extend(('--mount-bind', src, os.path.relpath(dst, root)))
-    for d in morphlib.fsutils.invert_paths(os.walk(root), writable_paths):
+    if tree_walker is None:
+        tree_walker = os.walk(root)
+    for d in morphlib.fsutils.invert_paths(tree_walker, writable_paths):
         if not os.path.islink(d):
             cmdargs.extend(('--mount-readonly', os.path.relpath(d, root)))
     if mount_proc:
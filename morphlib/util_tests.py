@@ -1,4 +1,4 @@
-# Copyright (C) 2011-2014  Codethink Limited
+# Copyright (C) 2011-2026  Codethink Limited
 #
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
@@ -53,6 +53,19 @@ class SanitiseMorphologyPathTests(unittest.TestCase):
             morphlib.util.sanitise_morphology_path('stratum/a.morph'))
 
 
+class InternStringTests(unittest.TestCase):
+
+    def test_returns_the_same_object_for_equal_strings(self):
+        a = morphlib.util.intern_string(''.join(['gl', 'ibc']))
+        b = morphlib.util.intern_string(''.join(['glib', 'c']))
+        self.assertEqual(a, 'glibc')
+        self.assertTrue(a is b)
+
+    def test_returns_other_values_unchanged(self):
+        self.assertEqual(morphlib.util.intern_string(None), None)
+        self.assertEqual(morphlib.util.intern_string(u'glibc'), u'glibc')
+
+
 class MakeConcurrencyTests(unittest.TestCase):
 
     def test_returns_2_for_1_core(self):